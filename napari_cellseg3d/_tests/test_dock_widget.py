@@ -1,8 +1,14 @@
 from pathlib import Path
 
+from qtpy.QtCore import QCoreApplication, QEvent
 from tifffile import imread
 
 from napari_cellseg3d.code_plugins.plugin_review_dock import Datamanager
+from napari_cellseg3d.code_plugins.plugin_review_journal import (
+    CHECKED,
+    NOT_CHECKED,
+    ReviewJournal,
+)
 
 
 def test_prepare(make_napari_viewer_proxy):
@@ -20,3 +26,59 @@ def test_prepare(make_napari_viewer_proxy):
     assert Path(widget.csv_path) == (
         Path(__file__).resolve().parent / "res/_train0.csv"
     )
+
+    widget._button_func()
+    assert widget.journal.status(widget.slice_num) == "Checked"
+    widget.export_csv()
+    assert Path(widget.csv_path).is_file()
+
+    # closing the widget writes the journal and merges its write-ahead log
+    journal_path = widget.journal.path
+    widget._button_func()
+    status = widget.journal.status(widget.slice_num)
+    widget.close()
+    assert widget.journal is None
+    assert not widget._flush_timer.isActive()
+    assert not journal_path.with_name(journal_path.name + "-wal").is_file()
+    journal = ReviewJournal(journal_path)
+    assert journal.status(widget.slice_num) == status
+    journal.close()
+
+    # also when the widget is destroyed with the viewer, without a close event
+    other = Datamanager(viewer)
+    other.prepare(path_image, ".tif", "", False)
+    other._button_func()
+    status = other.journal.status(other.slice_num)
+    other.deleteLater()
+    QCoreApplication.sendPostedEvents(None, QEvent.DeferredDelete)
+    assert other.journal is None
+    journal = ReviewJournal(journal_path)
+    assert journal.status(widget.slice_num) == status
+    journal.close()
+
+
+def test_review_journal(tmp_path):
+    journal = ReviewJournal.create(
+        tmp_path / "_train0.db", ["a.tif", "b.tif", "c.tif"]
+    )
+    journal.batch_size = 2
+    journal.set_status(1, CHECKED)
+    assert journal.status(1) == CHECKED
+    assert ReviewJournal(journal.path).status(1) == NOT_CHECKED  # buffered
+    journal.set_status(2, CHECKED)
+    journal.set_status(1, NOT_CHECKED)
+    journal.time = "00:01:02"
+    journal.flush()
+
+    reopened = ReviewJournal(journal.path)
+    assert reopened.statuses() == [NOT_CHECKED, NOT_CHECKED, CHECKED]
+    assert reopened.time == "00:01:02"
+    assert reopened.history(1)["status"].tolist() == [CHECKED, NOT_CHECKED]
+
+    csv_path = tmp_path / "_train0.csv"
+    journal.export_csv(csv_path)
+    journal.close()
+    imported = ReviewJournal.from_csv(csv_path, tmp_path / "_train1.db")
+    assert imported.filenames == ["a.tif", "b.tif", "c.tif"]
+    assert imported.statuses() == reopened.statuses()
+    assert imported.time == "00:01:02"
@@ -0,0 +1,121 @@
+import logging
+
+import numpy as np
+import pandas as pd
+from tifffile import imwrite
+
+from napari_cellseg3d.code_models.evaluation import (
+    contingency_table,
+    evaluate_model_performance,
+    main,
+    match_labels,
+)
+from napari_cellseg3d.code_models.metrics_engine import (
+    ORIENTATIONS,
+    evaluate_pairs,
+    evaluate_volumes,
+    orient,
+)
+from napari_cellseg3d.utils import dice_coeff
+
+
+def make_labels():
+    gt = np.zeros((1, 10, 10), dtype=np.uint16)
+    gt[0, 0:2, 0:5] = 1  # found
+    gt[0, 4:6, 0:2] = 2  # fused with 3
+    gt[0, 4:6, 3:5] = 3
+    gt[0, 8:10, 0:2] = 4  # missed
+    model = np.zeros_like(gt)
+    model[0, 0:2, 0:4] = 7
+    model[0, 4:6, 0:5] = 8
+    model[0, 8:10, 7:10] = 9  # artefact
+    return gt, model
+
+
+def test_contingency_table():
+    gt, model = make_labels()
+    table, gt_ids, model_ids = contingency_table(gt, model)
+    assert list(gt_ids) == [0, 1, 2, 3, 4]
+    assert list(model_ids) == [0, 7, 8, 9]
+    assert table.sum() == gt.size
+    assert table[1, 1] == 8
+    assert table[0, 2] == 2
+    assert table[4, 0] == 4
+
+
+def test_match_labels(caplog):
+    gt, model = make_labels()
+    matching = match_labels(gt, model)
+    assert matching.found.values.tolist() == [[7, 1, 0.8, 1.0, 0.8]]
+    assert list(matching.fused["gt_label"]) == [2, 3]
+    assert np.allclose(matching.fused["true_positive_ratio_model"], 0.8)
+    assert list(matching.artefacts["model_label"]) == [9]
+    assert list(matching.missed) == [4]
+    assert matching.number_gt_labels == 4
+    assert matching.number_gt_values == 5
+    assert match_labels(gt + 1, model).number_gt_values == 5  # no background
+
+    with caplog.at_level(logging.INFO):
+        results = evaluate_model_performance(gt, model)
+    # percentages include the background in the count of labels, as before
+    assert "Overall percent of neurons found: 60.00%" in caplog.text
+    assert results.neurons_found == 1
+    assert results.neurons_fused == 2
+    assert results.neurons_not_found == 1
+    assert results.artefacts_found == 1
+    assert np.isclose(results.mean_iou_fused, 0.4)
+
+
+def test_evaluate_cli(tmp_path):
+    gt, model = make_labels()
+    imwrite(str(tmp_path / "gt.tif"), gt)
+    imwrite(str(tmp_path / "pred.tif"), model)
+    csv_path = tmp_path / "results.csv"
+    main(
+        [
+            str(tmp_path / "gt.tif"),
+            str(tmp_path / "pred.tif"),
+            "--csv",
+            str(csv_path),
+        ]
+    )
+    results = pd.read_csv(csv_path)
+    assert results["neurons_found"][0] == 1
+
+
+def test_metrics_engine(tmp_path):
+    ground = np.zeros((16, 16, 16), dtype=np.uint16)
+    ground[2:6, 3:12, 5:9] = 1
+    ground[10:14, 10:14, 10:14] = 2
+    pred = np.rot90(np.flip(ground, axis=1), axes=(0, 2)).copy()
+
+    metrics = evaluate_volumes(ground, pred, rotate=False)
+    assert np.isclose(metrics["dice"], dice_coeff(ground > 0, pred > 0))
+    assert metrics["dice"] < 0.5
+
+    metrics = evaluate_volumes(ground, pred, rotate=True, surface=True)
+    best = orient(pred, ORIENTATIONS[metrics["orientation"]])
+    assert np.array_equal(best, ground)
+    assert np.isclose(metrics["dice"], 1)
+    assert np.isclose(metrics["iou"], 1)
+    assert metrics["precision"] == metrics["recall"] == 1
+    assert metrics["hausdorff_95"] == metrics["mean_surface_distance"] == 0
+
+    shifted = np.roll(ground, 2, axis=0)
+    metrics = evaluate_volumes(ground, shifted, surface=True)
+    assert metrics["precision"] == metrics["recall"] < 1
+    assert 0 < metrics["mean_surface_distance"] <= metrics["hausdorff_95"]
+    # surface distances are opt-in
+    assert np.isnan(evaluate_volumes(ground, shifted)["hausdorff_95"])
+
+    pairs = []
+    for i, volume in enumerate([ground, pred, shifted[:12]]):
+        imwrite(tmp_path / f"ground_{i}.tif", ground)
+        imwrite(tmp_path / f"pred_{i}.tif", volume)
+        pairs.append(
+            (tmp_path / f"ground_{i}.tif", tmp_path / f"pred_{i}.tif")
+        )
+    results = dict(evaluate_pairs(pairs, rotate=True, num_workers=2))
+    assert sorted(results) == [0, 1, 2]
+    assert results[0]["dice"] == results[1]["dice"]
+    assert results[2]["dice"] < 1
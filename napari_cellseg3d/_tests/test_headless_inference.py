@@ -0,0 +1,108 @@
+import json
+import subprocess
+import sys
+
+import numpy as np
+import pandas as pd
+import torch
+from tifffile import imread, imwrite
+
+from napari_cellseg3d import config
+from napari_cellseg3d.code_models.headless_inference import (
+    SUMMARY_FILENAME,
+    load_config,
+    main,
+)
+from napari_cellseg3d.utils import rand_gen
+
+
+class TinyModel(torch.nn.Module):
+    weights_file = "tiny.pth"
+
+    def __init__(self, input_img_size=None):
+        super().__init__()
+        self.conv = torch.nn.Conv3d(1, 1, kernel_size=3, padding=1)
+
+    def forward(self, x):
+        return torch.sigmoid(self.conv(x))
+
+
+def test_headless_modules_import_no_gui():
+    modules = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            "import sys; import napari_cellseg3d.code_models.headless_inference; "
+            "import napari_cellseg3d.code_models.batch_processing; "
+            "print(' '.join(sys.modules))",
+        ],
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout.split()
+    for forbidden in ["napari", "qtpy", "superqt", "PyQt5", "PySide2"]:
+        assert forbidden not in modules
+
+
+def test_headless_inference_cli(tmp_path, monkeypatch):
+    monkeypatch.setitem(config.MODEL_LIST, "TinyModel", TinyModel)
+    weights_path = tmp_path / "tiny.pth"
+    torch.save(TinyModel().state_dict(), weights_path)
+    images = tmp_path / "images"
+    images.mkdir()
+    for i in range(2):
+        imwrite(
+            str(images / f"volume_{i}.tif"),
+            rand_gen.random((20, 20, 20)).astype(np.float32),
+        )
+    results = tmp_path / "results"
+    config_path = tmp_path / "config.json"
+    config_path.write_text(
+        json.dumps(
+            {
+                "inputs": str(images / "*.tif"),
+                "results_path": str(results),
+                "model": {"name": "TinyModel", "model_input_size": 8},
+                "weights": str(weights_path),
+                "sliding_window": {"window_size": 8},
+                "thresholding": 0.5,
+                "instance": {"method": "Connected Components", "workers": 2},
+                "compute_stats": True,
+            }
+        )
+    )
+
+    assert load_config(str(config_path)).instance_workers == 2
+    assert main([str(config_path)]) == 0
+    summary = json.loads((results / SUMMARY_FILENAME).read_text())
+    assert summary["done"] == 2
+    record = summary["files"][0]
+    assert set(record["timings"]) == {
+        "load",
+        "inference",
+        "instance",
+        "stats",
+        "save",
+    }
+    semantic = imread(record["outputs"]["semantic"])
+    assert semantic.shape == (20, 20, 20)
+    assert semantic.min() >= 0
+    assert semantic.max() <= 1
+    assert imread(record["outputs"]["instance"]).shape == (20, 20, 20)
+    pd.read_csv(record["outputs"]["stats"])
+
+    # resume : finished files are skipped, removed outputs are recomputed
+    (results / "volume_1_TinyModel_semantic.tif").unlink()
+    assert main([str(config_path)]) == 0
+    summary = json.loads((results / SUMMARY_FILENAME).read_text())
+    assert summary["skipped"] == 1
+    assert summary["done"] == 1
+    assert main([str(config_path), "--overwrite"]) == 0
+    summary = json.loads((results / SUMMARY_FILENAME).read_text())
+    assert summary["done"] == 2
+
+    assert (
+        main([str(config_path), "--inputs", str(tmp_path / "none.tif")]) == 0
+    )
+    imwrite(str(images / "bad.tif"), np.zeros((2, 2), dtype=np.float32))
+    assert main([str(config_path)]) == 1
@@ -1,3 +1,4 @@
+import os
 from pathlib import Path
 
 import napari
@@ -5,15 +6,38 @@ import numpy as np
 import pytest
 import torch
 from monai.data import DataLoader
+from tifffile import imread, imwrite
 
+from napari_cellseg3d.code_models.results_writer import (
+    smallest_label_dtype,
+    write_result,
+)
+from napari_cellseg3d.code_models.tiled_inference import (
+    get_tiles,
+    open_volume,
+    tiled_inference,
+)
 from napari_cellseg3d.code_models.worker_inference import InferenceWorker
 from napari_cellseg3d.code_models.workers_utils import (
     PRETRAINED_WEIGHTS_DIR,
     InferenceResult,
+    ModelCache,
     ONNXModelWrapper,
+    QuantileCache,
+    QuantileNormalization,
     WeightsDownloader,
+    autotune_sw_batch_size,
+)
+from napari_cellseg3d.config import (
+    MODEL_LIST,
+    InferenceWorkerConfig,
+    ModelInfo,
+    PipelineConfig,
+    ResultsWriterConfig,
+    SlidingWindowConfig,
+    TiledInferenceConfig,
+    WeightsInfo,
 )
-from napari_cellseg3d.config import InferenceWorkerConfig
 from napari_cellseg3d.utils import rand_gen
 
 
@@ -93,6 +117,51 @@ def test_inference_on_folder():
     assert res.semantic_segmentation is not None
 
 
+def test_pipelined_inference_on_folder(tmp_path):
+    config = InferenceWorkerConfig(
+        results_path=str(tmp_path),
+        sliding_window_config=SlidingWindowConfig(window_size=8),
+        pipeline_config=PipelineConfig(queue_size=1),
+    )
+    config.images_filepaths = [f"image_{i}.tif" for i in range(3)]
+
+    class mock_work:
+        @staticmethod
+        def eval():
+            return True
+
+        def __call__(self, x):
+            return torch.Tensor(x)
+
+    worker = InferenceWorker(worker_config=config)
+    worker.aniso_transform = mock_work()
+    loader = [
+        {"image": torch.Tensor(rand_gen.random(size=(1, 1, 8, 8, 8)))}
+        for _ in range(3)
+    ]
+    results = list(
+        worker.pipelined_inference_on_folder(
+            loader, model=mock_work(), post_process_transforms=mock_work()
+        )
+    )
+    assert [res.image_id for res in results] == [1, 2, 3]
+    assert len(list(tmp_path.glob("image_*.tif"))) == 3
+    for i, (res, data) in enumerate(zip(results, loader)):
+        expected = worker.inference_on_folder(
+            data, i, model=mock_work(), post_process_transforms=mock_work()
+        )
+        assert np.allclose(
+            res.semantic_segmentation, expected.semantic_segmentation
+        )
+    assert worker._save_pool is None
+    assert set(worker._stage_timer.busy_time) == {
+        "loading",
+        "inference",
+        "post-processing",
+        "saving",
+    }
+
+
 def test_post_processing():
     image = rand_gen.random((1, 1, 64, 64, 64))
     labels = rand_gen.random((1, 2, 64, 64, 64))
@@ -107,3 +176,230 @@ def test_post_processing():
     assert results.shape == (2, 64, 64, 64)
 
     worker.stats_csv(np.squeeze(labels))
+
+
+def test_tiled_inference(tmp_path):
+    volume = rand_gen.random((20, 24, 18)).astype(np.float32)
+    image_path = str(tmp_path / "volume.tif")
+    imwrite(image_path, volume)
+
+    lazy_volume = open_volume(image_path)
+    assert isinstance(lazy_volume, np.memmap)
+
+    tiles = get_tiles(lazy_volume.shape, tile_size=8, tile_overlap=2)
+    covered = np.zeros(lazy_volume.shape, dtype=bool)
+    for tile in tiles:
+        covered[tile] = True
+    assert covered.all()
+
+    out = tiled_inference(
+        lazy_volume,
+        predictor=lambda x: x,
+        output_path=str(tmp_path / "result.tif"),
+        tile_size=8,
+        tile_overlap=2,
+        scratch_path=str(tmp_path),
+    )
+    assert out.shape == volume.shape
+    assert np.allclose(out, volume, atol=1e-5)
+    assert np.allclose(imread(str(tmp_path / "result.tif")), volume, atol=1e-5)
+    assert list(tmp_path.glob("cellseg3d_tiles_*")) == []
+
+    with pytest.raises(ValueError, match="must be smaller than tile size"):
+        tiled_inference(
+            lazy_volume,
+            predictor=lambda x: x,
+            output_path=str(tmp_path / "result.tif"),
+            tile_size=8,
+            tile_overlap=8,
+        )
+
+
+def test_write_result(tmp_path):
+    probabilities = rand_gen.random((2, 20, 40, 37)).astype(np.float32)
+    writer_config = ResultsWriterConfig(
+        compression="zstd", chunk_size=16, probability_dtype="uint8"
+    )
+    path = write_result(
+        tmp_path / "semantic.tif", probabilities, writer_config
+    )
+    result = imread(str(path))
+    assert result.dtype == np.uint8
+    assert np.allclose(result / 255, probabilities, atol=1 / 255)
+
+    labels = rand_gen.integers(0, 300, size=(20, 40, 37))
+    path = write_result(
+        tmp_path / "labels", labels, writer_config, labels=True
+    )
+    assert path.name == "labels.tif"
+    result = imread(str(path))
+    assert result.dtype == np.uint16
+    assert np.array_equal(result, labels)
+    assert smallest_label_dtype(255) == np.uint8
+    assert smallest_label_dtype(2**16) == np.uint32
+
+    with pytest.raises(ValueError, match="not available"):
+        write_result(
+            tmp_path / "labels.tif",
+            labels,
+            ResultsWriterConfig(compression="lz4"),
+        )
+
+    volume = rand_gen.random((16, 16, 16)).astype(np.float32)
+    out = tiled_inference(
+        volume,
+        predictor=lambda x: x,
+        output_path=str(tmp_path / "tiled.tif"),
+        tile_size=8,
+        tile_overlap=2,
+        writer_config=ResultsWriterConfig(
+            compression="zstd", chunk_size=16, probability_dtype="float16"
+        ),
+    )
+    assert np.allclose(np.asarray(out[:]), volume, atol=1e-3)
+
+
+def test_write_result_zarr(tmp_path):
+    zarr = pytest.importorskip("zarr")
+    probabilities = rand_gen.random((2, 20, 40, 37)).astype(np.float32)
+    writer_config = ResultsWriterConfig(
+        format="zarr", compression="zstd", chunk_size=16
+    )
+    path = write_result(
+        tmp_path / "semantic.tif", probabilities, writer_config
+    )
+    assert path.name == "semantic.ome.zarr"
+    assert (path / ".zgroup").is_file()  # OME-Zarr 0.4 uses Zarr format 2
+    root = zarr.open_group(str(path), mode="r")
+    assert root.attrs["multiscales"][0]["axes"][0]["name"] == "c"
+    assert root["0"].chunks == (1, 16, 16, 16)
+    assert np.allclose(root["0"][:], probabilities)
+
+
+def test_inference_on_file_tiled(tmp_path):
+    image_path = str(tmp_path / "volume.tif")
+    imwrite(image_path, rand_gen.random((16, 16, 16)).astype(np.float32))
+
+    config = InferenceWorkerConfig()
+    config.images_filepaths = [image_path]
+    config.results_path = str(tmp_path)
+    config.sliding_window_config = SlidingWindowConfig(window_size=8)
+    config.tiled_inference_config = TiledInferenceConfig(
+        enabled=True, tile_size=8, tile_overlap=2
+    )
+
+    class mock_work:
+        @staticmethod
+        def eval():
+            return True
+
+        def __call__(self, x):
+            return torch.Tensor(x)
+
+    worker = InferenceWorker(worker_config=config)
+    res = worker.inference_on_file_tiled(
+        image_path, 0, model=mock_work(), post_process_transforms=mock_work()
+    )
+    assert isinstance(res, InferenceResult)
+    assert res.semantic_segmentation.shape == (16, 16, 16)
+    assert res.instance_labels is None
+
+
+def test_autotune_sw_batch_size():
+    calls = []
+
+    def predictor(x):
+        calls.append(x.shape[0])
+        return x
+
+    batch_size = autotune_sw_batch_size(
+        predictor, window_size=8, candidates=(1, 2, 4), n_repeats=1
+    )
+    assert batch_size in (1, 2, 4)
+    assert calls[0] == 1
+
+    # input and output of a single 8x8x8 window take 4 kB, only batch size 1 fits
+    batch_size = autotune_sw_batch_size(
+        predictor,
+        window_size=8,
+        candidates=(1, 2, 4),
+        memory_budget=5e-3,
+        n_repeats=1,
+    )
+    assert batch_size == 1
+
+
+def test_tune_sw_batch_size():
+    config = InferenceWorkerConfig()
+    config.sliding_window_config = SlidingWindowConfig(
+        window_size=8, sw_batch_size=3, auto_tune_batch_size=True
+    )
+    worker = InferenceWorker(worker_config=config)
+    assert worker.sw_batch_size == 3
+
+    class mock_work:
+        @staticmethod
+        def eval():
+            return True
+
+        def __call__(self, x):
+            return torch.Tensor(x)
+
+    batch_size = worker.tune_sw_batch_size(mock_work(), mock_work())
+    assert worker.sw_batch_size == batch_size
+
+
+def test_quantile_cache(tmp_path):
+    volume = rand_gen.random((20, 20, 20)).astype(np.float32)
+    path = tmp_path / "volume.tif"
+    imwrite(str(path), volume)
+    cache = QuantileCache()
+
+    quantiles = cache.get(open_volume(path), path=path)
+    assert np.allclose(quantiles, np.quantile(volume, [0.01, 0.99]), atol=1e-4)
+    assert len(cache) == 1
+    # cached values are used as long as the file is unchanged
+    assert cache.get(np.zeros(1), path=path) == quantiles
+    os.utime(path, ns=(0, 0))
+    assert cache.get(np.zeros(1), path=path) == (0.0, 0.0)
+    cache.clear()
+    assert len(cache) == 0
+
+    # all windows are clipped to the values of the whole volume
+    normalization = QuantileNormalization(quantiles)
+    window = torch.from_numpy(volume[:8, :8, :8])
+    assert torch.equal(
+        normalization(window), window.clip(quantiles[0], quantiles[1])
+    )
+
+
+def test_model_cache(tmp_path, monkeypatch):
+    class TinyModel(torch.nn.Module):
+        weights_file = "tiny.pth"
+
+        def __init__(self, input_img_size=None):
+            super().__init__()
+            self.conv = torch.nn.Conv3d(1, 1, kernel_size=1)
+
+    monkeypatch.setitem(MODEL_LIST, "TinyModel", TinyModel)
+    weights_path = tmp_path / "tiny.pth"
+    torch.save(TinyModel().state_dict(), weights_path)
+    weights = WeightsInfo(path=str(weights_path), use_custom=True)
+    cache = ModelCache(max_models=1)
+
+    model = cache.get(ModelInfo("TinyModel", 8), weights, "cpu")
+    assert cache.get(ModelInfo("TinyModel", 8), weights, "cpu") is model
+    assert len(cache) == 1
+    # different input size : new model, the previous one is evicted
+    other = cache.get(ModelInfo("TinyModel", 16), weights, "cpu")
+    assert other is not model
+    assert len(cache) == 1
+    # modified weights are reloaded
+    state = TinyModel().state_dict()
+    torch.save(state, weights_path)
+    os.utime(weights_path, ns=(0, 0))
+    reloaded = cache.get(ModelInfo("TinyModel", 16), weights, "cpu")
+    assert reloaded is not other
+    assert torch.equal(reloaded.conv.weight, state["conv.weight"])
+    cache.clear()
+    assert len(cache) == 0
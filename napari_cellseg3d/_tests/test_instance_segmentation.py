@@ -0,0 +1,184 @@
+from functools import partial
+
+import numpy as np
+import pandas as pd
+import pytest
+from skimage.measure import label, regionprops
+
+from napari_cellseg3d.code_models import instance_segmentation
+from napari_cellseg3d.code_models.instance_segmentation import (
+    ConnectedComponents,
+    UnionFind,
+    binary_connected,
+    clear_large_objects,
+    clear_small_objects,
+    filter_components_by_size,
+    label_components,
+    tiled_instance_segmentation,
+    volume_stats,
+)
+from napari_cellseg3d.utils import process_pool, rand_gen
+
+
+def make_spheres(shape=(48, 48, 48), number=30, radius=4):
+    volume = np.zeros(shape, dtype=np.float32)
+    z, y, x = np.mgrid[: shape[0], : shape[1], : shape[2]]
+    for c in rand_gen.integers(radius, min(shape) - radius, (number, 3)):
+        distance = (z - c[0]) ** 2 + (y - c[1]) ** 2 + (x - c[2]) ** 2
+        volume[distance < radius**2] = 1
+    return volume
+
+
+def assert_same_labels(labels, expected):
+    """Checks that two label images are identical up to a permutation of label IDs."""
+    assert labels.shape == expected.shape
+    pairs = np.unique(np.stack([labels.ravel(), expected.ravel()]), axis=1)
+    assert pairs.shape[1] == len(np.unique(labels)) == len(np.unique(expected))
+
+
+def test_union_find():
+    union_find = UnionFind(6)
+    union_find.union(4, 2)
+    union_find.union(5, 4)
+    union_find.union(1, 3)
+    assert union_find.find(5) == 2
+    assert list(union_find.roots()) == [0, 1, 2, 1, 2, 2]
+
+
+@pytest.mark.parametrize("n_workers", [1, 2])
+def test_tiled_instance_segmentation(n_workers):
+    volume = make_spheres()
+    func = partial(binary_connected, thres=0.5, thres_small=0)
+
+    result = tiled_instance_segmentation(
+        volume, func, tile_size=16, tile_overlap=4, n_workers=n_workers
+    )
+    assert result.dtype == np.uint32
+    assert_same_labels(result, label(volume > 0.5))
+
+    unstitched = tiled_instance_segmentation(
+        volume, func, tile_size=16, tile_overlap=0, stitch=False, n_workers=1
+    )
+    assert unstitched.max() < len(np.unique(result))
+
+    with pytest.raises(ValueError, match="must be smaller than tile size"):
+        tiled_instance_segmentation(volume, func, tile_size=8, tile_overlap=8)
+
+
+def test_tiled_instance_segmentation_memory_budget(monkeypatch):
+    pools = []
+
+    def recording_pool(max_workers):
+        pools.append(max_workers)
+        return process_pool(max_workers)
+
+    monkeypatch.setattr(instance_segmentation, "process_pool", recording_pool)
+    volume = make_spheres()
+    func = partial(binary_connected, thres=0.5, thres_small=0)
+    tile_bytes = 24**3 * (volume.itemsize + 4)  # tile and halo, and labels
+
+    # fewer processes are used when their tiles do not fit in the budget
+    result = tiled_instance_segmentation(
+        volume,
+        func,
+        tile_size=16,
+        tile_overlap=4,
+        n_workers=4,
+        memory_budget=2 * tile_bytes,
+    )
+    assert pools == [2]
+    assert_same_labels(result, label(volume > 0.5))
+
+    result = tiled_instance_segmentation(
+        volume,
+        func,
+        tile_size=16,
+        tile_overlap=4,
+        n_workers=4,
+        memory_budget=tile_bytes,
+    )
+    assert pools == [2]  # one tile at a time, in the current process
+    assert_same_labels(result, label(volume > 0.5))
+
+
+def test_instance_method_as_function(qtbot):
+    method = ConnectedComponents()
+    method.counters[0].setValue(2)
+    volume = make_spheres(shape=(24, 24, 24), number=5)
+
+    func = method.as_function(n_workers=1)
+    assert func.args[1] == [method.sliders[0].slider_value, 2]
+    np.testing.assert_array_equal(
+        func(volume), method.run_method_on_channels(volume)
+    )
+
+
+def test_label_components():
+    spheres = make_spheres(number=40, radius=6)
+    labels, num = label_components(spheres > 0, tile_size=16)
+    expected = label(spheres > 0)
+    assert num == expected.max()
+    assert_same_labels(labels, expected)
+
+    # touching objects with different values stay separate, as in skimage
+    instances = expected.copy()
+    instances[:, :24][instances[:, :24] > 0] += 1000
+    labels, num = label_components(instances, tile_size=16)
+    assert_same_labels(labels, label(instances, connectivity=3))
+
+    kept, removed = filter_components_by_size(
+        spheres > 0, min_size=300, max_size=1000, tile_size=16
+    )
+    sizes = np.bincount(expected.ravel())[1:]
+    assert removed == np.count_nonzero((sizes < 300) | (sizes >= 1000))
+    assert np.array_equal(
+        np.unique(expected[kept > 0]),
+        np.flatnonzero((sizes >= 300) & (sizes < 1000)) + 1,
+    )
+
+
+def test_clear_objects():
+    volume = np.zeros((40, 40, 40), dtype=np.float32)
+    volume[2:4, 2:4, 2:4] = 0.7  # 8 voxels
+    volume[10:30, 10:30, 10:20] = 0.9  # 4000 voxels
+    cleared = clear_large_objects(volume, 1000)
+    assert np.array_equal(cleared[2:4, 2:4, 2:4], volume[2:4, 2:4, 2:4])
+    assert not cleared[10:30].any()
+    assert np.array_equal(
+        clear_large_objects(volume, 1000, use_window=False), cleared
+    )
+
+    binary = (volume > 0).astype(np.uint16)
+    cleaned = clear_small_objects(binary, 10)
+    assert cleaned.max() == 1
+    assert not cleaned[2:4].any()
+    assert cleaned[10:30, 10:30, 10:20].all()
+
+
+def test_volume_stats():
+    labels = label(make_spheres(number=10, radius=5) > 0)
+    labels[labels == labels.max()] = 1000  # non-contiguous label
+    spacing = (2.0, 1.0, 0.75)
+
+    stats = volume_stats(labels, spacing=spacing)
+    regions = regionprops(labels, spacing=spacing)
+    assert stats.number_objects == len(regions)
+    assert list(stats.labels) == [r.label for r in regions]
+    assert np.allclose(stats.volume, [r.area for r in regions])
+    assert np.allclose(stats.centroid_y, [r.centroid[1] for r in regions])
+    assert np.allclose(
+        stats.axis_major_length, [r.axis_major_length for r in regions]
+    )
+    assert np.allclose(stats.filling_ratio, (labels > 0).mean())
+
+    stats_df = pd.DataFrame(stats.get_dict())
+    assert len(stats_df) == stats.number_objects
+    assert stats_df["Number objects"][0] == stats.number_objects
+    assert np.array_equal(stats_df["Volume"], [r.num_pixels for r in regions])
+    assert stats_df["Total object volume (pixels)"][0] == (labels > 0).sum()
+    assert np.allclose(
+        stats_df["Volume (physical units)"], [r.area for r in regions]
+    )
+    assert "Volume (physical units)" not in volume_stats(labels).get_dict()
+
+    assert volume_stats(np.zeros_like(labels)) is None
@@ -1,11 +1,14 @@
 from pathlib import Path
 
 import numpy as np
+from skimage.segmentation import find_boundaries
 from tifffile import imread
 
 from napari_cellseg3d.dev_scripts import artefact_labeling as al
 from napari_cellseg3d.dev_scripts import correct_labels as cl
 from napari_cellseg3d.dev_scripts import evaluate_labels as el
+from napari_cellseg3d.dev_scripts import label_objects as lo
+from napari_cellseg3d.dev_scripts import whole_brain_utils as wb
 
 res_folder = Path(__file__).resolve().parent / "res"
 image_path = res_folder / "test.tif"
@@ -37,6 +40,42 @@ def test_correct_labels():
     )
 
 
+def test_map_objects():
+    objects = lo.object_slices(labels)
+    assert [v for v, _ in objects] == list(np.unique(labels[labels > 0]))
+    for value, box in objects:
+        assert (labels[box] == value).sum() == (labels == value).sum()
+
+    sizes = [
+        (value, result)
+        for value, _, result in lo.map_objects(
+            al._map_artefact, labels, labels, n_workers=2, chunksize=8
+        )
+    ]
+    assert [v for v, _ in sizes] == [v for v, _ in objects]
+    for value, mapped in sizes:
+        np.testing.assert_array_equal(mapped, [value, value])
+
+
+def test_relabel_non_unique_i(tmp_path):
+    split = np.zeros((8, 8, 8), dtype=np.int32)
+    split[0:3, 0:3, 0:3] = 5  # two parts of label 5
+    split[5:8, 5:8, 5:8] = 5
+    split[4, 0, 7] = 3  # single voxel, removed by the watershed
+    split[0, 4:8, 4:8] = 7  # flat object filling its bounding box
+    path = str(tmp_path / "relabeled.tif")
+
+    mapping = cl.relabel_non_unique_i(split, path, go_fast=True, n_workers=1)
+    assert mapping == [[3, [1]], [5, [2, 3]], [7, [4]]]
+    relabeled = imread(path)
+    assert len(np.unique(relabeled[split == 5])) == 2
+    np.testing.assert_array_equal(relabeled > 0, split > 0)
+
+    mapping = cl.relabel_non_unique_i(split, path, n_workers=1)
+    assert [list(m[1]) for m in mapping] == [[], [1, 2], [3]]
+    assert imread(path)[4, 0, 7] == 0
+
+
 def test_relabel():
     cl.relabel(
         str(image_path),
@@ -50,3 +89,53 @@ def test_evaluate_model_performance():
     el.evaluate_model_performance(
         labels, labels, print_details=True, visualize=False
     )
+
+
+def _per_label_boundaries(image_regions):
+    """Boundaries as found by the previous get_boundaries, one label at a time."""
+    boundaries = np.zeros_like(image_regions)
+    new_labels = image_regions
+    for i in np.unique(image_regions):
+        if i == 0:
+            continue
+        boundary = find_boundaries(new_labels == i)
+        boundaries += np.where(boundary > 0, i, 0)
+        new_labels = np.where(boundary > 0, 0, new_labels)
+    return boundaries
+
+
+def test_label_boundaries():
+    regions = np.zeros((40, 40, 40), dtype=int)
+    regions[0:10, 0:12, 3:9] = 3
+    regions[14:20, 5:30, 20:40] = 7
+    regions[25:39, 25:39, 2:12] = 12
+    regions[25:30, 2:8, 30:35] = 5
+    expected = _per_label_boundaries(regions)
+    boundaries = wb.label_boundaries(regions, block_size=6, n_workers=3)
+    np.testing.assert_array_equal(boundaries, expected)
+
+    segmentation = regions > 0
+    result = wb.remove_boundaries_from_segmentation(
+        segmentation, image_labels=regions
+    )
+    np.testing.assert_array_equal(result, segmentation & ~(expected > 0))
+
+    # touching regions : both sides of the interface are marked with the sum of the labels
+    boxes = np.zeros((30, 30, 30), dtype=int)
+    boxes[5:15, 5:25, 5:25] = 1
+    boxes[15:25, 5:25, 5:25] = 2
+    boundaries = wb.label_boundaries(boxes)
+    assert np.all(boundaries[14:16, 6:24, 6:24] == 3)
+    assert np.all(boundaries[16:24, 6:24, 6:24] == 0)
+    # the previous loop also marked the next layer of the label processed last
+    previous = _per_label_boundaries(boxes) > 0
+    assert np.all(previous[16, 6:24, 6:24])
+    assert np.all(previous[(boundaries > 0) & (boxes > 0)])
+
+    # each iteration erodes every region by one voxel
+    thick = wb.label_boundaries(regions, thickness=2, block_size=5)
+    np.testing.assert_array_equal(
+        thick, wb.label_boundaries(regions, thickness=2, block_size=100)
+    )
+    assert np.all(thick[24:27, 30, 6] > 0)
+    assert np.all(thick[27:37, 27:37, 4:10] == 0)
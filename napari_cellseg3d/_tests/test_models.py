@@ -3,16 +3,24 @@ from pathlib import Path
 import numpy as np
 import pytest
 import torch
+import torch.nn.functional as F
 
+from napari_cellseg3d.code_models import crf as crf_module
 from napari_cellseg3d.code_models.crf import (
     CRFWorker,
     correct_shape_for_crf,
     crf_batch,
     crf_with_config,
 )
+from napari_cellseg3d.code_models.crf_torch import (
+    MAX_INTENSITY_BINS,
+    BilateralGrid,
+    crf_torch,
+)
 from napari_cellseg3d.code_models.models.model_TRAILMAP_MS import TRAILMAP_MS_
 from napari_cellseg3d.code_models.models.wnet.soft_Ncuts import SoftNCutsLoss
 from napari_cellseg3d.config import MODEL_LIST, CRFConfig
+from napari_cellseg3d.dev_scripts.benchmark_soft_ncuts import dense_soft_ncuts
 from napari_cellseg3d.utils import rand_gen
 
 
@@ -53,6 +61,11 @@ def test_soft_ncuts_loss():
     assert isinstance(res, torch.Tensor)
     assert 0 <= res <= 1  # ASSUMES NUMBER OF CLASS IS 2, NOT CORRECT IF K>2
 
+    with torch.autocast(device_type="cpu", dtype=torch.bfloat16):
+        res_amp = loss.forward(labels, labels)
+    assert res_amp.dtype == torch.float32
+    assert torch.isclose(res_amp, res, atol=1e-2)
+
     loss = SoftNCutsLoss(
         data_shape=[dims, dims, dims],
         device="cpu",
@@ -63,6 +76,34 @@ def test_soft_ncuts_loss():
     assert loss.radius == 5
 
 
+@pytest.mark.parametrize("radius", [2, 3])
+def test_soft_ncuts_separable(radius):
+    shape = (12, 10, 8)
+    labels = torch.softmax(torch.rand([2, 3, *shape]), dim=1)
+    inputs = torch.rand([2, 1, *shape])
+    loss = SoftNCutsLoss(
+        data_shape=shape,
+        device="cpu",
+        intensity_sigma=1,
+        spatial_sigma=4,
+        radius=radius,
+    )
+
+    volumes = torch.rand([1, 2, *shape])
+    kernel = loss.gaussian_kernel(radius, 4).expand(2, 1, -1, -1, -1)
+    dense = F.conv3d(volumes, kernel, padding=radius, groups=2)
+    assert torch.allclose(loss.gaussian_filter(volumes), dense, atol=1e-5)
+
+    labels.requires_grad_()
+    dense_labels = labels.detach().clone().requires_grad_()
+    res = loss(labels, inputs)
+    expected = dense_soft_ncuts(loss, dense_labels, inputs)
+    assert torch.isclose(res, expected, atol=1e-5)
+    res.backward()
+    expected.backward()
+    assert torch.allclose(labels.grad, dense_labels.grad, atol=1e-5)
+
+
 def test_crf_batch():
     dims = 8
     mock_image = rand_gen.random(size=(1, dims, dims, dims))
@@ -92,6 +133,79 @@ def test_crf_config():
     assert result.shape == mock_label.shape
 
 
+def test_crf_tiled(monkeypatch):
+    def mock_crf(image, prob, *params):
+        assert image.shape[1:] == prob.shape[1:]
+        assert max(prob.shape[1:]) <= 8
+        return prob
+
+    monkeypatch.setattr(crf_module, "CRF_INSTALLED", True)
+    monkeypatch.setattr(crf_module, "crf", mock_crf)
+    mock_image = rand_gen.random(size=(1, 20, 12, 9))
+    mock_label = rand_gen.random(size=(2, 20, 12, 9))
+
+    block_stats = []
+    result = crf_module.crf_tiled(
+        mock_image,
+        mock_label,
+        *range(5),
+        tile_size=8,
+        tile_overlap=2,
+        block_stats=block_stats,
+    )
+    assert np.allclose(result, mock_label, atol=1e-5)
+    assert len(block_stats) == 3 * 2 * 2
+    assert all(stats["seconds"] >= 0 for stats in block_stats)
+
+    config = CRFConfig(tile_size=8, tile_overlap=2, backend="pydensecrf")
+    result = crf_with_config(mock_image, mock_label, config)
+    assert np.allclose(result, mock_label, atol=1e-5)
+
+
+def test_crf_torch():
+    dims = 16
+    truth = np.zeros((dims, dims, dims), dtype=bool)
+    truth[4:12, 4:12, 4:12] = True
+    image = (truth * 100 + rand_gen.normal(0, 5, truth.shape))[None]
+    foreground = np.clip(
+        0.2 + 0.6 * truth + rand_gen.normal(0, 0.3, truth.shape), 0.01, 0.99
+    )
+    prob = np.stack([1 - foreground, foreground]).astype(np.float32)
+    config = CRFConfig(backend="torch")
+
+    result = crf_with_config(image, prob, config, device="cpu")
+    assert isinstance(result, np.ndarray)
+    assert result.shape == prob.shape
+    assert np.allclose(result.sum(0), 1, atol=1e-5)
+    assert np.mean(result.argmax(0) == truth) > np.mean(
+        prob.argmax(0) == truth
+    )
+
+    batch = crf_torch(
+        torch.from_numpy(np.stack([image, image])),
+        torch.from_numpy(np.stack([prob, prob])),
+        config.sa,
+        config.sb,
+        config.sg,
+        config.w1,
+        config.w2,
+    )
+    assert isinstance(batch, torch.Tensor)
+    assert torch.allclose(batch[0], batch[1])
+    assert np.allclose(batch[0].numpy(), result, atol=1e-5)
+
+    with pytest.raises(ValueError, match="single-channel"):
+        crf_torch(np.stack([image, image], axis=1)[0], prob, *range(5))
+
+    # large volumes run in blocks, large intensity ranges on a bounded grid
+    config = CRFConfig(backend="torch", tile_size=8, tile_overlap=2)
+    tiled = crf_with_config(image, prob, config, device="cpu")
+    assert tiled.shape == prob.shape
+    assert np.allclose(tiled.sum(0), 1, atol=1e-4)
+    grid = BilateralGrid(torch.from_numpy(image[0] * 1000), 10, 5)
+    assert grid.grid_shape[-1] <= MAX_INTENSITY_BINS
+
+
 def test_crf_worker(qtbot):
     dims = 8
     mock_image = rand_gen.random(size=(1, dims, dims, dims))
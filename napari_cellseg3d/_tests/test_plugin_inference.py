@@ -1,14 +1,19 @@
+import torch
+
 from napari_cellseg3d._tests.fixtures import LogFixture
 from napari_cellseg3d.code_models.instance_segmentation import (
     INSTANCE_SEGMENTATION_METHOD_LIST,
     volume_stats,
 )
 from napari_cellseg3d.code_models.models.model_test import TestModel
-from napari_cellseg3d.code_models.workers_utils import InferenceResult
+from napari_cellseg3d.code_models.workers_utils import (
+    MODEL_CACHE,
+    InferenceResult,
+)
 from napari_cellseg3d.code_plugins.plugin_model_inference import (
     Inferer,
 )
-from napari_cellseg3d.config import MODEL_LIST
+from napari_cellseg3d.config import MODEL_LIST, ModelInfo, WeightsInfo
 from napari_cellseg3d.utils import rand_gen
 
 
@@ -91,3 +96,19 @@ def test_inference(make_napari_viewer_proxy, qtbot):
     #     widget.worker.start()
 
     assert widget.on_finish()
+
+
+def test_release_cached_models(make_napari_viewer_proxy, tmp_path):
+    viewer = make_napari_viewer_proxy()
+    widget = Inferer(viewer)
+
+    MODEL_LIST["test"] = TestModel
+    weights_path = tmp_path / "test.pth"
+    torch.save(TestModel().state_dict(), weights_path)
+    weights = WeightsInfo(path=str(weights_path), use_custom=True)
+    MODEL_CACHE.clear()  # models cached by other tests
+    MODEL_CACHE.get(ModelInfo("test", 8), weights, "cpu")
+    assert len(MODEL_CACHE) == 1
+
+    widget.release_cached_models()
+    assert len(MODEL_CACHE) == 0
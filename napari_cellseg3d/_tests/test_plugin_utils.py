@@ -1,6 +1,15 @@
+from functools import partial
+from pathlib import Path
+
 import numpy as np
+from tifffile import imread, imwrite
 
-from napari_cellseg3d.code_plugins.plugin_convert import StatsUtils
+from napari_cellseg3d.code_models.batch_processing import process_files
+from napari_cellseg3d.code_models.instance_segmentation import threshold
+from napari_cellseg3d.code_plugins.plugin_convert import (
+    StatsUtils,
+    ThresholdUtils,
+)
 from napari_cellseg3d.code_plugins.plugin_crop import Cropping
 from napari_cellseg3d.code_plugins.plugin_utilities import (
     UTILITIES_WIDGETS,
@@ -70,3 +79,51 @@ def test_stats_plugin(make_napari_viewer_proxy):
     view.window.add_dock_widget(widget)
     widget.csv_name.setText("test.csv")
     widget._start()
+
+
+def _write_volumes(folder, count):
+    paths = []
+    for i in range(count):
+        path = folder / f"volume_{i}.tif"
+        imwrite(str(path), rand_gen.random((10, 10, 10)).astype(np.float32))
+        paths.append(str(path))
+    return paths
+
+
+def test_batch_processing(tmp_path):
+    paths = _write_volumes(tmp_path, 3)
+    invalid = tmp_path / "invalid.tif"
+    invalid.write_text("not an image")
+    function = partial(threshold, thresh=0.5)
+
+    for num_workers in [1, 2]:
+        output_folder = tmp_path / f"results_{num_workers}"
+        results = process_files(
+            [*paths, str(invalid)],
+            function,
+            output_folder,
+            num_workers=num_workers,
+            dtype=np.float64,
+        )
+        assert results[-1] is None
+        for path, result in zip(paths, results):
+            assert result == str(output_folder / Path(path).name)
+            output = imread(result)
+            assert output.dtype == np.float64
+            np.testing.assert_array_equal(output, function(imread(path)))
+
+
+def test_threshold_folder(make_napari_viewer_proxy, qtbot, tmp_path):
+    view = make_napari_viewer_proxy()
+    widget = ThresholdUtils(view)
+    widget.images_filepaths = _write_volumes(tmp_path, 2)
+    widget.results_path = str(tmp_path / "results")
+    widget.folder_choice.setChecked(True)
+    widget.binarize_counter.setValue(0.5)
+
+    widget._start()
+    assert widget.batch_worker is not None
+    qtbot.waitUntil(lambda: widget.batch_worker is None, timeout=60000)
+
+    results = list((tmp_path / "results").glob("threshold_results_*/*.tif"))
+    assert len(results) == 2
@@ -1,5 +1,7 @@
 from pathlib import Path
 
+from tifffile import imread, imwrite
+
 from napari_cellseg3d import plugins
 from napari_cellseg3d.code_plugins import plugin_metrics as m
 
@@ -8,7 +10,7 @@ def test_all_plugins_import(make_napari_viewer_proxy):
     plugins.napari_experimental_provide_dock_widget()
 
 
-def test_plugin_metrics(make_napari_viewer_proxy):
+def test_plugin_metrics(make_napari_viewer_proxy, qtbot, tmp_path):
     viewer = make_napari_viewer_proxy()
     w = m.MetricsUtils(viewer=viewer, parent=None)
     viewer.window.add_dock_widget(w)
@@ -19,3 +21,14 @@ def test_plugin_metrics(make_napari_viewer_proxy):
     w.image_filewidget.text_field = im_path
     w.labels_filewidget.text_field = labels_path
     w.compute_dice()
+
+    labels = imread(labels_path)
+    imwrite(tmp_path / "pred.tif", labels)
+    w.images_filepaths = [labels_path]
+    w.labels_filepaths = [str(tmp_path / "pred.tif")]
+    w.compute_dice()
+    qtbot.waitUntil(lambda: w.results[0] is not None, timeout=60000)
+    assert w.results[0]["dice"] == 1
+    assert not w.surface_choice.isChecked()
+    assert not w.worker.surface
+    assert len(list(tmp_path.glob(m.METRICS_CSV.format("*")))) == 1
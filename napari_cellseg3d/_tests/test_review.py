@@ -1,6 +1,16 @@
 from pathlib import Path
 
+import numpy as np
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+
+from napari_cellseg3d import utils
 from napari_cellseg3d.code_plugins import plugin_review as rev
+from napari_cellseg3d.code_plugins.plugin_review_view import (
+    OrthogonalViews,
+    ResampledTileCache,
+)
+from napari_cellseg3d.utils import rand_gen
 
 
 def test_launch_review(make_napari_viewer_proxy):
@@ -23,3 +33,46 @@ def test_launch_review(make_napari_viewer_proxy):
     widget._viewer.close()
 
     assert widget._viewer is not None
+
+
+def test_resampled_tile_cache():
+    volume = rand_gen.integers(0, 1000, size=(20, 31, 17)).astype(np.int16)
+    zoom = [1, 2.5, 0.6]
+    resampled = utils.resize(volume, zoom)
+    cache = ResampledTileCache(volume, zoom, tile_size=16, max_tiles=4)
+    assert cache.shape == resampled.shape
+
+    center = [10, 40, 5]
+    crop = cache.crop(center, size=24)
+    expected = np.zeros((24, 24, 24), np.int16)
+    expected[2:22, :, 7:17] = resampled[:, 28:52, :]
+    assert np.array_equal(crop, expected)
+    assert len(cache._tiles) <= 4
+
+    hits = cache.hits
+    assert np.array_equal(
+        cache.crop([0, 0, 0], size=8)[4:, 4:, 4:], resampled[:4, :4, :4]
+    )
+    cache.crop([0, 0, 0], size=8)
+    assert cache.hits > hits
+
+    identity = ResampledTileCache(volume)
+    assert np.array_equal(
+        identity.crop([10, 15, 8], size=10), volume[5:15, 10:20, 3:13]
+    )
+    assert not identity.crop([100, 100, 100]).any()
+
+
+def test_orthogonal_views():
+    canvas = FigureCanvasAgg(Figure())
+    axes = [canvas.figure.add_subplot(3, 1, i) for i in range(1, 4)]
+    views = OrthogonalViews(canvas, axes)
+    crop = rand_gen.integers(200, 2000, size=(100, 100, 100)).astype(np.int16)
+
+    views.update(crop)  # full draw
+    assert views._backgrounds is not None
+    views.update(crop[::-1])  # blit
+    assert np.array_equal(views.images[0].get_array(), crop[::-1][50])
+    assert np.array_equal(
+        views.images[2].get_array(), crop[::-1].transpose(2, 0, 1)[50]
+    )
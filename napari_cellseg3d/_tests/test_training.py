@@ -1,6 +1,19 @@
+import contextlib
 from pathlib import Path
 
+import numpy as np
 import pytest
+import torch
+from monai.data import MetaTensor
+from monai.data.meta_obj import set_track_meta
+from monai.transforms import (
+    Compose,
+    EnsureChannelFirstd,
+    LoadImaged,
+    Orientationd,
+    RandSpatialCropSamplesd,
+    SpatialPadd,
+)
 
 from napari_cellseg3d._tests.fixtures import (
     LogFixture,
@@ -11,11 +24,35 @@ from napari_cellseg3d._tests.fixtures import (
     WNetFixture,
 )
 from napari_cellseg3d.code_models.models.model_test import TestModel
-from napari_cellseg3d.code_models.workers_utils import TrainingReport
+from napari_cellseg3d.code_models.worker_training import (
+    SupervisedTrainingWorker,
+    WNetTrainingWorker,
+)
+from napari_cellseg3d.code_models.workers_utils import (
+    QUANTILE_CACHE,
+    AsyncCheckpointer,
+    MixedPrecision,
+    NormalizeBatch,
+    PersistentCached,
+    QuantileNormalizationd,
+    ThroughputMeter,
+    TrainingProgress,
+    TrainingReport,
+    VolumeQuantilesd,
+    get_source_path,
+)
 from napari_cellseg3d.code_plugins.plugin_model_training import (
     Trainer,
 )
-from napari_cellseg3d.config import MODEL_LIST
+from napari_cellseg3d.config import (
+    MODEL_LIST,
+    SupervisedTrainingWorkerConfig,
+    WNetTrainingWorkerConfig,
+)
+from napari_cellseg3d.dev_scripts.benchmark_normalization import (
+    per_sample_quantile,
+    per_sample_remap,
+)
 
 WANDB_MODE = "disabled"
 
@@ -68,8 +105,9 @@ def test_supervised_training(make_napari_viewer_proxy):
         provided_loss=LossFixture(),
         provided_scheduler=SchedulerFixture(),
     ):
-        assert isinstance(res_i, TrainingReport)
+        assert isinstance(res_i, (TrainingReport, TrainingProgress))
         res = res_i
+    assert isinstance(res, TrainingReport)
     assert res.epoch == 1
 
     widget.worker = worker
@@ -80,6 +118,15 @@ def test_supervised_training(make_napari_viewer_proxy):
     assert widget.loss_1_values["loss"] == [1, 1, 1, 1]
     assert widget.loss_2_values == [1, 1, 1, 1]
 
+    widget._stop_requested = True
+    widget.on_yield(
+        TrainingProgress(
+            epoch=1, step=1, total_steps=2, weights=ModelFixture().state_dict()
+        )
+    )
+    assert widget.worker is None
+    assert not widget._stop_requested
+
 
 def test_unsupervised_training(make_napari_viewer_proxy):
     viewer = make_napari_viewer_proxy()
@@ -107,10 +154,12 @@ def test_unsupervised_training(make_napari_viewer_proxy):
         provided_optimizer=OptimizerFixture(),
         provided_loss=LossFixture(),
     ):
-        assert isinstance(res_i, TrainingReport)
+        assert isinstance(res_i, (TrainingReport, TrainingProgress))
         res = res_i
+    assert isinstance(res, TrainingReport)
     assert res.epoch == 0
     widget.worker._abort_requested = True
+    widget.worker.request_weights()
     res = next(
         widget.worker.train(
             provided_model=WNetFixture(),
@@ -118,8 +167,9 @@ def test_unsupervised_training(make_napari_viewer_proxy):
             provided_loss=LossFixture(),
         )
     )
-    assert isinstance(res, TrainingReport)
-    assert not res.show_plot
+    assert isinstance(res, TrainingProgress)
+    assert res.step == 1
+    assert res.weights is not None
     with pytest.raises(
         AttributeError,
         match="'WNetTrainingWorker' object has no attribute 'model'",
@@ -137,3 +187,189 @@ def test_unsupervised_training(make_napari_viewer_proxy):
     assert isinstance(eval_res, TrainingReport)
     assert eval_res.show_plot
     assert eval_res.epoch == -10
+
+
+def test_persistent_cache(tmp_path):
+    set_track_meta(True)  # disabled by WNet training
+
+    def preprocessing(pad_size):
+        return Compose(
+            [
+                LoadImaged(keys=["image", "label"]),
+                EnsureChannelFirstd(
+                    keys=["image", "label"], channel_dim="no_channel"
+                ),
+                SpatialPadd(keys=["image", "label"], spatial_size=pad_size),
+            ]
+        )
+
+    data = [{"image": im_path_str, "label": lab_path_str}]
+    expected = preprocessing([8, 8, 8])(data[0])["image"]
+
+    cache = PersistentCached(
+        ["image", "label"], preprocessing([8, 8, 8]), tmp_path
+    )
+    assert cache.prepare(data) == 0
+    assert cache.prepare(data) == 1
+    cached = cache(data[0])
+    assert isinstance(cached["image"], MetaTensor)
+    assert np.allclose(cached["image"], expected)
+    assert torch.equal(cached["image"].affine, expected.affine)
+    assert get_source_path(cached["image"]) == im_path_str
+
+    # quantiles of cached volumes are computed once per volume, not per patch
+    QUANTILE_CACHE.clear()
+    for _ in range(2):
+        quantiles = VolumeQuantilesd(keys=["image", "label"])(cache(data[0]))
+    assert len(QUANTILE_CACHE) == 2
+    assert quantiles["image_quantiles"] == QUANTILE_CACHE.get(
+        None, path=im_path_str
+    )
+
+    # random transforms may modify the cached volumes in place without altering the cache
+    augment = Compose(
+        [
+            RandSpatialCropSamplesd(
+                keys=["image", "label"],
+                roi_size=[4, 4, 4],
+                random_size=False,
+                num_samples=2,
+            ),
+            QuantileNormalizationd(keys=["image"]),
+        ]
+    )
+    augment(cached)
+    assert np.allclose(cache(data[0])["image"], expected)
+
+    # a different preprocessing uses a different entry
+    other = PersistentCached(
+        ["image", "label"], preprocessing([16, 16, 16]), tmp_path
+    )
+    assert other.cache_key(data[0]) != cache.cache_key(data[0])
+    assert other.prepare(data) == 0
+    assert len(list(tmp_path.iterdir())) == 2
+
+
+def test_mixed_precision(tmp_path):
+    model = torch.nn.Conv3d(1, 2, 3, padding=1)
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.1)
+    amp = MixedPrecision("cpu", enabled=True, channels_last=True)
+    model = amp.prepare_model(model)
+    inputs = amp.prepare_inputs(torch.rand(2, 1, 8, 8, 8))
+    assert inputs.is_contiguous(memory_format=torch.channels_last_3d)
+
+    throughput = ThroughputMeter("cpu")
+    throughput.start()
+    weights = model.weight.detach().clone()
+    with amp.autocast():
+        outputs = model(inputs)
+    if amp.enabled:
+        assert outputs.dtype == torch.bfloat16
+    amp.step(outputs.float().mean(), optimizer)
+    throughput.update(inputs.shape[0])
+    assert not torch.equal(weights, model.weight)
+
+    record = throughput.stop()
+    assert record["samples"] == 2
+    throughput.save(tmp_path / "throughput.csv")
+    assert (tmp_path / "throughput.csv").read_text().startswith("epoch")
+
+    assert MixedPrecision("cpu", enabled=False).description == "float32"
+
+    # gradients are clipped before the step
+    optimizer = torch.optim.SGD(model.parameters(), lr=1)
+    weights = model.weight.detach().clone()
+    amp.step(model(inputs).float().sum() * 1e6, optimizer, clip_value=0.01)
+    assert (weights - model.weight).abs().max() <= 0.01 + 1e-6
+
+
+def test_normalize_batch():
+    batch = torch.rand(3, 2, 8, 8, 8) * 1000
+    batch[1, 1] = 5  # constant image
+
+    remapped = NormalizeBatch(new_min=0, new_max=100)(batch.clone())
+    expected = per_sample_remap(batch.clone())
+    assert torch.allclose(remapped[1, 0], expected[1, 0], atol=1e-3)
+    assert torch.equal(remapped[1, 1], torch.zeros(8, 8, 8))
+    assert remapped[0, 0].min() == 0
+    assert torch.isclose(remapped[0, 0].max(), torch.tensor(100.0))
+
+    quantile = NormalizeBatch(mode="quantile")
+    assert torch.allclose(
+        quantile(batch.clone()), per_sample_quantile(batch.clone())
+    )
+    # without the size limit of torch.quantile
+    flat = batch.reshape(6, -1)
+    assert torch.allclose(
+        quantile._quantile(flat, 0.99),
+        torch.quantile(flat, 0.99, dim=1),
+    )
+
+    # in place, also on numpy arrays and single CHWD images
+    image = np.linspace(0, 10, 64, dtype=np.float32).reshape(1, 4, 4, 4)
+    NormalizeBatch(batch_dims=1)(image)
+    assert image.min() == 0
+    assert image.max() == 1
+    with pytest.raises(ValueError, match="Unknown normalization mode"):
+        NormalizeBatch(mode="zscore")
+
+
+def test_async_checkpointer(tmp_path):
+    model = torch.nn.Linear(4, 2)
+    checkpointer = AsyncCheckpointer()
+    checkpointer.save(model, tmp_path / "checkpoint.pth")
+    expected = model.weight.detach().clone()
+    with torch.no_grad():  # later updates do not affect the checkpoint
+        model.weight.add_(1)
+    checkpointer.close()
+
+    weights = torch.load(tmp_path / "checkpoint.pth")
+    assert torch.equal(weights["weight"], expected)
+
+
+def test_checkpointer_closed_on_error():
+    class RecordingCheckpointer(AsyncCheckpointer):
+        closed = False
+
+        def close(self):
+            self.closed = True
+            super().close()
+
+    for worker in [
+        SupervisedTrainingWorker(SupervisedTrainingWorkerConfig()),
+        WNetTrainingWorker(WNetTrainingWorkerConfig()),
+    ]:
+        worker.checkpointer = RecordingCheckpointer()
+        # the default configs have no model or data, so training fails
+        with contextlib.suppress(TypeError):
+            for _ in worker.train():
+                pass
+        assert worker.checkpointer.closed
+
+
+def test_persistent_cache_orientation(tmp_path):
+    pytest.importorskip("nibabel")  # required by Orientationd
+    load = Compose(
+        [
+            LoadImaged(keys=["image"]),
+            EnsureChannelFirstd(keys=["image"], channel_dim="no_channel"),
+        ]
+    )
+    cache = PersistentCached(["image"], load, tmp_path)
+    crop_and_orient = Compose(
+        [
+            RandSpatialCropSamplesd(
+                keys=["image"],
+                roi_size=[2, 3, 4],
+                random_size=False,
+                num_samples=1,
+            ),
+            Orientationd(keys=["image"], axcodes="PLI"),
+        ]
+    )
+    data = {"image": im_path_str}
+    # patches cropped from cached volumes are reoriented like uncached ones
+    assert (
+        crop_and_orient(cache(data))[0]["image"].shape
+        == crop_and_orient(load(data))[0]["image"].shape
+    )
@@ -1,12 +1,15 @@
 import random
+import time
 from functools import partial
 from pathlib import Path
 
 import numpy as np
 import pytest
 import torch
+from monai.transforms import LoadImaged
+from tifffile import imwrite
 
-from napari_cellseg3d import utils
+from napari_cellseg3d import readers, utils
 from napari_cellseg3d.dev_scripts import thread_test
 
 rand_gen = utils.rand_gen
@@ -208,6 +211,54 @@ def test_load_images():
     images = utils.load_images(str(path))
     assert images.shape == (6, 6, 6)
 
+    lazy_images = utils.load_images(str(path), lazy=True)
+    assert np.array_equal(lazy_images, images)
+
+
+def test_readers(tmp_path):
+    volume = np.arange(5 * 6 * 7, dtype=np.float32).reshape(5, 6, 7)
+    path = tmp_path / "volume.npy"
+    np.save(path, volume)
+
+    assert readers.is_supported(path)
+    assert not readers.is_supported(tmp_path / "volume.png")
+    assert readers.volume_name(tmp_path / "volume.ome.zarr") == "volume"
+    lazy_volume = readers.open_volume(path)
+    assert isinstance(lazy_volume, np.memmap)
+    assert np.array_equal(lazy_volume[1:3], volume[1:3])
+    with pytest.raises(ValueError, match="Unsupported file format"):
+        readers.open_volume(tmp_path / "volume.png")
+
+    # read with axes reversed, like TIFF files loaded by MONAI
+    loaded = readers.volume_loader(keys=["image"], image_only=True)(
+        {"image": str(path)}
+    )["image"]
+    assert np.array_equal(np.asarray(loaded), volume.T)
+
+    # TIFF files are left to the MONAI default readers
+    tiff_path = tmp_path / "volume.tif"
+    imwrite(tiff_path, volume)
+    default = LoadImaged(keys=["image"], image_only=True)(
+        {"image": str(tiff_path)}
+    )["image"]
+    with_reader = readers.volume_loader(keys=["image"], image_only=True)(
+        {"image": str(tiff_path)}
+    )["image"]
+    assert np.array_equal(np.asarray(with_reader), np.asarray(default))
+    assert np.array_equal(np.asarray(with_reader.affine), default.affine)
+
+    @readers.register_reader(".raw")
+    def read_raw(path, key=None):
+        return np.memmap(path, dtype=np.float32, mode="r", shape=(5, 6, 7))
+
+    try:
+        volume.tofile(tmp_path / "volume.raw")
+        assert np.array_equal(
+            readers.open_volume(tmp_path / "volume.raw"), volume
+        )
+    finally:
+        del readers.READERS[".raw"]
+
 
 def test_parse_default_path():
     user_path = Path.home()
@@ -259,6 +310,34 @@ def test_quantile_norm():
     assert array_norm.max() <= high_quantile
 
 
+def test_compute_quantiles(tmp_path, monkeypatch):
+    array = rand_gen.random(size=(30, 40, 50)).astype(np.float32)
+    expected = np.quantile(array, [0.01, 0.99])
+    assert np.allclose(utils.compute_quantiles(array), expected)
+    assert np.allclose(
+        utils.compute_quantiles(torch.from_numpy(array)), expected
+    )
+
+    # large or lazily-loaded volumes are read slab by slab into a histogram
+    path = tmp_path / "volume.npy"
+    np.save(path, array)
+    lazy_array = np.load(path, mmap_mode="r")
+    assert np.allclose(
+        utils.compute_quantiles(lazy_array, slab_size=7), expected, atol=1e-4
+    )
+    monkeypatch.setattr(utils, "EXACT_QUANTILES_MAX_SIZE", 0)
+    assert np.allclose(
+        utils.compute_quantiles(torch.from_numpy(array)), expected, atol=1e-4
+    )
+    labels = rand_gen.integers(0, 1000, size=(30, 40, 50)).astype(np.uint16)
+    assert np.allclose(
+        utils.compute_quantiles(labels, 0.05, 0.5),
+        np.quantile(labels, [0.05, 0.5]),
+    )
+    with pytest.raises(ValueError, match="quantile_high"):
+        utils.compute_quantiles(array, 0.9, 0.1)
+
+
 def test_get_all_matching_files():
     test_image_path = Path(__file__).resolve().parent / "res/wnet_test"
     paths = utils.get_all_matching_files(test_image_path)
@@ -266,3 +345,20 @@ def test_get_all_matching_files():
     assert len(paths) == 1
     assert [Path(p).is_file() for p in paths]
     assert [Path(p).suffix == ".tif" for p in paths]
+
+
+def test_peak_memory():
+    host_peak = utils._process_status("VmHWM")
+    with utils.PeakMemory() as memory:
+        # larger than the malloc mmap threshold, so that memory freed by previous tests is not reused
+        volume = np.ones((64, 64, 64, 32))
+        nbytes = volume.nbytes
+        time.sleep(0.1)  # sampled while allocated
+        del volume
+    if memory.peak is not None:  # Linux only
+        assert memory.peak >= nbytes // 2
+        # the peak of the main process, e.g. napari, is not reset
+        assert utils._process_status("VmHWM") >= host_peak
+
+    with utils.process_pool(1) as pool:
+        assert pool.submit(np.prod, [2, 3]).result() == 6
@@ -6,6 +6,9 @@
 * worker_training.py: contains the code for the training worker
 * instance_segmentation.py: contains the code for instance segmentation
 * crf.py: contains the code for the CRF postprocessing
+* evaluation.py: contains the code to evaluate instance labels against a ground truth
+* headless_inference.py: contains the ``cellseg3d-infer`` command to run inference without napari
+* results_writer.py: contains the writers for compressed TIFF and OME-Zarr inference results
 * worker_utils.py: contains functions used by the workers
 
 """
@@ -0,0 +1,116 @@
+"""Batch processing of image folders, as used by the Utilities plugins.
+
+Files are processed one at a time by each worker : a file is read, transformed and written by the same process,
+so only the volumes currently being processed are held in memory, and only file paths are sent between processes.
+At most ``num_workers`` files are in flight, so that a cancelled batch stops after the files already started.
+
+Transforms must be picklable to run in worker processes, e.g. module-level functions
+or :py:func:`functools.partial` objects built from them. They can be used from scripts, for instance::
+
+    from functools import partial
+    from napari_cellseg3d.code_models.batch_processing import process_files
+    from napari_cellseg3d.code_models.instance_segmentation import threshold
+
+    process_files(paths, partial(threshold, thresh=0.5), "results/threshold", num_workers=4)
+"""
+from concurrent.futures import FIRST_COMPLETED, wait
+from pathlib import Path
+
+import numpy as np
+from tifffile import imread, imwrite
+
+from napari_cellseg3d.utils import LOGGER as logger
+from napari_cellseg3d.utils import process_pool
+
+
+def process_file(path, function, output_folder, dtype=None):
+    """Reads an image, applies a transform and writes the result in a folder, under the same file name.
+
+    Args:
+        path (str): path to the image
+        function (callable): transform taking an image and returning the processed image
+        output_folder (str): folder to write the result to
+        dtype (np.dtype): type the result is cast to before writing. If None, the result is written as is.
+
+    Returns:
+        str: path to the written result
+    """
+    result = np.asarray(function(imread(str(path))))
+    if dtype is not None:
+        result = result.astype(dtype)
+    output_path = Path(output_folder) / Path(path).name
+    imwrite(str(output_path), result)
+    return str(output_path)
+
+
+def _try_process_file(path, function, output_folder, dtype):
+    """Runs :py:func:`process_file`, logging errors instead of raising them so that a single file does not stop a batch."""
+    try:
+        return process_file(path, function, output_folder, dtype)
+    except Exception as e:
+        logger.error(f"Could not process {path} : {e}")
+        return None
+
+
+def iter_process_files(
+    paths, function, output_folder, num_workers=1, dtype=None
+):
+    """Processes files with :py:func:`process_file`, in parallel processes if ``num_workers`` > 1.
+
+    Closing the generator cancels files that have not been started yet.
+
+    Args:
+        paths (list): paths to the images
+        function (callable): picklable transform taking an image and returning the processed image
+        output_folder (str): folder to write the results to, created if needed
+        num_workers (int): number of processes, and maximum number of files processed at once
+        dtype (np.dtype): type the results are cast to before writing
+
+    Yields:
+        (int, str): index of the file and path to its result, or None if it could not be processed,
+        in the order the files finish
+    """
+    Path(output_folder).mkdir(parents=True, exist_ok=True)
+    if num_workers <= 1:
+        for i, path in enumerate(paths):
+            yield i, _try_process_file(path, function, output_folder, dtype)
+        return
+
+    with process_pool(num_workers) as pool:
+        queued = list(enumerate(paths))[::-1]
+        running = {}
+        try:
+            while queued or running:
+                while queued and len(running) < num_workers:
+                    index, path = queued.pop()
+                    future = pool.submit(
+                        _try_process_file,
+                        path,
+                        function,
+                        output_folder,
+                        dtype,
+                    )
+                    running[future] = index
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield running.pop(future), future.result()
+        finally:
+            if queued:
+                logger.info(
+                    f"Batch cancelled, {len(queued)} files were not processed"
+                )
+
+
+def process_files(paths, function, output_folder, num_workers=1, dtype=None):
+    """Processes files and waits for all results, see :py:func:`iter_process_files`.
+
+    Returns:
+        list: path to the result of each file, or None for files that could not be processed
+    """
+    results = [None] * len(paths)
+    for index, output_path in iter_process_files(
+        paths, function, output_folder, num_workers, dtype
+    ):
+        results[index] = output_path
+    logger.info(f"Saved processed folder as : {output_folder}")
+    return results
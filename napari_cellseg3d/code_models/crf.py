@@ -17,22 +17,34 @@ Philipp Krähenbühl and Vladlen Koltun
 NIPS 2011
 
 Implemented using the pydense library available at https://github.com/lucasb-eyer/pydensecrf.
+
+A dense CRF over a whole volume stores several floats per voxel (6 bilateral features alone) and is infeasible
+for large volumes, so volumes can also be processed in overlapping blocks, in parallel processes (see :py:func:`crf_tiled`).
+
+An approximate implementation using PyTorch is also available, which does not require pydensecrf and runs on GPU
+(see :py:mod:`napari_cellseg3d.code_models.crf_torch`).
 """
 import importlib
+import time
+from concurrent.futures import FIRST_COMPLETED, as_completed, wait
+from itertools import repeat
 
 import numpy as np
+from monai.data.utils import compute_importance_map
 from napari.qt.threading import GeneratorWorker
 
+from napari_cellseg3d.code_models.crf_torch import crf_torch
+from napari_cellseg3d.code_models.tiled_inference import get_tiles
 from napari_cellseg3d.config import CRFConfig
 from napari_cellseg3d.utils import LOGGER as logger
+from napari_cellseg3d.utils import PeakMemory, process_pool
 
 spec = importlib.util.find_spec("pydensecrf")
 CRF_INSTALLED = spec is not None
 if not CRF_INSTALLED:
     logger.info(
-        "pydensecrf not installed, CRF post-processing will not be available. "
-        "Please install by running : pip install pydensecrf@git+https://github.com/lucasb-eyer/pydensecrf.git#egg=master"
-        "This is not a hard requirement, you do not need it to install it unless you want to use the CRF post-processing step."
+        "pydensecrf not installed, the CRF will use an approximate PyTorch implementation instead. "
+        "To use pydensecrf, install it by running : pip install pydensecrf@git+https://github.com/lucasb-eyer/pydensecrf.git#egg=master"
     )
 else:
     import pydensecrf.densecrf as dcrf
@@ -42,6 +54,9 @@ else:
         unary_from_softmax,
     )
 
+CRF_BACKENDS = ["auto", "pydensecrf", "torch"]
+"""Available CRF implementations. "auto" uses pydensecrf if installed, and PyTorch otherwise."""
+
 __author__ = "Yves Paychère, Colin Hofmann, Cyril Achard"
 __credits__ = [
     "Yves Paychère",
@@ -76,7 +91,7 @@ def correct_shape_for_crf(image, desired_dims=4):
     return image
 
 
-def crf_batch(images, probs, sa, sb, sg, w1, w2, n_iter=5):
+def crf_batch(images, probs, sa, sb, sg, w1, w2, n_iter=5, num_workers=1):
     """CRF post-processing step for the W-Net, applied to a batch of images.
 
     Args:
@@ -88,6 +103,7 @@ def crf_batch(images, probs, sa, sb, sg, w1, w2, n_iter=5):
         w1 (float): weight of the appearance/bilateral kernel.
         w2 (float): weight of the smoothness/gaussian kernel.
         n_iter (int, optional): Number of iterations for the CRF post-processing step. Defaults to 5.
+        num_workers (int, optional): Number of processes running images in parallel. Defaults to 1.
 
     Returns:
         np.ndarray: Array of shape (N, K, H, W, D) containing the refined class probabilities for each pixel.
@@ -95,13 +111,22 @@ def crf_batch(images, probs, sa, sb, sg, w1, w2, n_iter=5):
     if not CRF_INSTALLED:
         return None
 
-    return np.stack(
-        [
+    if num_workers > 1:
+        with process_pool(num_workers) as pool:
+            results = list(
+                pool.map(
+                    crf,
+                    images,
+                    probs,
+                    *(repeat(p) for p in (sa, sb, sg, w1, w2, n_iter)),
+                )
+            )
+    else:
+        results = [
             crf(images[i], probs[i], sa, sb, sg, w1, w2, n_iter=n_iter)
             for i in range(images.shape[0])
-        ],
-        axis=0,
-    )
+        ]
+    return np.stack(results, axis=0)
 
 
 def crf(image, prob, sa, sb, sg, w1, w2, n_iter=5):
@@ -164,7 +189,156 @@ def crf(image, prob, sa, sb, sg, w1, w2, n_iter=5):
     )
 
 
-def crf_with_config(image, prob, config: CRFConfig = None, log=logger.info):
+def _crf_block(index, image, prob, params, backend="pydensecrf", device=None):
+    """Runs the CRF on one block, possibly in a worker process.
+
+    Returns:
+        tuple: block index, marginals, duration in seconds and peak memory used by the block in bytes (None if unavailable)
+    """
+    start = time.perf_counter()
+    with PeakMemory() as memory:
+        if backend == "torch":
+            marginals = crf_torch(
+                image, prob, *params[:5], n_iter=params[5], device=device
+            )
+        else:
+            marginals = crf(image, prob, *params)
+        marginals = marginals.astype(np.float32)
+    return index, marginals, time.perf_counter() - start, memory.peak
+
+
+def crf_tiled(
+    image,
+    prob,
+    sa,
+    sb,
+    sg,
+    w1,
+    w2,
+    n_iter=5,
+    tile_size=128,
+    tile_overlap=16,
+    num_workers=1,
+    log=None,
+    block_stats: list = None,
+    backend="pydensecrf",
+    device=None,
+):
+    """Runs the CRF on overlapping blocks of a volume and blends the marginals of the blocks back.
+
+    Each block is an independent dense CRF, so memory only depends on ``tile_size``.
+    Blocks run in ``num_workers`` processes, and their marginals are blended with gaussian weights,
+    so that block borders, which lack context, count less than block centers.
+    With the torch backend, blocks run one at a time on ``device``.
+
+    Args:
+        image (np.ndarray): Array of shape (C, H, W, D) containing the input image.
+        prob (np.ndarray): Array of shape (K, H, W, D) containing the predicted class probabilities for each pixel.
+        sa (float): alpha standard deviation, the scale of the spatial part of the appearance/bilateral kernel.
+        sb (float): beta standard deviation, the scale of the color part of the appearance/bilateral kernel.
+        sg (float): gamma standard deviation, the scale of the smoothness/gaussian kernel.
+        w1 (float): weight of the appearance/bilateral kernel.
+        w2 (float): weight of the smoothness/gaussian kernel.
+        n_iter (int, optional): Number of iterations for the CRF post-processing step. Defaults to 5.
+        tile_size (int, optional): Size of the cubic blocks. Defaults to 128.
+        tile_overlap (int, optional): Number of voxels shared by neighbouring blocks. Defaults to 16.
+        num_workers (int, optional): Number of processes running blocks in parallel. Defaults to 1 (no extra process).
+        log (function, optional): Logging function, called with the progress and peak memory of each block.
+        block_stats (list, optional): If given, a dict with the slices, duration and peak memory of each block is appended to it.
+        backend (str, optional): CRF implementation run on each block, "pydensecrf" or "torch". Defaults to "pydensecrf".
+        device (str, optional): Device used by the torch backend. If None, uses CUDA if available.
+
+    Returns:
+        np.ndarray: Array of shape (K, H, W, D) containing the refined class probabilities for each pixel.
+    """
+    if backend == "pydensecrf" and not CRF_INSTALLED:
+        return None
+
+    spatial_shape = tuple(image.shape[1:])
+    tiles = get_tiles(spatial_shape, tile_size, tile_overlap)
+    params = (sa, sb, sg, w1, w2, n_iter)
+    result = np.zeros((prob.shape[0], *spatial_shape), dtype=np.float32)
+    weight_sum = np.zeros(spatial_shape, dtype=np.float32)
+    tile_weights = {}
+
+    def blocks():
+        for n, tile in enumerate(tiles):
+            yield (
+                n,
+                np.ascontiguousarray(image[(slice(None), *tile)]),
+                np.ascontiguousarray(prob[(slice(None), *tile)]),
+                params,
+                backend,
+                device,
+            )
+
+    def add(n, marginals, duration, peak_memory):
+        tile = tiles[n]
+        shape = marginals.shape[1:]
+        if shape not in tile_weights:
+            tile_weights[shape] = (
+                compute_importance_map(shape, mode="gaussian", device="cpu")
+                .numpy()
+                .astype(np.float32)
+            )
+        result[(slice(None), *tile)] += marginals * tile_weights[shape]
+        weight_sum[tile] += tile_weights[shape]
+        memory = (
+            f", peak memory {peak_memory / 2**20:.0f} MB"
+            if peak_memory is not None
+            else ""
+        )
+        if log is not None:
+            log(
+                f"CRF block {n + 1}/{len(tiles)} done in {duration:.1f}s{memory}"
+            )
+        if block_stats is not None:
+            block_stats.append(
+                {
+                    "block": tile,
+                    "seconds": duration,
+                    "peak_memory": peak_memory,
+                }
+            )
+
+    if num_workers > 1 and backend == "pydensecrf":
+        with process_pool(num_workers) as pool:
+            pending = set()
+            # only a few blocks are sent ahead, to bound memory
+            for args in blocks():
+                pending.add(pool.submit(_crf_block, *args))
+                if len(pending) >= 2 * num_workers:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        add(*future.result())
+            for future in as_completed(pending):
+                add(*future.result())
+    else:
+        for args in blocks():
+            add(*_crf_block(*args))
+
+    result /= np.maximum(weight_sum, np.finfo(np.float32).eps)
+    return result
+
+
+def get_backend(backend="auto"):
+    """Returns the CRF implementation to use, "pydensecrf" or "torch", for a backend in CRF_BACKENDS."""
+    if backend not in CRF_BACKENDS:
+        raise ValueError(
+            f"Unknown CRF backend {backend}, choose from {CRF_BACKENDS}"
+        )
+    if backend == "auto":
+        return "pydensecrf" if CRF_INSTALLED else "torch"
+    if backend == "pydensecrf" and not CRF_INSTALLED:
+        raise ImportError(
+            "pydensecrf is not installed, use the torch CRF backend instead."
+        )
+    return backend
+
+
+def crf_with_config(
+    image, prob, config: CRFConfig = None, log=logger.info, device=None
+):
     """Implements the CRF post-processing step for the W-Net.
 
     Args:
@@ -172,9 +346,11 @@ def crf_with_config(image, prob, config: CRFConfig = None, log=logger.info):
         prob (np.ndarray): Array of shape (K, H, W, D) containing the predicted class probabilities for each pixel.
         config (CRFConfig, optional): Configuration for the CRF post-processing step. Defaults to None.
         log (function, optional): Logging function. Defaults to logger.info.
+        device (str, optional): Device used by the torch backend. If None, uses CUDA if available.
     """
     if config is None:
         config = CRFConfig()
+    backend = get_backend(config.backend)
     if image.shape[-3:] != prob.shape[-3:]:
         raise ValueError(
             f"Image and probability shapes do not match: {image.shape} vs {prob.shape}"
@@ -189,16 +365,27 @@ def crf_with_config(image, prob, config: CRFConfig = None, log=logger.info):
         log(f"Image shape : {image.shape}")
         log(f"Labels shape : {prob.shape}")
 
-    return crf(
-        image,
-        prob,
-        config.sa,
-        config.sb,
-        config.sg,
-        config.w1,
-        config.w2,
-        config.n_iters,
-    )
+    params = (config.sa, config.sb, config.sg, config.w1, config.w2)
+    if config.tile_size is not None and any(
+        s > config.tile_size for s in image.shape[1:]
+    ):
+        return crf_tiled(
+            image,
+            prob,
+            *params,
+            n_iter=config.n_iters,
+            tile_size=config.tile_size,
+            tile_overlap=config.tile_overlap,
+            num_workers=config.num_workers,
+            log=log,
+            backend=backend,
+            device=device,
+        )
+    if backend == "torch":
+        return crf_torch(
+            image, prob, *params, n_iter=config.n_iters, device=device
+        )
+    return crf(image, prob, *params, config.n_iters)
 
 
 class CRFWorker(GeneratorWorker):
@@ -210,6 +397,7 @@ class CRFWorker(GeneratorWorker):
         labels_list: list,
         config: CRFConfig = None,
         log=None,
+        device=None,
     ):
         """Initializes the CRFWorker.
 
@@ -218,6 +406,7 @@ class CRFWorker(GeneratorWorker):
             labels_list (list): List of labels to process.
             config (CRFConfig, optional): Configuration for the CRF post-processing step. Defaults to None.
             log (function, optional): Logging function. Defaults to None.
+            device (str, optional): Device used by the torch backend. If None, uses CUDA if available.
         """
         super().__init__(self._run_crf_job)
 
@@ -228,11 +417,11 @@ class CRFWorker(GeneratorWorker):
         else:
             self.config = config
         self.log = log
+        self.device = device
 
     def _run_crf_job(self):
         """Runs the CRF post-processing step for the W-Net."""
-        if not CRF_INSTALLED:
-            raise ImportError("pydensecrf is not installed.")
+        backend = get_backend(self.config.backend)
 
         if len(self.images) != len(self.labels):
             raise ValueError("Number of images and labels must be the same.")
@@ -241,19 +430,30 @@ class CRFWorker(GeneratorWorker):
             if self.images[i].shape[-3:] != self.labels[i].shape[-3:]:
                 raise ValueError("Image and labels must have the same shape.")
 
-            im = correct_shape_for_crf(self.images[i])
-            prob = correct_shape_for_crf(self.labels[i])
-
-            logger.debug(f"image shape : {im.shape}")
-            logger.debug(f"labels shape : {prob.shape}")
-
-            yield crf(
-                im,
-                prob,
-                self.config.sa,
-                self.config.sb,
-                self.config.sg,
-                self.config.w1,
-                self.config.w2,
-                n_iter=self.config.n_iters,
+        if (
+            backend == "pydensecrf"
+            and self.config.tile_size is None
+            and self.config.num_workers > 1
+        ):
+            # whole images in parallel, results are yielded in order
+            with process_pool(self.config.num_workers) as pool:
+                yield from pool.map(
+                    crf_with_config,
+                    self.images,
+                    self.labels,
+                    repeat(self.config),
+                    repeat(None),
+                )
+            return
+
+        for i in range(len(self.images)):
+            logger.debug(f"image shape : {self.images[i].shape}")
+            logger.debug(f"labels shape : {self.labels[i].shape}")
+            # large images are split in blocks run in parallel
+            yield crf_with_config(
+                self.images[i],
+                self.labels[i],
+                self.config,
+                log=self.log,
+                device=self.device,
             )
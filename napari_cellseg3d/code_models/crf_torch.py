@@ -0,0 +1,216 @@
+"""Approximate mean-field CRF implemented with PyTorch operations, as an alternative to pydensecrf.
+
+Uses the same model and parameters as :py:func:`napari_cellseg3d.code_models.crf.crf` (Potts compatibility,
+a smoothness/gaussian kernel and an appearance/bilateral kernel), with two approximations :
+
+* the gaussian kernel is applied with separable 1D convolutions, truncated at 3 standard deviations
+* the bilateral kernel is applied on a bilateral grid : values are splatted on a grid downsampled by ``sa`` in space
+  and by ``sb`` in intensity, blurred there, and interpolated back (see Chen et al., Real-time edge-aware image processing with the bilateral grid, 2007).
+  The intensity axis has at most :py:data:`MAX_INTENSITY_BINS` nodes : for images with a larger intensity range
+  (e.g. raw 16-bit images), ``sb`` is increased so that the grid size stays bounded.
+
+Both kernels are normalized, so that messages are weighted averages of the neighbouring marginals.
+Images of a batch are processed together, on any device, without pydensecrf.
+The bilateral grid requires single-channel images.
+Memory use grows with the volume size, run large volumes in blocks with :py:func:`napari_cellseg3d.code_models.crf.crf_tiled`.
+"""
+import itertools
+import math
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+MAX_INTENSITY_BINS = 128
+"""Maximum number of nodes of the bilateral grid along the intensity axis."""
+
+
+def _gaussian_kernel1d(sigma, device, dtype):
+    """Returns a 1D gaussian kernel with peak value 1, truncated at 3 standard deviations."""
+    radius = max(int(math.ceil(3 * sigma)), 1)
+    x = torch.arange(-radius, radius + 1, device=device, dtype=dtype)
+    return torch.exp(-(x**2) / (2 * sigma**2))
+
+
+def _filter_axis(tensor, kernel, axis):
+    """Convolves a tensor with a 1D kernel along one axis, with zero padding."""
+    moved = tensor.movedim(axis, -1)
+    shape = moved.shape
+    filtered = F.conv1d(
+        moved.reshape(-1, 1, shape[-1]),
+        kernel.view(1, 1, -1),
+        padding=kernel.shape[0] // 2,
+    )
+    return filtered.reshape(shape).movedim(-1, axis)
+
+
+def gaussian_filter(values, sigma):
+    """Applies a separable, unnormalized gaussian filter to each channel of values of shape (N, C, H, W, D)."""
+    kernel = _gaussian_kernel1d(sigma, values.device, values.dtype)
+    size = kernel.shape[0]
+    shape = values.shape
+    values = values.reshape(-1, 1, *shape[2:])
+    for axis in range(3):
+        kernel_shape = [1, 1, 1, 1, 1]
+        kernel_shape[axis + 2] = size
+        padding = [0, 0, 0]
+        padding[axis] = size // 2
+        values = F.conv3d(values, kernel.view(kernel_shape), padding=padding)
+    return values.reshape(shape)
+
+
+class BilateralGrid:
+    """Bilateral filter of a single-channel 3D image, approximated on a downsampled grid.
+
+    The grid coordinates of each voxel are computed once, so that the filter can be applied to several values
+    (e.g. the marginals of each mean-field iteration) at the cost of splatting, blurring and slicing.
+    """
+
+    def __init__(
+        self,
+        image: torch.Tensor,
+        sa: float,
+        sb: float,
+        max_bins: int = MAX_INTENSITY_BINS,
+    ):
+        """Creates the grid for an image.
+
+        Args:
+            image (torch.Tensor): image of shape (H, W, D)
+            sa (float): spatial standard deviation, in voxels. Also the grid spacing in space.
+            sb (float): intensity standard deviation, in image units. Also the grid spacing in intensity.
+                Increased if needed so that the grid has at most ``max_bins`` nodes along the intensity axis.
+            max_bins (int): maximum number of grid nodes along the intensity axis
+        """
+        positions = [
+            torch.arange(s, device=image.device, dtype=image.dtype) / sa
+            for s in image.shape
+        ]
+        grids = torch.meshgrid(*positions, indexing="ij")
+        intensity_range = float(image.max() - image.min())
+        sb = max(sb, intensity_range / (max_bins - 2))
+        intensity = (image - image.min()) / sb
+        coordinates = [g.reshape(-1) for g in grids] + [intensity.reshape(-1)]
+        base = [c.floor() for c in coordinates]
+        self.grid_shape = [int(b.max()) + 2 for b in base]
+        self.strides = [
+            int(np.prod(self.grid_shape[i + 1 :])) for i in range(4)
+        ]
+        # index of the lowest of the 16 grid nodes surrounding each voxel, the others are at constant offsets
+        self.index = sum(b.long() * s for b, s in zip(base, self.strides))
+        # linear interpolation weights of the lower and upper node along each grid axis
+        self.weights = [
+            (1 - (c - b), c - b) for c, b in zip(coordinates, base)
+        ]
+        self.image_shape = tuple(image.shape)
+        self.kernel = _gaussian_kernel1d(1, image.device, image.dtype)
+
+    def _corners(self):
+        """Yields the grid index and interpolation weight of each voxel, for each of the 16 surrounding grid nodes."""
+        for corner in itertools.product((0, 1), repeat=4):
+            offset = sum(c * s for c, s in zip(corner, self.strides))
+            weight = self.weights[0][corner[0]]
+            for axis in range(1, 4):
+                weight = weight * self.weights[axis][corner[axis]]
+            yield self.index + offset, weight
+
+    def filter(self, values: torch.Tensor) -> torch.Tensor:
+        """Returns the bilateral filtering of values of shape (C, H, W, D), unnormalized."""
+        channels = values.shape[0]
+        flat = values.reshape(channels, -1)
+        grid = torch.zeros(
+            channels,
+            int(np.prod(self.grid_shape)),
+            device=values.device,
+            dtype=values.dtype,
+        )
+        corners = list(self._corners())
+        for index, weight in corners:
+            grid.index_add_(1, index, flat * weight)
+        grid = grid.view(channels, *self.grid_shape)
+        for axis in range(1, 5):
+            grid = _filter_axis(grid, self.kernel, axis)
+        grid = grid.reshape(channels, -1)
+        result = torch.zeros_like(flat)
+        for index, weight in corners:
+            result += grid[:, index] * weight
+        return result.view(channels, *self.image_shape)
+
+
+def _normalized(filtered):
+    """Divides filtered marginals by the filtered constant image (last channel)."""
+    return filtered[:-1] / filtered[-1:].clamp_min(1e-8)
+
+
+def crf_torch(
+    images,
+    probs,
+    sa,
+    sb,
+    sg,
+    w1,
+    w2,
+    n_iter=5,
+    device=None,
+    clip=1e-5,
+):
+    """Runs mean-field inference of a dense CRF with PyTorch, on a batch of images.
+
+    Args:
+        images (np.ndarray or torch.Tensor): Array of shape (N, 1, H, W, D) or (1, H, W, D) containing the input images.
+        probs (np.ndarray or torch.Tensor): Array of shape (N, K, H, W, D) or (K, H, W, D) containing the predicted class probabilities.
+        sa (float): alpha standard deviation, the scale of the spatial part of the appearance/bilateral kernel.
+        sb (float): beta standard deviation, the scale of the color part of the appearance/bilateral kernel.
+        sg (float): gamma standard deviation, the scale of the smoothness/gaussian kernel.
+        w1 (float): weight of the appearance/bilateral kernel.
+        w2 (float): weight of the smoothness/gaussian kernel.
+        n_iter (int, optional): Number of mean-field iterations. Defaults to 5.
+        device (str, optional): Device to run on. If None, uses the device of ``probs`` if it is a tensor, else CUDA if available.
+        clip (float, optional): Probabilities are clipped to this minimum before taking their log, like pydensecrf's unary_from_softmax.
+
+    Returns:
+        np.ndarray or torch.Tensor: refined class probabilities, with the type and shape of ``probs``
+    """
+    return_numpy = not isinstance(probs, torch.Tensor)
+    if device is None:
+        if isinstance(probs, torch.Tensor):
+            device = probs.device
+        else:
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+    images = torch.as_tensor(np.asarray(images) if return_numpy else images)
+    probs = torch.as_tensor(probs)
+    unbatched = probs.ndim == 4
+    if unbatched:
+        images, probs = images[None], probs[None]
+    if images.shape[1] != 1:
+        raise ValueError(
+            f"The PyTorch CRF requires single-channel images, got {images.shape[1]} channels"
+        )
+    if images.shape[2:] != probs.shape[2:]:
+        raise ValueError(
+            f"Image and probability shapes do not match: {images.shape} vs {probs.shape}"
+        )
+    images = images.to(device=device, dtype=torch.float32)
+    probs = probs.to(device=device, dtype=torch.float32)
+
+    unary = -torch.log(probs.clamp_min(clip))
+    q = torch.softmax(-unary, dim=1)
+    grids = [BilateralGrid(image[0], sa, sb) for image in images]
+    ones = torch.ones_like(q[:, :1])
+    for _ in range(n_iter):
+        values = torch.cat([q, ones], dim=1)
+        smoothness = _normalized(
+            gaussian_filter(values, sg).transpose(0, 1)
+        ).transpose(0, 1)
+        appearance = torch.stack(
+            [_normalized(grid.filter(v)) for grid, v in zip(grids, values)]
+        )
+        # Potts model : each label is penalized by the messages of all other labels
+        pairwise = w2 * (smoothness.sum(1, keepdim=True) - smoothness) + w1 * (
+            appearance.sum(1, keepdim=True) - appearance
+        )
+        q = torch.softmax(-unary - pairwise, dim=1)
+
+    if unbatched:
+        q = q[0]
+    return q.cpu().numpy() if return_numpy else q
@@ -0,0 +1,395 @@
+"""Evaluation of instance labels against a ground truth.
+
+All metrics are derived from the contingency table between ground truth and model labels,
+which counts the overlap in pixels between every pair of labels and is built in a single pass over the volumes.
+The table is stored as a sparse matrix, since each label only overlaps with a few others.
+
+Can also be run from the command line, e.g. :
+
+.. code-block:: bash
+
+    cellseg3d-evaluate ground_truth.tif prediction.tif --csv results.csv
+"""
+import argparse
+import logging
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Tuple
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from tifffile import imread
+
+from napari_cellseg3d.utils import LOGGER as logger
+
+PERCENT_CORRECT = 0.5
+"""How much of the original label should be found by the model to be classified as correct."""
+MATCH_COLUMNS = [
+    "model_label",
+    "gt_label",
+    "ratio_pixel_found",
+    "true_positive_ratio_model",
+    "iou",
+]
+ARTEFACT_COLUMNS = ["model_label", "ratio_false_pixel"]
+
+
+def _compact_labels(labels: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Maps label values to consecutive indices, with the background always at index 0.
+
+    Returns:
+        (np.ndarray, np.ndarray): label values, and index of each pixel in the label values
+    """
+    labels = np.asarray(labels).ravel()
+    if labels.size == 0:
+        return np.zeros(1, dtype=np.int64), np.zeros(0, dtype=np.intp)
+    if not np.issubdtype(labels.dtype, np.integer):
+        raise ValueError(f"Labels must be integers, got {labels.dtype}")
+    if labels.min() < 0:
+        raise ValueError("Labels must be non-negative")
+    max_label = int(labels.max())
+    if max_label <= 4 * labels.size:  # use a lookup table
+        labels = labels.astype(np.intp, copy=False)
+        present = np.bincount(labels, minlength=1) > 0
+        present[0] = True
+        ids = np.flatnonzero(present)
+        lookup = np.zeros(max_label + 1, dtype=np.intp)
+        lookup[ids] = np.arange(ids.size)
+        return ids, lookup[labels]
+    ids, index = np.unique(np.append(labels, 0), return_inverse=True)
+    return ids, index[:-1]
+
+
+def contingency_table(gt_labels, model_labels):
+    """Counts the overlap between every ground truth label and every model label.
+
+    Args:
+        gt_labels (np.ndarray): ground truth labels
+        model_labels (np.ndarray): model labels, of the same shape as ``gt_labels``
+
+    Returns:
+        (scipy.sparse.csr_matrix, np.ndarray, np.ndarray): sparse table whose entry (i, j) is the number of pixels
+        labeled ``gt_ids[i]`` in the ground truth and ``model_ids[j]`` by the model, then ``gt_ids`` and ``model_ids``.
+        The background (0) is always at index 0 of both.
+    """
+    if np.shape(gt_labels) != np.shape(model_labels):
+        raise ValueError(
+            f"Ground truth and model labels must have the same shape, got {np.shape(gt_labels)} and {np.shape(model_labels)}"
+        )
+    gt_ids, gt_index = _compact_labels(gt_labels)
+    model_ids, model_index = _compact_labels(model_labels)
+    # background pixels are counted separately, as they are usually the majority
+    labeled = np.flatnonzero((gt_index > 0) | (model_index > 0))
+    counts = np.ones(labeled.size + 1, dtype=np.int64)
+    counts[-1] = gt_index.size - labeled.size
+    table = sparse.coo_matrix(
+        (
+            counts,
+            (
+                np.append(gt_index[labeled], 0),
+                np.append(model_index[labeled], 0),
+            ),
+        ),
+        shape=(gt_ids.size, model_ids.size),
+    ).tocsr()  # sums duplicate entries
+    return table, gt_ids, model_ids
+
+
+@dataclass
+class LabelMatching:
+    """Matching between model labels and ground truth labels.
+
+    * ``found`` : model labels matching exactly one ground truth label
+    * ``fused`` : model labels matching several ground truth labels, one row per ground truth label
+    * ``artefacts`` : model labels mostly on the background
+    * ``missed`` : ground truth labels matched by no model label
+
+    For ``found`` and ``fused``, ``ratio_pixel_found`` is the fraction of the ground truth label covered by the model label,
+    and ``true_positive_ratio_model`` the fraction of the model label covering the ground truth label(s).
+    """
+
+    found: pd.DataFrame
+    fused: pd.DataFrame
+    artefacts: pd.DataFrame
+    missed: np.ndarray
+    number_gt_labels: int
+    number_model_labels: int
+    number_gt_values: int
+
+
+def match_labels(
+    gt_labels, model_labels, threshold_correct=PERCENT_CORRECT
+) -> LabelMatching:
+    """Matches model labels to ground truth labels from their contingency table.
+
+    A ground truth label is considered found by a model label if more than ``threshold_correct`` of its pixels are in it.
+    A model label is considered an artefact if more than ``threshold_correct`` of its pixels are on the background.
+
+    Args:
+        gt_labels (np.ndarray): ground truth labels
+        model_labels (np.ndarray): model labels
+        threshold_correct (float): fraction of pixels required for a match
+
+    Returns:
+        LabelMatching: the matched, fused, artefact and missed labels
+    """
+    table, gt_ids, model_ids = contingency_table(gt_labels, model_labels)
+    gt_sizes = np.asarray(table.sum(axis=1)).ravel()
+    model_sizes = np.asarray(table.sum(axis=0)).ravel()
+
+    # entries sorted by model label, then ground truth label
+    entries = table.T.tocsr().tocoo()
+    model_index, gt_index, overlap = entries.row, entries.col, entries.data
+    on_object = model_index > 0
+    model_index, gt_index, overlap = (
+        model_index[on_object],
+        gt_index[on_object],
+        overlap[on_object],
+    )
+    true_positive_ratio_model = overlap / model_sizes[model_index]
+
+    background = gt_index == 0
+    artefact = background & (true_positive_ratio_model > threshold_correct)
+    artefacts = pd.DataFrame(
+        {
+            "model_label": model_ids[model_index[artefact]],
+            "ratio_false_pixel": true_positive_ratio_model[artefact],
+        },
+        columns=ARTEFACT_COLUMNS,
+    )
+
+    ratio_pixel_found = overlap / np.maximum(gt_sizes[gt_index], 1)
+    match = ~background & (ratio_pixel_found > threshold_correct)
+    model_index, gt_index, overlap = (
+        model_index[match],
+        gt_index[match],
+        overlap[match],
+    )
+    matches = pd.DataFrame(
+        {
+            "model_label": model_ids[model_index],
+            "gt_label": gt_ids[gt_index],
+            "ratio_pixel_found": ratio_pixel_found[match],
+            "true_positive_ratio_model": true_positive_ratio_model[match],
+            "iou": overlap
+            / (gt_sizes[gt_index] + model_sizes[model_index] - overlap),
+        },
+        columns=MATCH_COLUMNS,
+    )
+    # model labels matching several ground truth labels are fused
+    matches_per_model_label = np.bincount(
+        model_index, minlength=model_ids.size
+    )
+    fused = matches_per_model_label[model_index] > 1
+    # for fused labels, the true positive ratio accounts for all ground truth labels
+    fused_pixels = np.bincount(
+        model_index, weights=overlap, minlength=model_ids.size
+    )
+    matches.loc[fused, "true_positive_ratio_model"] = (
+        fused_pixels[model_index[fused]] / model_sizes[model_index[fused]]
+    )
+
+    matched = np.zeros(gt_ids.size, dtype=bool)
+    matched[gt_index] = True
+    matched[0] = True
+    return LabelMatching(
+        found=matches[~fused].reset_index(drop=True),
+        fused=matches[fused].reset_index(drop=True),
+        artefacts=artefacts,
+        missed=gt_ids[~matched],
+        number_gt_labels=gt_ids.size - 1,
+        number_model_labels=model_ids.size - 1,
+        number_gt_values=int(np.count_nonzero(gt_sizes)),
+    )
+
+
+def _mean(values) -> float:
+    return float(np.mean(values)) if len(values) > 0 else np.nan
+
+
+@dataclass
+class EvaluationResults:
+    """Metrics describing how well model labels match ground truth labels.
+
+    See :py:func:`evaluate_model_performance` for details.
+    """
+
+    neurons_found: int
+    neurons_fused: int
+    neurons_not_found: int
+    artefacts_found: int
+    mean_true_positive_ratio_model: float
+    mean_ratio_pixel_found: float
+    mean_ratio_pixel_found_fused: float
+    mean_true_positive_ratio_model_fused: float
+    mean_ratio_false_pixel_artefact: float
+    mean_iou_found: float
+    mean_iou_fused: float
+    matching: LabelMatching = field(default=None, repr=False)
+
+    def as_dict(self):
+        """Returns the metrics as a dict, without the matching."""
+        results = asdict(self)
+        results.pop("matching")
+        return results
+
+    @classmethod
+    def from_matching(cls, matching: LabelMatching):
+        """Computes the metrics from a :py:class:`LabelMatching`."""
+        return cls(
+            neurons_found=len(matching.found),
+            neurons_fused=len(matching.fused),
+            neurons_not_found=len(matching.missed),
+            artefacts_found=len(matching.artefacts),
+            mean_true_positive_ratio_model=_mean(
+                matching.found["true_positive_ratio_model"]
+            ),
+            mean_ratio_pixel_found=_mean(matching.found["ratio_pixel_found"]),
+            mean_ratio_pixel_found_fused=_mean(
+                matching.fused["ratio_pixel_found"]
+            ),
+            mean_true_positive_ratio_model_fused=_mean(
+                matching.fused["true_positive_ratio_model"]
+            ),
+            mean_ratio_false_pixel_artefact=_mean(
+                matching.artefacts["ratio_false_pixel"]
+            ),
+            mean_iou_found=_mean(matching.found["iou"]),
+            mean_iou_fused=_mean(matching.fused["iou"]),
+            matching=matching,
+        )
+
+
+def evaluate_model_performance(
+    gt_labels,
+    model_labels,
+    threshold_correct=PERCENT_CORRECT,
+    print_details=False,
+) -> EvaluationResults:
+    """Evaluates model labels against ground truth labels.
+
+    Computed metrics :
+
+        * neurons_found : number of ground truth labels individually found by a model label
+        * neurons_fused : number of ground truth labels found by a model label that also found other ground truth labels
+        * neurons_not_found : number of ground truth labels not found by any model label
+        * artefacts_found : number of model labels mostly on the background
+        * mean_true_positive_ratio_model : mean over found labels of (correctly labeled pixels)/(pixels of the model label)
+        * mean_ratio_pixel_found : mean over found labels of (correctly labeled pixels)/(pixels of the true label)
+        * mean_ratio_pixel_found_fused : same as above, for fused labels
+        * mean_true_positive_ratio_model_fused : mean over fused labels of (pixels in any of the fused true labels)/(pixels of the model label)
+        * mean_ratio_false_pixel_artefact : mean over artefacts of (wrongly labeled pixels)/(pixels of the model label)
+        * mean_iou_found, mean_iou_fused : mean intersection over union of found and fused labels with their true label
+
+    Args:
+        gt_labels (np.ndarray): ground truth labels
+        model_labels (np.ndarray): model labels
+        threshold_correct (float): fraction of pixels required for a match, see :py:func:`match_labels`
+        print_details (bool): if True, logs all metrics
+
+    Returns:
+        EvaluationResults: the metrics above, and the underlying :py:class:`LabelMatching`
+    """
+    results = EvaluationResults.from_matching(
+        match_labels(gt_labels, model_labels, threshold_correct)
+    )
+    # as before, percentages are relative to the number of distinct values in the ground truth, background included
+    number_gt_values = max(results.matching.number_gt_values, 1)
+    logger.info(
+        f"Percent of non-fused neurons found: {results.neurons_found / number_gt_values * 100:.2f}%"
+    )
+    logger.info(
+        f"Percent of fused neurons found: {results.neurons_fused / number_gt_values * 100:.2f}%"
+    )
+    logger.info(
+        f"Overall percent of neurons found: {(results.neurons_found + results.neurons_fused) / number_gt_values * 100:.2f}%"
+    )
+    if print_details:
+        for name, value in results.as_dict().items():
+            logger.info(f"{name.replace('_', ' ').capitalize()}: {value}")
+    return results
+
+
+def _get_pairs(gt_path: Path, model_path: Path):
+    if gt_path.is_dir() != model_path.is_dir():
+        raise ValueError(
+            "Ground truth and prediction must both be files or both be folders"
+        )
+    if not gt_path.is_dir():
+        return [(gt_path, model_path)]
+    pattern = {".tif", ".tiff"}
+    gt_files = sorted(p for p in gt_path.glob("*") if p.suffix in pattern)
+    model_files = sorted(
+        p for p in model_path.glob("*") if p.suffix in pattern
+    )
+    if len(gt_files) != len(model_files):
+        raise ValueError(
+            f"Found {len(gt_files)} ground truth files but {len(model_files)} predictions"
+        )
+    return list(zip(gt_files, model_files))
+
+
+def main(argv=None):
+    """Command-line entry point, see ``cellseg3d-evaluate --help``."""
+    parser = argparse.ArgumentParser(
+        prog="cellseg3d-evaluate",
+        description="Evaluates instance labels against ground truth labels. "
+        "If folders are given, files are paired in alphabetical order.",
+    )
+    parser.add_argument(
+        "ground_truth", help="ground truth labels (file or folder)"
+    )
+    parser.add_argument("prediction", help="model labels (file or folder)")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=PERCENT_CORRECT,
+        help="fraction of pixels required for a match (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--csv", help="path of a csv file to save the metrics to"
+    )
+    parser.add_argument(
+        "--objects-csv",
+        help="path of a csv file to save the per-object matches to",
+    )
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    rows = []
+    objects = []
+    for gt_path, model_path in _get_pairs(
+        Path(args.ground_truth), Path(args.prediction)
+    ):
+        logger.info(f"Evaluating {model_path.name} against {gt_path.name}")
+        results = evaluate_model_performance(
+            imread(str(gt_path)),
+            imread(str(model_path)),
+            threshold_correct=args.threshold,
+            print_details=True,
+        )
+        rows.append(
+            {
+                "ground_truth": str(gt_path),
+                "prediction": str(model_path),
+                **results.as_dict(),
+            }
+        )
+        for status in ["found", "fused"]:
+            matches = getattr(results.matching, status).assign(
+                prediction=str(model_path), status=status
+            )
+            objects.append(matches)
+
+    if args.csv is not None:
+        pd.DataFrame(rows).to_csv(args.csv, index=False)
+        logger.info(f"Saved metrics to {args.csv}")
+    if args.objects_csv is not None:
+        pd.concat(objects).to_csv(args.objects_csv, index=False)
+        logger.info(f"Saved matches to {args.objects_csv}")
+    return rows
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,469 @@
+"""Batch inference without napari or Qt.
+
+Runs the same pipeline as the inference plugin (model loading, sliding window inference,
+post-processing, instance segmentation and stats) on a folder or glob of volumes, from a JSON config file.
+Volumes can be in any format of :py:mod:`napari_cellseg3d.readers` (TIFF, Zarr, N5, HDF5, .npy).
+Results are named after each input file, so that an interrupted run can be resumed :
+files whose results all exist already are skipped, unless ``--overwrite`` is given.
+Each result is written to a temporary file first and then renamed, so a partially written file is never mistaken for a result.
+
+A ``run_summary.json`` file is written to the results folder, with the status, outputs and per-stage timings of every file.
+
+Can be run from the command line, e.g. :
+
+.. code-block:: bash
+
+    cellseg3d-infer config.json --inputs "volumes/*.tif" --results-path results
+
+Example config file :
+
+.. code-block:: json
+
+    {
+        "inputs": "volumes",
+        "results_path": "results",
+        "device": "cuda:0",
+        "model": {"name": "SwinUNetR", "model_input_size": 64},
+        "weights": null,
+        "sliding_window": {"window_size": 64, "window_overlap": 0.25},
+        "thresholding": 0.5,
+        "zoom": null,
+        "instance": {"method": "Voronoi-Otsu", "parameters": {"spot_sigma": 2}, "workers": 1},
+        "artifact_removal_size": null,
+        "compute_stats": true
+    }
+
+If ``weights`` is null, the pretrained weights of the model are downloaded and used.
+Volumes larger than 512 pixels are segmented in tiles, by ``workers`` processes in parallel (default 1), except with Voronoi-Otsu.
+CRF post-processing is not available in headless mode.
+"""
+import argparse
+import json
+import logging
+import time
+from dataclasses import asdict
+from functools import partial
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import torch
+from monai.inferers import sliding_window_inference
+from monai.transforms import SpatialPad, Zoom
+from tifffile import imwrite
+
+from napari_cellseg3d import config, utils
+from napari_cellseg3d.code_models.instance_segmentation import (
+    CONNECTED_COMP,
+    VORONOI_OTSU,
+    WATERSHED,
+    InstanceMethod,
+    binary_connected,
+    binary_watershed,
+    clear_large_objects,
+    volume_stats,
+    voronoi_otsu,
+)
+from napari_cellseg3d.code_models.workers_utils import (
+    MODEL_CACHE,
+    QUANTILE_CACHE,
+    QuantileNormalization,
+    get_post_process_transforms,
+)
+from napari_cellseg3d.readers import is_supported, open_volume, volume_name
+
+logger = utils.LOGGER
+
+SUMMARY_FILENAME = "run_summary.json"
+INSTANCE_FUNCTIONS = {
+    VORONOI_OTSU: (
+        voronoi_otsu,
+        {"spot_sigma": 2, "outline_sigma": 2, "remove_small_size": 1},
+    ),
+    WATERSHED: (
+        binary_watershed,
+        {
+            "thres_objects": 0.5,
+            "thres_seeding": 0.9,
+            "thres_small": 30,
+            "rem_seed_thres": 3,
+        },
+    ),
+    CONNECTED_COMP: (binary_connected, {"thres": 0.8, "thres_small": 3}),
+}
+"""Instance segmentation functions and their default parameters (same as the plugin), by method name."""
+
+
+def load_config(path=None, **overrides) -> config.HeadlessInferenceConfig:
+    """Reads a headless inference config from a JSON file.
+
+    Args:
+        path (str): path to the JSON file. If None, only ``overrides`` and defaults are used.
+        **overrides: values replacing those of the file, with the same keys. None values are ignored.
+
+    Returns:
+        config.HeadlessInferenceConfig: the config
+    """
+    params = {}
+    if path is not None:
+        with Path(path).open() as f:
+            params = json.load(f)
+    params.update({k: v for k, v in overrides.items() if v is not None})
+    unknown = set(params) - {
+        "inputs",
+        "results_path",
+        "device",
+        "model",
+        "weights",
+        "sliding_window",
+        "thresholding",
+        "zoom",
+        "instance",
+        "artifact_removal_size",
+        "compute_stats",
+        "overwrite",
+    }
+    if len(unknown) > 0:
+        raise ValueError(f"Unknown config keys : {sorted(unknown)}")
+    if params.get("inputs") is None:
+        raise ValueError("No inputs given")
+
+    weights = params.get("weights")
+    instance = params.get("instance") or {}
+    method = instance.get("method")
+    if method is not None and method not in INSTANCE_FUNCTIONS:
+        raise ValueError(
+            f"Unknown instance segmentation method {method}, choose from {list(INSTANCE_FUNCTIONS)}"
+        )
+    thresholding = params.get("thresholding")
+    zoom = params.get("zoom")
+
+    return config.HeadlessInferenceConfig(
+        inputs=str(params["inputs"]),
+        results_path=str(
+            params.get(
+                "results_path", config.HeadlessInferenceConfig.results_path
+            )
+        ),
+        device=params.get("device", "cpu"),
+        model_info=config.ModelInfo(**params.get("model", {})),
+        weights_config=config.WeightsInfo(path=weights, use_custom=True)
+        if weights is not None
+        else config.WeightsInfo(use_pretrained=True),
+        sliding_window_config=config.SlidingWindowConfig(
+            **params.get("sliding_window", {})
+        ),
+        thresholding=config.Thresholding(
+            enabled=thresholding is not None,
+            threshold_value=thresholding
+            if thresholding is not None
+            else config.Thresholding.threshold_value,
+        ),
+        zoom=config.Zoom(enabled=zoom is not None, zoom_values=zoom),
+        instance_method=method,
+        instance_parameters=instance.get("parameters", {}),
+        instance_workers=int(instance.get("workers", 1)),
+        artifact_removal_size=params.get("artifact_removal_size"),
+        compute_stats=bool(params.get("compute_stats", False)),
+        overwrite=bool(params.get("overwrite", False)),
+    )
+
+
+def find_images(inputs) -> list:
+    """Returns the sorted list of files to infer on, from a folder of volumes or a glob pattern."""
+    if Path(inputs).is_dir() and not is_supported(inputs):
+        paths = [p for p in Path(inputs).glob("*") if is_supported(p)]
+    else:
+        pattern = Path(inputs)
+        paths = list(
+            Path(pattern.anchor).glob(str(pattern.relative_to(pattern.anchor)))
+        )
+    return sorted(paths)
+
+
+def get_output_paths(image_path, conf: config.HeadlessInferenceConfig):
+    """Returns the paths of the results for an image, by result type.
+
+    Names only depend on the input file and model, so that finished files can be found again when resuming.
+    """
+    stem = f"{volume_name(image_path)}_{conf.model_info.name}"
+    folder = Path(conf.results_path)
+    outputs = {"semantic": folder / f"{stem}_semantic.tif"}
+    if conf.instance_method is not None:
+        outputs["instance"] = folder / f"{stem}_instance.tif"
+        if conf.compute_stats:
+            outputs["stats"] = folder / f"{stem}_stats.csv"
+    return outputs
+
+
+def _atomic_write(path, write):
+    """Writes a file with ``write(temp_path)``, then renames it to ``path``."""
+    temp_path = path.with_name(f".{path.name}.part")
+    try:
+        write(temp_path)
+        temp_path.replace(path)
+    finally:
+        if temp_path.exists():
+            temp_path.unlink()
+
+
+class HeadlessInference:
+    """Runs inference on files from a :py:class:`~napari_cellseg3d.config.HeadlessInferenceConfig`, without napari or Qt."""
+
+    def __init__(self, conf: config.HeadlessInferenceConfig):
+        """Creates a HeadlessInference runner. The model is loaded on the first call to :py:meth:`run`."""
+        self.config = conf
+        self.model = None
+        self.post_process_transforms = get_post_process_transforms(
+            conf.thresholding
+        )
+
+    def predict(self, volume: np.ndarray, path=None) -> np.ndarray:
+        """Returns the semantic segmentation of a 3D volume.
+
+        Args:
+            volume (np.ndarray): the 3D volume
+            path (str): file the volume was read from, used to cache its quantiles. Optional.
+        """
+        window_config = self.config.sliding_window_config
+        shape = volume.shape
+        inputs = torch.from_numpy(volume.astype(np.float32))[None, None]
+        if window_config.is_enabled():
+            roi_size = [window_config.window_size] * 3
+            overlap = window_config.window_overlap
+        else:
+            roi_size = utils.get_padding_dim(shape)
+            inputs = SpatialPad(spatial_size=roi_size, method="end")(
+                inputs[0]
+            )[None]
+            overlap = 0
+
+        # same clipping values for all windows of the volume
+        normalization = QuantileNormalization(
+            QUANTILE_CACHE.get(volume, path=path)
+        )
+
+        def predictor(x):
+            return self.post_process_transforms(self.model(normalization(x)))
+
+        self.model.eval()
+        with torch.no_grad():
+            outputs = sliding_window_inference(
+                torch.as_tensor(inputs),
+                roi_size=roi_size,
+                sw_batch_size=window_config.sw_batch_size,
+                predictor=predictor,
+                sw_device=self.config.device,
+                device="cpu",
+                overlap=overlap,
+                mode="gaussian",
+                sigma_scale=0.01,
+            )
+        out = outputs[0].detach().cpu().numpy()
+        out = out[(slice(None), *(slice(0, s) for s in shape))]
+        if self.config.zoom.enabled:
+            out = Zoom(
+                zoom=self.config.zoom.zoom_values,
+                keep_size=False,
+                padding_mode="empty",
+            )(out)
+        return np.squeeze(np.array(out).astype(np.float32))
+
+    def instance_segmentation(self, semantic: np.ndarray) -> np.ndarray:
+        """Runs the configured instance segmentation on each channel of the semantic segmentation."""
+        function, defaults = INSTANCE_FUNCTIONS[self.config.instance_method]
+        parameters = {**defaults, **(self.config.instance_parameters or {})}
+        func = partial(function, **parameters)
+        n_workers = (
+            1  # pyclesperanto runs on the GPU
+            if self.config.instance_method == VORONOI_OTSU
+            else self.config.instance_workers
+        )
+        channels = semantic if semantic.ndim == 4 else [semantic]
+        results = []
+        for channel in channels:
+            if self.config.artifact_removal_size is not None:
+                channel = clear_large_objects(
+                    channel, self.config.artifact_removal_size
+                )
+            results.append(
+                InstanceMethod.sliding_window(
+                    channel, func, n_workers=n_workers
+                )
+            )
+        return np.squeeze(np.array(results))
+
+    @staticmethod
+    def stats(instance_labels: np.ndarray) -> pd.DataFrame:
+        """Returns the stats of the instance labels, with a Channel column if there are several channels."""
+        channels = (
+            instance_labels if instance_labels.ndim == 4 else [instance_labels]
+        )
+        frames = []
+        for i, channel in enumerate(channels):
+            stats = volume_stats(channel)
+            if stats is None:
+                continue
+            frame = pd.DataFrame(stats.get_dict())
+            if len(channels) > 1:
+                frame.insert(0, "Channel", i)
+            frames.append(frame)
+        if len(frames) == 0:
+            return pd.DataFrame()
+        return pd.concat(frames, ignore_index=True)
+
+    def process_file(self, image_path) -> dict:
+        """Runs the whole pipeline on one file and saves the results.
+
+        Returns:
+            dict: record of the file with its status ("done", "skipped" or "failed"), outputs, timings in seconds and error if any
+        """
+        outputs = get_output_paths(image_path, self.config)
+        record = {
+            "input": str(image_path),
+            "outputs": {k: str(v) for k, v in outputs.items()},
+            "timings": {},
+        }
+        if not self.config.overwrite and all(
+            p.exists() for p in outputs.values()
+        ):
+            logger.info(f"Skipping {Path(image_path).name}, already done")
+            record["status"] = "skipped"
+            return record
+
+        timings = record["timings"]
+
+        def timed(stage, func, *args):
+            start = time.perf_counter()
+            result = func(*args)
+            timings[stage] = time.perf_counter() - start
+            return result
+
+        try:
+            logger.info(f"Running inference on {Path(image_path).name}")
+            volume = timed(
+                "load", lambda: np.squeeze(np.asarray(open_volume(image_path)))
+            )
+            if volume.ndim != 3:
+                raise ValueError(
+                    f"Data array is not 3-dimensional but {volume.ndim}-dimensional,"
+                    f" please check for extra channel/batch dimensions"
+                )
+            semantic = timed("inference", self.predict, volume, image_path)
+            results = {"semantic": semantic}
+            if self.config.instance_method is not None:
+                results["instance"] = timed(
+                    "instance", self.instance_segmentation, semantic
+                )
+                if self.config.compute_stats:
+                    results["stats"] = timed(
+                        "stats", self.stats, results["instance"]
+                    )
+
+            start = time.perf_counter()
+            Path(self.config.results_path).mkdir(parents=True, exist_ok=True)
+            for name, result in results.items():
+                if isinstance(result, pd.DataFrame):
+                    _atomic_write(
+                        outputs[name],
+                        partial(result.to_csv, index=False),
+                    )
+                else:
+                    _atomic_write(outputs[name], partial(imwrite, data=result))
+            timings["save"] = time.perf_counter() - start
+            record["status"] = "done"
+        except Exception as e:
+            logger.exception(e)
+            record["status"] = "failed"
+            record["error"] = f"{type(e).__name__}: {e}"
+        return record
+
+    def run(self) -> dict:
+        """Runs inference on all input files and writes the run summary to the results folder.
+
+        Returns:
+            dict: the run summary
+        """
+        start = time.perf_counter()
+        images = find_images(self.config.inputs)
+        logger.info(f"Found {len(images)} files to infer on")
+        summary = {
+            "config": asdict(self.config),
+            "model_load_time": 0.0,
+            "files": [],
+        }
+        files = summary["files"]
+        for image_path in images:
+            if self.model is None and (
+                self.config.overwrite
+                or not all(
+                    p.exists()
+                    for p in get_output_paths(image_path, self.config).values()
+                )
+            ):
+                load_start = time.perf_counter()
+                self.model = MODEL_CACHE.get(
+                    self.config.model_info,
+                    self.config.weights_config,
+                    self.config.device,
+                )
+                summary["model_load_time"] = time.perf_counter() - load_start
+            files.append(self.process_file(image_path))
+
+        summary["total_time"] = time.perf_counter() - start
+        for status in ["done", "skipped", "failed"]:
+            summary[status] = sum(f["status"] == status for f in files)
+        Path(self.config.results_path).mkdir(parents=True, exist_ok=True)
+        summary_path = Path(self.config.results_path) / SUMMARY_FILENAME
+        _atomic_write(
+            summary_path,
+            lambda p: p.write_text(json.dumps(summary, indent=4, default=str)),
+        )
+        logger.info(
+            f"Done : {summary['done']} processed, {summary['skipped']} skipped, {summary['failed']} failed."
+            f" Summary saved to {summary_path}"
+        )
+        return summary
+
+
+def main(argv=None):
+    """Command-line entry point, see ``cellseg3d-infer --help``."""
+    parser = argparse.ArgumentParser(
+        prog="cellseg3d-infer",
+        description="Runs inference on a folder or glob of volumes without napari. "
+        "Options given on the command line override those of the config file.",
+    )
+    parser.add_argument("config", nargs="?", help="path of a JSON config file")
+    parser.add_argument("--inputs", help="folder of volumes or glob pattern")
+    parser.add_argument("--results-path", help="folder to save results to")
+    parser.add_argument("--device", help="device to run inference on")
+    parser.add_argument(
+        "--weights",
+        help="path of the weights to use, instead of the pretrained ones",
+    )
+    parser.add_argument(
+        "--overwrite",
+        action="store_true",
+        default=None,
+        help="process all files, even those whose results already exist",
+    )
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    try:
+        conf = load_config(
+            args.config,
+            inputs=args.inputs,
+            results_path=args.results_path,
+            device=args.device,
+            weights=args.weights,
+            overwrite=args.overwrite,
+        )
+    except (OSError, ValueError, TypeError) as e:
+        parser.error(str(e))
+    summary = HeadlessInference(conf).run()
+    return 1 if summary["failed"] > 0 else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -1,22 +1,30 @@
 """Instance segmentation methods for 3D images."""
 import abc
+import itertools
+import multiprocessing
+from collections import deque
 from dataclasses import dataclass
 from functools import partial
-from typing import List
+from typing import TYPE_CHECKING, List
 
 import numpy as np
 import pyclesperanto_prototype as cle
-from qtpy.QtWidgets import QWidget
-from skimage.measure import label, regionprops
+from scipy import ndimage, sparse
+from scipy.sparse.csgraph import connected_components
+from skimage.measure import label
 from skimage.morphology import remove_small_objects
-from skimage.segmentation import watershed
+from skimage.segmentation import relabel_sequential, watershed
 from tifffile import imread
 from tqdm import tqdm
 
 # local
-from napari_cellseg3d import interface as ui
 from napari_cellseg3d.utils import LOGGER as logger
-from napari_cellseg3d.utils import fill_list_in_between, sphericity_axis
+from napari_cellseg3d.utils import process_pool, sphericity_axis
+
+if TYPE_CHECKING:
+    from qtpy.QtWidgets import QWidget
+
+    from napari_cellseg3d import interface as ui
 
 # from skimage.measure import marching_cubes
 # from skimage.measure import mesh_surface_area
@@ -31,6 +39,10 @@ VORONOI_OTSU = "Voronoi-Otsu"
 
 USE_SLIDING_WINDOW = True
 """If True, uses a sliding window to perform instance segmentation to avoid memory issues."""
+TILE_OVERLAP = 32
+"""Number of pixels by which each tile is extended on every side, used to merge labels of objects cut by tile boundaries."""
+TILE_MEMORY_BUDGET = 4 * 2**30
+"""Maximum size in bytes of the tiles and their labels in flight when tiles are segmented in parallel."""
 
 
 class InstanceMethod:
@@ -42,7 +54,7 @@ class InstanceMethod:
         function: callable,
         num_sliders: int,
         num_counters: int,
-        widget_parent: QWidget = None,
+        widget_parent: "QWidget" = None,
     ):
         """Methods for instance segmentation.
 
@@ -56,14 +68,16 @@ class InstanceMethod:
         """
         self.name = name
         self.function = function
-        self.counters: List[ui.DoubleIncrementCounter] = []
-        self.sliders: List[ui.Slider] = []
+        self.counters: List["ui.DoubleIncrementCounter"] = []
+        self.sliders: List["ui.Slider"] = []
         self._setup_widgets(
             num_counters, num_sliders, widget_parent=widget_parent
         )
 
         self.recorded_parameters = {}
         """Stores the parameters when calling self.record_parameters()"""
+        self.n_workers = 1
+        """Number of processes used to segment tiles when USE_SLIDING_WINDOW is True. If None, uses all available CPUs."""
 
     def _setup_widgets(self, num_counters, num_sliders, widget_parent=None):
         """Initializes the needed widgets for the instance segmentation method, adding sliders and counters to the instance segmentation widget.
@@ -73,6 +87,10 @@ class InstanceMethod:
             num_sliders: Number of Slider UI elements needed to set the parameters of the function
             widget_parent: parent for the declared widgets.
         """
+        from napari_cellseg3d import (
+            interface as ui,
+        )
+
         if num_sliders > 0:
             for i in range(num_sliders):
                 widget = f"slider_{i}"
@@ -107,22 +125,8 @@ class InstanceMethod:
         """Runs the method on the image with the parameters set in the widget."""
         raise NotImplementedError()
 
-    def _make_list_from_channels(
-        self, image
-    ):  # TODO(cyril) : adapt to batch dimension (needed ?)
-        if len(image.shape) > 4:
-            raise ValueError(
-                f"Image has {len(image.shape)} dimensions, but should have at most 4 dimensions (CHWD)"
-            )
-        if len(image.shape) < 2:
-            raise ValueError(
-                f"Image has {len(image.shape)} dimensions, but should have at least 2 dimensions (HW)"
-            )
-        if len(image.shape) == 4:
-            image = np.squeeze(image)
-            if len(image.shape) == 4:
-                return [im for im in image]
-        return [image]
+    def _make_list_from_channels(self, image):
+        return _split_channels(image)
 
     def record_parameters(self):
         """Records all the parameters of the instance segmentation method from the current values of the widgets."""
@@ -163,8 +167,30 @@ class InstanceMethod:
             f"and counters ({len(self.counters)})"
         )
 
+        if USE_SLIDING_WINDOW:
+            func = partial(_call_with_parameters, self.function, parameters)
+            return self.sliding_window(image, func, n_workers=self.n_workers)
+
         return self.function(image, *parameters)
 
+    def as_function(self, n_workers=None):
+        """Returns a picklable function running the method with the current parameters of the widgets on each channel of an image.
+
+        Unlike :py:meth:`run_method_on_channels`, the function does not use the widgets, so it can run in worker processes.
+
+        Args:
+            n_workers (int): number of processes used to segment tiles. If None, uses ``self.n_workers``.
+        """
+        parameters = [slider.slider_value for slider in self.sliders] + [
+            counter.value() for counter in self.counters
+        ]
+        return partial(
+            _run_on_channels,
+            self.function,
+            parameters,
+            self.n_workers if n_workers is None else n_workers,
+        )
+
     def run_method_on_channels(self, image):
         """Runs the method on each channel of the image with the parameters set in the widget.
 
@@ -192,80 +218,359 @@ class InstanceMethod:
         return result.squeeze()
 
     @staticmethod
-    def sliding_window(volume, func, patch_size=512, increment_labels=True):
+    def sliding_window(
+        volume,
+        func,
+        patch_size=512,
+        increment_labels=True,
+        n_workers=1,
+    ):
         """Given a volume of dimensions HxWxD, runs the provided function segmentation on the volume using a sliding window of size patch_size.
 
         If the edge has been reached, the patch size is reduced to fit the remaining space.
         The result is a segmentation of the same size as the input volume.
+        See :py:func:`tiled_instance_segmentation` for details.
 
         Args:
             volume (np.array): The volume to segment
             func (callable): Function to use for instance segmentation. Should be a partial function with the parameters already set.
             patch_size (int): The size of the sliding window.
-            increment_labels (bool): If True, increments the labels of each patch by the maximum label of the previous patch.
+            increment_labels (bool): If True, labels are made unique across patches and objects cut by patch boundaries are merged.
+                If False, the labels of each patch are kept as is.
+            n_workers (int): Number of processes to segment patches with. If None, uses all available CPUs,
+                within the memory budget of :py:func:`tiled_instance_segmentation`.
 
         Returns:
             np.array: Instance segmentation labels from
         """
-        result = np.zeros(volume.shape, dtype=np.uint32)
-        max_label_id = 0
-        x, y, z = volume.shape[-3:]
-        pbar_total = (x // patch_size) * (y // patch_size) * (z // patch_size)
-        pbar = tqdm(total=pbar_total)
-        for i in range(0, x, patch_size):
-            for j in range(0, y, patch_size):
-                for k in range(0, z, patch_size):
-                    patch = volume[
-                        i : min(i + patch_size, x),
-                        j : min(j + patch_size, y),
-                        k : min(k + patch_size, z),
-                    ]
-                    patch_result = func(patch)
-                    patch_result = np.array(patch_result)
-                    # make sure labels are unique, only where result is not 0
-                    if increment_labels:
-                        patch_result[patch_result > 0] += max_label_id
-                        max_label_id = np.max(patch_result)
-                    result[
-                        i : min(i + patch_size, x),
-                        j : min(j + patch_size, y),
-                        k : min(k + patch_size, z),
-                    ] = patch_result
-                    pbar.update(1)
-        pbar.close()
+        return tiled_instance_segmentation(
+            volume,
+            func,
+            tile_size=patch_size,
+            tile_overlap=TILE_OVERLAP if increment_labels else 0,
+            n_workers=n_workers,
+            stitch=increment_labels,
+        )
+
+
+def _split_channels(
+    image,
+):  # TODO(cyril) : adapt to batch dimension (needed ?)
+    """Returns the list of channels of a HW, HWD or CHWD image."""
+    if len(image.shape) > 4:
+        raise ValueError(
+            f"Image has {len(image.shape)} dimensions, but should have at most 4 dimensions (CHWD)"
+        )
+    if len(image.shape) < 2:
+        raise ValueError(
+            f"Image has {len(image.shape)} dimensions, but should have at least 2 dimensions (HW)"
+        )
+    if len(image.shape) == 4:
+        image = np.squeeze(image)
+        if len(image.shape) == 4:
+            return [im for im in image]
+    return [image]
+
+
+def _call_with_parameters(function, parameters, image):
+    """Calls function on image with positional parameters, which cannot be bound before the image with partial."""
+    return function(image, *parameters)
+
+
+def _run_on_channels(function, parameters, n_workers, image):
+    """Runs an instance segmentation function with positional parameters on each channel of an image, see :py:meth:`InstanceMethod.as_function`."""
+    results = []
+    for channel in _split_channels(image):
+        if USE_SLIDING_WINDOW:
+            results.append(
+                InstanceMethod.sliding_window(
+                    channel,
+                    partial(_call_with_parameters, function, parameters),
+                    n_workers=n_workers,
+                )
+            )
+        else:
+            results.append(function(channel, *parameters))
+    return np.array(results).squeeze()
+
+
+class UnionFind:
+    """Disjoint-set forest over integer labels, used to merge labels of the same object found in different tiles."""
+
+    def __init__(self, size):
+        """Creates a forest where each label from 0 to size-1 is its own set."""
+        self.parent = np.arange(size, dtype=np.int64)
+
+    def find(self, x):
+        """Returns the root of the set containing x, compressing the path to it."""
+        root = x
+        while self.parent[root] != root:
+            root = self.parent[root]
+        while self.parent[x] != root:
+            self.parent[x], x = root, self.parent[x]
+        return root
+
+    def union(self, a, b):
+        """Merges the sets containing a and b. The smallest label is kept as root."""
+        root_a, root_b = self.find(a), self.find(b)
+        if root_a != root_b:
+            self.parent[max(root_a, root_b)] = min(root_a, root_b)
+
+    def roots(self):
+        """Returns the root of every label, as an array indexed by label."""
+        parent = self.parent
+        while True:
+            grandparent = parent[parent]
+            if np.array_equal(grandparent, parent):
+                return parent
+            parent = grandparent
+
+
+def _segment_tile(func, tile):
+    """Runs func on a tile and returns sequential uint32 labels. Module-level to be usable in worker processes."""
+    labels = np.asarray(func(tile))
+    return relabel_sequential(labels)[0].astype(np.uint32)
+
+
+def _map_tiles(func, volume, tiles, n_workers, max_in_flight):
+    """Yields the segmentation of each tile, in order, keeping at most max_in_flight tiles in flight."""
+    if n_workers == 1 or len(tiles) == 1:
+        for index, (_, halo) in tiles:
+            yield index, _segment_tile(func, np.asarray(volume[halo]))
+        return
+
+    with process_pool(n_workers) as pool:
+        pending = deque()
+        for index, (_, halo) in tiles:
+            pending.append(
+                (
+                    index,
+                    pool.submit(_segment_tile, func, np.asarray(volume[halo])),
+                )
+            )
+            if len(pending) >= max_in_flight:
+                index, future = pending.popleft()
+                yield index, future.result()
+        while pending:
+            index, future = pending.popleft()
+            yield index, future.result()
+
+
+def _intersect(slices_a, slices_b):
+    """Returns the intersection of two tuples of slices, or None if empty."""
+    intersection = tuple(
+        slice(max(a.start, b.start), min(a.stop, b.stop))
+        for a, b in zip(slices_a, slices_b)
+    )
+    if any(s.start >= s.stop for s in intersection):
+        return None
+    return intersection
+
+
+def _relative(slices, origin):
+    """Expresses slices relative to the start of origin slices."""
+    return tuple(
+        slice(s.start - o.start, s.stop - o.start)
+        for s, o in zip(slices, origin)
+    )
+
+
+def _merge_overlapping_labels(union_find, labels_a, labels_b, threshold):
+    """Merges labels from two segmentations of the same region if they overlap by at least threshold of the smallest one."""
+    mask = (labels_a > 0) & (labels_b > 0)
+    if not mask.any():
+        return
+    num_labels = len(union_find.parent)
+    keys, overlaps = np.unique(
+        labels_a[mask].astype(np.int64) * num_labels + labels_b[mask],
+        return_counts=True,
+    )
+    pairs_a, pairs_b = np.divmod(keys, num_labels)
+    ids_a, sizes_a = np.unique(labels_a[labels_a > 0], return_counts=True)
+    ids_b, sizes_b = np.unique(labels_b[labels_b > 0], return_counts=True)
+    smallest = np.minimum(
+        sizes_a[np.searchsorted(ids_a, pairs_a)],
+        sizes_b[np.searchsorted(ids_b, pairs_b)],
+    )
+    merged = overlaps >= threshold * smallest
+    for label_a, label_b in zip(pairs_a[merged], pairs_b[merged]):
+        union_find.union(label_a, label_b)
+
+
+def tiled_instance_segmentation(
+    volume,
+    func,
+    tile_size=512,
+    tile_overlap=TILE_OVERLAP,
+    n_workers=1,
+    stitch=True,
+    merge_threshold=0.5,
+    memory_budget=TILE_MEMORY_BUDGET,
+):
+    """Runs an instance segmentation function on overlapping tiles in parallel, then merges labels across tile boundaries.
+
+    The volume is split in non-overlapping tiles, each extended by ``tile_overlap`` pixels on every side.
+    Tiles are segmented in a process pool; each tile writes its labels for its own region to the result.
+    Up to two tiles per process are sent ahead, as long as they fit in ``memory_budget`` with their labels,
+    so fewer processes are used for large tiles.
+    Where the extension of a tile covers a neighbouring tile, both segmentations are compared, and labels overlapping
+    by at least ``merge_threshold`` of the smallest of the two are merged using union-find.
+    Objects cut by a tile boundary therefore get a single label, while distinct touching objects are kept separate.
+
+    Args:
+        volume (np.ndarray): 3D volume to segment
+        func (callable): instance segmentation function, e.g. a partial of :py:func:`binary_watershed`. Must be picklable to use several workers.
+        tile_size (int): size of the tiles
+        tile_overlap (int): number of pixels by which tiles are extended on each side. Must be smaller than tile_size.
+        n_workers (int): maximum number of processes to use. If None, uses all available CPUs. If 1, runs in the current process.
+        stitch (bool): if False, labels of each tile are written as is, without making them unique or merging them
+        merge_threshold (float): fraction of the smallest of two labels that must overlap for them to be merged
+        memory_budget (int): maximum size in bytes of the tiles and their labels in flight
+
+    Returns:
+        np.ndarray: instance labels of the same shape as the volume
+    """
+    if tile_overlap >= tile_size:
+        raise ValueError(
+            f"Tile overlap ({tile_overlap}) must be smaller than tile size ({tile_size})"
+        )
+    shape = volume.shape[-3:]
+    n_workers = (
+        n_workers if n_workers is not None else multiprocessing.cpu_count()
+    )
+
+    grid = [range(0, size, tile_size) for size in shape]
+    tiles = {}
+    for index in itertools.product(*[range(len(g)) for g in grid]):
+        starts = [grid[d][i] for d, i in enumerate(index)]
+        core = tuple(
+            slice(start, min(start + tile_size, size))
+            for start, size in zip(starts, shape)
+        )
+        halo = tuple(
+            slice(
+                max(s.start - tile_overlap, 0),
+                min(s.stop + tile_overlap, size),
+            )
+            for s, size in zip(core, shape)
+        )
+        tiles[index] = (core, halo)
+
+    # each tile in flight holds its data and its uint32 labels
+    tile_bytes = max(
+        int(np.prod([s.stop - s.start for s in halo]))
+        for _, halo in tiles.values()
+    ) * (np.dtype(volume.dtype).itemsize + 4)
+    max_in_flight = max(1, min(2 * n_workers, memory_budget // tile_bytes))
+    if max_in_flight < n_workers:
+        logger.debug(
+            f"Segmenting {max_in_flight} tiles at once instead of {n_workers} to fit in the memory budget"
+        )
+        n_workers = max_in_flight
+
+    result = np.zeros(shape, dtype=np.uint32)
+    bands = []
+    max_label_id = 0
+    pbar = tqdm(total=len(tiles))
+    for index, labels in _map_tiles(
+        func, volume, list(tiles.items()), n_workers, max_in_flight
+    ):
+        core, halo = tiles[index]
+        if stitch:
+            num_labels = int(labels.max())
+            labels[labels > 0] += max_label_id
+            max_label_id += num_labels
+            for offset in itertools.product((-1, 0, 1), repeat=3):
+                neighbour = tuple(i + o for i, o in zip(index, offset))
+                if neighbour == index or neighbour not in tiles:
+                    continue
+                band = _intersect(halo, tiles[neighbour][0])
+                if band is not None:
+                    bands.append((band, labels[_relative(band, halo)].copy()))
+        result[core] = labels[_relative(core, halo)]
+        pbar.update(1)
+    pbar.close()
+
+    if not stitch or max_label_id == 0:
         return result
 
+    union_find = UnionFind(max_label_id + 1)
+    for band, labels in bands:
+        _merge_overlapping_labels(
+            union_find, result[band], labels, merge_threshold
+        )
+    _, lookup = np.unique(union_find.roots(), return_inverse=True)
+    lookup = lookup.astype(np.uint32)
+    for core, _ in tiles.values():
+        result[core] = lookup[result[core]]
+    return result
+
 
 @dataclass
 class ImageStats:
-    """Dataclass containing various statistics from instance labels."""
-
-    volume: List[float]
-    centroid_x: List[float]
-    centroid_y: List[float]
-    centroid_z: List[float]
-    sphericity_ax: List[float]
-    image_size: List[int]
-    total_image_volume: int
-    total_filled_volume: int
+    """Dataclass containing various statistics from instance labels.
+
+    Per-object statistics are stored as arrays with one entry per label, in increasing label order.
+    Image-wide statistics are stored as scalars.
+    Volumes, centroids and axis lengths are in physical units, i.e. scaled by the voxel spacing.
+    """
+
+    labels: np.ndarray
+    voxel_count: np.ndarray
+    volume: np.ndarray
+    centroid_x: np.ndarray
+    centroid_y: np.ndarray
+    centroid_z: np.ndarray
+    axis_major_length: np.ndarray
+    axis_minor_length: np.ndarray
+    sphericity_ax: np.ndarray
+    image_size: tuple
+    total_image_volume: float
+    total_filled_volume: float
     filling_ratio: float
     number_objects: int
+    voxel_volume: float = 1.0
 
     def get_dict(self):
-        """Returns a dict containing the statistics."""
-        return {
-            "Volume": self.volume,
+        """Returns a dict of columns containing the statistics.
+
+        Volumes are given in pixels. If the voxel spacing is not 1, the volumes in physical units
+        are added in separate columns.
+        Image-wide statistics are only written in the first row, the following rows are left empty.
+        """
+
+        def first_row(value):
+            column = np.full(self.number_objects, "", dtype=object)
+            column[0] = value
+            return column
+
+        stats = {
+            "Label": self.labels,
+            "Volume": self.voxel_count,
             "Centroid x": self.centroid_x,
             "Centroid y": self.centroid_y,
             "Centroid z": self.centroid_z,
+            "Axis major length": self.axis_major_length,
+            "Axis minor length": self.axis_minor_length,
             # "Sphericity (volume/area)": sphericity_va,
             "Sphericity (axes)": self.sphericity_ax,
-            "Image size": self.image_size,
-            "Total image volume": self.total_image_volume,
-            "Total object volume (pixels)": self.total_filled_volume,
-            "Filling ratio": self.filling_ratio,
-            "Number objects": self.number_objects,
+            "Image size": first_row(self.image_size),
+            "Total image volume": first_row(int(np.prod(self.image_size))),
+            "Total object volume (pixels)": first_row(
+                int(self.voxel_count.sum())
+            ),
+            "Filling ratio": first_row(self.filling_ratio),
+            "Number objects": first_row(self.number_objects),
         }
+        if self.voxel_volume != 1.0:
+            stats["Volume (physical units)"] = self.volume
+            stats["Total image volume (physical units)"] = first_row(
+                self.total_image_volume
+            )
+            stats["Total object volume (physical units)"] = first_row(
+                self.total_filled_volume
+            )
+        return stats
 
 
 def threshold(volume, thresh):
@@ -369,44 +674,145 @@ def binary_watershed(
     return np.array(segm)
 
 
+def _seam_pairs(labels, image, axis, position):
+    """Returns the pairs of labels in contact across the plane between ``position - 1`` and ``position`` along ``axis``.
+
+    Voxels are in contact if they are neighbours with full connectivity (including diagonals) and have the same value in ``image``.
+    """
+    labels_a = np.take(labels, position - 1, axis=axis)
+    labels_b = np.take(labels, position, axis=axis)
+    values_a = np.take(image, position - 1, axis=axis)
+    values_b = np.take(image, position, axis=axis)
+    pairs = []
+    for offsets in itertools.product((-1, 0, 1), repeat=labels_a.ndim):
+        slices_a = tuple(
+            slice(max(-o, 0), n - max(o, 0))
+            for o, n in zip(offsets, labels_a.shape)
+        )
+        slices_b = tuple(
+            slice(max(o, 0), n - max(-o, 0))
+            for o, n in zip(offsets, labels_a.shape)
+        )
+        a = labels_a[slices_a]
+        b = labels_b[slices_b]
+        touching = (
+            (a > 0) & (b > 0) & (values_a[slices_a] == values_b[slices_b])
+        )
+        pairs.append(np.stack([a[touching], b[touching]]))
+    return np.concatenate(pairs, axis=1)
+
+
+def _label_tile(tile):
+    """Labels connected regions of a tile with full connectivity. Boolean tiles are labeled with scipy, which uses int32 labels."""
+    if tile.dtype == bool:
+        structure = np.ones((3,) * tile.ndim, dtype=bool)
+        return ndimage.label(tile, structure)
+    return label(tile, connectivity=tile.ndim, return_num=True)
+
+
+def label_components(image, tile_size=None):
+    """Labels connected regions of an image, with full connectivity, on the whole volume or tile by tile.
+
+    Neighbouring voxels belong to the same region if they have the same non-zero value, as in :py:func:`skimage.measure.label`.
+    With tiles, each tile is labeled separately, then regions in contact across tile boundaries are merged,
+    so that the result is the same as labeling the whole volume at once.
+
+    Args:
+        image (np.ndarray): boolean mask or integer labels
+        tile_size (int): size of the tiles. If None, the whole volume is labeled at once.
+
+    Returns:
+        (np.ndarray, int): labels of the regions, numbered from 1, and number of regions
+    """
+    image = np.asarray(image)
+    if tile_size is None or all(s <= tile_size for s in image.shape):
+        return _label_tile(image)
+
+    grid = [range(0, size, tile_size) for size in image.shape]
+    labels = np.zeros(
+        image.shape, dtype=np.int32 if image.size < 2**31 else np.int64
+    )
+    num_labels = 0
+    for starts in itertools.product(*grid):
+        core = tuple(
+            slice(start, min(start + tile_size, size))
+            for start, size in zip(starts, image.shape)
+        )
+        tile_labels, num = _label_tile(image[core])
+        tile_labels[tile_labels > 0] += num_labels
+        labels[core] = tile_labels
+        num_labels += num
+
+    pairs = [
+        _seam_pairs(labels, image, axis, position)
+        for axis, starts in enumerate(grid)
+        for position in starts[1:]
+    ]
+    pairs = np.concatenate(pairs, axis=1) if pairs else np.zeros((2, 0))
+    if pairs.shape[1] == 0:
+        return labels, num_labels
+    graph = sparse.coo_matrix(
+        (np.ones(pairs.shape[1], dtype=bool), (pairs[0], pairs[1])),
+        shape=(num_labels + 1,) * 2,
+    )
+    # the background is never paired, so it stays alone in component 0
+    num_components, lookup = connected_components(graph, directed=False)
+    return lookup.astype(labels.dtype)[labels], num_components - 1
+
+
+def filter_components_by_size(
+    image, min_size=None, max_size=None, tile_size=None
+):
+    """Labels connected regions of an image and removes those whose size is outside [min_size, max_size).
+
+    Sizes are counted with a single ``np.bincount`` over the labels, and regions are removed with a lookup table.
+
+    Args:
+        image (np.ndarray): boolean mask or integer labels, see :py:func:`label_components`
+        min_size (int): regions smaller than this are removed. If None, no lower bound.
+        max_size (int): regions of this size or larger are removed. If None, no upper bound.
+        tile_size (int): if set, the image is labeled tile by tile, see :py:func:`label_components`
+
+    Returns:
+        (np.ndarray, int): labels of the kept regions (not sequential), and number of removed regions
+    """
+    labels, num_labels = label_components(image, tile_size)
+    sizes = np.bincount(labels.ravel(), minlength=num_labels + 1)
+    keep = np.ones(num_labels + 1, dtype=bool)
+    if min_size is not None:
+        keep &= sizes >= min_size
+    if max_size is not None:
+        keep &= sizes < max_size
+    keep[0] = False
+    lookup = np.where(keep, np.arange(num_labels + 1), 0).astype(labels.dtype)
+    return lookup[labels], int(num_labels - np.count_nonzero(keep))
+
+
 def clear_large_objects(image, large_label_size=200, use_window=True):
-    """Uses watershed to label all obejcts, and removes the ones with a volume larger than the specified threshold.
+    """Labels all connected objects, and removes the ones with a volume larger than the specified threshold.
 
     This is intended for artifact removal, and should not be used for instance segmentation.
 
     Args:
         image: array containing the image
         large_label_size:  size threshold for removal of objects in pixels. E.g. if 10, all objects larger than 10 pixels as a whole will be removed.
-        use_window: if True, will use a sliding window to perform instance segmentation to avoid memory issues. Default : True
+        use_window: if True, labels the image in tiles to limit memory use. Objects crossing tiles are still measured as a whole. Default : True
 
     Returns:
         array: The image with large objects removed
     """
-    if use_window:
-        func = partial(
-            binary_watershed,
-            thres_objects=0,
-            thres_seeding=0,
-            thres_small=large_label_size,
-            rem_seed_thres=0,
-        )
-        res = InstanceMethod.sliding_window(
-            image, func, increment_labels=False
-        )
-        return np.where(res > 0, 0, image)
-
-    labeled = binary_watershed(
-        image,
-        thres_objects=0,
-        thres_seeding=0,
-        thres_small=large_label_size,
-        rem_seed_thres=0,
+    image = np.asarray(image)
+    kept, removed = filter_components_by_size(
+        image > 0,
+        max_size=large_label_size,
+        tile_size=512 if use_window else None,
     )
-    return np.where(labeled > 0, 0, image)
+    logger.debug(f"Removed {removed} objects larger than {large_label_size}")
+    return np.where(kept > 0, image, 0)
 
 
 def clear_small_objects(image, threshold, is_file_path=False):
-    """Calls skimage.remove_small_objects to remove small fragments that might be artifacts.
+    """Removes small fragments that might be artifacts.
 
     Args:
         image: array containing the image
@@ -419,17 +825,10 @@ def clear_small_objects(image, threshold, is_file_path=False):
     if is_file_path:
         image = imread(image)
 
-    # print(threshold)
+    result, removed = filter_components_by_size(image, min_size=threshold)
 
-    labeled = label(image)
-
-    result = remove_small_objects(labeled, threshold)
-
-    # print(np.sum(labeled))
-    # print(np.sum(result))
-
-    if np.sum(labeled) == np.sum(result):
-        print("Warning : no objects were removed")
+    if removed == 0:
+        logger.warning("No objects were removed")
 
     if np.amax(image) == 1:
         result = to_semantic(result)
@@ -455,54 +854,92 @@ def to_semantic(image, is_file_path=False):
     return image.astype(np.uint16)
 
 
-def volume_stats(volume_image):
-    """Computes various statistics from instance labels and returns them in a dict.
+def volume_stats(volume_image, spacing=(1.0, 1.0, 1.0)):
+    """Computes various statistics from instance labels and returns them in an :py:class:`ImageStats`.
+
+    All per-object statistics are computed at once from the moments of each label,
+    accumulated with ``np.bincount`` over the labeled voxels.
 
     Currently provided :
 
-        * "Volume": volume of each object
+        * "Label": label of each object
+        * "Volume": volume of each object, in pixels
         * "Centroid": x,y,z centroid coordinates for each object
+        * "Axis major/minor length": length of the longest and shortest axes of the ellipsoid with the same second moments as each object
         * "Sphericity (axes)": sphericity computed from semi-minor and semi-major axes
         * "Image size": size of the image
-        * "Total image volume": volume in pixels of the whole image
-        * "Total object volume (pixels)": total labeled volume in pixels
-        * "Filling ratio": ratio of labeled over total pixel volume
+        * "Total image volume": volume of the whole image
+        * "Total object volume (pixels)": total labeled volume
+        * "Filling ratio": ratio of labeled over total volume
         * "Number objects": total number of unique labeled objects
 
     Args:
         volume_image: instance labels image
+        spacing (tuple): physical size of a voxel along each axis. Volumes, centroids and axis lengths are scaled accordingly,
+            volumes in pixels are kept in separate columns.
 
     Returns:
-        dict: Statistics described above
+        ImageStats: Statistics described above, or None if the image is empty
     """
+    volume_image = np.asarray(volume_image)
+    if volume_image.ndim != 3:
+        raise ValueError(
+            f"Labels must be 3-dimensional, got {volume_image.ndim} dimensions"
+        )
     # check if empty or all 0
-    if np.sum(volume_image) == 0:
+    if not np.any(volume_image):
         logger.debug("Skipped empty label image")
         return None
 
-    properties = regionprops(volume_image)
-
-    def sphericity(region):
-        try:
-            return sphericity_axis(
-                region.axis_major_length * 0.5, region.axis_minor_length * 0.5
-            )
-        except ValueError:
-            return (
-                np.nan
-            )  # FIXME better way ? inconsistent errors in region.axis_minor_length
-
-    sphericities = []
-    nan_errors_count = 0
-    for region in properties:
-        sphericity_ax = sphericity(region)
-        if sphericity_axis is None:
-            sphericity_ax = np.nan
-            nan_errors_count += 1
-        sphericities.append(sphericity_ax)
-    logger.warning(
-        f"{nan_errors_count} invalid sphericities were set to NaN. This occurs for objects with a volume of 1 pixel."
+    spacing = np.asarray(spacing, dtype=np.float64)
+    foreground = np.flatnonzero(volume_image)
+    values = volume_image.ravel()[foreground]
+    # use bincount directly on the labels if they are reasonably compact, otherwise remap them first
+    if values.max() <= 4 * values.size:
+        index = values.astype(np.intp)
+        counts = np.bincount(index)
+        labels = np.flatnonzero(counts)
+    else:
+        labels, index = np.unique(values, return_inverse=True)
+        counts = np.bincount(index)
+    counts = counts.astype(np.float64)
+
+    coordinates = np.unravel_index(foreground, volume_image.shape)
+    first_moments = [
+        np.bincount(index, weights=coordinate, minlength=counts.size)
+        for coordinate in coordinates
+    ]
+    second_moments = np.empty((counts.size, 3, 3))
+    for a, b in itertools.combinations_with_replacement(range(3), 2):
+        second_moments[:, a, b] = second_moments[:, b, a] = np.bincount(
+            index,
+            weights=coordinates[a] * coordinates[b].astype(np.float64),
+            minlength=counts.size,
+        )
+    if labels.size < counts.size:  # compact labels : drop absent ones
+        counts = counts[labels]
+        first_moments = [m[labels] for m in first_moments]
+        second_moments = second_moments[labels]
+
+    centroids = np.stack(first_moments, axis=1) / counts[:, None]
+    covariance = second_moments / counts[:, None, None] - (
+        centroids[:, :, None] * centroids[:, None, :]
     )
+    covariance *= spacing[:, None] * spacing[None, :]
+    centroids *= spacing
+    # same definition as skimage.measure.regionprops
+    eigenvalues = np.clip(np.linalg.eigvalsh(covariance), 0, None)
+    axis_major_length = np.sqrt(20 * eigenvalues[:, -1])
+    axis_minor_length = np.sqrt(20 * eigenvalues[:, 0])
+
+    sphericities = sphericity_axis(
+        axis_major_length * 0.5, axis_minor_length * 0.5
+    )
+    nan_errors_count = int(np.isnan(sphericities).sum())
+    if nan_errors_count > 0:
+        logger.warning(
+            f"{nan_errors_count} invalid sphericities were set to NaN. This occurs for objects with a volume of 1 pixel."
+        )
     # for region in properties:
     # object = (volume_image == region.label).transpose(1, 2, 0)
     # verts, faces, _, values = marching_cubes(
@@ -513,27 +950,26 @@ def volume_stats(volume_image):
     #     sphericity_volume_area(region.area, surface_area_pixels)
     # )
 
-    volume = [region.area for region in properties]
-
-    fill = partial(fill_list_in_between, n=len(properties) - 1, fill_value="")
-
-    if len(volume_image.flatten()) != 0:
-        ratio = fill([np.sum(volume) / len(volume_image.flatten())])
-    else:
-        ratio = [0]
-        ratio = fill(ratio)
+    voxel_volume = float(np.prod(spacing))
+    total_image_volume = volume_image.size * voxel_volume
+    total_filled_volume = foreground.size * voxel_volume
 
     return ImageStats(
-        volume,
-        [region.centroid[0] for region in properties],
-        [region.centroid[1] for region in properties],
-        [region.centroid[2] for region in properties],
-        sphericities,
-        fill([volume_image.shape]),
-        fill([len(volume_image.flatten())]),
-        fill([np.sum(volume)]),
-        ratio,
-        fill([len(properties)]),
+        labels=labels,
+        voxel_count=counts.astype(np.int64),
+        volume=counts * voxel_volume,
+        centroid_x=centroids[:, 0],
+        centroid_y=centroids[:, 1],
+        centroid_z=centroids[:, 2],
+        axis_major_length=axis_major_length,
+        axis_minor_length=axis_minor_length,
+        sphericity_ax=sphericities,
+        image_size=volume_image.shape,
+        total_image_volume=total_image_volume,
+        total_filled_volume=total_filled_volume,
+        filling_ratio=total_filled_volume / total_image_volume,
+        number_objects=int(labels.size),
+        voxel_volume=voxel_volume,
     )
 
 
@@ -627,7 +1063,7 @@ class Watershed(InstanceMethod):
                 thres_small=self.counters[0].value(),
                 rem_seed_thres=self.counters[1].value(),
             )
-            return self.sliding_window(image, func)
+            return self.sliding_window(image, func, n_workers=self.n_workers)
 
         return self.function(
             image,
@@ -695,7 +1131,7 @@ class ConnectedComponents(InstanceMethod):
                 thres=self.sliders[0].slider_value,
                 thres_small=self.counters[0].value(),
             )
-            return self.sliding_window(image, func)
+            return self.sliding_window(image, func, n_workers=self.n_workers)
 
         return self.function(
             image, self.sliders[0].slider_value, self.counters[0].value()
@@ -735,6 +1171,8 @@ class VoronoiOtsu(InstanceMethod):
         )
         self.counters[2].setValue(1)
 
+        self.n_workers = 1  # pyclesperanto runs on the GPU, tiles are not segmented in parallel
+
     @property
     def spot_sigma(self):
         """Returns the value of the spot sigma counter."""
@@ -777,7 +1215,7 @@ class VoronoiOtsu(InstanceMethod):
                 outline_sigma=self.counters[1].value(),
                 remove_small_size=self.counters[2].value(),
             )
-            return self.sliding_window(image, func)
+            return self.sliding_window(image, func, n_workers=self.n_workers)
 
         return self.function(
             image,
@@ -787,77 +1225,6 @@ class VoronoiOtsu(InstanceMethod):
         )
 
 
-class InstanceWidgets(QWidget):
-    """Base widget with several sliders, for use in instance segmentation parameters."""
-
-    def __init__(self, parent=None):
-        """Creates an InstanceWidgets widget.
-
-        Args:
-            parent: parent widget
-
-        """
-        super().__init__(parent)
-        self.method_choice = ui.DropdownMenu(
-            list(INSTANCE_SEGMENTATION_METHOD_LIST.keys())
-        )
-        self.methods = {}
-        """Contains the instance of the method, with its name as key"""
-        self.instance_widgets = {}
-        """Contains the lists of widgets for each methods, to show/hide"""
-
-        self.method_choice.currentTextChanged.connect(self._set_visibility)
-        self._build()
-
-    def _build(self):
-        group = ui.GroupedWidget("Instance segmentation")
-        group.layout.addWidget(self.method_choice)
-
-        try:
-            for name, method in INSTANCE_SEGMENTATION_METHOD_LIST.items():
-                method_class = method(widget_parent=self.parent())
-                self.methods[name] = method_class
-                self.instance_widgets[name] = []
-                # moderately unsafe way to init those widgets ?
-                if len(method_class.sliders) > 0:
-                    for slider in method_class.sliders:
-                        group.layout.addWidget(slider.container)
-                        self.instance_widgets[name].append(slider)
-                if len(method_class.counters) > 0:
-                    for counter in method_class.counters:
-                        group.layout.addWidget(counter.label)
-                        group.layout.addWidget(counter)
-                        self.instance_widgets[name].append(counter)
-        except RuntimeError as e:
-            logger.debug(
-                f"Caught runtime error {e}, most likely during testing"
-            )
-
-        self.setLayout(group.layout)
-        self._set_visibility()
-
-    def _set_visibility(self):
-        for name in self.instance_widgets:
-            if name != self.method_choice.currentText():
-                for widget in self.instance_widgets[name]:
-                    widget.set_visibility(False)
-            else:
-                for widget in self.instance_widgets[name]:
-                    widget.set_visibility(True)
-
-    def run_method(self, volume):
-        """Calls instance function with chosen parameters.
-
-        Args:
-            volume: image data to run method on
-
-        Returns: processed image from self._method
-
-        """
-        method = self.methods[self.method_choice.currentText()]
-        return method.run_method_on_channels(volume)
-
-
 INSTANCE_SEGMENTATION_METHOD_LIST = {
     VORONOI_OTSU: VoronoiOtsu,
     WATERSHED: Watershed,
@@ -0,0 +1,242 @@
+"""Semantic evaluation of predicted labels against ground truth labels, as used by the Metrics plugin.
+
+All overlap metrics (Dice, IoU, precision, recall) derive from three counts : the foreground sizes of both volumes,
+which do not depend on orientation, and their intersection, which is counted for every orientation candidate
+in the same pass over the ground truth. Candidates are strided views of the prediction (rotations and flips),
+so no rotated copy is made, and the pass runs over slabs of Z slices so temporaries stay small.
+Surface-distance metrics (95th percentile Hausdorff distance and average symmetric surface distance)
+require two distance transforms of the whole volume, so they are only computed if requested, for the best orientation.
+
+File pairs are evaluated in parallel processes, and results are yielded as they finish.
+"""
+import csv
+from concurrent.futures import as_completed
+from pathlib import Path
+
+import numpy as np
+from napari.qt.threading import GeneratorWorker
+from scipy import ndimage
+from tifffile import imread
+
+from napari_cellseg3d.utils import LOGGER as logger
+from napari_cellseg3d.utils import process_pool
+
+ORIENTATIONS = [
+    (rotation, flip)
+    for rotation in [None, (0, 1), (1, 2), (0, 2)]
+    for flip in [(), (0, 1, 2), (0,), (1,), (2,)]
+]
+"""Orientation candidates tried to find the best orientation of the prediction,
+as (axes of a 90 degree rotation or None, flipped axes)."""
+METRICS_COLUMNS = [
+    "ground_truth",
+    "prediction",
+    "dice",
+    "iou",
+    "precision",
+    "recall",
+    "hausdorff_95",
+    "mean_surface_distance",
+    "orientation",
+]
+"""Columns of the metrics csv file."""
+
+
+def orient(volume, orientation):
+    """Returns a view of the volume rotated and flipped according to an orientation of :py:data:`ORIENTATIONS`."""
+    rotation, flip = orientation
+    if rotation is not None:
+        volume = np.rot90(volume, axes=rotation)
+    return np.flip(volume, axis=flip) if flip else volume
+
+
+def pad_to_shape(volume, shape):
+    """Pads a volume with zeros on both sides to the given shape, like MONAI's SpatialPad."""
+    padding = [
+        ((s - v) // 2, s - v - (s - v) // 2)
+        for s, v in zip(shape, volume.shape)
+    ]
+    return np.pad(volume, padding)
+
+
+def orientation_overlaps(ground, pred, orientations, slab_size=16):
+    """Counts the overlap between the ground truth and each orientation of the prediction.
+
+    Args:
+        ground (np.ndarray): boolean ground truth
+        pred (np.ndarray): boolean prediction
+        orientations (list): orientations of :py:data:`ORIENTATIONS`
+        slab_size (int): number of Z slices processed at once
+
+    Returns:
+        np.ndarray: number of voxels in both volumes for each orientation, or -1 if the oriented prediction
+        does not have the shape of the ground truth
+    """
+    views = [orient(pred, o) for o in orientations]
+    valid = [v.shape == ground.shape for v in views]
+    overlaps = np.where(valid, 0, -1).astype(np.int64)
+    for z in range(0, ground.shape[0], slab_size):
+        slab = ground[z : z + slab_size]
+        for i, view in enumerate(views):
+            if valid[i]:
+                overlaps[i] += np.count_nonzero(slab & view[z : z + slab_size])
+    return overlaps
+
+
+def overlap_metrics(overlap, ground_size, pred_size, smooth=1.0):
+    """Computes Dice, IoU, precision and recall from the overlap and foreground sizes of two volumes.
+
+    Dice and IoU are smoothed like :py:func:`napari_cellseg3d.utils.dice_coeff`;
+    precision and recall are NaN when undefined.
+    """
+    union = ground_size + pred_size - overlap
+    return {
+        "dice": (2.0 * overlap + smooth) / (ground_size + pred_size + smooth),
+        "iou": (overlap + smooth) / (union + smooth),
+        "precision": overlap / pred_size if pred_size > 0 else np.nan,
+        "recall": overlap / ground_size if ground_size > 0 else np.nan,
+    }
+
+
+def _surface(mask):
+    return mask & ~ndimage.binary_erosion(mask)
+
+
+def surface_distances(ground, pred):
+    """Computes the 95th percentile Hausdorff distance and the average symmetric surface distance, in voxels.
+
+    Returns:
+        (float, float): both distances, 0 if both volumes are empty, NaN if only one is
+    """
+    ground_surface = _surface(ground)
+    pred_surface = _surface(pred)
+    if not ground_surface.any() and not pred_surface.any():
+        return 0.0, 0.0
+    if not ground_surface.any() or not pred_surface.any():
+        return np.nan, np.nan
+    to_ground = ndimage.distance_transform_edt(~ground_surface)[pred_surface]
+    to_pred = ndimage.distance_transform_edt(~pred_surface)[ground_surface]
+    hausdorff = max(np.percentile(to_ground, 95), np.percentile(to_pred, 95))
+    mean_distance = np.concatenate([to_ground, to_pred]).mean()
+    return float(hausdorff), float(mean_distance)
+
+
+def evaluate_volumes(ground, pred, rotate=False, surface=False):
+    """Evaluates a predicted volume against a ground truth volume.
+
+    Both are converted to foreground masks and padded to a common shape.
+
+    Args:
+        ground (np.ndarray): ground truth labels
+        pred (np.ndarray): predicted labels
+        rotate (bool): whether to find the orientation of the prediction with the best Dice coefficient
+        surface (bool): whether to compute surface-distance metrics. If False, they are set to NaN.
+
+    Returns:
+        dict: metrics of :py:data:`METRICS_COLUMNS`, for the best orientation
+    """
+    ground = np.squeeze(np.asarray(ground)) > 0
+    pred = np.squeeze(np.asarray(pred)) > 0
+    if ground.ndim != pred.ndim:
+        raise ValueError(
+            f"Ground truth and prediction must have the same dimensions, got {ground.shape} and {pred.shape}"
+        )
+    shape = np.maximum(ground.shape, pred.shape)
+    ground = pad_to_shape(ground, shape)
+    pred = pad_to_shape(pred, shape)
+
+    orientations = (
+        ORIENTATIONS if rotate and ground.ndim == 3 else [(None, ())]
+    )
+    overlaps = orientation_overlaps(ground, pred, orientations)
+    best = int(np.argmax(overlaps))
+    metrics = overlap_metrics(
+        overlaps[best], np.count_nonzero(ground), np.count_nonzero(pred)
+    )
+    if surface:
+        hausdorff, mean_distance = surface_distances(
+            ground, orient(pred, orientations[best])
+        )
+    else:
+        hausdorff, mean_distance = np.nan, np.nan
+    metrics["hausdorff_95"] = hausdorff
+    metrics["mean_surface_distance"] = mean_distance
+    metrics["orientation"] = best
+    return metrics
+
+
+def evaluate_pair(ground_path, pred_path, rotate=False, surface=False):
+    """Loads and evaluates a ground truth and prediction file pair, see :py:func:`evaluate_volumes`."""
+    metrics = evaluate_volumes(
+        imread(str(ground_path)), imread(str(pred_path)), rotate, surface
+    )
+    return {
+        "ground_truth": str(ground_path),
+        "prediction": str(pred_path),
+        **metrics,
+    }
+
+
+def evaluate_pairs(pairs, rotate=False, surface=False, num_workers=1):
+    """Evaluates file pairs, in parallel processes if ``num_workers`` > 1.
+
+    Args:
+        pairs (list): (ground truth path, prediction path) pairs
+        rotate (bool): whether to find the best orientation of each prediction
+        surface (bool): whether to compute surface-distance metrics. If False, they are set to NaN.
+        num_workers (int): number of processes
+
+    Yields:
+        (int, dict): index of the pair and its metrics, in the order the evaluations finish
+    """
+    if num_workers <= 1:
+        for i, (ground_path, pred_path) in enumerate(pairs):
+            yield i, evaluate_pair(ground_path, pred_path, rotate, surface)
+        return
+    with process_pool(num_workers) as pool:
+        futures = {
+            pool.submit(evaluate_pair, ground, pred, rotate, surface): i
+            for i, (ground, pred) in enumerate(pairs)
+        }
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+
+
+class MetricsWorker(GeneratorWorker):
+    """Worker evaluating file pairs, appending each result to a csv file as it finishes."""
+
+    def __init__(
+        self, pairs, csv_path=None, rotate=False, surface=False, num_workers=1
+    ):
+        """Creates a worker.
+
+        Args:
+            pairs (list): (ground truth path, prediction path) pairs
+            csv_path (str): csv file to write the metrics of each pair to. If None, no file is written.
+            rotate (bool): whether to find the best orientation of each prediction
+            surface (bool): whether to compute surface-distance metrics. If False, they are set to NaN.
+            num_workers (int): number of processes
+        """
+        super().__init__(self._run)
+        self.pairs = pairs
+        self.csv_path = csv_path
+        self.rotate = rotate
+        self.surface = surface
+        self.num_workers = num_workers
+
+    def _run(self):
+        results = evaluate_pairs(
+            self.pairs, self.rotate, self.surface, self.num_workers
+        )
+        if self.csv_path is None:
+            yield from results
+            return
+        Path(self.csv_path).parent.mkdir(parents=True, exist_ok=True)
+        with Path(self.csv_path).open("w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=METRICS_COLUMNS)
+            writer.writeheader()
+            for index, metrics in results:
+                writer.writerow(metrics)
+                f.flush()
+                yield index, metrics
+        logger.info(f"Metrics saved to {self.csv_path}")
@@ -10,7 +10,6 @@ import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from scipy.stats import norm
 
 from napari_cellseg3d.utils import LOGGER as logger
 
@@ -57,6 +56,7 @@ class SoftNCutsLoss(nn.Module):
         self.W = data_shape[1]
         self.D = data_shape[2]
         self.device = device
+        self._kernels = {}  # 1D gaussian kernel for each device
 
         if self.radius is None:
             self.radius = min(
@@ -70,6 +70,9 @@ class SoftNCutsLoss(nn.Module):
     def forward(self, labels, inputs):
         """Forward pass of the Soft N-Cuts loss.
 
+        All classes are processed at once : the spatial gaussian kernel is separable,
+        so the weights are convolved with three 1D depthwise convolutions, grouped over classes.
+
         Args:
             labels (torch.Tensor): Tensor of shape (N, K, H, W, D) containing the predicted class probabilities for each pixel.
             inputs (torch.Tensor): Tensor of shape (N, C, H, W, D) containing the input images.
@@ -77,52 +80,85 @@ class SoftNCutsLoss(nn.Module):
         Returns:
             The Soft N-Cuts loss of shape (N,).
         """
-        # inputs.shape[0]
-        # inputs.shape[1]
         K = labels.shape[1]
 
-        labels.to(self.device)
-        inputs.to(self.device)
+        # Compute the average pixel value for each class, and the difference from each pixel
+        class_probs = labels.unsqueeze(2)  # N, K, 1, H, W, D
+        voxels = inputs.unsqueeze(1)  # N, 1, C, H, W, D
+        class_mean = torch.mean(
+            voxels * class_probs, dim=(3, 4, 5), keepdim=True
+        ) / torch.add(
+            torch.mean(class_probs, dim=(3, 4, 5), keepdim=True), 1e-5
+        )
+        diff = (voxels - class_mean).pow(2).sum(dim=2)  # N, K, H, W, D
+
+        # Weight the loss by the difference from the class average.
+        weights = torch.exp(diff.pow(2).mul(-1 / self.intensity_sigma**2))
+
+        # convolutions may run in reduced precision under autocast, sums and ratios are computed in float32
+        convolved = self.gaussian_filter(
+            torch.cat([labels * weights, weights], dim=1)
+        ).float()
+        numerator = torch.sum(labels * convolved[:, :K], dim=(2, 3, 4))
+        denominator = torch.sum(labels * convolved[:, K:], dim=(2, 3, 4))
+
+        # mean over the batch, summed over classes
+        loss = torch.sum(
+            torch.mean(
+                torch.abs(numerator / torch.add(denominator, 1e-6)), dim=0
+            )
+        )
+        return K - loss
 
-        loss = 0
+    def gaussian_filter(self, volumes):
+        """Convolves each channel of the volumes with the spatial gaussian kernel, using three 1D convolutions.
 
-        kernel = self.gaussian_kernel(self.radius, self.spatial_sigma).to(
-            self.device
-        )
+        Args:
+            volumes (torch.Tensor): Tensor of shape (N, C, H, W, D).
 
-        for k in range(K):
-            # Compute the average pixel value for this class, and the difference from each pixel
-            class_probs = labels[:, k].unsqueeze(1)
-            class_mean = torch.mean(
-                inputs * class_probs, dim=(2, 3, 4), keepdim=True
-            ) / torch.add(
-                torch.mean(class_probs, dim=(2, 3, 4), keepdim=True), 1e-5
+        Returns:
+            The filtered volumes, of the same shape, equal to a 3D convolution with :py:meth:`gaussian_kernel`.
+        """
+        channels = volumes.shape[1]
+        kernel = self._cached_kernel_1d(volumes.device)
+        for dim in range(3):
+            shape = [1, 1, 1]
+            shape[dim] = kernel.shape[0]
+            padding = [0, 0, 0]
+            padding[dim] = self.radius
+            volumes = F.conv3d(
+                volumes,
+                kernel.view(1, 1, *shape).expand(channels, 1, *shape),
+                padding=padding,
+                groups=channels,
             )
-            diff = (inputs - class_mean).pow(2).sum(dim=1).unsqueeze(1)
+        return volumes
 
-            # Weight the loss by the difference from the class average.
-            weights = torch.exp(
-                diff.pow(2).mul(-1 / self.intensity_sigma**2)
-            )
+    def _cached_kernel_1d(self, device):
+        """Returns the 1D gaussian kernel on the given device, computing it only once per device."""
+        key = str(device)
+        if key not in self._kernels:
+            self._kernels[key] = self.gaussian_kernel_1d(
+                self.radius, self.spatial_sigma
+            ).to(device)
+        return self._kernels[key]
 
-            numerator = torch.sum(
-                class_probs
-                * F.conv3d(class_probs * weights, kernel, padding=self.radius),
-                dim=(1, 2, 3, 4),
-            )
-            denominator = torch.sum(
-                class_probs * F.conv3d(weights, kernel, padding=self.radius),
-                dim=(1, 2, 3, 4),
-            )
-            loss += nn.L1Loss()(
-                numerator / torch.add(denominator, 1e-6),
-                torch.zeros_like(numerator),
-            )
+    @staticmethod
+    def gaussian_kernel_1d(radius, sigma):
+        """Computes the 1D Gaussian kernel, normalized so that its center is 1.
 
-        return K - loss
+        Args:
+            radius (int): The radius of the kernel.
+            sigma (float): The standard deviation of the Gaussian distribution.
+
+        Returns:
+            The Gaussian kernel of shape (2*radius+1,).
+        """
+        x = np.linspace(-radius, radius, 2 * radius + 1) / sigma
+        return torch.from_numpy(np.exp(-(x**2) / 2).astype(np.float32))
 
     def gaussian_kernel(self, radius, sigma):
-        """Computes the Gaussian kernel.
+        """Computes the 3D Gaussian kernel, as the outer product of 1D kernels along each axis.
 
         Args:
             radius (int): The radius of the kernel.
@@ -131,17 +167,12 @@ class SoftNCutsLoss(nn.Module):
         Returns:
             The Gaussian kernel of shape (1, 1, 2*radius+1, 2*radius+1, 2*radius+1).
         """
-        x_2 = np.linspace(-radius, radius, 2 * radius + 1) ** 2
-        dist = (
-            np.sqrt(
-                x_2.reshape(-1, 1, 1)
-                + x_2.reshape(1, -1, 1)
-                + x_2.reshape(1, 1, -1)
-            )
-            / sigma
+        kernel_1d = self.gaussian_kernel_1d(radius, sigma)
+        kernel = (
+            kernel_1d.view(-1, 1, 1)
+            * kernel_1d.view(1, -1, 1)
+            * kernel_1d.view(1, 1, -1)
         )
-        kernel = norm.pdf(dist) / norm.pdf(0)
-        kernel = torch.from_numpy(kernel.astype(np.float32))
         return kernel.view(
             (1, 1, kernel.shape[0], kernel.shape[1], kernel.shape[2])
         )
@@ -0,0 +1,239 @@
+"""Writers for inference results, as compressed tiled (Big)TIFF or chunked OME-Zarr.
+
+Results are read from their source one slab of Z slices at a time and written as they are read,
+so that the whole result never has to be held in memory in its final format.
+To reduce the size of results on disk :
+
+* labels are stored with the smallest unsigned integer type that can hold the largest label
+* probabilities can be quantized to float16 or uint8 (0-255 for 0-1)
+
+With the default :py:class:`~napari_cellseg3d.config.ResultsWriterConfig` (uncompressed float32 TIFF),
+results are written with a plain :py:func:`tifffile.imwrite`, as before.
+"""
+import importlib
+from pathlib import Path
+
+import numpy as np
+import tifffile
+
+from napari_cellseg3d.config import ResultsWriterConfig
+from napari_cellseg3d.utils import LOGGER as logger
+
+spec = importlib.util.find_spec("zarr")
+ZARR_INSTALLED = spec is not None
+if ZARR_INSTALLED:
+    import zarr
+    from numcodecs import Blosc
+
+ZARR_V3 = ZARR_INSTALLED and int(zarr.__version__.split(".")[0]) >= 3
+"""Whether zarr 3 is installed, which writes the Zarr format 3 unless told otherwise."""
+
+FORMAT_SUFFIXES = {"tif": ".tif", "zarr": ".ome.zarr"}
+"""File suffix of each result format."""
+COMPRESSIONS = {
+    "tif": [None, "zstd", "deflate"],
+    "zarr": [None, "zstd", "lz4"],
+}
+"""Compressions available for each result format."""
+PROBABILITY_DTYPES = ["float32", "float16", "uint8"]
+"""Data types probabilities can be stored as."""
+BIGTIFF_THRESHOLD = 2**32 - 2**25
+"""Size in bytes above which results are written as BigTIFF."""
+
+
+def smallest_label_dtype(max_label: int) -> np.dtype:
+    """Returns the smallest unsigned integer type that can store labels up to ``max_label``."""
+    for dtype in [np.uint8, np.uint16, np.uint32]:
+        if max_label <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    return np.dtype(np.uint64)
+
+
+def quantize_probabilities(array: np.ndarray, dtype: str) -> np.ndarray:
+    """Converts probabilities in [0, 1] to the given data type, see PROBABILITY_DTYPES.
+
+    For uint8, probabilities are scaled to 0-255 and rounded.
+    """
+    if dtype == "uint8":
+        return np.rint(np.clip(array, 0, 1) * 255).astype(np.uint8)
+    return np.asarray(array).astype(dtype, copy=False)
+
+
+def get_result_path(path, writer_config: ResultsWriterConfig) -> Path:
+    """Returns ``path`` with the suffix of the result format."""
+    path = Path(path)
+    name = path.name
+    for suffix in [".ome.zarr", ".zarr", ".tiff", ".tif"]:
+        if name.endswith(suffix):
+            name = name[: -len(suffix)]
+            break
+    return path.with_name(name + FORMAT_SUFFIXES[writer_config.format])
+
+
+def _iter_blocks(shape, slab_size):
+    """Yields indices of slabs of Z slices covering a ZYX or CZYX volume, channel by channel."""
+    channels = [()] if len(shape) == 3 else [(c,) for c in range(shape[0])]
+    depth = shape[-3]
+    for channel in channels:
+        for z in range(0, depth, slab_size):
+            yield (*channel, slice(z, min(z + slab_size, depth)))
+
+
+def _check_config(writer_config: ResultsWriterConfig):
+    if writer_config.format not in FORMAT_SUFFIXES:
+        raise ValueError(
+            f"Unknown results format {writer_config.format}, choose from {list(FORMAT_SUFFIXES)}"
+        )
+    if writer_config.compression not in COMPRESSIONS[writer_config.format]:
+        raise ValueError(
+            f"Compression {writer_config.compression} is not available for {writer_config.format}, "
+            f"choose from {COMPRESSIONS[writer_config.format]}"
+        )
+    if writer_config.probability_dtype not in PROBABILITY_DTYPES:
+        raise ValueError(
+            f"Unknown probability dtype {writer_config.probability_dtype}, choose from {PROBABILITY_DTYPES}"
+        )
+    if writer_config.format == "tif" and writer_config.chunk_size % 16 != 0:
+        raise ValueError(
+            f"TIFF tile size must be a multiple of 16, got {writer_config.chunk_size}"
+        )
+    if writer_config.format == "zarr" and not ZARR_INSTALLED:
+        raise ImportError(
+            "zarr is required to write OME-Zarr results, please install it with : pip install zarr"
+        )
+
+
+def _write_tiff(path, source, dtype, convert, writer_config):
+    shape = tuple(source.shape)
+    tile = writer_config.chunk_size
+    size = int(np.prod(shape)) * dtype.itemsize
+
+    def tiles():
+        for index in _iter_blocks(shape, writer_config.chunk_size):
+            for page in convert(source[index]):
+                for y in range(0, shape[-2], tile):
+                    for x in range(0, shape[-1], tile):
+                        yield page[y : y + tile, x : x + tile]
+
+    tifffile.imwrite(
+        str(path),
+        tiles(),
+        shape=shape,
+        dtype=dtype,
+        tile=(tile, tile),
+        compression=writer_config.compression,
+        bigtiff=size > BIGTIFF_THRESHOLD,
+    )
+
+
+def _write_zarr(path, source, dtype, convert, writer_config):
+    shape = tuple(source.shape)
+    chunk = writer_config.chunk_size
+    compressor = (
+        Blosc(
+            cname=writer_config.compression,
+            clevel=5,
+            shuffle=Blosc.BITSHUFFLE,
+        )
+        if writer_config.compression is not None
+        else None
+    )
+    chunks = (1,) * (len(shape) - 3) + (chunk,) * 3
+    if ZARR_V3:
+        # OME-Zarr 0.4 is stored in the Zarr format 2
+        root = zarr.open_group(str(path), mode="w", zarr_format=2)
+        array = root.create_array(
+            "0",
+            shape=shape,
+            chunks=chunks,
+            dtype=dtype,
+            compressors=compressor,
+        )
+    else:
+        root = zarr.open_group(str(path), mode="w")
+        array = root.create_dataset(
+            "0",
+            shape=shape,
+            chunks=chunks,
+            dtype=dtype,
+            compressor=compressor,
+        )
+    axes = [{"name": "c", "type": "channel"}] if len(shape) == 4 else []
+    axes += [{"name": a, "type": "space"} for a in "zyx"]
+    root.attrs["multiscales"] = [
+        {
+            "version": "0.4",
+            "axes": axes,
+            "datasets": [
+                {
+                    "path": "0",
+                    "coordinateTransformations": [
+                        {"type": "scale", "scale": [1.0] * len(shape)}
+                    ],
+                }
+            ],
+        }
+    ]
+    for index in _iter_blocks(shape, chunk):
+        array[index] = convert(source[index])
+
+
+def write_result(
+    path,
+    source,
+    writer_config: ResultsWriterConfig = None,
+    labels: bool = False,
+    max_label: int = None,
+) -> Path:
+    """Writes a result to disk, reading it from ``source`` one slab at a time.
+
+    Args:
+        path (str): path to write the result to. Its suffix is replaced by that of the result format.
+        source (array-like): ZYX or CZYX result supporting numpy-style slicing, e.g. a numpy array or memory-mapped file
+        writer_config (ResultsWriterConfig): format, compression and data types to use. If None, uses the defaults.
+        labels (bool): whether the result contains labels rather than probabilities
+        max_label (int): largest label in the result, used to choose the label data type. If None, computed from the source.
+
+    Returns:
+        Path: path the result was written to
+    """
+    writer_config = (
+        writer_config if writer_config is not None else ResultsWriterConfig()
+    )
+    _check_config(writer_config)
+    path = get_result_path(path, writer_config)
+    if labels and writer_config.compact_labels:
+        if max_label is None:
+            max_label = int(np.max(source)) if np.size(source) > 0 else 0
+        dtype = smallest_label_dtype(max_label)
+
+        def convert(block):
+            return np.asarray(block).astype(dtype, copy=False)
+
+    elif labels:
+        dtype = np.dtype(source.dtype)
+
+        def convert(block):
+            return np.asarray(block)
+
+    else:
+        dtype = np.dtype(writer_config.probability_dtype)
+
+        def convert(block):
+            return quantize_probabilities(
+                block, writer_config.probability_dtype
+            )
+
+    if writer_config.format == "tif" and writer_config.compression is None:
+        # plain TIFF, as written before compression was available
+        tifffile.imwrite(str(path), convert(source))
+    elif len(source.shape) not in [3, 4]:
+        raise ValueError(
+            f"Chunked results must be ZYX or CZYX volumes, got shape {source.shape}"
+        )
+    elif writer_config.format == "tif":
+        _write_tiff(path, source, dtype, convert, writer_config)
+    else:
+        _write_zarr(path, source, dtype, convert, writer_config)
+    logger.debug(f"Wrote {path.name} as {dtype}")
+    return path
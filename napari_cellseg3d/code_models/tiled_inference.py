@@ -0,0 +1,266 @@
+"""Out-of-core tiled inference for volumes that do not fit in memory.
+
+The volume is read lazily from disk (see :py:mod:`napari_cellseg3d.readers`), one tile at a time.
+Each tile is processed with MONAI's sliding window inference, and the overlapping tile predictions
+are blended in disk-backed accumulators. The final semantic output is then written tile by tile to a TIFF file,
+so that peak memory usage depends on the tile and window sizes rather than on the size of the volume.
+"""
+import shutil
+import tempfile
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+import numpy as np
+import tifffile
+import torch
+from monai.data.utils import compute_importance_map
+from monai.inferers import sliding_window_inference
+
+from napari_cellseg3d.code_models.results_writer import (
+    BIGTIFF_THRESHOLD,
+    write_result,
+)
+from napari_cellseg3d.config import ResultsWriterConfig
+from napari_cellseg3d.readers import open_volume
+from napari_cellseg3d.utils import LOGGER as logger
+
+
+def get_tile_starts(size: int, tile_size: int, tile_overlap: int) -> List[int]:
+    """Returns the start positions of tiles along one dimension, so that the last tile ends at ``size``.
+
+    Args:
+        size (int): size of the dimension
+        tile_size (int): size of the tiles
+        tile_overlap (int): number of pixels shared by neighbouring tiles
+    """
+    if tile_size >= size:
+        return [0]
+    step = max(tile_size - tile_overlap, 1)
+    starts = list(range(0, size - tile_size, step))
+    starts.append(size - tile_size)
+    return starts
+
+
+def get_tiles(
+    shape, tile_size: int, tile_overlap: int
+) -> List[Tuple[slice, slice, slice]]:
+    """Returns the slices of all overlapping tiles covering a 3D volume.
+
+    Args:
+        shape (tuple): shape of the volume (ZYX)
+        tile_size (int): size of the (cubic) tiles
+        tile_overlap (int): number of pixels shared by neighbouring tiles
+    """
+    starts = [get_tile_starts(s, tile_size, tile_overlap) for s in shape]
+    return [
+        (
+            slice(i, min(i + tile_size, shape[0])),
+            slice(j, min(j + tile_size, shape[1])),
+            slice(k, min(k + tile_size, shape[2])),
+        )
+        for i in starts[0]
+        for j in starts[1]
+        for k in starts[2]
+    ]
+
+
+class DiskAccumulator:
+    """Weighted sum of overlapping tile predictions, stored in memory-mapped files."""
+
+    def __init__(self, folder, shape):
+        """Creates the accumulators in the given folder.
+
+        Args:
+            folder (str): folder in which to create the memory-mapped files
+            shape (tuple): shape of the accumulated output (CZYX)
+        """
+        self.shape = tuple(shape)
+        self.sum = np.lib.format.open_memmap(
+            str(Path(folder) / "sum.npy"),
+            mode="w+",
+            dtype=np.float32,
+            shape=self.shape,
+        )
+        self.weights = np.lib.format.open_memmap(
+            str(Path(folder) / "weights.npy"),
+            mode="w+",
+            dtype=np.float32,
+            shape=self.shape[1:],
+        )
+
+    def add(self, tile_slices, values, weights):
+        """Adds a weighted tile prediction to the accumulators.
+
+        Args:
+            tile_slices (tuple): slices of the tile in the volume (ZYX)
+            values (np.ndarray): tile prediction (CZYX)
+            weights (np.ndarray): blending weights of the tile (ZYX)
+        """
+        self.sum[(slice(None), *tile_slices)] += values * weights
+        self.weights[tile_slices] += weights
+
+    def blended(self, index):
+        """Returns the blended output of one channel over a slab of Z slices.
+
+        Args:
+            index (tuple): ``(z_slice,)`` for single-channel outputs, ``(channel, z_slice)`` otherwise
+        """
+        *channel, slab = index
+        values = self.sum[channel[0] if len(channel) > 0 else 0, slab]
+        return values / np.maximum(
+            self.weights[slab], np.finfo(np.float32).eps
+        )
+
+    def write(
+        self,
+        output_path,
+        slab_size=64,
+        writer_config: Optional[ResultsWriterConfig] = None,
+    ):
+        """Writes the blended output to a TIFF file, one slab of slices at a time.
+
+        Args:
+            output_path (str): path of the TIFF file to create
+            slab_size (int): number of Z slices normalized and written at once
+            writer_config (ResultsWriterConfig): format and compression of the result, see :py:func:`~napari_cellseg3d.code_models.results_writer.write_result`.
+                If None or uncompressed float32 TIFF, the result is written to a memory-mapped TIFF.
+
+        Returns:
+            array-like: memory-mapped or lazily-loaded result, of shape ZYX if there is a single channel, CZYX otherwise
+        """
+        out_shape = self.shape[1:] if self.shape[0] == 1 else self.shape
+        if writer_config is not None and not writer_config.is_plain_tiff():
+            path = write_result(
+                output_path, _BlendedView(self, out_shape), writer_config
+            )
+            return open_volume(path)
+        nbytes = int(np.prod(out_shape)) * np.dtype(np.float32).itemsize
+        output = tifffile.memmap(
+            str(output_path),
+            shape=out_shape,
+            dtype=np.float32,
+            bigtiff=nbytes > BIGTIFF_THRESHOLD,
+        )
+        for z in range(0, self.shape[1], slab_size):
+            slab = slice(z, min(z + slab_size, self.shape[1]))
+            blended = self.sum[:, slab] / np.maximum(
+                self.weights[slab], np.finfo(np.float32).eps
+            )
+            if self.shape[0] == 1:
+                output[slab] = blended[0]
+            else:
+                output[:, slab] = blended
+        output.flush()
+        return output
+
+    def close(self):
+        """Releases the memory-mapped files."""
+        self.sum = None
+        self.weights = None
+
+
+class _BlendedView:
+    """Read-only, array-like view of the blended output of a :py:class:`DiskAccumulator`, used to write it slab by slab."""
+
+    def __init__(self, accumulator: DiskAccumulator, shape):
+        self.accumulator = accumulator
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(np.float32)
+
+    def __getitem__(self, index):
+        return self.accumulator.blended(index)
+
+
+def tiled_inference(
+    volume,
+    predictor: callable,
+    output_path,
+    window_size: Optional[int] = None,
+    window_overlap: float = 0.25,
+    tile_size: int = 256,
+    tile_overlap: int = 32,
+    sw_batch_size: int = 1,
+    sw_device="cpu",
+    scratch_path=None,
+    log: callable = None,
+    writer_config: Optional[ResultsWriterConfig] = None,
+):
+    """Runs sliding window inference on a volume tile by tile, without ever loading the whole volume in memory.
+
+    Args:
+        volume (array-like): 3D volume supporting numpy-style slicing, e.g. from :py:func:`open_volume`
+        predictor (callable): function taking a NCZYX tensor and returning the model prediction for it
+        output_path (str): path of the TIFF file to write the result to
+        window_size (int): size of the sliding window within each tile. If None, tiles are processed as a whole.
+        window_overlap (float): overlap between sliding windows, as a fraction of the window size
+        tile_size (int): size of the tiles read from disk
+        tile_overlap (int): number of pixels shared by neighbouring tiles, used to blend them
+        sw_batch_size (int): number of windows run through the predictor at once
+        sw_device (str): device to run the predictor on
+        scratch_path (str): folder in which to create the temporary accumulators. If None, uses the system temporary folder.
+        log (callable): function to log progress with. If None, uses logger.info.
+        writer_config (ResultsWriterConfig): format and compression of the result. If None, writes an uncompressed float32 TIFF.
+
+    Returns:
+        array-like: memory-mapped or lazily-loaded result, saved at ``output_path`` with the suffix of the result format
+    """
+    log = log if log is not None else logger.info
+    if len(volume.shape) != 3:
+        raise ValueError(
+            f"Data array is not 3-dimensional but {len(volume.shape)}-dimensional,"
+            f" please check for extra channel/batch dimensions"
+        )
+    if tile_overlap >= tile_size:
+        raise ValueError(
+            f"Tile overlap ({tile_overlap}) must be smaller than tile size ({tile_size})"
+        )
+    shape = tuple(volume.shape)
+    tiles = get_tiles(shape, tile_size, tile_overlap)
+    log(f"Running tiled inference on {len(tiles)} tiles of size {tile_size}")
+
+    scratch = tempfile.mkdtemp(prefix="cellseg3d_tiles_", dir=scratch_path)
+    accumulator = None
+    tile_weights = {}
+    try:
+        for n, tile_slices in enumerate(tiles):
+            tile = np.array(volume[tile_slices], dtype=np.float32)
+            inputs = torch.from_numpy(tile).reshape(1, 1, *tile.shape)
+            roi_size = (
+                [window_size] * 3 if window_size is not None else tile.shape
+            )
+            with torch.no_grad():
+                outputs = sliding_window_inference(
+                    inputs,
+                    roi_size=roi_size,
+                    sw_batch_size=sw_batch_size,
+                    predictor=predictor,
+                    sw_device=sw_device,
+                    device="cpu",
+                    overlap=window_overlap,
+                    mode="gaussian",
+                    sigma_scale=0.01,
+                )
+            outputs = outputs[0].detach().cpu().numpy().astype(np.float32)
+            if accumulator is None:
+                accumulator = DiskAccumulator(
+                    scratch, (outputs.shape[0], *shape)
+                )
+            if tile.shape not in tile_weights:
+                tile_weights[tile.shape] = (
+                    compute_importance_map(
+                        tile.shape, mode="gaussian", device="cpu"
+                    )
+                    .numpy()
+                    .astype(np.float32)
+                )
+            accumulator.add(tile_slices, outputs, tile_weights[tile.shape])
+            log(f"Tile {n + 1}/{len(tiles)} done")
+
+        log("Writing results...")
+        return accumulator.write(
+            output_path, slab_size=tile_size, writer_config=writer_config
+        )
+    finally:
+        if accumulator is not None:
+            accumulator.close()
+        shutil.rmtree(scratch, ignore_errors=True)
@@ -1,6 +1,9 @@
 """Contains the :py:class:`~InferenceWorker` class, which is a custom worker to run inference jobs in."""
+import itertools
 import platform
 import sys
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import numpy as np
@@ -16,14 +19,12 @@ from monai.transforms import (
     EnsureChannelFirstd,
     EnsureType,
     EnsureTyped,
-    LoadImaged,
     SpatialPad,
     SpatialPadd,
     ToTensor,
     Zoom,
 )
 from napari._qt.qthreading import GeneratorWorker
-from tifffile import imwrite
 
 # local
 from napari_cellseg3d import config, utils
@@ -32,17 +33,30 @@ from napari_cellseg3d.code_models.instance_segmentation import (
     clear_large_objects,
     volume_stats,
 )
+from napari_cellseg3d.code_models.results_writer import (
+    get_result_path,
+    write_result,
+)
+from napari_cellseg3d.code_models.tiled_inference import (
+    open_volume,
+    tiled_inference,
+)
 from napari_cellseg3d.code_models.workers_utils import (
+    MODEL_CACHE,
     PRETRAINED_WEIGHTS_DIR,
+    QUANTILE_CACHE,
     InferenceResult,
-    LogSignal,
     ONNXModelWrapper,
     QuantileNormalization,
-    RemapTensor,
-    Threshold,
+    StageTimer,
     TqdmToLogSignal,
     WeightsDownloader,
+    autotune_sw_batch_size,
+    get_post_process_transforms,
+    get_source_path,
 )
+from napari_cellseg3d.interface import LogSignal
+from napari_cellseg3d.readers import volume_loader
 
 logger = utils.LOGGER
 # experimental code to auto-remove erroneously over-labeled empty regions from instance segmentation
@@ -112,6 +126,13 @@ class InferenceWorker(GeneratorWorker):
         self.downloader = WeightsDownloader()
         """Download utility"""
 
+        self.sw_batch_size = self.config.sliding_window_config.sw_batch_size
+        """Number of windows run through the model at once, see :py:func:`~self.tune_sw_batch_size`"""
+
+        self._stage_timer = StageTimer()
+        self._save_pool = None
+        self._pending_saves = []
+
     @staticmethod
     def create_inference_dict(images_filepaths):
         """Create a dict for MONAI with "image" keys with all image paths in :py:attr:`~self.images_filepaths`.
@@ -187,6 +208,12 @@ class InferenceWorker(GeneratorWorker):
             self.log(
                 f"Window overlap is {self.config.sliding_window_config.window_overlap}"
             )
+            self.log(f"Window batch size is {self.sw_batch_size}")
+
+        if config.tiled_inference_config.enabled:
+            self.log(
+                f"Tiled inference is enabled, tile size is {config.tiled_inference_config.tile_size}"
+            )
 
         if config.keep_on_cpu:
             self.log("Dataset loaded to CPU")
@@ -209,7 +236,7 @@ class InferenceWorker(GeneratorWorker):
         """Loads the folder specified in :py:attr:`~self.images_filepaths` and returns a MONAI DataLoader."""
         images_dict = self.create_inference_dict(self.config.images_filepaths)
 
-        data_check = LoadImaged(keys=["image"], image_only=True)(
+        data_check = volume_loader(keys=["image"], image_only=True)(
             images_dict[0]
         )
         check = data_check["image"].shape
@@ -220,7 +247,7 @@ class InferenceWorker(GeneratorWorker):
             logger.debug(f"Loading image with shape : {str(check)}")
             load_transforms = Compose(
                 [
-                    LoadImaged(keys=["image"], image_only=True),
+                    volume_loader(keys=["image"], image_only=True),
                     # AddChanneld(keys=["image"]), #already done
                     EnsureChannelFirstd(keys=["image"]),
                     # Orientationd(keys=["image"], axcodes="PLI"),
@@ -235,7 +262,7 @@ class InferenceWorker(GeneratorWorker):
             logger.debug(f"Loading image with shape: {str(pad)}")
             load_transforms = Compose(
                 [
-                    LoadImaged(keys=["image"], image_only=True),
+                    volume_loader(keys=["image"], image_only=True),
                     # AddChanneld(keys=["image"]), #already done
                     EnsureChannelFirstd(keys=["image"]),
                     # QuantileNormalizationd(keys=["image"]),
@@ -249,7 +276,9 @@ class InferenceWorker(GeneratorWorker):
         self.log("Loading dataset...")
         inference_ds = Dataset(data=images_dict, transform=load_transforms)
         inference_loader = DataLoader(
-            inference_ds, batch_size=1, num_workers=2
+            inference_ds,
+            batch_size=1,
+            num_workers=self.config.pipeline_config.load_workers,
         )
         self.log("Done")
         return inference_loader
@@ -321,6 +350,65 @@ class InferenceWorker(GeneratorWorker):
         self.log("Done")
         return input_image
 
+    @staticmethod
+    def _make_predictor(model, post_process_transforms, normalization):
+        """Returns a function running normalization, the model and post-processing on a batch of windows.
+
+        Args:
+            model (torch.nn.Module): the model to run
+            post_process_transforms (monai.transforms.Compose): the transforms to apply to the output
+            normalization (callable): the normalization to apply to the inputs
+        """
+
+        def model_output_wrapper(inputs):
+            inputs = normalization(inputs)
+            result = model(inputs)
+
+            ####################### EXPERIMENTAL CODE
+            if EXPERIMENTAL_AUTO_DISCARD_EMPTY_REGIONS:
+                result = post_process_transforms(result)
+                logger.debug("Checking for empty regions")
+                check_result = result.detach().cpu().numpy()
+                for i in range(check_result.shape[0]):
+                    for j in range(check_result.shape[1]):
+                        fraction_labeled = utils.fraction_above_threshold(
+                            check_result[i, j],
+                            EXPERIMENTAL_AUTO_DISCARD_VALUE,
+                        )
+                        logger.debug(f"Fraction labeled: {fraction_labeled}")
+                        if (
+                            fraction_labeled
+                            > EXPERIMENTAL_AUTO_DISCARD_FRACTION_THRESHOLD
+                        ):
+                            logger.debug(
+                                f"Discarding empty region with fraction {fraction_labeled}"
+                            )
+                            result[i, j] = torch.zeros_like(result[i, j])
+                return result
+            ##########################################
+            return post_process_transforms(result)
+
+        return model_output_wrapper
+
+    def tune_sw_batch_size(self, model, post_process_transforms):
+        """Sets :py:attr:`~self.sw_batch_size` to the batch size with the highest throughput for the model and device.
+
+        See :py:func:`~napari_cellseg3d.code_models.workers_utils.autotune_sw_batch_size`.
+        """
+        window_config = self.config.sliding_window_config
+        self.log("Tuning window batch size...")
+        model.eval()
+        self.sw_batch_size = autotune_sw_batch_size(
+            self._make_predictor(
+                model, post_process_transforms, QuantileNormalization()
+            ),
+            window_size=window_config.window_size,
+            device=self.config.device,
+            memory_budget=window_config.memory_budget,
+        )
+        self.log(f"Window batch size set to {self.sw_batch_size}")
+        return self.sw_batch_size
+
     def model_output(
         self,
         inputs,
@@ -356,7 +444,10 @@ class InferenceWorker(GeneratorWorker):
                 self.config.layer is None
                 and self.config.images_filepaths is not None
             ):
-                normalization = QuantileNormalization()
+                # same clipping values for all windows of the volume
+                normalization = QuantileNormalization(
+                    QUANTILE_CACHE.get(inputs, path=get_source_path(inputs))
+                )
             else:
 
                 def normalization(x):
@@ -364,40 +455,9 @@ class InferenceWorker(GeneratorWorker):
 
             try:
                 # outputs = model(inputs)
-
-                def model_output_wrapper(inputs):
-                    inputs = normalization(inputs)
-                    result = model(inputs)
-
-                    ####################### EXPERIMENTAL CODE
-                    if EXPERIMENTAL_AUTO_DISCARD_EMPTY_REGIONS:
-                        result = post_process_transforms(result)
-                        logger.debug("Checking for empty regions")
-                        check_result = result.detach().cpu().numpy()
-                        for i in range(check_result.shape[0]):
-                            for j in range(check_result.shape[1]):
-                                fraction_labeled = (
-                                    utils.fraction_above_threshold(
-                                        check_result[i, j],
-                                        EXPERIMENTAL_AUTO_DISCARD_VALUE,
-                                    )
-                                )
-                                logger.debug(
-                                    f"Fraction labeled: {fraction_labeled}"
-                                )
-                                if (
-                                    fraction_labeled
-                                    > EXPERIMENTAL_AUTO_DISCARD_FRACTION_THRESHOLD
-                                ):
-                                    logger.debug(
-                                        f"Discarding empty region with fraction {fraction_labeled}"
-                                    )
-                                    result[i, j] = torch.zeros_like(
-                                        result[i, j]
-                                    )
-                        return result
-                    ##########################################
-                    return post_process_transforms(result)
+                model_output_wrapper = self._make_predictor(
+                    model, post_process_transforms, normalization
+                )
 
                 model.eval()
                 with torch.no_grad():
@@ -408,7 +468,7 @@ class InferenceWorker(GeneratorWorker):
                     outputs = sliding_window_inference(
                         inputs,
                         roi_size=window_size,
-                        sw_batch_size=1,  # TODO add param
+                        sw_batch_size=self.sw_batch_size,
                         predictor=model_output_wrapper,
                         sw_device=self.config.device,
                         device=dataset_device,
@@ -551,17 +611,15 @@ class InferenceWorker(GeneratorWorker):
         # sys.stderr = old_stderr
         return instance_labels, stats
 
-    def save_image(
+    def get_results_filepath(
         self,
-        image,
         from_layer=False,
         i=0,
         additional_info="",
     ):
-        """Save the image to the :py:attr:`~self.results_path` folder.
+        """Returns the path to save a result to in the :py:attr:`~self.results_path` folder, creating the folder if needed.
 
         Args:
-            image (np.ndarray): the image to save
             from_layer (bool, optional): whether the inference was run on a layer or not. Defaults to False.
             i (int, optional): the index of the image. Defaults to 0.
             additional_info (str, optional): additional info to add to the filename. Defaults to "".
@@ -591,17 +649,55 @@ class InferenceWorker(GeneratorWorker):
         )
         if not Path(self.config.results_path).exists():
             Path(self.config.results_path).mkdir(parents=True, exist_ok=True)
-        try:
-            imwrite(file_path, image)
-        except ValueError as e:
-            raise e
-        filename = Path(file_path).stem
+        return file_path
+
+    def save_image(
+        self,
+        image,
+        from_layer=False,
+        i=0,
+        additional_info="",
+    ):
+        """Save the image to the :py:attr:`~self.results_path` folder.
+
+        Args:
+            image (np.ndarray): the image to save
+            from_layer (bool, optional): whether the inference was run on a layer or not. Defaults to False.
+            i (int, optional): the index of the image. Defaults to 0.
+            additional_info (str, optional): additional info to add to the filename. Defaults to "".
+        """
+        file_path = self.get_results_filepath(
+            from_layer=from_layer, i=i, additional_info=additional_info
+        )
+        filename = self._write_image(file_path, image).name
 
         if from_layer:
             self.log(f"Layer prediction saved as : {filename}")
         else:
             self.log(f"File n°{i+1} saved as : {filename}")
 
+    def _write_image(self, file_path, image, labels=False):
+        """Writes an image to disk, in the background if a saving pool is running (see :py:meth:`pipelined_inference_on_folder`).
+
+        The format is set by :py:attr:`~self.config.results_writer_config`, see :py:func:`~napari_cellseg3d.code_models.results_writer.write_result`.
+
+        Returns:
+            Path: path the image is written to
+        """
+        writer_config = self.config.results_writer_config
+        if self._save_pool is None:
+            return write_result(file_path, image, writer_config, labels=labels)
+        self._pending_saves.append(
+            self._save_pool.submit(
+                self._stage_timer.timed("saving", write_result),
+                file_path,
+                image,
+                writer_config,
+                labels=labels,
+            )
+        )
+        return get_result_path(file_path, writer_config)
+
     def aniso_transform(self, image):
         """Applies an anisotropic transform to the image."""
         if self.config.post_process_config.zoom.enabled:
@@ -627,7 +723,9 @@ class InferenceWorker(GeneratorWorker):
         if image_id is not None:
             self.log(f"Running instance segmentation for image n°{image_id}")
 
-        method = self.config.post_process_config.instance.method
+        instance_config = self.config.post_process_config.instance
+        method = instance_config.method
+        method.n_workers = instance_config.n_workers
         instance_labels = method.run_method_on_channels_from_params(
             semantic_labels
         )
@@ -650,15 +748,24 @@ class InferenceWorker(GeneratorWorker):
             + filetype
         )
 
-        imwrite(instance_filepath, instance_labels)
+        instance_filepath = self._write_image(
+            instance_filepath, instance_labels, labels=True
+        )
         self.log(
             f"Instance segmentation results for image n°{image_id} have been saved as:"
         )
-        self.log(Path(instance_filepath).name)
+        self.log(instance_filepath.name)
         return instance_labels
 
     def inference_on_folder(self, inf_data, i, model, post_process_transforms):
         """Runs inference on a folder."""
+        out = self.infer_folder_image(
+            inf_data, i, model, post_process_transforms
+        )
+        return self.post_process_folder_image(inf_data, out, i)
+
+    def infer_folder_image(self, inf_data, i, model, post_process_transforms):
+        """Runs the model on an image from a folder and returns the semantic segmentation."""
         self.log("-" * 10)
         self.log(f"Inference started on image n°{i + 1}...")
 
@@ -680,6 +787,11 @@ class InferenceWorker(GeneratorWorker):
             logger.debug(
                 f"Output shape {out.shape[-3:]} does not match input shape {inputs_shape_corrected[-3:]} on HWD dims even after rotation"
             )
+        return out
+
+    def post_process_folder_image(self, inf_data, out, i):
+        """Saves the semantic segmentation of an image from a folder, then runs instance segmentation, stats and CRF on it."""
+        inputs = inf_data["image"]
         self.save_image(out, i=i)
         instance_labels, stats = self.get_instance_result(out, i=i)
         if self.config.use_crf:
@@ -711,6 +823,137 @@ class InferenceWorker(GeneratorWorker):
             i=i,
         )
 
+    def pipelined_inference_on_folder(
+        self, inference_loader, model, post_process_transforms
+    ):
+        """Runs inference on a folder, overlapping the loading, inference, post-processing and saving of consecutive images.
+
+        Images are loaded ahead by the DataLoader workers and run through the model in this thread,
+        while the previous images are post-processed and saved by thread pools, see :py:class:`~napari_cellseg3d.config.PipelineConfig`.
+        At most ``queue_size`` inferred images wait for post-processing, to bound memory usage.
+        Results are yielded in order, and the utilization of each stage is logged at the end.
+        """
+        pipeline = self.config.pipeline_config
+        self._stage_timer = StageTimer()
+        post_pool = ThreadPoolExecutor(
+            max_workers=pipeline.post_process_workers,
+            thread_name_prefix="cellseg3d_post_process",
+        )
+        self._save_pool = ThreadPoolExecutor(
+            max_workers=pipeline.save_workers,
+            thread_name_prefix="cellseg3d_save",
+        )
+        self._pending_saves = []
+        pending = deque()
+        post_process = self._stage_timer.timed(
+            "post-processing", self.post_process_folder_image
+        )
+        try:
+            images = iter(inference_loader)
+            for i in itertools.count():
+                with self._stage_timer.time("loading"):
+                    inf_data = next(images, None)
+                if inf_data is None:
+                    break
+                with self._stage_timer.time("inference"):
+                    out = self.infer_folder_image(
+                        inf_data, i, model, post_process_transforms
+                    )
+                pending.append(
+                    post_pool.submit(post_process, inf_data, out, i)
+                )
+                while len(pending) > pipeline.queue_size or (
+                    len(pending) > 0 and pending[0].done()
+                ):
+                    yield pending.popleft().result()
+            while len(pending) > 0:
+                yield pending.popleft().result()
+            for future in self._pending_saves:
+                future.result()
+        finally:
+            for future in pending:
+                future.cancel()
+            post_pool.shutdown(wait=True)
+            self._save_pool.shutdown(wait=True)
+            self._save_pool = None
+            self._pending_saves = []
+            utilization = self._stage_timer.utilization(
+                {
+                    "post-processing": pipeline.post_process_workers,
+                    "saving": pipeline.save_workers,
+                }
+            )
+            self.log(
+                "Pipeline utilization : "
+                + ", ".join(
+                    f"{stage} {fraction:.0%}"
+                    for stage, fraction in utilization.items()
+                )
+            )
+
+    def inference_on_file_tiled(
+        self, image_path, i, model, post_process_transforms
+    ):
+        """Runs out-of-core inference on a file, streaming it from disk tile by tile.
+
+        See :py:func:`~napari_cellseg3d.code_models.tiled_inference.tiled_inference`.
+        The semantic output is written to the results folder as it is computed, and returned memory-mapped.
+        """
+        self.log("-" * 10)
+        self.log(f"Tiled inference started on image n°{i + 1}...")
+        tiled_config = self.config.tiled_inference_config
+
+        volume = open_volume(image_path)
+        window_size = self.config.sliding_window_config.window_size
+        file_path = self.get_results_filepath(i=i)
+
+        if self.config.post_process_config.zoom.enabled:
+            self.log(
+                "Anisotropy correction is not available with tiled inference, skipping"
+            )
+
+        self.log("Computing volume quantiles...")
+        normalization = QuantileNormalization(
+            QUANTILE_CACHE.get(volume, path=image_path)
+        )
+        model.eval()
+        out = tiled_inference(
+            volume,
+            predictor=self._make_predictor(
+                model, post_process_transforms, normalization
+            ),
+            output_path=file_path,
+            window_size=window_size,
+            window_overlap=self.config.sliding_window_config.window_overlap,
+            tile_size=tiled_config.tile_size,
+            tile_overlap=tiled_config.tile_overlap,
+            sw_batch_size=self.sw_batch_size,
+            sw_device=self.config.device,
+            scratch_path=tiled_config.scratch_path,
+            log=self.log_w_replacement,
+            writer_config=self.config.results_writer_config,
+        )
+        self.log(
+            f"File n°{i+1} saved as : {get_result_path(file_path, self.config.results_writer_config).name}"
+        )
+
+        if (
+            self.config.post_process_config.instance.enabled
+            or self.config.use_crf
+        ):
+            self.log(
+                "Instance segmentation and CRF are not available with tiled inference, skipping"
+            )
+        self.log(f"Inference completed on image n°{i+1}")
+
+        return self.create_inference_result(
+            out,
+            None,
+            from_layer=False,
+            original=volume,
+            i=i,
+        )
+
     def run_crf(self, image, labels, aniso_transform, image_id=0):
         """Runs CRF on the image and labels."""
         try:
@@ -725,7 +968,11 @@ class InferenceWorker(GeneratorWorker):
                     )
 
             crf_results = crf_with_config(
-                image, labels, config=self.config.crf_config, log=self.log
+                image,
+                labels,
+                config=self.config.crf_config,
+                log=self.log,
+                device=self.config.device,
             )
             self.save_image(
                 crf_results,
@@ -841,58 +1088,14 @@ class InferenceWorker(GeneratorWorker):
         try:
             dims = self.config.model_info.model_input_size
             self.log(f"MODEL DIMS : {dims}")
-            model_name = self.config.model_info.name
-            model_class = self.config.model_info.get_model()
-            self.log(f"Model name : {model_name}")
-
-            weights_config = self.config.weights_config
             post_process_config = self.config.post_process_config
-            if Path(weights_config.path).suffix == ".pt":
-                self.log("Instantiating PyTorch jit model...")
-                model = torch.jit.load(weights_config.path)
-            # try:
-            elif Path(weights_config.path).suffix == ".onnx":
-                self.log("Instantiating ONNX model...")
-                model = ONNXModelWrapper(weights_config.path)
-            else:  # assume is .pth
-                self.log("Instantiating model...")
-                model = model_class(
-                    input_img_size=[dims, dims, dims],
-                    # device=self.config.device,
-                    # num_classes=self.config.model_info.num_classes,
-                )
-                try:
-                    model = model.to(self.config.device)
-                except RuntimeError as e:
-                    self._raise_error(e, "Issue loading model to device")
-                # logger.debug(f"model : {model}")
-                if model is None:
-                    raise ValueError("Model is None")
-                # try:
-                self.log("Loading weights...")
-                if weights_config.use_custom:
-                    weights = weights_config.path
-                else:
-                    self.downloader.download_weights(
-                        model_name,
-                        model_class.weights_file,
-                    )
-                    weights = str(
-                        PRETRAINED_WEIGHTS_DIR / Path(model_class.weights_file)
-                    )
-                try:
-                    missing = model.load_state_dict(  # note that this is redefined in WNet_
-                        torch.load(
-                            weights,
-                            map_location=self.config.device,
-                        ),
-                        strict=False,  # True, # TODO(cyril): change to True
-                    )
-                    self.log(f"Weights status : {missing}")
-                except Exception as e:
-                    self._raise_error(e, "Error when loading weights")
-                    return None
-                self.log("Done")
+            model = MODEL_CACHE.get(
+                self.config.model_info,
+                self.config.weights_config,
+                self.config.device,
+                downloader=self.downloader,
+                log=self.log,
+            )
             # except Exception as e:
             #     self._raise_error(e, "Issue loading weights")
             # except Exception as e:
@@ -928,23 +1131,9 @@ class InferenceWorker(GeneratorWorker):
             #     ]
             # )
 
-            if not post_process_config.thresholding.enabled:
-                post_process_transforms = Compose(
-                    [
-                        RemapTensor(new_max=1.0, new_min=0.0),
-                        EnsureType(),
-                    ]
-                )
-            else:
-                t = post_process_config.thresholding.threshold_value
-                post_process_transforms = Compose(
-                    [
-                        RemapTensor(new_max=1.0, new_min=0.0),
-                        # AsDiscrete(threshold=t),
-                        Threshold(threshold=t),
-                        EnsureType(),
-                    ]
-                )
+            post_process_transforms = get_post_process_transforms(
+                post_process_config.thresholding
+            )
 
             is_folder = self.config.images_filepaths is not None
             is_layer = self.config.layer is not None
@@ -954,7 +1143,8 @@ class InferenceWorker(GeneratorWorker):
                     "Both a layer and a folder have been specified, please specify only one of the two. Aborting."
                 )
             elif is_folder:
-                inference_loader = self.load_folder()
+                if not self.config.tiled_inference_config.enabled:
+                    inference_loader = self.load_folder()
                 ##################
                 ##################
                 # DEBUG
@@ -973,7 +1163,22 @@ class InferenceWorker(GeneratorWorker):
             if model is None:
                 raise ValueError("Model is None")
 
-            if is_folder:
+            if (
+                self.config.sliding_window_config.is_enabled()
+                and self.config.sliding_window_config.auto_tune_batch_size
+            ):
+                self.tune_sw_batch_size(model, post_process_transforms)
+
+            if is_folder and self.config.tiled_inference_config.enabled:
+                for i, image_path in enumerate(self.config.images_filepaths):
+                    yield self.inference_on_file_tiled(
+                        image_path, i, model, post_process_transforms
+                    )
+            elif is_folder and self.config.pipeline_config.enabled:
+                yield from self.pipelined_inference_on_folder(
+                    inference_loader, model, post_process_transforms
+                )
+            elif is_folder:
                 for i, inf_data in enumerate(inference_loader):
                     yield self.inference_on_folder(
                         inf_data, i, model, post_process_transforms
@@ -983,8 +1188,7 @@ class InferenceWorker(GeneratorWorker):
                     input_image, model, post_process_transforms
                 )
 
-            model.to("cpu")
-            model = None
+            model = None  # kept loaded in MODEL_CACHE for the next job
             del model
             inference_loader = None
             del inference_loader
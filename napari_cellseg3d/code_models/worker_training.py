@@ -32,7 +32,6 @@ from monai.transforms import (
     EnsureChannelFirstd,
     EnsureType,
     EnsureTyped,
-    LoadImaged,
     Orientationd,
     Rand3DElasticd,
     RandAffined,
@@ -52,14 +51,24 @@ from napari_cellseg3d import config, utils
 from napari_cellseg3d.code_models.models.wnet.model import WNet
 from napari_cellseg3d.code_models.models.wnet.soft_Ncuts import SoftNCutsLoss
 from napari_cellseg3d.code_models.workers_utils import (
+    MODEL_CACHE,
     PRETRAINED_WEIGHTS_DIR,
-    LogSignal,
+    AsyncCheckpointer,
+    MixedPrecision,
+    NormalizeBatch,
+    PersistentCached,
     QuantileNormalizationd,
     RemapTensor,
     Threshold,
+    ThroughputMeter,
+    TrainingProgress,
     TrainingReport,
+    VolumeQuantilesd,
     WeightsDownloader,
+    state_dict_to_cpu,
 )
+from napari_cellseg3d.interface import LogSignal
+from napari_cellseg3d.readers import volume_loader
 
 logger = utils.LOGGER
 try:
@@ -110,10 +119,20 @@ class TrainingWorkerBase(GeneratorWorker):
         self.train_files = []
         self.val_files = []
         self.config = None
+        self.checkpointer = AsyncCheckpointer()
 
         self._weight_error = False
+        self._weights_requested = False
+        self._train_start_time = time.time()
+        self._last_step_time = self._train_start_time
         ################################
 
+    def release_inference_models(self):
+        """Releases the models kept loaded by inference jobs, so that their memory is available for training."""
+        if len(MODEL_CACHE) > 0:
+            self.log("Releasing models cached for inference")
+            MODEL_CACHE.clear()
+
     def set_download_log(self, widget):
         """Sets the log widget for the downloader to output to."""
         self.downloader.log_widget = widget
@@ -123,7 +142,7 @@ class TrainingWorkerBase(GeneratorWorker):
 
         Goes in a Log object, defined in :py:mod:`napari_cellseg3d.interface`.
         Sends a signal to the main thread to log the text.
-        Signal is defined in napari_cellseg3d.workers_utils.LogSignal.
+        Signal is defined in napari_cellseg3d.interface.LogSignal.
 
         Args:
             text (str): text to logged
@@ -142,6 +161,84 @@ class TrainingWorkerBase(GeneratorWorker):
         self.errored.emit(exception)
         self.quit()
 
+    def get_preprocessing_cache(self, keys, preprocessing, data_list):
+        """Wraps deterministic preprocessing in a persistent on-disk cache, if enabled in the config.
+
+        All items of ``data_list`` are preprocessed and cached right away, if they were not already.
+
+        Args:
+            keys (list): keys of the data to preprocess
+            preprocessing (monai.transforms.Compose): deterministic transforms to cache
+            data_list (list): data dicts that will be preprocessed
+
+        Returns:
+            PersistentCached: the cached preprocessing, or None if caching is disabled
+        """
+        if self.config.cache_path is None:
+            return None
+        cache = PersistentCached(
+            keys=keys,
+            transform=preprocessing,
+            cache_path=self.config.cache_path,
+        )
+        hits = cache.prepare(data_list)
+        self.log(
+            f"Preprocessed data cache : {hits}/{len(data_list)} volumes were already cached in {self.config.cache_path}"
+        )
+        return cache
+
+    def request_weights(self):
+        """Requests a copy of the current weights, which will be sent with the next progress event.
+
+        Weights are not sent otherwise, to avoid holding references to them in the GUI thread.
+        """
+        self._weights_requested = True
+
+    def _start_progress(self):
+        """Resets the timers used in progress events, to be called when training starts."""
+        self._train_start_time = time.time()
+        self._last_step_time = self._train_start_time
+
+    def _progress(
+        self, epoch, step, total_steps, losses, model=None
+    ) -> TrainingProgress:
+        """Creates the progress event for a training step, with the weights of the model if they were requested."""
+        now = time.time()
+        progress = TrainingProgress(
+            epoch=epoch,
+            step=step,
+            total_steps=total_steps,
+            losses=losses,
+            step_time=now - self._last_step_time,
+            elapsed_time=now - self._train_start_time,
+        )
+        self._last_step_time = now
+        if self._weights_requested and model is not None:
+            progress.weights = state_dict_to_cpu(model)
+            self._weights_requested = False
+        return progress
+
+    def _send_preview(self, epoch) -> bool:
+        """Whether preview images should be sent to the GUI at the end of this epoch."""
+        return (
+            (epoch + 1) % self.config.preview_interval == 0
+            or epoch + 1 == self.config.max_epochs
+        )
+
+    def _log_throughput(self, record):
+        """Logs the throughput of an epoch, as recorded by a ThroughputMeter."""
+        message = f"Throughput: {record['samples/s']:.2f} samples/s"
+        if not np.isnan(record["peak memory (MB)"]):
+            message += f", peak memory: {record['peak memory (MB)']:.0f} MB"
+        self.log(message)
+        if WANDB_INSTALLED:
+            wandb.log(
+                {
+                    "Performance/Samples per second": record["samples/s"],
+                    "Performance/Peak memory (MB)": record["peak memory (MB)"],
+                }
+            )
+
     @abstractmethod
     def log_parameters(self):
         """Logs the parameters of the training."""
@@ -176,7 +273,7 @@ class WNetTrainingWorker(TrainingWorkerBase):
         self.dice_metric = DiceMetric(
             include_background=False, reduction="mean", get_not_nans=False
         )
-        self.normalize_function = utils.remap_image
+        self.normalize_function = NormalizeBatch(new_min=0, new_max=100)
         self.start_time = time.time()
         self.ncuts_losses = []
         self.rec_losses = []
@@ -197,20 +294,24 @@ class WNetTrainingWorker(TrainingWorkerBase):
         Returns:
             (tuple): A tuple containing the shape of the data and the dataset
         """
-        patch_func = Compose(
+        load = Compose(
             [
-                LoadImaged(keys=["image"], image_only=True),
+                volume_loader(keys=["image"], image_only=True),
                 EnsureChannelFirstd(keys=["image"], channel_dim="no_channel"),
-                RandSpatialCropSamplesd(
-                    keys=["image"],
-                    roi_size=(
-                        self.config.sample_size
-                    ),  # multiply by axis_stretch_factor if anisotropy
-                    # max_roi_size=(120, 120, 120),
-                    random_size=False,
-                    num_samples=self.config.num_samples,
-                ),
-                Orientationd(keys=["image"], axcodes="PLI"),
+            ]
+        )
+        crop = RandSpatialCropSamplesd(
+            keys=["image"],
+            roi_size=(
+                self.config.sample_size
+            ),  # multiply by axis_stretch_factor if anisotropy
+            # max_roi_size=(120, 120, 120),
+            random_size=False,
+            num_samples=self.config.num_samples,
+        )
+        orientation = Orientationd(keys=["image"], axcodes="PLI")
+        pad = Compose(
+            [
                 SpatialPadd(
                     keys=["image"],
                     spatial_size=(
@@ -220,6 +321,13 @@ class WNetTrainingWorker(TrainingWorkerBase):
                 EnsureTyped(keys=["image"]),
             ]
         )
+        # volumes are cached before reorienting, so that patches are cropped then reoriented either way
+        cache = self.get_preprocessing_cache(
+            ["image"], load, self.config.train_data_dict
+        )
+        patch_func = Compose(
+            [load if cache is None else cache, crop, orientation, pad]
+        )
         dataset = PatchDataset(
             data=self.config.train_data_dict,
             samples_per_image=self.config.num_samples,
@@ -231,9 +339,9 @@ class WNetTrainingWorker(TrainingWorkerBase):
 
     def get_dataset_eval(self, eval_dataset_dict):
         """Creates a Dataset applying some transforms/augmentation on the data using the MONAI library."""
-        eval_transforms = Compose(
+        preprocessing = Compose(
             [
-                LoadImaged(keys=["image", "label"]),
+                volume_loader(keys=["image", "label"]),
                 EnsureChannelFirstd(
                     keys=["image", "label"], channel_dim="no_channel"
                 ),
@@ -253,13 +361,20 @@ class WNetTrainingWorker(TrainingWorkerBase):
                 #         utils.get_padding_dim(self.config.sample_size)
                 #     ),
                 # ),
-                EnsureTyped(keys=["image", "label"]),
             ]
         )
 
+        cache = self.get_preprocessing_cache(
+            ["image", "label"], preprocessing, eval_dataset_dict
+        )
         return CacheDataset(
             data=eval_dataset_dict,
-            transform=eval_transforms,
+            transform=Compose(
+                [
+                    preprocessing if cache is None else cache,
+                    EnsureTyped(keys=["image", "label"]),
+                ]
+            ),
         )
 
     def get_dataset(self, train_transforms):
@@ -273,28 +388,39 @@ class WNetTrainingWorker(TrainingWorkerBase):
         """
         train_files = self.config.train_data_dict
 
-        first_volume = LoadImaged(keys=["image"])(train_files[0])
+        first_volume = volume_loader(keys=["image"])(train_files[0])
         first_volume_shape = first_volume["image"].shape
 
         # Transforms to be applied to each volume
         load_single_images = Compose(
             [
-                LoadImaged(keys=["image"]),
+                volume_loader(keys=["image"]),
                 EnsureChannelFirstd(keys=["image"]),
                 Orientationd(keys=["image"], axcodes="PLI"),
                 SpatialPadd(
                     keys=["image"],
                     spatial_size=(utils.get_padding_dim(first_volume_shape)),
                 ),
-                EnsureTyped(keys=["image"]),
                 # RemapTensord(keys=["image"], new_min=0.0, new_max=100.0),
             ]
         )
 
+        cache = self.get_preprocessing_cache(
+            ["image"], load_single_images, train_files
+        )
+        if cache is not None:
+            load_single_images = cache
+
         # Create the dataset
         dataset = CacheDataset(
             data=train_files,
-            transform=Compose([load_single_images, train_transforms]),
+            transform=Compose(
+                [
+                    load_single_images,
+                    EnsureTyped(keys=["image"]),
+                    train_transforms,
+                ]
+            ),
         )
 
         return first_volume_shape, dataset
@@ -388,6 +514,10 @@ class WNetTrainingWorker(TrainingWorkerBase):
             )
         if self.config.do_augmentation:
             self.log("Using data augmentation")
+        if self.config.use_amp:
+            self.log("Using mixed precision")
+        if self.config.channels_last:
+            self.log("Using channels-last memory format")
         ##############
         self.log("-- Model --")
         self.log(f"Using {self.config.num_classes} classes")
@@ -436,6 +566,7 @@ class WNetTrainingWorker(TrainingWorkerBase):
             # disable metadata tracking in MONAI
             set_track_meta(False)
             ##############
+            self.release_inference_models()
             if WANDB_INSTALLED:
                 config_dict = self.config.__dict__
                 logger.debug(f"wandb config : {config_dict}")
@@ -479,8 +610,18 @@ class WNetTrainingWorker(TrainingWorkerBase):
                 else provided_model
             )
             model.to(device)
-
-            if self.config.use_clipping:
+            amp = MixedPrecision(
+                device,
+                enabled=self.config.use_amp,
+                channels_last=self.config.channels_last,
+            )
+            model = amp.prepare_model(model)
+            throughput = ThroughputMeter(device)
+            # scaled gradients must be unscaled before clipping, see MixedPrecision.step
+            clip_after_unscale = (
+                self.config.use_clipping and amp.scaler.is_enabled()
+            )
+            if self.config.use_clipping and not clip_after_unscale:
                 for p in model.parameters():
                     p.register_hook(
                         lambda grad: torch.clamp(
@@ -571,27 +712,29 @@ class WNetTrainingWorker(TrainingWorkerBase):
             self.log("*" * 20)
 
             # Train the model
+            self._start_progress()
             for epoch in range(self.config.max_epochs):
                 self.log(f"Epoch {epoch + 1} of {self.config.max_epochs}")
 
                 epoch_ncuts_loss = 0
                 epoch_rec_loss = 0
                 epoch_loss = 0
+                throughput.start()
 
                 for _i, batch in enumerate(self.dataloader):
                     # raise NotImplementedError("testing")
                     image_batch = batch["image"].to(device)
                     # Normalize the image
-                    for i in range(image_batch.shape[0]):
-                        for j in range(image_batch.shape[1]):
-                            image_batch[i, j] = self.normalize_function(
-                                image_batch[i, j]
-                            )
+                    image_batch = self.normalize_function(image_batch)
+                    image_batch = amp.prepare_inputs(image_batch)
 
-                    # Forward pass
-                    enc, dec = model(image_batch)
-                    # Compute the Ncuts loss
-                    Ncuts = criterionE(enc, image_batch)
+                    with amp.autocast():
+                        # Forward pass
+                        enc, dec = model(image_batch)
+                        # Compute the Ncuts loss
+                        Ncuts = criterionE(enc, image_batch)
+                    # reconstruction losses are computed in float32 (BCE cannot be autocast)
+                    enc, dec = enc.float(), dec.float()
 
                     epoch_ncuts_loss += Ncuts.item()
                     if WANDB_INSTALLED:
@@ -629,13 +772,25 @@ class WNetTrainingWorker(TrainingWorkerBase):
                             {"Train/Weighted sum of losses": loss.item()}
                         )
 
-                    loss.backward(loss)
-                    optimizer.step()
+                    amp.step(
+                        loss,
+                        optimizer,
+                        gradient=loss.detach(),
+                        clip_value=self.config.clipping
+                        if clip_after_unscale
+                        else None,
+                    )
+                    throughput.update(image_batch.shape[0])
 
-                    yield TrainingReport(
-                        show_plot=False,
-                        weights=model.state_dict(),
-                        supervised=False,
+                    yield self._progress(
+                        epoch,
+                        _i + 1,
+                        len(self.dataloader),
+                        {
+                            "SoftNCuts": Ncuts.item(),
+                            "Reconstruction": reconstruction_loss.item(),
+                        },
+                        model,
                     )
 
                     if self._abort_requested:
@@ -656,6 +811,7 @@ class WNetTrainingWorker(TrainingWorkerBase):
                         if WANDB_INSTALLED:
                             wandb.finish()
 
+                self._log_throughput(throughput.stop())
                 self.ncuts_losses.append(
                     epoch_ncuts_loss / len(self.dataloader)
                 )
@@ -664,35 +820,38 @@ class WNetTrainingWorker(TrainingWorkerBase):
 
                 if self.eval_dataloader is None:
                     try:
-                        enc_out = enc[0].detach().cpu().numpy()
-                        dec_out = dec[0].detach().cpu().numpy()
-                        image_batch = image_batch[0].detach().cpu().numpy()
-
-                        images_dict = {
-                            "Encoder output": {
-                                "data": enc_out,
-                                "cmap": "turbo",
-                            },
-                            "Encoder output (discrete)": {
-                                "data": np.where(enc_out > 0.5, enc_out, 0),
-                                "cmap": "bop blue",
-                            },
-                            "Decoder output": {
-                                "data": np.squeeze(dec_out),
-                                "cmap": "gist_earth",
-                            },
-                            "Input image": {
-                                "data": np.squeeze(image_batch),
-                                "cmap": "inferno",
-                            },
-                        }
+                        images_dict = None
+                        if self._send_preview(epoch):
+                            enc_out = enc[0].detach().cpu().numpy()
+                            dec_out = dec[0].detach().cpu().numpy()
+                            image_batch = image_batch[0].detach().cpu().numpy()
+
+                            images_dict = {
+                                "Encoder output": {
+                                    "data": enc_out,
+                                    "cmap": "turbo",
+                                },
+                                "Encoder output (discrete)": {
+                                    "data": np.where(
+                                        enc_out > 0.5, enc_out, 0
+                                    ),
+                                    "cmap": "bop blue",
+                                },
+                                "Decoder output": {
+                                    "data": np.squeeze(dec_out),
+                                    "cmap": "gist_earth",
+                                },
+                                "Input image": {
+                                    "data": np.squeeze(image_batch),
+                                    "cmap": "inferno",
+                                },
+                            }
 
                         yield TrainingReport(
                             show_plot=True,
                             epoch=epoch,
                             loss_1_values={"SoftNCuts": self.ncuts_losses},
                             loss_2_values=self.rec_losses,
-                            weights=model.state_dict(),
                             images_dict=images_dict,
                             supervised=False,
                         )
@@ -763,9 +922,9 @@ class WNetTrainingWorker(TrainingWorkerBase):
                 self.log("-" * 20)
 
                 # Save the model
-                if epoch % 5 == 0:
-                    torch.save(
-                        model.state_dict(),
+                if epoch % self.config.checkpoint_interval == 0:
+                    self.checkpointer.save(
+                        model,
                         self.config.results_path_folder
                         + "/wnet_checkpoint.pth",
                     )
@@ -790,10 +949,14 @@ class WNetTrainingWorker(TrainingWorkerBase):
                 f"Saving the model to: {self.config.results_path_folder}/wnet.pth",
             )
             save_weights_path = self.config.results_path_folder + "/wnet.pth"
+            self.checkpointer.close()
             torch.save(
                 model.state_dict(),
                 save_weights_path,
             )
+            throughput.save(
+                self.config.results_path_folder + "/training_throughput.csv"
+            )
 
             if WANDB_INSTALLED and self.wandb_config.save_model_artifact:
                 model_artifact = wandb.Artifact(
@@ -828,6 +991,9 @@ class WNetTrainingWorker(TrainingWorkerBase):
             self.raise_error(e, msg)
             self.quit()
             raise e
+        finally:
+            # also on errors and when stopped, so that pending checkpoints are written
+            self.checkpointer.close()
 
     def eval(self, model, epoch) -> TrainingReport:
         """Evaluates the model on the validation set.
@@ -848,11 +1014,7 @@ class WNetTrainingWorker(TrainingWorkerBase):
                 )
 
                 # normalize val_inputs across channels
-                for i in range(val_inputs.shape[0]):
-                    for j in range(val_inputs.shape[1]):
-                        val_inputs[i][j] = self.normalize_function(
-                            val_inputs[i][j]
-                        )
+                val_inputs = self.normalize_function(val_inputs)
                 logger.debug(f"Val inputs shape: {val_inputs.shape}")
                 val_outputs = sliding_window_inference(
                     val_inputs,
@@ -909,36 +1071,40 @@ class WNetTrainingWorker(TrainingWorkerBase):
                     + "_best_metric.pth"
                 )
                 self.log(f"Saving new best model to {save_path}")
-                torch.save(model.state_dict(), save_path)
+                self.checkpointer.save(model, save_path)
 
             if WANDB_INSTALLED:
                 # log validation dice score for each validation round
                 wandb.log({"Validation/Dice metric": metric})
 
             self.dice_metric.reset()
-            dec_out_val = val_decoder_outputs[0].detach().cpu().numpy().copy()
-            enc_out_val = val_outputs[0].detach().cpu().numpy().copy()
-            lab_out_val = val_labels[0].detach().cpu().numpy().copy()
-            val_in = val_inputs[0].detach().cpu().numpy().copy()
-
-            display_dict = {
-                "Reconstruction": {
-                    "data": np.squeeze(dec_out_val),
-                    "cmap": "gist_earth",
-                },
-                "Segmentation": {
-                    "data": np.squeeze(enc_out_val),
-                    "cmap": "turbo",
-                },
-                "Inputs": {
-                    "data": np.squeeze(val_in),
-                    "cmap": "inferno",
-                },
-                "Labels": {
-                    "data": np.squeeze(lab_out_val),
-                    "cmap": "bop blue",
-                },
-            }
+            display_dict = None
+            if self._send_preview(epoch):
+                dec_out_val = (
+                    val_decoder_outputs[0].detach().cpu().numpy().copy()
+                )
+                enc_out_val = val_outputs[0].detach().cpu().numpy().copy()
+                lab_out_val = val_labels[0].detach().cpu().numpy().copy()
+                val_in = val_inputs[0].detach().cpu().numpy().copy()
+
+                display_dict = {
+                    "Reconstruction": {
+                        "data": np.squeeze(dec_out_val),
+                        "cmap": "gist_earth",
+                    },
+                    "Segmentation": {
+                        "data": np.squeeze(enc_out_val),
+                        "cmap": "turbo",
+                    },
+                    "Inputs": {
+                        "data": np.squeeze(val_in),
+                        "cmap": "inferno",
+                    },
+                    "Labels": {
+                        "data": np.squeeze(lab_out_val),
+                        "cmap": "bop blue",
+                    },
+                }
             val_decoder_outputs = None
             del val_decoder_outputs
             val_outputs = None
@@ -955,7 +1121,6 @@ class WNetTrainingWorker(TrainingWorkerBase):
                     "Dice metric": self.dice_values,
                 },
                 loss_2_values=self.rec_losses,
-                weights=model.state_dict(),
                 images_dict=display_dict,
                 supervised=False,
             )
@@ -1075,6 +1240,10 @@ class SupervisedTrainingWorker(TrainingWorkerBase):
 
         if self.config.do_augmentation:
             self.log("Data augmentation is enabled")
+        if self.config.use_amp:
+            self.log("Mixed precision is enabled")
+        if self.config.channels_last:
+            self.log("Channels-last memory format is enabled")
 
         if self.config.weights_info.use_custom:
             self.log(f"Using weights from : {self.config.weights_info.path}")
@@ -1151,6 +1320,7 @@ class SupervisedTrainingWorker(TrainingWorkerBase):
         start_time = time.time()
 
         try:
+            self.release_inference_models()
             if WANDB_INSTALLED:
                 config_dict = self.config.__dict__
                 logger.debug(f"wandb config : {config_dict}")
@@ -1190,7 +1360,7 @@ class SupervisedTrainingWorker(TrainingWorkerBase):
             model_class = model_config.get_model()
 
             ######## Check that labels are semantic, not instance
-            check_labels = LoadImaged(keys=["label"])(
+            check_labels = volume_loader(keys=["label"])(
                 self.config.train_data_dict[0]
             )
             if check_labels["label"].max() > 1:
@@ -1201,7 +1371,7 @@ class SupervisedTrainingWorker(TrainingWorkerBase):
             ########
 
             if not self.config.sampling:
-                data_check = LoadImaged(keys=["image"])(
+                data_check = volume_loader(keys=["image"])(
                     self.config.train_data_dict[0]
                 )
                 check = data_check["image"].shape
@@ -1217,6 +1387,13 @@ class SupervisedTrainingWorker(TrainingWorkerBase):
 
             device = torch.device(self.config.device)
             model = model.to(device)
+            amp = MixedPrecision(
+                device,
+                enabled=self.config.use_amp,
+                channels_last=self.config.channels_last,
+            )
+            model = amp.prepare_model(model)
+            throughput = ThroughputMeter(device)
 
             if WANDB_INSTALLED:
                 wandb.watch(model, log_freq=100)
@@ -1291,22 +1468,30 @@ class SupervisedTrainingWorker(TrainingWorkerBase):
                 ]
             )
 
-            def get_patch_loader_func(num_samples):
+            load = Compose(
+                [
+                    volume_loader(keys=["image", "label"]),
+                    EnsureChannelFirstd(keys=["image", "label"]),
+                ]
+            )
+            orientation = Orientationd(keys=["image", "label"], axcodes="PLI")
+
+            # patches are normalized with the quantiles of the volume they are cropped from
+            quantiles = VolumeQuantilesd(keys=["image"])
+
+            def get_patch_loader_func(num_samples, cache=None):
                 """Returns a function that will be used to extract patches from the images."""
-                return Compose(
+                crop = RandSpatialCropSamplesd(
+                    keys=["image", "label"],
+                    roi_size=(
+                        self.config.sample_size
+                    ),  # multiply by axis_stretch_factor if anisotropy
+                    # max_roi_size=(120, 120, 120),
+                    random_size=False,
+                    num_samples=num_samples,
+                )
+                pad_and_normalize = Compose(
                     [
-                        LoadImaged(keys=["image", "label"]),
-                        EnsureChannelFirstd(keys=["image", "label"]),
-                        RandSpatialCropSamplesd(
-                            keys=["image", "label"],
-                            roi_size=(
-                                self.config.sample_size
-                            ),  # multiply by axis_stretch_factor if anisotropy
-                            # max_roi_size=(120, 120, 120),
-                            random_size=False,
-                            num_samples=num_samples,
-                        ),
-                        Orientationd(keys=["image", "label"], axcodes="PLI"),
                         SpatialPadd(
                             keys=["image", "label"],
                             spatial_size=(
@@ -1317,8 +1502,21 @@ class SupervisedTrainingWorker(TrainingWorkerBase):
                         EnsureTyped(keys=["image"]),
                     ]
                 )
+                return Compose(
+                    [
+                        load if cache is None else cache,
+                        quantiles,
+                        crop,
+                        orientation,
+                        pad_and_normalize,
+                    ]
+                )
 
             if do_sampling:
+                # volumes are cached before reorienting, so that patches are cropped then reoriented either way
+                cache = self.get_preprocessing_cache(
+                    ["image", "label"], load, self.config.train_data_dict
+                )
                 # if there is only one volume, split samples
                 # TODO(cyril) : maybe implement something in user config to toggle this behavior
                 if len(self.config.train_data_dict) < 2:
@@ -1341,18 +1539,22 @@ class SupervisedTrainingWorker(TrainingWorkerBase):
                         num_val_samples = 2
 
                     sample_loader_train = get_patch_loader_func(
-                        num_train_samples
+                        num_train_samples, cache
+                    )
+                    sample_loader_eval = get_patch_loader_func(
+                        num_val_samples, cache
                     )
-                    sample_loader_eval = get_patch_loader_func(num_val_samples)
                 else:
                     num_train_samples = (
                         num_val_samples
                     ) = self.config.num_samples
 
                     sample_loader_train = get_patch_loader_func(
-                        num_train_samples
+                        num_train_samples, cache
+                    )
+                    sample_loader_eval = get_patch_loader_func(
+                        num_val_samples, cache
                     )
-                    sample_loader_eval = get_patch_loader_func(num_val_samples)
 
                 logger.debug(f"AMOUNT of train samples : {num_train_samples}")
                 logger.debug(
@@ -1376,7 +1578,7 @@ class SupervisedTrainingWorker(TrainingWorkerBase):
             else:
                 load_whole_images = Compose(
                     [
-                        LoadImaged(
+                        volume_loader(
                             keys=["image", "label"],
                             # image_only=True,
                             # reader=WSIReader(backend="tifffile")
@@ -1388,6 +1590,16 @@ class SupervisedTrainingWorker(TrainingWorkerBase):
                             keys=["image", "label"],
                             spatial_size=PADDING,
                         ),
+                    ]
+                )
+                cache = self.get_preprocessing_cache(
+                    ["image", "label"],
+                    load_whole_images,
+                    self.config.train_data_dict,
+                )
+                load_whole_images = Compose(
+                    [
+                        load_whole_images if cache is None else cache,
                         EnsureTyped(keys=["image", "label"]),
                     ]
                 )
@@ -1504,6 +1716,7 @@ class SupervisedTrainingWorker(TrainingWorkerBase):
             #     self.quit()
             #     yield TrainingReport(False)
 
+            self._start_progress()
             for epoch in range(self.config.max_epochs):
                 # self.log("\n")
                 self.log("-" * 10)
@@ -1522,10 +1735,11 @@ class SupervisedTrainingWorker(TrainingWorkerBase):
                 model.train()
                 epoch_loss = 0
                 step = 0
+                throughput.start()
                 for batch_data in train_loader:
                     step += 1
                     inputs, labels = (
-                        batch_data["image"].to(device),
+                        amp.prepare_inputs(batch_data["image"].to(device)),
                         batch_data["label"].to(device),
                     )
                     # logger.debug(f"Inputs shape : {inputs.shape}")
@@ -1534,22 +1748,23 @@ class SupervisedTrainingWorker(TrainingWorkerBase):
                         labels = labels.clamp(0, 1)
 
                     optimizer.zero_grad()
-                    outputs = model(inputs)
-                    # logger.debug(f"Output dimensions : {outputs.shape}")
-                    if outputs.shape[1] > 1:
-                        outputs = outputs[
-                            :, 1:, :, :
-                        ]  # TODO(cyril): adapt if additional channels
-                        if len(outputs.shape) < 4:
-                            outputs = outputs.unsqueeze(0)
+                    with amp.autocast():
+                        outputs = model(inputs)
+                        # logger.debug(f"Output dimensions : {outputs.shape}")
+                        if outputs.shape[1] > 1:
+                            outputs = outputs[
+                                :, 1:, :, :
+                            ]  # TODO(cyril): adapt if additional channels
+                            if len(outputs.shape) < 4:
+                                outputs = outputs.unsqueeze(0)
                     # logger.debug(f"Outputs shape : {outputs.shape}")
-                    loss = self.loss_function(outputs, labels)
+                    loss = self.loss_function(outputs.float(), labels)
 
                     if WANDB_INSTALLED:
                         wandb.log({"Training/Loss": loss.item()})
 
-                    loss.backward()
-                    optimizer.step()
+                    amp.step(loss, optimizer)
+                    throughput.update(inputs.shape[0])
                     epoch_loss += loss.detach().item()
                     self.log(
                         f"* {step}/{len(train_dataset) // train_loader.batch_size}, "
@@ -1574,10 +1789,12 @@ class SupervisedTrainingWorker(TrainingWorkerBase):
                         if WANDB_INSTALLED:
                             wandb.finish()
 
-                    yield TrainingReport(
-                        show_plot=False,
-                        weights=model.state_dict(),
-                        supervised=True,
+                    yield self._progress(
+                        epoch,
+                        step,
+                        len(train_loader),
+                        {"Loss": loss.detach().item()},
+                        model,
                     )
 
                 if WANDB_INSTALLED:
@@ -1590,6 +1807,7 @@ class SupervisedTrainingWorker(TrainingWorkerBase):
                         }
                     )
 
+                self._log_throughput(throughput.stop())
                 epoch_loss /= step
                 epoch_loss_values.append(epoch_loss)
                 self.log(f"Epoch: {epoch + 1}, Average loss: {epoch_loss:.4f}")
@@ -1608,6 +1826,13 @@ class SupervisedTrainingWorker(TrainingWorkerBase):
                 )
                 self.log("ETA: " + f"{eta:.2f}" + " minutes")
 
+                if (epoch + 1) % self.config.checkpoint_interval == 0:
+                    self.checkpointer.save(
+                        model,
+                        Path(self.config.results_path_folder)
+                        / f"{model_name}_latest.pth",
+                    )
+
                 if (
                     (epoch + 1) % self.config.validation_interval == 0
                     or epoch + 1 == self.config.max_epochs
@@ -1708,31 +1933,32 @@ class SupervisedTrainingWorker(TrainingWorkerBase):
                         dice_metric.reset()
                         val_metric_values.append(metric)
 
-                        images_dict = {
-                            "Validation output": {
-                                "data": checkpoint_output[0],
-                                "cmap": "turbo",
-                            },
-                            "Validation output (discrete)": {
-                                "data": checkpoint_output[1],
-                                "cmap": "bop blue",
-                            },
-                            "Validation image": {
-                                "data": checkpoint_output[2],
-                                "cmap": "inferno",
-                            },
-                            "Validation labels": {
-                                "data": checkpoint_output[3],
-                                "cmap": "green",
-                            },
-                        }
+                        images_dict = None
+                        if self._send_preview(epoch):
+                            images_dict = {
+                                "Validation output": {
+                                    "data": checkpoint_output[0],
+                                    "cmap": "turbo",
+                                },
+                                "Validation output (discrete)": {
+                                    "data": checkpoint_output[1],
+                                    "cmap": "bop blue",
+                                },
+                                "Validation image": {
+                                    "data": checkpoint_output[2],
+                                    "cmap": "inferno",
+                                },
+                                "Validation labels": {
+                                    "data": checkpoint_output[3],
+                                    "cmap": "green",
+                                },
+                            }
 
                         train_report = TrainingReport(
                             show_plot=True,
                             epoch=epoch,
                             loss_1_values={"Loss": epoch_loss_values},
                             loss_2_values=val_metric_values,
-                            weights=model.state_dict(),
                             images_dict=images_dict,
                             supervised=True,
                         )
@@ -1749,14 +1975,13 @@ class SupervisedTrainingWorker(TrainingWorkerBase):
                             best_metric = metric
                             best_metric_epoch = epoch + 1
                             self.log("Saving best metric model")
-                            torch.save(
-                                model.state_dict(),
+                            self.checkpointer.save(
+                                model,
                                 Path(self.config.results_path_folder)
                                 / Path(
                                     weights_filename,
                                 ),
                             )
-                            self.log("Saving complete")
                         self.log(
                             f"Current epoch: {epoch + 1}, Current mean dice: {metric:.4f}"
                             f"\nBest mean dice: {best_metric:.4f} "
@@ -1775,10 +2000,15 @@ class SupervisedTrainingWorker(TrainingWorkerBase):
             # Save last checkpoint
             weights_filename = f"{model_name}_latest.pth"
             self.log("Saving last model")
+            self.checkpointer.close()
             torch.save(
                 model.state_dict(),
                 Path(self.config.results_path_folder) / Path(weights_filename),
             )
+            throughput.save(
+                Path(self.config.results_path_folder)
+                / "training_throughput.csv"
+            )
             self.log("Saving complete, exiting")
             model.to("cpu")
 
@@ -1804,4 +2034,6 @@ class SupervisedTrainingWorker(TrainingWorkerBase):
             self.raise_error(e, "Error in training")
             self.quit()
         finally:
+            # also on errors and when stopped, so that pending checkpoints are written
+            self.checkpointer.close()
             self.quit()
@@ -1,22 +1,30 @@
 """Several worker-related utilities for inference and training."""
+import hashlib
+import inspect
+import shutil
+import tempfile
+import threading
+import time
 import typing as t
-from dataclasses import dataclass
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass, replace
 from pathlib import Path
 from typing import TYPE_CHECKING
 
 import numpy as np
 import torch
-from monai.transforms import MapTransform, Transform
-from qtpy.QtCore import Signal
-from superqt.utils._qthreading import WorkerBaseSignals
+from monai.data import MetaTensor
+from monai.transforms import Compose, EnsureType, MapTransform, Transform
 from tqdm import tqdm
 
 # local
-from napari_cellseg3d import interface as ui
 from napari_cellseg3d import utils
 from napari_cellseg3d.utils import LOGGER as logger
 
 if TYPE_CHECKING:
+    from napari_cellseg3d import interface as ui
     from napari_cellseg3d.code_models.instance_segmentation import ImageStats
 
 PRETRAINED_WEIGHTS_DIR = Path(__file__).parent.resolve() / Path(
@@ -27,7 +35,7 @@ PRETRAINED_WEIGHTS_DIR = Path(__file__).parent.resolve() / Path(
 class WeightsDownloader:
     """A utility class the downloads the weights of a model when needed."""
 
-    def __init__(self, log_widget: t.Optional[ui.Log] = None):
+    def __init__(self, log_widget: t.Optional["ui.Log"] = None):
         """Creates a WeightsDownloader, optionally with a log widget to display the progress.
 
         Args:
@@ -119,31 +127,6 @@ class WeightsDownloader:
             )
 
 
-class LogSignal(WorkerBaseSignals):
-    """Signal to send messages to be logged from another thread.
-
-    Separate from Worker instances as indicated `on this post`_
-
-    .. _on this post: https://stackoverflow.com/questions/2970312/pyqt4-qtcore-pyqtsignal-object-has-no-attribute-connect
-    """  # TODO link ?
-
-    log_signal = Signal(str)
-    """qtpy.QtCore.Signal: signal to be sent when some text should be logged"""
-    log_w_replace_signal = Signal(str)
-    """qtpy.QtCore.Signal: signal to be sent when some text should be logged, replacing the last line"""
-    warn_signal = Signal(str)
-    """qtpy.QtCore.Signal: signal to be sent when some warning should be emitted in main thread"""
-    error_signal = Signal(Exception, str)
-    """qtpy.QtCore.Signal: signal to be sent when some error should be emitted in main thread"""
-
-    # Should not be an instance variable but a class variable, not defined in __init__, see
-    # https://stackoverflow.com/questions/2970312/pyqt4-qtcore-pyqtsignal-object-has-no-attribute-connect
-
-    def __init__(self, parent=None):
-        """Creates a LogSignal."""
-        super().__init__(parent=parent)
-
-
 class TqdmToLogSignal:
     """File-like object to redirect tqdm output to the logger widget in the GUI that self.log emits to."""
 
@@ -206,8 +189,775 @@ class ONNXModelWrapper(torch.nn.Module):
         pass
 
 
+TORCH_LOAD_MMAP = "mmap" in inspect.signature(torch.load).parameters
+"""Whether torch.load can memory-map weight files (PyTorch 2.1+)."""
+
+
+def load_weights(path, device):
+    """Loads a state dict from a file, memory-mapping it if possible.
+
+    Memory-mapping avoids reading the whole file in RAM before copying the tensors to the device.
+    Files saved with the legacy (non-zip) serialization cannot be memory-mapped and are loaded normally.
+
+    Args:
+        path (str): path to the weights
+        device (str): device to load the tensors on
+    """
+    if TORCH_LOAD_MMAP:
+        try:
+            return torch.load(path, map_location=device, mmap=True)
+        except RuntimeError:
+            logger.debug(f"Could not memory-map {path}, loading it normally")
+    return torch.load(path, map_location=device)
+
+
+def get_weights_path(
+    model_info, weights_config, downloader: WeightsDownloader = None
+) -> str:
+    """Returns the path of the weights to load, downloading the pretrained weights if custom weights are not used."""
+    if weights_config.use_custom or Path(weights_config.path).suffix in [
+        ".pt",
+        ".onnx",
+    ]:
+        return str(weights_config.path)
+    model_class = model_info.get_model()
+    downloader = downloader if downloader is not None else WeightsDownloader()
+    downloader.download_weights(model_info.name, model_class.weights_file)
+    return str(PRETRAINED_WEIGHTS_DIR / Path(model_class.weights_file))
+
+
+def load_model(
+    model_info,
+    weights_config,
+    device,
+    downloader: WeightsDownloader = None,
+    log: callable = None,
+):
+    """Instantiates a model for inference and loads its weights.
+
+    Weights ending in ``.pt`` are loaded as a TorchScript model and weights ending in ``.onnx`` as an ONNX model.
+    Otherwise, the model class from ``model_info`` is instantiated and the weights are loaded in it,
+    downloading the pretrained weights if custom weights are not used.
+
+    Args:
+        model_info (config.ModelInfo): name and input size of the model
+        weights_config (config.WeightsInfo): weights to load
+        device (str): device to load the model on
+        downloader (WeightsDownloader): downloader for pretrained weights. If None, a new one is created.
+        log (callable): function to log progress with. If None, uses logger.info.
+
+    Returns:
+        torch.nn.Module: the model, ready for inference
+    """
+    log = log if log is not None else logger.info
+    dims = model_info.model_input_size
+    model_class = model_info.get_model()
+    log(f"Model name : {model_info.name}")
+
+    if Path(weights_config.path).suffix == ".pt":
+        log("Instantiating PyTorch jit model...")
+        return torch.jit.load(weights_config.path)
+    if Path(weights_config.path).suffix == ".onnx":
+        log("Instantiating ONNX model...")
+        return ONNXModelWrapper(weights_config.path)
+    # assume is .pth
+    log("Instantiating model...")
+    model = model_class(input_img_size=[dims, dims, dims])
+    model = model.to(device)
+    log("Loading weights...")
+    weights = get_weights_path(model_info, weights_config, downloader)
+    missing = model.load_state_dict(  # note that this is redefined in WNet_
+        load_weights(weights, device),
+        strict=False,  # True, # TODO(cyril): change to True
+    )
+    log(f"Weights status : {missing}")
+    log("Done")
+    return model
+
+
+class ModelCache:
+    """Process-wide cache of models loaded for inference, so that consecutive jobs do not reload the same model.
+
+    Models are keyed by name, weights file (path and modification time), device and input size,
+    and the least recently used model is evicted when more than ``max_models`` are cached.
+    Cached models are shared between jobs and must only be used for inference.
+    """
+
+    def __init__(self, max_models: int = 2):
+        """Creates an empty ModelCache.
+
+        Args:
+            max_models (int): maximum number of models kept loaded. If 0, models are never cached.
+        """
+        self.max_models = max_models
+        self._models = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        """Returns the number of cached models."""
+        return len(self._models)
+
+    @staticmethod
+    def get_key(model_info, weights_path, device):
+        """Returns the cache key of a model."""
+        path = Path(weights_path).resolve()
+        return (
+            model_info.name,
+            str(path),
+            path.stat().st_mtime_ns,
+            str(device),
+            model_info.model_input_size,
+        )
+
+    def get(
+        self,
+        model_info,
+        weights_config,
+        device,
+        downloader: WeightsDownloader = None,
+        log: callable = None,
+    ):
+        """Returns the model from the cache, loading it with :py:func:`load_model` if needed.
+
+        Args:
+            model_info (config.ModelInfo): name and input size of the model
+            weights_config (config.WeightsInfo): weights to load
+            device (str): device to load the model on
+            downloader (WeightsDownloader): downloader for pretrained weights. If None, a new one is created.
+            log (callable): function to log progress with. If None, uses logger.info.
+        """
+        log = log if log is not None else logger.info
+        weights_path = get_weights_path(model_info, weights_config, downloader)
+        key = self.get_key(model_info, weights_path, device)
+        with self._lock:
+            if key in self._models:
+                self._models.move_to_end(key)
+                log(f"Using cached model {model_info.name}")
+                return self._models[key]
+            model = load_model(
+                model_info,
+                replace(weights_config, path=weights_path, use_custom=True),
+                device,
+                log=log,
+            )
+            if self.max_models > 0:
+                self._models[key] = model
+                while len(self._models) > self.max_models:
+                    evicted, _ = self._models.popitem(last=False)
+                    logger.debug(f"Evicted model {evicted[0]} from cache")
+                self._empty_cuda_cache()
+            return model
+
+    def clear(self):
+        """Removes all models from the cache."""
+        with self._lock:
+            self._models.clear()
+            self._empty_cuda_cache()
+
+    @staticmethod
+    def _empty_cuda_cache():
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+
+MODEL_CACHE = ModelCache()
+"""Models cache shared by the inference plugin, the headless inference and scripts."""
+
+
+def autotune_sw_batch_size(
+    predictor: callable,
+    window_size: int,
+    in_channels: int = 1,
+    device="cpu",
+    candidates=(1, 2, 4, 8, 16, 32),
+    memory_budget: t.Optional[float] = None,
+    n_repeats: int = 2,
+) -> int:
+    """Times the predictor on batches of random windows and returns the batch size with the highest throughput.
+
+    Candidates are tried in increasing order; tuning stops as soon as a batch size exceeds the memory budget,
+    runs out of memory, or is clearly slower than the best one found so far.
+
+    Args:
+        predictor (callable): function taking a NCZYX tensor and returning the prediction for it
+        window_size (int): size of the sliding window
+        in_channels (int): number of input channels of the model
+        device (str): device the predictor runs on
+        candidates (tuple): batch sizes to try
+        memory_budget (float): maximum memory in MB a batch may use. If None, uses the free memory on CUDA devices and is unlimited on CPU.
+            On CPU, memory use is estimated from the size of the input and output tensors.
+        n_repeats (int): number of timed runs for each batch size, after one warm-up run
+
+    Returns:
+        int: the batch size with the highest number of windows processed per second
+    """
+    use_cuda = torch.device(device).type == "cuda"
+    if memory_budget is not None:
+        budget = memory_budget * 1024**2
+    elif use_cuda:
+        budget = torch.cuda.mem_get_info(device)[0]
+    else:
+        budget = None
+
+    best_batch_size, best_throughput = min(candidates), 0
+    for batch_size in sorted(candidates):
+        inputs = torch.rand(
+            batch_size, in_channels, window_size, window_size, window_size
+        ).to(device)
+        try:
+            if use_cuda:
+                torch.cuda.reset_peak_memory_stats(device)
+            with torch.no_grad():
+                outputs = predictor(inputs)  # warm-up
+                if use_cuda:
+                    torch.cuda.synchronize(device)
+                start = time.perf_counter()
+                for _ in range(n_repeats):
+                    outputs = predictor(inputs)
+                if use_cuda:
+                    torch.cuda.synchronize(device)
+                elapsed = time.perf_counter() - start
+        except RuntimeError as e:  # most likely out of memory
+            logger.debug(f"Batch size {batch_size} failed : {e}")
+            break
+        finally:
+            if use_cuda:
+                torch.cuda.empty_cache()
+
+        if use_cuda:
+            memory_used = torch.cuda.max_memory_allocated(device)
+        else:
+            memory_used = (
+                inputs.element_size() * inputs.nelement()
+                + outputs.element_size() * outputs.nelement()
+            )
+        if budget is not None and memory_used > budget:
+            logger.debug(
+                f"Batch size {batch_size} exceeds memory budget ({memory_used} > {budget} bytes)"
+            )
+            break
+
+        throughput = n_repeats * batch_size / max(elapsed, 1e-9)
+        logger.debug(f"Batch size {batch_size} : {throughput:.2f} windows/s")
+        if throughput > best_throughput:
+            best_batch_size, best_throughput = batch_size, throughput
+        elif throughput < 0.9 * best_throughput:
+            break
+    return best_batch_size
+
+
+def cpu_supports_bf16() -> bool:
+    """Returns True if the CPU has native bfloat16 support, used for mixed-precision on CPU."""
+    try:
+        return bool(torch.ops.mkldnn._is_mkldnn_bf16_supported())
+    except (AttributeError, RuntimeError):
+        return False
+
+
+class MixedPrecision:
+    """Handles autocasting and gradient scaling for mixed-precision (AMP) training.
+
+    Uses float16 with gradient scaling on CUDA, and bfloat16 on CPU if supported.
+    When disabled or unsupported, autocasting and scaling are no-ops and training runs in float32.
+    """
+
+    def __init__(self, device, enabled=False, channels_last=False):
+        """Creates a MixedPrecision helper.
+
+        Args:
+            device (str): device used for training
+            enabled (bool): whether to use mixed precision
+            channels_last (bool): whether to use the channels-last memory format for models and 3D inputs
+        """
+        self.device_type = torch.device(device).type
+        self.dtype = (
+            torch.float16 if self.device_type == "cuda" else torch.bfloat16
+        )
+        self.enabled = enabled
+        if enabled and self.device_type == "cpu" and not cpu_supports_bf16():
+            logger.warning(
+                "bfloat16 is not supported on this CPU, mixed precision is disabled"
+            )
+            self.enabled = False
+        elif enabled and self.device_type not in ["cpu", "cuda"]:
+            logger.warning(
+                f"Mixed precision is not supported on {self.device_type}, it is disabled"
+            )
+            self.enabled = False
+        self.channels_last = channels_last
+        use_scaler = self.enabled and self.device_type == "cuda"
+        try:
+            self.scaler = torch.amp.GradScaler("cuda", enabled=use_scaler)
+        except AttributeError:  # torch < 2.3
+            self.scaler = torch.cuda.amp.GradScaler(enabled=use_scaler)
+
+    @property
+    def description(self) -> str:
+        """Returns a short description of the precision in use."""
+        return str(self.dtype).split(".")[-1] if self.enabled else "float32"
+
+    def autocast(self):
+        """Returns a context manager in which operations run in mixed precision."""
+        return torch.autocast(
+            device_type=self.device_type,
+            dtype=self.dtype,
+            enabled=self.enabled,
+        )
+
+    def prepare_model(self, model):
+        """Converts the model to the channels-last memory format, if enabled."""
+        if self.channels_last:
+            model = model.to(memory_format=torch.channels_last_3d)
+        return model
+
+    def prepare_inputs(self, inputs: torch.Tensor) -> torch.Tensor:
+        """Converts 3D inputs (NCHWD) to the channels-last memory format, if enabled."""
+        if self.channels_last and inputs.ndim == 5:
+            inputs = inputs.contiguous(memory_format=torch.channels_last_3d)
+        return inputs
+
+    def step(self, loss, optimizer, gradient=None, clip_value=None):
+        """Runs the backward pass and the optimizer step, scaling gradients if needed.
+
+        Args:
+            loss (torch.Tensor): loss to backpropagate
+            optimizer (torch.optim.Optimizer): optimizer to step
+            gradient (torch.Tensor): gradient of the loss, passed to ``backward``
+            clip_value (float): if not None, gradients are unscaled and clipped to [-clip_value, clip_value]
+                before the optimizer step, so that the clipping applies to the true gradients
+        """
+        self.scaler.scale(loss).backward(gradient)
+        if clip_value is not None:
+            self.scaler.unscale_(optimizer)
+            parameters = [
+                p for group in optimizer.param_groups for p in group["params"]
+            ]
+            torch.nn.utils.clip_grad_value_(parameters, clip_value)
+        self.scaler.step(optimizer)
+        self.scaler.update()
+
+
+class ThroughputMeter:
+    """Records the training throughput and peak memory usage of each epoch."""
+
+    def __init__(self, device):
+        """Creates a ThroughputMeter for the given device."""
+        self.device = torch.device(device)
+        self.records = []
+        self._samples = 0
+        self._start_time = None
+
+    def start(self):
+        """Starts measuring an epoch."""
+        self._samples = 0
+        if self.device.type == "cuda":
+            torch.cuda.reset_peak_memory_stats(self.device)
+        self._start_time = time.time()
+
+    def update(self, batch_size: int):
+        """Records that a batch of ``batch_size`` samples was processed."""
+        self._samples += batch_size
+
+    def stop(self) -> dict:
+        """Stops measuring the current epoch and returns its record."""
+        if self.device.type == "cuda":
+            torch.cuda.synchronize(self.device)
+        elapsed = time.time() - self._start_time
+        record = {
+            "epoch": len(self.records) + 1,
+            "samples": self._samples,
+            "time (s)": elapsed,
+            "samples/s": self._samples / elapsed if elapsed > 0 else np.nan,
+            "peak memory (MB)": (
+                torch.cuda.max_memory_allocated(self.device) / 1024**2
+                if self.device.type == "cuda"
+                else np.nan
+            ),
+        }
+        self.records.append(record)
+        return record
+
+    def save(self, path):
+        """Saves the records of all epochs to a csv file."""
+        if len(self.records) == 0:
+            return
+        with Path(path).open("w") as f:
+            f.write(",".join(self.records[0].keys()) + "\n")
+            for record in self.records:
+                f.write(",".join(str(v) for v in record.values()) + "\n")
+
+
+def state_dict_to_cpu(model) -> dict:
+    """Returns a copy of the weights of a model on the CPU, detached from the model parameters."""
+    return {
+        key: value.detach().to("cpu", copy=True)
+        for key, value in model.state_dict().items()
+    }
+
+
+class AsyncCheckpointer:
+    """Saves model checkpoints in a background thread, so that training does not wait for the disk.
+
+    The weights are copied to the CPU when :py:meth:`save` is called, so that they are not affected
+    by the following training steps. Checkpoints are written one at a time, in the order they were requested.
+    """
+
+    def __init__(self):
+        """Creates an AsyncCheckpointer. The background thread is started on the first save."""
+        self._executor = None
+        self._pending = []
+
+    def save(self, model, path):
+        """Saves the weights of a model to path in the background.
+
+        Args:
+            model (torch.nn.Module): model to save the weights of
+            path (str): path of the checkpoint file
+        """
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix="cellseg3d_checkpoint"
+            )
+        weights = state_dict_to_cpu(model)
+        self._pending = [f for f in self._pending if not f.done()]
+        self._pending.append(
+            self._executor.submit(self._write, weights, str(path))
+        )
+
+    @staticmethod
+    def _write(weights, path):
+        try:
+            torch.save(weights, path)
+        except Exception as e:
+            logger.error(f"Could not save checkpoint to {path} : {e}")
+            raise
+
+    def wait(self):
+        """Waits for all pending checkpoints to be written."""
+        for future in self._pending:
+            future.exception()  # errors are logged by the writer
+        self._pending = []
+
+    def close(self):
+        """Waits for pending checkpoints and stops the background thread."""
+        self.wait()
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+
+class StageTimer:
+    """Accumulates the time spent in each stage of a pipeline, from any number of threads.
+
+    Used to report how busy each stage was over the run, to find which one limits throughput.
+    """
+
+    def __init__(self):
+        """Creates a StageTimer, starting the wall clock."""
+        self.busy_time = {}
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def time(self, stage: str):
+        """Context manager adding the time spent in its block to ``stage``."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.busy_time[stage] = (
+                    self.busy_time.get(stage, 0.0) + elapsed
+                )
+
+    def timed(self, stage: str, func: callable) -> callable:
+        """Returns ``func`` wrapped so that its calls are timed as ``stage``."""
+
+        def wrapper(*args, **kwargs):
+            with self.time(stage):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    def utilization(self, workers: t.Optional[t.Dict[str, int]] = None):
+        """Returns the fraction of the elapsed time each stage was busy.
+
+        Args:
+            workers (dict): number of workers of each stage, the busy time of a stage is divided by it. Defaults to 1.
+        """
+        workers = workers if workers is not None else {}
+        elapsed = max(time.perf_counter() - self._start, 1e-9)
+        return {
+            stage: busy / (elapsed * workers.get(stage, 1))
+            for stage, busy in self.busy_time.items()
+        }
+
+
+DATASET_CACHE_VERSION = 2
+"""Version of the preprocessed data cache format, changing it invalidates existing caches."""
+
+
+def hash_file(path, chunk_size: int = 2**20) -> str:
+    """Returns a hash of the content of a file, read in chunks."""
+    file_hash = hashlib.blake2b(digest_size=16)
+    with Path(path).open("rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+def transform_fingerprint(transform) -> str:
+    """Returns a string describing a (deterministic) transform and its parameters, stable across runs.
+
+    Public attributes of MONAI transforms are described recursively, other objects only by their type.
+    """
+    if transform is None or isinstance(transform, (bool, int, float, str)):
+        return repr(transform)
+    if isinstance(transform, (list, tuple)):
+        return f"[{','.join(transform_fingerprint(t) for t in transform)}]"
+    if isinstance(transform, dict):
+        return f"{{{','.join(f'{k}:{transform_fingerprint(v)}' for k, v in sorted(transform.items()))}}}"
+    if isinstance(transform, np.ndarray) and transform.size <= 64:
+        return repr(transform.tolist())
+    if isinstance(transform, (torch.dtype, np.dtype)):
+        return str(transform)
+    if isinstance(transform, Transform) or hasattr(transform, "transforms"):
+        attributes = ",".join(
+            f"{k}={transform_fingerprint(v)}"
+            for k, v in sorted(vars(transform).items())
+            if not k.startswith("_") and k != "R"  # skip random state
+        )
+        return f"{type(transform).__name__}({attributes})"
+    return type(transform).__name__
+
+
+class PersistentCached(MapTransform):
+    """MONAI-style dict transform that runs a deterministic preprocessing transform once and caches its results on disk.
+
+    Results are stored as .npy files in a folder named after a hash of the input files content
+    and of the preprocessing transform parameters, so that changing either invalidates the cache.
+    Cached volumes are memory-mapped (copy-on-write), so that subsequent random transforms only read the parts they need.
+    The affine and source file of MONAI-loaded volumes are cached too, and cached volumes are returned as MetaTensors,
+    so that transforms applied after the cache (e.g. reorienting patches, or :py:class:`VolumeQuantilesd`)
+    behave as without the cache.
+    """
+
+    def __init__(
+        self,
+        keys,
+        transform: Transform,
+        cache_path,
+        allow_missing_keys: bool = False,
+    ):
+        """Creates a PersistentCached transform.
+
+        Args:
+            keys: keys of the data to preprocess, whose values are file paths or arrays
+            transform (Transform): deterministic preprocessing to cache, e.g. loading, reorienting and padding
+            cache_path (str): folder in which to store preprocessed data
+            allow_missing_keys (bool): don't raise an error if a key is missing
+        """
+        super().__init__(keys, allow_missing_keys)
+        self.transform = transform
+        self.cache_path = Path(cache_path)
+        self.fingerprint = (
+            f"v{DATASET_CACHE_VERSION}:{transform_fingerprint(transform)}"
+        )
+        self._file_hashes = {}
+
+    def _hash_input(self, value) -> str:
+        if isinstance(value, (str, Path)):
+            stat = Path(value).stat()
+            file_id = (str(value), stat.st_size, stat.st_mtime_ns)
+            if file_id not in self._file_hashes:
+                self._file_hashes[file_id] = hash_file(value)
+            return self._file_hashes[file_id]
+        return hashlib.blake2b(
+            np.ascontiguousarray(value).tobytes(), digest_size=16
+        ).hexdigest()
+
+    def cache_key(self, data) -> str:
+        """Returns the name of the cache entry for the given data."""
+        key_hash = hashlib.blake2b(self.fingerprint.encode(), digest_size=16)
+        for key in self.key_iterator(data):
+            key_hash.update(f"{key}:{self._hash_input(data[key])}".encode())
+        return key_hash.hexdigest()
+
+    def prepare(self, data_list) -> int:
+        """Preprocesses and caches all items of a dataset that are not cached yet.
+
+        Returns:
+            int: number of items that were already cached
+        """
+        hits = 0
+        for data in data_list:
+            if (self.cache_path / self.cache_key(data)).is_dir():
+                hits += 1
+            else:
+                self._write(data)
+        return hits
+
+    def _write(self, data):
+        entry = self.cache_path / self.cache_key(data)
+        result = self.transform(dict(data))
+        self.cache_path.mkdir(parents=True, exist_ok=True)
+        tmp = Path(tempfile.mkdtemp(prefix=".tmp_", dir=self.cache_path))
+        try:
+            for key in self.key_iterator(data):
+                value = result[key]
+                if isinstance(value, MetaTensor):
+                    np.save(tmp / f"{key}_affine.npy", value.affine.numpy())
+                    (tmp / f"{key}_source.txt").write_text(
+                        str(get_source_path(value) or "")
+                    )
+                if isinstance(value, torch.Tensor):
+                    value = value.detach().cpu().numpy()
+                np.save(tmp / f"{key}.npy", np.asarray(value))
+            tmp.rename(entry)  # atomic, fails if another process wrote it
+        except OSError:
+            if not entry.is_dir():
+                raise
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+        return entry
+
+    def __call__(self, data):
+        """Returns the preprocessed data, from the cache if available."""
+        d = dict(data)
+        entry = self.cache_path / self.cache_key(d)
+        if not entry.is_dir():
+            entry = self._write(d)
+        for key in self.key_iterator(d):
+            d[key] = np.load(entry / f"{key}.npy", mmap_mode="c")
+            if (entry / f"{key}_affine.npy").is_file():
+                meta = {}
+                source = (entry / f"{key}_source.txt").read_text()
+                if source:
+                    meta["filename_or_obj"] = source
+                d[key] = MetaTensor(
+                    torch.from_numpy(d[key]),
+                    affine=torch.from_numpy(
+                        np.load(entry / f"{key}_affine.npy")
+                    ),
+                    meta=meta,
+                )
+        return d
+
+
+class QuantileCache:
+    """Process-wide cache of the quantiles of volumes on disk, so that each volume is only scanned once.
+
+    Quantiles are keyed by file path, size and modification time, so that a modified file is scanned again.
+    See :py:func:`napari_cellseg3d.utils.compute_quantiles`.
+    """
+
+    def __init__(self, max_entries: int = 256):
+        """Creates an empty QuantileCache.
+
+        Args:
+            max_entries (int): maximum number of volumes whose quantiles are kept
+        """
+        self.max_entries = max_entries
+        self._quantiles = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        """Returns the number of cached volumes."""
+        return len(self._quantiles)
+
+    @staticmethod
+    def get_key(path, quantile_low, quantile_high):
+        """Returns the cache key of a volume, or None if it is not a file on disk."""
+        try:
+            path = Path(path).resolve()
+            stat = path.stat()
+        except (TypeError, OSError):
+            return None
+        return (
+            str(path),
+            stat.st_size,
+            stat.st_mtime_ns,
+            quantile_low,
+            quantile_high,
+        )
+
+    def get(self, volume, path=None, quantile_low=0.01, quantile_high=0.99):
+        """Returns the low and high quantiles of a volume, computing them if needed.
+
+        Args:
+            volume (array-like): the volume, in memory or lazily-loaded
+            path (str): file the volume was read from. If None, quantiles are computed without being cached.
+            quantile_low (float): low quantile, between 0 and 1
+            quantile_high (float): high quantile, between 0 and 1
+        """
+        key = (
+            self.get_key(path, quantile_low, quantile_high)
+            if path is not None
+            else None
+        )
+        with self._lock:
+            if key is not None and key in self._quantiles:
+                self._quantiles.move_to_end(key)
+                return self._quantiles[key]
+        quantiles = utils.compute_quantiles(
+            volume, quantile_low, quantile_high
+        )
+        if key is not None:
+            with self._lock:
+                self._quantiles[key] = quantiles
+                while len(self._quantiles) > self.max_entries:
+                    self._quantiles.popitem(last=False)
+        return quantiles
+
+    def clear(self):
+        """Removes all quantiles from the cache."""
+        with self._lock:
+            self._quantiles.clear()
+
+
+QUANTILE_CACHE = QuantileCache()
+"""Quantiles of the volumes normalized by this process."""
+
+
+def get_source_path(image):
+    """Returns the file a MONAI-loaded image was read from, or that a memory-mapped image maps (e.g. a cache entry), or None."""
+    if isinstance(image, np.memmap):
+        return image.filename
+    meta = getattr(image, "meta", None)
+    if not meta:
+        return None
+    path = meta.get("filename_or_obj")
+    if isinstance(path, (list, tuple)):
+        path = path[0] if len(path) == 1 else None
+    return path
+
+
+class VolumeQuantilesd(MapTransform):
+    """MONAI-style dict transform storing the quantiles of whole volumes, to normalize patches cropped from them consistently.
+
+    Quantiles are stored under ``"{key}_quantiles"`` and used by :py:class:`QuantileNormalizationd`.
+    """
+
+    def __init__(self, keys, allow_missing_keys: bool = False):
+        """Creates a VolumeQuantilesd transform."""
+        super().__init__(keys, allow_missing_keys)
+
+    def __call__(self, data):
+        """Computes the quantiles of each volume, see :py:class:`QuantileCache`."""
+        d = dict(data)
+        for key in self.key_iterator(d):
+            d[f"{key}_quantiles"] = QUANTILE_CACHE.get(
+                d[key], path=get_source_path(d[key])
+            )
+        return d
+
+
 class QuantileNormalizationd(MapTransform):
-    """MONAI-style dict transform to normalize each image in a batch individually by quantile normalization."""
+    """MONAI-style dict transform to normalize each image in a batch individually by quantile normalization.
+
+    If quantiles were stored by :py:class:`VolumeQuantilesd`, they are used instead of those of the image.
+    """
 
     def __init__(self, keys, allow_missing_keys: bool = False):
         """Creates a QuantileNormalizationd transform."""
@@ -217,14 +967,17 @@ class QuantileNormalizationd(MapTransform):
         """Normalize each image in a batch individually by quantile normalization."""
         d = dict(data)
         for key in self.keys:
-            d[key] = self.normalizer(d[key])
+            quantile_values = d.pop(f"{key}_quantiles", None)
+            d[key] = self.normalizer(d[key], quantile_values)
         return d
 
-    def normalizer(self, image: torch.Tensor):
+    def normalizer(self, image: torch.Tensor, quantile_values=None):
         """Normalize each image in a batch individually by quantile normalization."""
         if image.ndim == 4:
             for i in range(image.shape[0]):
-                image[i] = utils.quantile_normalization(image[i])
+                image[i] = utils.quantile_normalization(
+                    image[i], quantile_values=quantile_values
+                )
         else:
             raise NotImplementedError(
                 "QuantileNormalizationd only supports 2D and 3D tensors with NCHWD format"
@@ -233,11 +986,26 @@ class QuantileNormalizationd(MapTransform):
 
 
 class QuantileNormalization(Transform):
-    """MONAI-style transform to normalize each image in a batch individually by quantile normalization."""
+    """MONAI-style transform to normalize each image in a batch individually by quantile normalization.
+
+    To normalize all windows or tiles of a volume the same way, pass the quantiles of the whole volume,
+    e.g. from :py:data:`QUANTILE_CACHE`.
+    """
+
+    def __init__(self, quantile_values=None):
+        """Creates a QuantileNormalization transform.
+
+        Args:
+            quantile_values (tuple): low and high values to clip inputs to. If None, computed from each input.
+        """
+        super().__init__()
+        self.quantile_values = quantile_values
 
     def __call__(self, img):
         """Normalize each image in a batch individually by quantile normalization."""
-        return utils.quantile_normalization(img)
+        return utils.quantile_normalization(
+            img, quantile_values=self.quantile_values
+        )
 
 
 class RemapTensor(Transform):
@@ -259,6 +1027,108 @@ class RemapTensor(Transform):
         return utils.remap_image(img, new_max=self.max, new_min=self.min)
 
 
+class NormalizeBatch(Transform):
+    """MONAI-style transform normalizing every image of a batch at once, in place and on the batch's device.
+
+    Each image (all dimensions after the first ``batch_dims``, e.g. each sample and channel of a NCHWD batch)
+    is normalized with its own statistics, computed in a single reduction over the whole batch :
+
+    * ``"remap"`` : rescales each image from its [min, max] range to [new_min, new_max], like :py:func:`napari_cellseg3d.utils.remap_image`.
+      Min-max normalization is remapping to [0, 1]. Constant images are set to ``new_min``.
+    * ``"quantile"`` : clips each image to its low and high quantiles, like :py:func:`napari_cellseg3d.utils.quantile_normalization`.
+    """
+
+    MODES = ["remap", "quantile"]
+
+    def __init__(
+        self,
+        mode: str = "remap",
+        new_min: float = 0,
+        new_max: float = 1,
+        quantile_low: float = 0.01,
+        quantile_high: float = 0.99,
+        batch_dims: int = 2,
+    ):
+        """Creates a NormalizeBatch transform.
+
+        Args:
+            mode (str): normalization to apply, see :py:attr:`MODES`
+            new_min (float): minimum of the remapped images
+            new_max (float): maximum of the remapped images
+            quantile_low (float): low quantile to clip to, between 0 and 1
+            quantile_high (float): high quantile to clip to, between 0 and 1
+            batch_dims (int): number of leading dimensions indexing images, e.g. 2 for NCHWD batches and 1 for CHWD images
+        """
+        super().__init__()
+        if mode not in self.MODES:
+            raise ValueError(
+                f"Unknown normalization mode {mode}, choose from {self.MODES}"
+            )
+        if quantile_high < quantile_low:
+            raise ValueError(
+                f"quantile_high must be greater than quantile_low, got {quantile_high} and {quantile_low}"
+            )
+        self.mode = mode
+        self.new_min = new_min
+        self.new_max = new_max
+        self.quantile_low = quantile_low
+        self.quantile_high = quantile_high
+        self.batch_dims = batch_dims
+
+    def _quantile(self, flat, quantile):
+        """Returns the quantile of each row, with linear interpolation like torch.quantile but without its size limit (2**24 elements)."""
+        position = quantile * (flat.shape[1] - 1)
+        below = int(position)
+        low = torch.kthvalue(flat, below + 1, dim=1).values
+        if position == below:
+            return low
+        high = torch.kthvalue(flat, below + 2, dim=1).values
+        return low + (position - below) * (high - low)
+
+    def __call__(self, img):
+        """Normalizes the images of the batch in place and returns it. Numpy arrays are modified in place too."""
+        batch = torch.as_tensor(img)
+        if not batch.is_floating_point():
+            raise TypeError(
+                f"NormalizeBatch requires floating point images, got {batch.dtype}"
+            )
+        shape = batch.shape[: self.batch_dims] + (1,) * (
+            batch.ndim - self.batch_dims
+        )
+        flat = batch.reshape(*batch.shape[: self.batch_dims], -1).flatten(
+            end_dim=self.batch_dims - 1
+        )
+        if self.mode == "remap":
+            # separate amin/amax reductions are faster than aminmax on CPU
+            low, high = flat.amin(dim=1), flat.amax(dim=1)
+            value_range = high - low
+            scale = torch.where(
+                value_range > 0,
+                (self.new_max - self.new_min) / value_range,
+                torch.zeros_like(value_range),
+            )
+            offset = self.new_min - low * scale
+            batch.mul_(scale.reshape(shape)).add_(offset.reshape(shape))
+        else:
+            if flat.numel() <= utils.EXACT_QUANTILES_MAX_SIZE:
+                low, high = torch.quantile(
+                    flat,
+                    torch.tensor(
+                        [self.quantile_low, self.quantile_high],
+                        dtype=flat.dtype,
+                        device=flat.device,
+                    ),
+                    dim=1,
+                )
+            else:
+                low = self._quantile(flat, self.quantile_low)
+                high = self._quantile(flat, self.quantile_high)
+            low, high = low.reshape(shape), high.reshape(shape)
+            torch.maximum(batch, low, out=batch)
+            torch.minimum(batch, high, out=batch)
+        return img
+
+
 # class RemapTensord(MapTransform):
 #     def __init__(
 #         self, keys, new_max, new_min, allow_missing_keys: bool = False
@@ -296,6 +1166,21 @@ class Threshold(Transform):
         return torch.Tensor(res).float()
 
 
+def get_post_process_transforms(thresholding) -> Compose:
+    """Returns the transforms applied to model outputs during inference.
+
+    Outputs are remapped to [0, 1], then thresholded if enabled in ``thresholding``.
+
+    Args:
+        thresholding (config.Thresholding): thresholding config
+    """
+    transforms = [RemapTensor(new_max=1.0, new_min=0.0)]
+    if thresholding.enabled:
+        transforms.append(Threshold(threshold=thresholding.threshold_value))
+    transforms.append(EnsureType())
+    return Compose(transforms)
+
+
 @dataclass
 class InferenceResult:
     """Class to record results of a segmentation job."""
@@ -317,10 +1202,26 @@ class TrainingReport:
     epoch: int = 0
     loss_1_values: t.Dict = None  # example : {"Loss" : [0.1, 0.2, 0.3]}
     loss_2_values: t.List = None
-    weights: np.array = None
     images_dict: t.Dict = (
         None  # output, discrete output, target, target labels
     )
     supervised: bool = True
     # OR decoder output, encoder output, target, target labels
     # format : {"Layer name" : {"data" : np.array, "cmap" : "turbo"}}
+
+
+@dataclass
+class TrainingProgress:
+    """Lightweight progress event sent by training workers after each training step.
+
+    Only contains scalars, except for the weights which are only sent when requested,
+    see :py:meth:`~napari_cellseg3d.code_models.worker_training.TrainingWorkerBase.request_weights`.
+    """
+
+    epoch: int = 0
+    step: int = 0
+    total_steps: int = 0
+    losses: t.Dict[str, float] = None  # example : {"Loss" : 0.1}
+    step_time: float = 0.0  # in seconds
+    elapsed_time: float = 0.0  # in seconds, since the start of training
+    weights: t.Dict = None  # CPU copy of the state dict, only if requested
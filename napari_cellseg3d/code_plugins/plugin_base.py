@@ -1,20 +1,63 @@
 """Base classes for napari_cellseg3d plugins."""
+import os
 from functools import partial
 from pathlib import Path
 
 import napari
+from napari.qt.threading import GeneratorWorker
 
 # Qt
 from qtpy.QtCore import qInstallMessageHandler
-from qtpy.QtWidgets import QTabWidget, QWidget
+from qtpy.QtWidgets import QProgressBar, QTabWidget, QWidget
 
 # local
 from napari_cellseg3d import interface as ui
 from napari_cellseg3d import utils
+from napari_cellseg3d.code_models.batch_processing import iter_process_files
 
 logger = utils.LOGGER
 
 
+class BatchWorker(GeneratorWorker):
+    """Worker processing files with :py:func:`~napari_cellseg3d.code_models.batch_processing.iter_process_files`, yielding (index, result path) as each file finishes.
+
+    Quitting the worker cancels the files that have not been started yet.
+    """
+
+    def __init__(
+        self, paths, function, output_folder, num_workers=1, dtype=None
+    ):
+        """Creates a worker.
+
+        Args:
+            paths (list): paths to the images
+            function (callable): picklable transform taking an image and returning the processed image
+            output_folder (str): folder to write the results to, created if needed
+            num_workers (int): number of processes, and maximum number of files processed at once
+            dtype (np.dtype): type the results are cast to before writing
+        """
+        super().__init__(self._run)
+        self.paths = paths
+        self.function = function
+        self.output_folder = output_folder
+        self.num_workers = num_workers
+        self.dtype = dtype
+
+    def _run(self):
+        results = iter_process_files(
+            self.paths,
+            self.function,
+            self.output_folder,
+            self.num_workers,
+            self.dtype,
+        )
+        try:
+            yield from results
+        finally:
+            results.close()  # also on quit, to stop submitting files
+        logger.info(f"Saved processed folder as : {self.output_folder}")
+
+
 class BasePluginSingleImage(QTabWidget):
     """A basic plugin template for working with **single images**."""
 
@@ -497,6 +540,8 @@ class BasePluginUtils(BasePluginFolder):
 
     save_path = None
     utils_default_paths = [Path.home() / "cellseg3d"]
+    processes_folders = False
+    """Whether folders are processed with :py:meth:`_start_batch`, in which case the folder processing widgets are shown"""
 
     def __init__(
         self,
@@ -519,6 +564,98 @@ class BasePluginUtils(BasePluginFolder):
         self.layer = None
         """Should contain the layer associated with the results of the utility widget"""
 
+        ################
+        # Folder processing widgets
+        self.batch_worker = None
+        """BatchWorker processing the current folder, if any"""
+        self.num_workers_choice = ui.IntIncrementCounter(
+            lower=1,
+            upper=os.cpu_count() or 1,
+            default=1,
+            parent=self,
+            text_label="Files processed in parallel",
+        )
+        self.batch_progress = QProgressBar(self)
+        self.batch_progress.setVisible(False)
+        self.cancel_batch_btn = ui.Button("Cancel", self._cancel_batch)
+        self.cancel_batch_btn.setVisible(False)
+        self.batch_container = ui.ContainerWidget(b=0, parent=self)
+        ui.add_widgets(
+            self.batch_container.layout,
+            [
+                self.num_workers_choice.label,
+                self.num_workers_choice,
+                self.batch_progress,
+                self.cancel_batch_btn,
+            ],
+        )
+
+        self.num_workers_choice.setToolTip(
+            "Number of files processed at the same time, each in its own process.\n"
+            "Each file is read, processed and saved one at a time, so memory use grows with this number."
+        )
+        self.cancel_batch_btn.setToolTip(
+            "Stop processing the folder. Files being processed are finished and saved."
+        )
+
+    def _build_io_panel(self):
+        """Also adds the folder processing widgets, shown in folder mode if :py:attr:`processes_folders` is True."""
+        io_panel = super()._build_io_panel()
+        io_panel.layout.addWidget(self.batch_container)
+        return io_panel
+
+    def _set_io_visibility(self):
+        super()._set_io_visibility()
+        if self.processes_folders:
+            self._show_io_element(self.batch_container, self.folder_choice)
+            ui.toggle_visibility(self.folder_choice, self.batch_container)
+        else:
+            self._hide_io_element(self.batch_container)
+
+    def _start_batch(self, paths, function, folder_name, dtype=None):
+        """Processes files in a worker, writing the results to a new folder in the results path.
+
+        Args:
+            paths (list): paths to the images
+            function (callable): picklable transform taking an image and returning the processed image
+            folder_name (str): name of the results folder
+            dtype (np.dtype): type the results are cast to before writing
+        """
+        if self.batch_worker is not None:
+            logger.warning("A folder is already being processed")
+            return
+        self.batch_worker = BatchWorker(
+            paths,
+            function,
+            str(Path(self.results_path) / folder_name),
+            num_workers=self.num_workers_choice.value(),
+            dtype=dtype,
+        )
+        self.batch_worker.yielded.connect(self._on_batch_yield)
+        self.batch_worker.errored.connect(logger.exception)
+        self.batch_worker.finished.connect(self._on_batch_finished)
+        self.batch_progress.setRange(0, len(paths))
+        self.batch_progress.setValue(0)
+        self.batch_progress.setVisible(True)
+        self.cancel_batch_btn.setVisible(True)
+        self.batch_worker.start()
+
+    def _on_batch_yield(self, result):
+        index, output_path = result
+        self.batch_progress.setValue(self.batch_progress.value() + 1)
+        if output_path is not None:
+            logger.debug(f"Processed file {index} : {output_path}")
+
+    def _on_batch_finished(self):
+        self.batch_worker = None
+        self.batch_progress.setVisible(False)
+        self.cancel_batch_btn.setVisible(False)
+
+    def _cancel_batch(self):
+        if self.batch_worker is not None:
+            logger.info("Cancelling folder processing...")
+            self.batch_worker.quit()
+
     def _update_default_paths(self, path=None):
         """Override to also update utilities' pool of default paths."""
         default_path = super()._update_default_paths(path)
@@ -1,4 +1,5 @@
 """Several image processing utilities."""
+from functools import partial
 from pathlib import Path
 from warnings import warn
 
@@ -11,7 +12,6 @@ from tifffile import imread
 import napari_cellseg3d.interface as ui
 from napari_cellseg3d import utils
 from napari_cellseg3d.code_models.instance_segmentation import (
-    InstanceWidgets,
     clear_large_objects,
     clear_small_objects,
     threshold,
@@ -31,6 +31,7 @@ class ArtifactRemovalUtils(BasePluginUtils):
     """Class to remove artifacts from images by removing large objects."""
 
     save_path = Path.home() / "cellseg3d" / "artifact_removed"
+    processes_folders = True
 
     def __init__(self, viewer: "napari.Viewer.viewer", parent=None):
         """Creates a ArtifactRemovalUtils widget.
@@ -122,15 +123,11 @@ class ArtifactRemovalUtils(BasePluginUtils):
         elif (
             self.folder_choice.isChecked() and len(self.labels_filepaths) != 0
         ):
-            images = [
-                self._remove_large(imread(file), remove_size)
-                for file in self.labels_filepaths
-            ]
-            utils.save_folder(
-                self.results_path,
-                f"artifact_removed_results_{utils.get_date_time()}",
-                images,
+            self._start_batch(
                 self.labels_filepaths,
+                partial(clear_large_objects, large_label_size=remove_size),
+                f"artifact_removed_results_{utils.get_date_time()}",
+                dtype=np.uint16,
             )
         else:
             logger.warning("Please specify a layer or a folder")
@@ -232,6 +229,7 @@ class AnisoUtils(BasePluginUtils):
     """Class to correct anisotropy in images."""
 
     save_path = Path.home() / "cellseg3d" / "anisotropy"
+    processes_folders = True
 
     def __init__(self, viewer: "napari.Viewer.viewer", parent=None):
         """Creates a AnisoUtils widget.
@@ -314,15 +312,10 @@ class AnisoUtils(BasePluginUtils):
         elif (
             self.folder_choice.isChecked() and len(self.images_filepaths) != 0
         ):
-            images = [
-                utils.resize(np.array(imread(file)), zoom)
-                for file in self.images_filepaths
-            ]
-            utils.save_folder(
-                self.results_path,
-                f"isotropic_results_{utils.get_date_time()}",
-                images,
+            self._start_batch(
                 self.images_filepaths,
+                partial(utils.resize, zoom_factors=zoom),
+                f"isotropic_results_{utils.get_date_time()}",
             )
 
 
@@ -330,6 +323,7 @@ class RemoveSmallUtils(BasePluginUtils):
     """Widget to remove small objects."""
 
     save_path = Path.home() / "cellseg3d" / "small_removed"
+    processes_folders = True
 
     def __init__(self, viewer: "napari.viewer.Viewer", parent=None):
         """Creates a RemoveSmallUtils widget.
@@ -417,17 +411,12 @@ class RemoveSmallUtils(BasePluginUtils):
                     add_as_labels=True,
                 )
         elif (
-            self.folder_choice.isChecked() and len(self.images_filepaths) != 0
+            self.folder_choice.isChecked() and len(self.labels_filepaths) != 0
         ):
-            images = [
-                clear_small_objects(file, remove_size, is_file_path=True)
-                for file in self.images_filepaths
-            ]
-            utils.save_folder(
-                self.results_path,
+            self._start_batch(
+                self.labels_filepaths,
+                partial(clear_small_objects, threshold=remove_size),
                 f"small_removed_results_{utils.get_date_time()}",
-                images,
-                self.images_filepaths,
             )
         return
 
@@ -436,6 +425,7 @@ class ToSemanticUtils(BasePluginUtils):
     """Widget to create semantic labels from instance labels."""
 
     save_path = Path.home() / "cellseg3d" / "semantic_labels"
+    processes_folders = True
 
     def __init__(self, viewer: "napari.viewer.Viewer", parent=None):
         """Creates a ToSemanticUtils widget.
@@ -507,15 +497,10 @@ class ToSemanticUtils(BasePluginUtils):
         elif (
             self.folder_choice.isChecked() and len(self.labels_filepaths) != 0
         ):
-            images = [
-                to_semantic(file, is_file_path=True)
-                for file in self.labels_filepaths
-            ]
-            utils.save_folder(
-                self.results_path,
-                f"semantic_results_{utils.get_date_time()}",
-                images,
+            self._start_batch(
                 self.labels_filepaths,
+                to_semantic,
+                f"semantic_results_{utils.get_date_time()}",
             )
         else:
             logger.warning("Please specify a layer or a folder")
@@ -525,6 +510,7 @@ class ToInstanceUtils(BasePluginUtils):
     """Widget to convert semantic labels to instance labels."""
 
     save_path = Path.home() / "cellseg3d" / "instance_labels"
+    processes_folders = True
 
     def __init__(self, viewer: "napari.viewer.Viewer", parent=None):
         """Creates a ToInstanceUtils widget.
@@ -545,7 +531,7 @@ class ToInstanceUtils(BasePluginUtils):
         self.image_layer_loader.layer_list.label.setText("Layer :")
         self.image_layer_loader.set_layer_type(napari.layers.Layer)
 
-        self.instance_widgets = InstanceWidgets(parent=self)
+        self.instance_widgets = ui.InstanceWidgets(parent=self)
         self.start_btn = ui.Button("Start", self._start)
 
         self.results_path = str(self.save_path)
@@ -602,15 +588,14 @@ class ToInstanceUtils(BasePluginUtils):
         elif (
             self.folder_choice.isChecked() and len(self.images_filepaths) != 0
         ):
-            images = [
-                self.instance_widgets.run_method(imread(file))
-                for file in self.images_filepaths
+            method = self.instance_widgets.methods[
+                self.instance_widgets.method_choice.currentText()
             ]
-            utils.save_folder(
-                self.results_path,
-                f"instance_results_{utils.get_date_time()}",
-                images,
+            # files are processed in parallel, tiles of each file are not
+            self._start_batch(
                 self.images_filepaths,
+                method.as_function(n_workers=1),
+                f"instance_results_{utils.get_date_time()}",
             )
 
 
@@ -623,6 +608,7 @@ class ThresholdUtils(BasePluginUtils):
     """
 
     save_path = Path.home() / "cellseg3d" / "threshold"
+    processes_folders = True
 
     def __init__(self, viewer: "napari.viewer.Viewer", parent=None):
         """Creates a ThresholdUtils widget."""
@@ -711,15 +697,10 @@ class ThresholdUtils(BasePluginUtils):
         elif (
             self.folder_choice.isChecked() and len(self.images_filepaths) != 0
         ):
-            images = [
-                self.function(imread(file), remove_size)
-                for file in self.images_filepaths
-            ]
-            utils.save_folder(
-                self.results_path,
-                f"threshold_results_{utils.get_date_time()}",
-                images,
+            self._start_batch(
                 self.images_filepaths,
+                partial(self.function, thresh=remove_size),
+                f"threshold_results_{utils.get_date_time()}",
             )
 
 
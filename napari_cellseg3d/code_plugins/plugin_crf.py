@@ -1,5 +1,6 @@
 """CRF plugin for napari_cellseg3d."""
 import contextlib
+import os
 from functools import partial
 from pathlib import Path
 
@@ -10,9 +11,11 @@ from tqdm import tqdm
 from napari_cellseg3d import config, utils
 from napari_cellseg3d import interface as ui
 from napari_cellseg3d.code_models.crf import (
+    CRF_BACKENDS,
     CRF_INSTALLED,
     CRFWorker,
     crf_with_config,
+    get_backend,
 )
 from napari_cellseg3d.code_plugins.plugin_base import BasePluginUtils
 from napari_cellseg3d.utils import LOGGER as logger
@@ -27,6 +30,12 @@ class CRFParamsWidget(ui.GroupedWidget):
         super().__init__(title="CRF parameters", parent=parent)
         #######
         # CRF params #
+        self.backend_choice = ui.DropdownMenu(
+            CRF_BACKENDS if CRF_INSTALLED else ["torch"],
+            parent=self,
+            text_label="CRF implementation",
+        )
+        self.backend_choice.currentTextChanged.connect(self._toggle_backend)
         self.sa_choice = ui.DoubleIncrementCounter(
             default=10, parent=self, text_label="Alpha std"
         )
@@ -45,32 +54,31 @@ class CRFParamsWidget(ui.GroupedWidget):
         self.n_iter_choice = ui.IntIncrementCounter(
             default=5, parent=self, text_label="Number of iterations"
         )
+        self.tile_size_choice = ui.IntIncrementCounter(
+            lower=0,
+            upper=1024,
+            default=0,
+            step=16,
+            parent=self,
+            text_label="Block size (0 : whole volume)",
+        )
+        self.num_workers_choice = ui.IntIncrementCounter(
+            lower=1,
+            upper=os.cpu_count() or 1,
+            default=1,
+            parent=self,
+            text_label="Parallel processes",
+        )
         #######
         self._build()
         self._set_tooltips()
 
     def _build(self):
-        if not CRF_INSTALLED:
-            self.sa_choice.setVisible(False)
-            self.sb_choice.setVisible(False)
-            self.sg_choice.setVisible(False)
-            self.w1_choice.setVisible(False)
-            self.w2_choice.setVisible(False)
-            self.n_iter_choice.setVisible(False)
-            ###
-            ui.add_widgets(
-                self.layout,
-                [
-                    ui.make_label(
-                        "ERROR: CRF not installed.\nPlease refer to the documentation to install it."
-                    ),
-                ],
-            )
-            self._set_layout()
-            return
         ui.add_widgets(
             self.layout,
             [
+                self.backend_choice.label,
+                self.backend_choice,
                 # self.sa_choice.label,
                 self.sa_choice,
                 # self.sb_choice.label,
@@ -83,11 +91,29 @@ class CRFParamsWidget(ui.GroupedWidget):
                 self.w2_choice,
                 # self.n_iter_choice.label,
                 self.n_iter_choice,
+                self.tile_size_choice.label,
+                self.tile_size_choice,
+                self.num_workers_choice.label,
+                self.num_workers_choice,
             ],
         )
         self._set_layout()
+        self._toggle_backend()
+
+    def _toggle_backend(self):
+        """Shows the process count only for pydensecrf, the torch backend runs blocks one at a time on one device."""
+        use_processes = (
+            get_backend(self.backend_choice.currentText()) == "pydensecrf"
+        )
+        self.num_workers_choice.setVisible(use_processes)
+        self.num_workers_choice.label.setVisible(use_processes)
 
     def _set_tooltips(self):
+        self.backend_choice.setToolTip(
+            "pydensecrf : exact dense CRF, on CPU. Requires pydensecrf to be installed.\n"
+            "torch : faster approximate CRF, running on GPU if available.\n"
+            "auto : pydensecrf if it is installed, torch otherwise."
+        )
         self.sa_choice.setToolTip(
             "SA : Standard deviation of the Gaussian kernel in the appearance term."
         )
@@ -104,6 +130,15 @@ class CRFParamsWidget(ui.GroupedWidget):
             "W2 : Weight of the smoothness term in the CRF."
         )
         self.n_iter_choice.setToolTip("Number of iterations of the CRF.")
+        self.tile_size_choice.tooltips = (
+            "Size of the overlapping blocks large volumes are split into.\n"
+            "Memory use depends on the block size instead of the volume size.\n"
+            "Set to 0 to run the CRF on whole volumes."
+        )
+        self.num_workers_choice.tooltips = (
+            "Number of processes running blocks (or whole images) in parallel.\n"
+            "Each process needs the memory of one block."
+        )
 
     def make_config(self):
         """Make a CRF config from the widget values."""
@@ -114,6 +149,9 @@ class CRFParamsWidget(ui.GroupedWidget):
             w1=self.w1_choice.value(),
             w2=self.w2_choice.value(),
             n_iters=self.n_iter_choice.value(),
+            tile_size=self.tile_size_choice.value() or None,
+            num_workers=self.num_workers_choice.value(),
+            backend=self.backend_choice.currentText(),
         )
 
 
@@ -145,11 +183,6 @@ class CRFWidget(BasePluginUtils):
         self.image_layer_loader.setVisible(True)
         self.label_layer_loader.layer_list.label.setText("Model output :")
 
-        if CRF_INSTALLED:
-            self.start_button.setVisible(True)
-        else:
-            self.start_button.setVisible(False)
-
         self.result_layer = None
         self.result_name = None
         self.crf_results = []
@@ -298,7 +298,7 @@ class Cropping(
 
         self.image_layer1 = self.image_layer_loader.layer()
 
-        if len(self.image_layer1.data) > 3:
+        if len(self.image_layer1.data.shape) > 3:
             self.image_layer1.data = np.squeeze(self.image_layer1.data)
 
         if self.crop_second_image:
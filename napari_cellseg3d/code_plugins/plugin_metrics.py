@@ -1,4 +1,6 @@
-"""CURRENTLY UNUSED."""
+"""Metrics plugin, evaluating predicted labels against ground truth labels."""
+import os
+from pathlib import Path
 from typing import TYPE_CHECKING
 
 import matplotlib.pyplot as plt
@@ -7,7 +9,6 @@ from matplotlib.backends.backend_qt5agg import (
     FigureCanvasQTAgg as FigureCanvas,
 )
 from matplotlib.figure import Figure
-from monai.transforms import SpatialPad, ToTensor
 from tifffile import imread
 
 if TYPE_CHECKING:
@@ -15,10 +16,18 @@ if TYPE_CHECKING:
 
 from napari_cellseg3d import interface as ui
 from napari_cellseg3d import utils
-from napari_cellseg3d.code_models.instance_segmentation import to_semantic
+from napari_cellseg3d.code_models.metrics_engine import (
+    ORIENTATIONS,
+    MetricsWorker,
+    orient,
+)
 from napari_cellseg3d.code_plugins.plugin_base import BasePluginFolder
+from napari_cellseg3d.utils import LOGGER as logger
 
 DEFAULT_THRESHOLD = 0.5
+METRICS_CSV = "metrics_{}.csv"
+"""Name of the csv file the metrics are saved to in the predictions folder, formatted with the date and time,
+so that previous evaluations are not overwritten."""
 
 
 class MetricsUtils(BasePluginFolder):
@@ -42,6 +51,11 @@ class MetricsUtils(BasePluginFolder):
         """Canvas to render plots on"""
         self.plots = []
         """Array that references all plots currently on the window"""
+        self.dice_plot = None
+        """Axes of the current plot"""
+        self.results = []
+        """Metrics of each pair of the current session, None until evaluated"""
+        self.worker = None
 
         ######################################
         # interface
@@ -54,6 +68,14 @@ class MetricsUtils(BasePluginFolder):
         self.btn_compute_dice = ui.Button("Compute Dice", self.compute_dice)
 
         self.rotate_choice = ui.CheckBox("Find best orientation")
+        self.surface_choice = ui.CheckBox("Compute surface distances")
+        self.num_workers_choice = ui.IntIncrementCounter(
+            lower=1,
+            upper=os.cpu_count() or 1,
+            default=1,
+            parent=self,
+            text_label="Parallel processes",
+        )
 
         self.btn_reset_plot = ui.Button("Clear plots", self.remove_plots)
 
@@ -69,9 +91,16 @@ class MetricsUtils(BasePluginFolder):
             "This will rotate and flip your images to find the orientation with the best Dice coefficient.\n"
             "Use this if your labels and predictions are not oriented the same way."
         )
+        self.surface_choice.setToolTip(
+            "Also compute the 95th percentile Hausdorff distance and the mean surface distance of each pair.\n"
+            "This is much slower than the Dice coefficient on large volumes."
+        )
         self.threshold_box.setToolTip(
             "Any label-prediction pair below this threshold will be shown in napari"
         )
+        self.num_workers_choice.tooltips = (
+            "Number of label pairs evaluated in parallel"
+        )
         self.btn_reset_plot.setToolTip("Erase all plots")
 
         self._build()
@@ -112,7 +141,15 @@ class MetricsUtils(BasePluginFolder):
         )
 
         ui.add_widgets(
-            param_group_l, [thresh_container, self.rotate_choice], None
+            param_group_l,
+            [
+                thresh_container,
+                self.rotate_choice,
+                self.surface_choice,
+                self.num_workers_choice.label,
+                self.num_workers_choice,
+            ],
+            None,
         )
 
         param_group_w.setLayout(param_group_l)
@@ -132,15 +169,28 @@ class MetricsUtils(BasePluginFolder):
 
         ui.ScrollArea.make_scrollable(self.layout, self)
 
-    def plot_dice(self, dice_coeffs, threshold=DEFAULT_THRESHOLD):
-        """Plots the dice loss for each pair of labels on viewer."""
+    def plot_dice(
+        self, dice_coeffs, threshold=DEFAULT_THRESHOLD, finished=None
+    ):
+        """Plots the dice loss for each pair of labels on viewer.
+
+        Args:
+            dice_coeffs (list): Dice coefficient of each pair
+            threshold (float): pairs below this score are shown in red
+            finished (list): whether each pair has been evaluated yet. Pending pairs are shown in grey.
+        """
         self.btn_reset_plot.setVisible(True)
         colors = []
+        finished = (
+            finished if finished is not None else [True] * len(dice_coeffs)
+        )
 
         bckgrd_color = (0, 0, 0, 0)
 
-        for coeff in dice_coeffs:  # TODO add threshold manual setting
-            if coeff < threshold:
+        for coeff, done in zip(dice_coeffs, finished):
+            if not done:
+                colors.append("grey")
+            elif coeff < threshold:
                 colors.append(ui.dark_red)  # 72071d # crimson red
             else:
                 colors.append(ui.default_cyan)  # 8dd3c7 # turquoise cyan
@@ -149,10 +199,12 @@ class MetricsUtils(BasePluginFolder):
                 self.canvas = FigureCanvas(Figure(figsize=(2, 5)))
                 self.layout.addWidget(self.canvas)
                 self.canvas.figure.tight_layout()
+                self.dice_plot = self.canvas.figure.add_subplot(1, 1, 1)
+                self.plots.append(self.canvas)
             else:
                 self.dice_plot.cla()
             self.canvas.figure.set_facecolor(bckgrd_color)
-            dice_plot = self.canvas.figure.add_subplot(1, 1, 1)
+            dice_plot = self.dice_plot
             labels = np.array(range(len(dice_coeffs))) + 1
 
             dice_plot.barh(labels, dice_coeffs, color=colors)
@@ -160,10 +212,10 @@ class MetricsUtils(BasePluginFolder):
 
             dice_plot.invert_yaxis()
 
-            self.plots.append(self.canvas)
             dice_plot.axvline(threshold, color=ui.dark_red)
+            done_coeffs = [c for c, d in zip(dice_coeffs, finished) if d]
             dice_plot.set_title(
-                f"Session {len(self.plots)}\nMean dice : {np.mean(dice_coeffs):.4f}"
+                f"Session {len(self.plots)}\nMean dice : {np.mean(done_coeffs):.4f}"
             )
             # dice_plot.set_xticks(rotation=45)
             dice_plot.set_xlabel("Dice coefficient")
@@ -180,123 +232,57 @@ class MetricsUtils(BasePluginFolder):
         self.btn_reset_plot.setVisible(False)
 
     def compute_dice(self):
-        """Computes the dice metric between pairs of labels.
+        """Computes the metrics between pairs of labels, in a worker.
 
-        Rotates the prediction label to find matching orientation as well.
+        Rotates the prediction label to find matching orientation as well, if selected.
+        Results are plotted and saved to a new csv file next to the predictions as each pair finishes.
         """
-        # u = 0
-        # t = 0
-
-        threshold = self.threshold_box.value()
-        rotate = self.rotate_choice.isChecked()
-
-        total_metrics = []
+        pairs = list(zip(self.images_filepaths, self.labels_filepaths))
+        if len(pairs) == 0:
+            logger.warning("No label pairs to evaluate")
+            return
         self.canvas = (
             None  # kind of terrible way to stack plots... but it works.
         )
-        image_id = 0
-        for ground_path, pred_path in zip(
-            self.images_filepaths, self.labels_filepaths
-        ):
-            image_id += 1
-            ground = imread(ground_path)
-            pred = imread(pred_path)
-
-            ground = to_semantic(ground).astype(np.int8)
-            pred = to_semantic(pred).astype(np.int8)
-
-            pred_dims = pred.shape[-3:]
-            # ground_dims = ground.shape[-3:]
-            # print(pred_dims)
-            # print(ground_dims)
-            pad_pred = utils.get_padding_dim(pred_dims)
-            # pad_ground = utils.get_padding_dim(ground_dims)
-
-            # origin, target = utils.align_array_sizes(array_shape=pad_ground, target_shape=pad_pred)
-
-            # ground = np.moveaxis(ground, origin, target)
-            # print(ground.shape)
-            # print(pred.shape)
-
-            while len(pred.shape) < 5:
-                pred = np.expand_dims(pred, axis=0)
-                # print("-")
-            while len(ground.shape) < 4:
-                ground = np.expand_dims(ground, axis=0)
-            ground = (SpatialPad(pad_pred)(ToTensor()(ground))).numpy()
-            while len(ground.shape) < len(pred.shape):
-                ground = np.expand_dims(ground, axis=0)
-                # print("&")
-
-            # print(ground.shape)
-            # print(pred.shape)
-
-            if ground.shape != pred.shape:
-                raise ValueError(
-                    f"Padded sizes of images do not match ! Padded ground label : {ground.shape} Padded pred label : {pred.shape}"
-                )
-            # if u < 1:
-            # self._viewer.add_image(
-            #     ground, name="ground", colormap="blue", opacity=0.7
-            # )
-            # self._viewer.add_image(pred, name="pred", colormap="red")
-            # self._viewer.add_image(
-            #     np.rot90(pred[0][0], axes=(0, 1)),
-            #     name="pred flip 0",
-            #     colormap="red",
-            #     opacity=0.7,
-            # )
-            # self._viewer.add_image(
-            #     np.rot90(pred[0][0], axes=(1, 2)),
-            #     name="pred flip 1",
-            #     colormap="red",
-            #     opacity=0.7,
-            # )
-            # self._viewer.add_image(
-            #     np.rot90(pred[0][0], axes=(0, 2)),
-            #     name="pred flip 2",
-            #     colormap="red",
-            #     opacity=0.7,
-            # )
-            # u += 1
-
-            scores = []
-            if rotate:  # TODO : recored best rotation for display
-                pred_flip_x = np.rot90(pred[0][0], axes=(0, 1))
-                pred_flip_y = np.rot90(pred[0][0], axes=(1, 2))
-                pred_flip_z = np.rot90(pred[0][0], axes=(0, 2))
-
-                for p in [pred[0][0], pred_flip_x, pred_flip_y, pred_flip_z]:
-                    scores.append(utils.dice_coeff(p, ground))
-                    scores.append(utils.dice_coeff(np.flip(p), ground))
-                    for i in range(3):
-                        scores.append(
-                            utils.dice_coeff(np.flip(p, axis=i), ground)
-                        )
-            else:
-                i = 0
-                scores.append(utils.dice_coeff(pred, ground))
-            # if t < 1:
-            #     for i in range(3):
-            #         self._viewer.add_image(
-            #             np.flip(pred_flip_x, axis=i),
-            #             name=f"flip",
-            #             colormap="green",
-            #             opacity=0.7,
-            #         )
-            #     t += 1
-
-            # print(scores)
-            score = max(scores)
-            if score < threshold:
-                # TODO add filename ?
-                self._viewer.dims.ndisplay = 3
-                self._viewer.add_image(
-                    ground, name=f"ground_{i+1}", colormap="blue", opacity=0.7
-                )
-                self._viewer.add_image(
-                    pred, name=f"pred_{i+1}", colormap="red", opacity=0.7
-                )
-            total_metrics.append(score)
-        # print(f"DICE METRIC :{total_metrics}")
-        self.plot_dice(total_metrics, threshold)
+        self.results = [None] * len(pairs)
+        csv_path = Path(self.labels_filepaths[0]).parent / METRICS_CSV.format(
+            utils.get_date_time()
+        )
+        self.worker = MetricsWorker(
+            pairs,
+            csv_path=csv_path,
+            rotate=self.rotate_choice.isChecked(),
+            surface=self.surface_choice.isChecked(),
+            num_workers=self.num_workers_choice.value(),
+        )
+        self.worker.yielded.connect(self._on_yield)
+        self.worker.errored.connect(logger.exception)
+        self.worker.finished.connect(
+            lambda: self.btn_compute_dice.setEnabled(True)
+        )
+        self.btn_compute_dice.setEnabled(False)
+        self.worker.start()
+
+    def _on_yield(self, result):
+        index, metrics = result
+        self.results[index] = metrics
+        threshold = self.threshold_box.value()
+        if metrics["dice"] < threshold:
+            # TODO add filename ?
+            ground = imread(metrics["ground_truth"])
+            pred = orient(
+                imread(metrics["prediction"]),
+                ORIENTATIONS[metrics["orientation"]],
+            )
+            self._viewer.dims.ndisplay = 3
+            self._viewer.add_image(
+                ground, name=f"ground_{index+1}", colormap="blue", opacity=0.7
+            )
+            self._viewer.add_image(
+                pred, name=f"pred_{index+1}", colormap="red", opacity=0.7
+            )
+        self.plot_dice(
+            [r["dice"] if r is not None else 0 for r in self.results],
+            threshold,
+            finished=[r is not None for r in self.results],
+        )
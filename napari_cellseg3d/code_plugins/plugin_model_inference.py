@@ -8,20 +8,37 @@ import pandas as pd
 if TYPE_CHECKING:
     import napari
 
+    from napari_cellseg3d.code_models.instance_segmentation import (
+        InstanceMethod,
+    )
+
 # local
 from napari_cellseg3d import config, utils
 from napari_cellseg3d import interface as ui
-from napari_cellseg3d.code_models.instance_segmentation import (
-    InstanceMethod,
-    InstanceWidgets,
-)
 from napari_cellseg3d.code_models.model_framework import ModelFramework
+from napari_cellseg3d.code_models.results_writer import (
+    PROBABILITY_DTYPES,
+    ZARR_INSTALLED,
+)
 from napari_cellseg3d.code_models.worker_inference import InferenceWorker
-from napari_cellseg3d.code_models.workers_utils import InferenceResult
+from napari_cellseg3d.code_models.workers_utils import (
+    MODEL_CACHE,
+    InferenceResult,
+)
 from napari_cellseg3d.code_plugins.plugin_crf import CRFParamsWidget
 
 logger = utils.LOGGER
 
+RESULTS_FORMATS = {
+    "TIFF": {"format": "tif"},
+    "Compressed TIFF (zstd)": {"format": "tif", "compression": "zstd"},
+}
+if ZARR_INSTALLED:
+    RESULTS_FORMATS["OME-Zarr (zstd)"] = {
+        "format": "zarr",
+        "compression": "zstd",
+    }
+
 
 class Inferer(ModelFramework, metaclass=ui.QWidgetSingleton):
     """A plugin to run already trained models in evaluation mode to preform inference and output a label on all given volumes."""
@@ -173,8 +190,37 @@ class Inferer(ModelFramework, metaclass=ui.QWidgetSingleton):
             text_label="Overlap %",
         )
 
+        self.window_batch_size_choice = ui.IntIncrementCounter(
+            lower=1,
+            upper=64,
+            default=config.SlidingWindowConfig.sw_batch_size,
+            text_label="Window batch size",
+        )
+        self.auto_tune_batch_size_choice = ui.CheckBox(
+            "Auto-tune batch size", func=self._toggle_window_batch_size
+        )
+
         self.keep_data_on_cpu_box = ui.CheckBox("Keep data on CPU")
 
+        self.use_tiled_inference_choice = ui.CheckBox(
+            "Out-of-core (tiled) inference",
+            func=self._toggle_display_tile_size,
+        )
+        self.tile_size_choice = ui.IntIncrementCounter(
+            lower=32,
+            upper=2048,
+            default=config.TiledInferenceConfig.tile_size,
+            step=32,
+            text_label="Tile size",
+        )
+
+        self.results_format_choice = ui.DropdownMenu(
+            list(RESULTS_FORMATS.keys()), text_label="Results format"
+        )
+        self.probability_dtype_choice = ui.DropdownMenu(
+            PROBABILITY_DTYPES, text_label="Save probabilities as"
+        )
+
         window_size_widgets = ui.combine_blocks(
             self.window_size_choice,
             self.window_size_choice.label,
@@ -187,6 +233,9 @@ class Inferer(ModelFramework, metaclass=ui.QWidgetSingleton):
             [
                 window_size_widgets,
                 self.window_overlap_slider.container,
+                self.window_batch_size_choice.label,
+                self.window_batch_size_choice,
+                self.auto_tune_batch_size_choice,
             ],
         )
         ##################
@@ -214,7 +263,7 @@ class Inferer(ModelFramework, metaclass=ui.QWidgetSingleton):
         ##################
         ##################
         # instance segmentation widgets
-        self.instance_widgets = InstanceWidgets(parent=self)
+        self.instance_widgets = ui.InstanceWidgets(parent=self)
         self.crf_widgets = CRFParamsWidget(parent=self)
 
         self.use_instance_choice = ui.CheckBox(
@@ -239,6 +288,9 @@ class Inferer(ModelFramework, metaclass=ui.QWidgetSingleton):
         ##################
 
         self.btn_start = ui.Button("Start", self.start)
+        self.btn_release_models = ui.Button(
+            "Release cached models", self.release_cached_models
+        )
         self.btn_close = self._make_close_button()
 
         self._set_tooltips()
@@ -268,6 +320,11 @@ class Inferer(ModelFramework, metaclass=ui.QWidgetSingleton):
         ##################
         # tooltips
         self.view_checkbox.setToolTip("Show results in the napari viewer")
+        self.btn_release_models.setToolTip(
+            "Models stay loaded (on GPU if used) between jobs to start faster.\n"
+            "Release them to free their memory, e.g. before training.\n"
+            "They are also released when closing this plugin or starting a training."
+        )
         self.display_number_choice_slider.tooltips = (
             "Choose how many results to display once the work is done.\n"
             "Maximum is 10 for clarity"
@@ -297,7 +354,29 @@ class Inferer(ModelFramework, metaclass=ui.QWidgetSingleton):
             "Size of the window to run inference with (in pixels)"
         )
         self.window_overlap_slider.tooltips = "Percentage of overlap between windows to use when using sliding window"
+        self.window_batch_size_choice.setToolTip(
+            "Number of windows run through the model at once.\nLarger values are faster but use more memory"
+        )
+        self.auto_tune_batch_size_choice.setToolTip(
+            "Times several batch sizes before inference and uses the fastest one that fits in memory"
+        )
 
+        self.use_tiled_inference_choice.setToolTip(
+            "Reads images from disk tile by tile rather than loading them in memory,"
+            "\nand writes results as they are computed. Only available for folders."
+            "\nUse this for volumes larger than your RAM."
+        )
+        self.tile_size_choice.setToolTip(
+            "Size of the tiles read from disk (in pixels)"
+        )
+        self.results_format_choice.setToolTip(
+            "Format of the saved results.\nCompressed formats are much smaller for large volumes, "
+            "and labels are always saved with the smallest integer type that fits them"
+        )
+        self.probability_dtype_choice.setToolTip(
+            "Data type of the saved probabilities.\n"
+            "float16 halves the file size, uint8 quarters it (probabilities are scaled to 0-255)"
+        )
         self.keep_data_on_cpu_box.setToolTip(
             "If enabled, data will be kept on the RAM rather than the VRAM.\nCan avoid out of memory issues with CUDA"
         )
@@ -393,6 +472,21 @@ class Inferer(ModelFramework, metaclass=ui.QWidgetSingleton):
             self.use_instance_choice, self.attempt_artifact_removal_box
         )
 
+    def _toggle_display_tile_size(self):
+        """Show or hide tile size choice depending on status of self.use_tiled_inference_choice."""
+        ui.toggle_visibility(
+            self.use_tiled_inference_choice, self.tile_size_choice
+        )
+        ui.toggle_visibility(
+            self.use_tiled_inference_choice, self.tile_size_choice.label
+        )
+
+    def _toggle_window_batch_size(self):
+        """Disables batch size choice if it is to be tuned automatically."""
+        self.window_batch_size_choice.setDisabled(
+            self.auto_tune_batch_size_choice.isChecked()
+        )
+
     def _toggle_display_window_size(self):
         """Show or hide window size choice depending on status of self.window_infer_box."""
         ui.toggle_visibility(self.use_window_choice, self.window_infer_params)
@@ -487,12 +581,21 @@ class Inferer(ModelFramework, metaclass=ui.QWidgetSingleton):
             [
                 self.use_window_choice,
                 self.window_infer_params,
+                self.use_tiled_inference_choice,
+                self.tile_size_choice.label,
+                self.tile_size_choice,
                 self.keep_data_on_cpu_box,
+                self.results_format_choice.label,
+                self.results_format_choice,
+                self.probability_dtype_choice.label,
+                self.probability_dtype_choice,
                 self.device_choice.label,
                 self.device_choice,
             ],
         )
         self.window_infer_params.setVisible(False)
+        self.tile_size_choice.setVisible(False)
+        self.tile_size_choice.label.setVisible(False)
 
         inference_param_group_w.setLayout(inference_param_group_l)
 
@@ -588,6 +691,7 @@ class Inferer(ModelFramework, metaclass=ui.QWidgetSingleton):
             tab.layout,
             [
                 self.btn_start,
+                self.btn_release_models,
                 self.btn_close,
             ],
         )
@@ -726,7 +830,7 @@ class Inferer(ModelFramework, metaclass=ui.QWidgetSingleton):
                             stats_df = pd.DataFrame(stats_dict)
 
                             self.log.print_and_log(
-                                f"Number of instances in channel {i} : {stats.number_objects[0]}"
+                                f"Number of instances in channel {i} : {stats.number_objects}"
                             )
 
                             csv_name = f"/{model_name}_{method_name}_seg_results_{image_id}_channel_{i}_{utils.get_date_time()}.csv"
@@ -808,6 +912,7 @@ class Inferer(ModelFramework, metaclass=ui.QWidgetSingleton):
                 raise RuntimeError("Worker config was not set correctly")
             self._setup_worker()
             self.btn_close.setVisible(False)
+            self.btn_release_models.setVisible(False)
 
         if self.worker.is_running:  # if worker is running, tries to stop
             self.log.print_and_log(
@@ -819,6 +924,17 @@ class Inferer(ModelFramework, metaclass=ui.QWidgetSingleton):
             self.worker.start()
             self.btn_start.setText("Running...  Click to stop")
 
+    def release_cached_models(self):
+        """Releases the models kept loaded between inference jobs, see :py:data:`~napari_cellseg3d.code_models.workers_utils.MODEL_CACHE`."""
+        if len(MODEL_CACHE) > 0:
+            logger.info(f"Releasing {len(MODEL_CACHE)} cached model(s)")
+        MODEL_CACHE.clear()
+
+    def remove_from_viewer(self):
+        """Releases the cached models and removes the widget from the napari window."""
+        self.release_cached_models()
+        super().remove_from_viewer()
+
     def _create_worker_from_config(
         self, worker_config: config.InferenceWorkerConfig
     ):
@@ -886,10 +1002,18 @@ class Inferer(ModelFramework, metaclass=ui.QWidgetSingleton):
             window_config = config.SlidingWindowConfig(
                 window_size=size,
                 window_overlap=self.window_overlap_slider.slider_value,
+                sw_batch_size=self.window_batch_size_choice.value(),
+                auto_tune_batch_size=self.auto_tune_batch_size_choice.isChecked(),
             )
         else:
             window_config = config.SlidingWindowConfig()
 
+        tiled_config = config.TiledInferenceConfig(
+            enabled=self.use_tiled_inference_choice.isChecked()
+            and self.folder_choice.isChecked(),
+            tile_size=self.tile_size_choice.value(),
+        )
+
         self.worker_config = config.InferenceWorkerConfig(
             device=self.check_device_choice(),
             model_info=self.model_info,
@@ -900,6 +1024,11 @@ class Inferer(ModelFramework, metaclass=ui.QWidgetSingleton):
             compute_stats=self.save_stats_to_csv_box.isChecked(),
             post_process_config=self.post_process_config,
             sliding_window_config=window_config,
+            tiled_inference_config=tiled_config,
+            results_writer_config=config.ResultsWriterConfig(
+                **RESULTS_FORMATS[self.results_format_choice.currentText()],
+                probability_dtype=self.probability_dtype_choice.currentText(),
+            ),
             use_crf=self.use_crf.isChecked(),
             crf_config=self.crf_widgets.make_config(),
         )
@@ -927,6 +1056,7 @@ class Inferer(ModelFramework, metaclass=ui.QWidgetSingleton):
         self.log.print_and_log("*" * 20)
         self.btn_start.setText("Start")
         self.btn_close.setVisible(True)
+        self.btn_release_models.setVisible(True)
 
         self.worker = None
         self.worker_config = None
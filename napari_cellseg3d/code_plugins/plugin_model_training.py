@@ -29,7 +29,10 @@ from napari_cellseg3d.code_models.worker_training import (
     SupervisedTrainingWorker,
     WNetTrainingWorker,
 )
-from napari_cellseg3d.code_models.workers_utils import TrainingReport
+from napari_cellseg3d.code_models.workers_utils import (
+    TrainingProgress,
+    TrainingReport,
+)
 
 logger = utils.LOGGER
 NUMBER_TABS = 4  # how many tabs in the widget
@@ -252,6 +255,9 @@ class Trainer(ModelFramework, metaclass=ui.QWidgetSingleton):
         )
 
         self.augment_choice = ui.CheckBox("Augment data")
+        self.cache_data_choice = ui.CheckBox("Cache preprocessed data")
+        self.use_amp_choice = ui.CheckBox("Mixed precision")
+        self.channels_last_choice = ui.CheckBox("Channels-last memory format")
 
         self.close_buttons = [
             self._make_close_button() for i in range(NUMBER_TABS)
@@ -360,6 +366,19 @@ class Trainer(ModelFramework, metaclass=ui.QWidgetSingleton):
             "Check this to enable data augmentation, which will randomly deform, flip and shift the intensity in images"
             " to provide a more diverse dataset"
         )
+        self.use_amp_choice.setToolTip(
+            "Check this to train in mixed precision (float16 on GPU, bfloat16 on supported CPUs),"
+            "\nwhich is usually faster and uses less memory"
+        )
+        self.channels_last_choice.setToolTip(
+            "Check this to use the channels-last memory format for the model and images,"
+            "\nwhich can be faster on recent GPUs, especially with mixed precision"
+        )
+        self.cache_data_choice.setToolTip(
+            "Check this to save preprocessed (loaded, reoriented and padded) images to disk,"
+            f"\nin {config.DATASET_CACHE_PATH}, so that later runs on the same images start faster."
+            "\nThe cache is updated automatically if the images or preprocessing change"
+        )
         [
             w.setToolTip("Size of the sample to extract")
             for w in self.patch_size_widgets
@@ -681,6 +700,14 @@ class Trainer(ModelFramework, metaclass=ui.QWidgetSingleton):
         #######################
         ui.add_blank(data_tab_w, data_tab_l)
         #######################
+        ui.GroupedWidget.create_single_widget_group(
+            "Caching",
+            self.cache_data_choice,
+            data_tab_l,
+        )
+        #######################
+        ui.add_blank(data_tab_w, data_tab_l)
+        #######################
         self.validation_group = ui.GroupedWidget.create_single_widget_group(
             "Training split (%)",
             self.train_split_percent_choice.container,
@@ -741,6 +768,8 @@ class Trainer(ModelFramework, metaclass=ui.QWidgetSingleton):
                 self.scheduler_patience_choice,
                 self.scheduler_factor_choice.label,
                 self.scheduler_factor_choice.container,
+                self.use_amp_choice,
+                self.channels_last_choice,
             ],
             None,
         )
@@ -1005,12 +1034,12 @@ class Trainer(ModelFramework, metaclass=ui.QWidgetSingleton):
         if self.worker.is_running:
             self.log.print_and_log("*" * 20)
             self.log.print_and_log(
-                f"Stop requested at {utils.get_time()}. \nWaiting for next yielding step..."
+                f"Stop requested at {utils.get_time()}. \nWaiting for next training step..."
             )
             self._stop_requested = True
             self.start_btn.setText("Stopping... Please wait")
             self.log.print_and_log("*" * 20)
-            self.worker.quit()
+            self.worker.request_weights()  # worker is stopped once received
         else:
             self.worker.start()
             self.start_btn.setText("Running...  Click to stop")
@@ -1111,6 +1140,11 @@ class Trainer(ModelFramework, metaclass=ui.QWidgetSingleton):
             )
         return self.worker_config
 
+    def _get_cache_path(self):
+        if self.cache_data_choice.isChecked():
+            return config.DATASET_CACHE_PATH
+        return None
+
     def _set_supervised_worker_config(
         self,
         model_config,
@@ -1149,6 +1183,9 @@ class Trainer(ModelFramework, metaclass=ui.QWidgetSingleton):
             sample_size=patch_size,
             do_augmentation=self.augment_choice.isChecked(),
             deterministic_config=deterministic_config,
+            cache_path=self._get_cache_path(),
+            use_amp=self.use_amp_choice.isChecked(),
+            channels_last=self.channels_last_choice.isChecked(),
         )
 
         return self.worker_config
@@ -1192,6 +1229,9 @@ class Trainer(ModelFramework, metaclass=ui.QWidgetSingleton):
             sample_size=patch_size,
             do_augmentation=self.augment_choice.isChecked(),
             deterministic_config=deterministic_config,
+            cache_path=self._get_cache_path(),
+            use_amp=self.use_amp_choice.isChecked(),
+            channels_last=self.channels_last_choice.isChecked(),
             num_classes=int(
                 self.wnet_widgets.num_classes_choice.currentText()
             ),
@@ -1252,6 +1292,7 @@ class Trainer(ModelFramework, metaclass=ui.QWidgetSingleton):
 
         self.start_btn.setText("Start")
         [btn.setVisible(True) for btn in self.close_buttons]
+        self._stop_requested = False
 
         if self.config.save_as_zip:
             shutil.make_archive(
@@ -1319,28 +1360,55 @@ class Trainer(ModelFramework, metaclass=ui.QWidgetSingleton):
                     self.result_layers[i].refresh()
                     self.result_layers[i].reset_contrast_limits()
 
+    def on_progress(self, progress: TrainingProgress):
+        """Updates the progress bar after a training step, and saves the weights if training is being stopped."""
+        if progress.total_steps > 0:
+            self.progress.setValue(
+                int(
+                    100
+                    * (progress.epoch + progress.step / progress.total_steps)
+                    / self.worker_config.max_epochs
+                )
+            )
+        if self._stop_requested and progress.weights is not None:
+            self.log.print_and_log(
+                "Saving weights from aborted training in results folder"
+            )
+            torch.save(
+                progress.weights,
+                Path(self.worker_config.results_path_folder)
+                / Path(
+                    f"latest_weights_aborted_training_{utils.get_time_filepath()}.pth",
+                ),
+            )
+            self.log.print_and_log("Saving complete")
+            self.worker.quit()
+            self.on_stop()
+
     def on_yield(self, report: TrainingReport):
         """Catches yielded signal from worker and plots the loss."""
+        if isinstance(report, TrainingProgress):
+            self.on_progress(report)
+            return
         if report == TrainingReport():
             return  # skip empty reports
 
         if report.show_plot:
-            try:
-                self.log.print_and_log(len(report.images_dict))
-
-                if (
-                    report.epoch == 0
-                    or report.epoch + 1
-                    == self.worker_config.validation_interval
-                ) and len(self.result_layers) == 0:
-                    self.result_layers = []
-                    self._display_results(report.images_dict)
-                else:
-                    self._display_results(
-                        report.images_dict, complete_missing=True
-                    )
-            except Exception as e:
-                logger.exception(e)
+            if report.images_dict is not None:
+                try:
+                    if (
+                        report.epoch == 0
+                        or report.epoch + 1
+                        == self.worker_config.validation_interval
+                    ) and len(self.result_layers) == 0:
+                        self.result_layers = []
+                        self._display_results(report.images_dict)
+                    else:
+                        self._display_results(
+                            report.images_dict, complete_missing=True
+                        )
+                except Exception as e:
+                    logger.exception(e)
 
             self.progress.setValue(
                 100 * (report.epoch + 1) // self.worker_config.max_epochs
@@ -1350,21 +1418,6 @@ class Trainer(ModelFramework, metaclass=ui.QWidgetSingleton):
             self.loss_1_values = report.loss_1_values
             self.loss_2_values = report.loss_2_values
 
-        if self._stop_requested:
-            self.log.print_and_log(
-                "Saving weights from aborted training in results folder"
-            )
-            torch.save(
-                report.weights,
-                Path(self.worker_config.results_path_folder)
-                / Path(
-                    f"latest_weights_aborted_training_{utils.get_time_filepath()}.pth",
-                ),
-            )
-            self.log.print_and_log("Saving complete")
-            self.on_stop()
-            self._stop_requested = False
-
     def _check_lens(self, size_column, loss_values):
         if len(size_column) != len(loss_values):
             logger.info(
@@ -19,6 +19,11 @@ from napari_cellseg3d import config, utils
 from napari_cellseg3d import interface as ui
 from napari_cellseg3d.code_plugins.plugin_base import BasePluginSingleImage
 from napari_cellseg3d.code_plugins.plugin_review_dock import Datamanager
+from napari_cellseg3d.code_plugins.plugin_review_view import (
+    OrthogonalViews,
+    ResampledTileCache,
+    ThrottledCallback,
+)
 
 logger = utils.LOGGER
 
@@ -186,7 +191,7 @@ class Reviewer(BasePluginSingleImage, metaclass=ui.QWidgetSingleton):
             self.config.labels = self.label_layer_loader.layer_data()
         else:
             self.config.image = utils.load_images(
-                self.image_filewidget.text_field.text()
+                self.image_filewidget.text_field.text(), lazy=True
             )
             self.config.labels = utils.load_images(
                 self.labels_filewidget.text_field.text()
@@ -262,7 +267,9 @@ class Reviewer(BasePluginSingleImage, metaclass=ui.QWidgetSingleton):
         if self.config.labels is not None:
             base_label = self.config.labels
         else:
-            base_label = np.zeros_like(images_original)
+            base_label = np.zeros(
+                images_original.shape, dtype=images_original.dtype
+            )
 
         viewer = napari.Viewer()
 
@@ -325,20 +332,15 @@ class Reviewer(BasePluginSingleImage, metaclass=ui.QWidgetSingleton):
             canvas.figure.suptitle(
                 "Shift-click on image for plot \n", fontsize=8
             )
-            xy_axes.imshow(np.zeros((100, 100), np.int16))
-            xy_axes.scatter(50, 50, s=30, c="green", alpha=0.6, marker="+")
             xy_axes.set_xlabel("X axis")
             xy_axes.set_ylabel("Y axis")
             yz_axes = canvas.figure.add_subplot(3, 1, 2)
-            yz_axes.imshow(np.zeros((100, 100), np.int16))
-            yz_axes.scatter(50, 50, s=30, c="green", alpha=0.6, marker="+")
             yz_axes.set_xlabel("Y axis")
             yz_axes.set_ylabel("Z axis")
             zx_axes = canvas.figure.add_subplot(3, 1, 3)
-            zx_axes.imshow(np.zeros((100, 100), np.int16))
-            zx_axes.scatter(50, 50, s=30, c="green", alpha=0.6, marker="+")
             zx_axes.set_xlabel("X axis")
             zx_axes.set_ylabel("Z axis")
+            views = OrthogonalViews(canvas, [xy_axes, yz_axes, zx_axes])
 
             # canvas.figure.tight_layout()
             canvas.figure.subplots_adjust(
@@ -352,48 +354,25 @@ class Reviewer(BasePluginSingleImage, metaclass=ui.QWidgetSingleton):
         )
         canvas_dock._close_btn = False
 
+        # the volume is resampled lazily, one cached tile at a time
+        crops = ResampledTileCache(
+            viewer.layers["volume"].data, self.config.zoom_factor
+        )
+
+        def plot_crop(cursor_position):
+            logger.debug(f"plot @ {cursor_position}")
+            views.update(crops.crop(cursor_position))
+
+        plot = ThrottledCallback(plot_crop)
+
         @viewer.mouse_drag_callbacks.append
         def update_canvas(viewer, event):
-            if "shift" in event.modifiers:
-                try:
-                    cursor_position = np.round(viewer.cursor.position).astype(
-                        int
-                    )
-                    logger.debug(f"plot @ {cursor_position}")
-
-                    cropped_volume = crop_volume_around_point(
-                        [
-                            cursor_position[0],
-                            cursor_position[1],
-                            cursor_position[2],
-                        ],
-                        viewer.layers["volume"],
-                        self.config.zoom_factor,
-                    )
-
-                    ##########
-                    ##########
-                    # DEBUG
-                    # viewer.add_image(cropped_volume, name="DEBUG_crop_plot")
-
-                    xy_axes.imshow(
-                        cropped_volume[50], cmap="inferno", vmin=200, vmax=2000
-                    )
-                    yz_axes.imshow(
-                        cropped_volume.transpose(1, 0, 2)[50],
-                        cmap="inferno",
-                        vmin=200,
-                        vmax=2000,
-                    )
-                    zx_axes.imshow(
-                        cropped_volume.transpose(2, 0, 1)[50],
-                        cmap="inferno",
-                        vmin=200,
-                        vmax=2000,
-                    )
-                    canvas.draw_idle()
-                except Exception as e:
-                    logger.exception(e)
+            # shift-click, then keep following the cursor while dragging
+            while "shift" in event.modifiers:
+                plot(np.round(viewer.cursor.position).astype(int)[-3:])
+                if event.type == "mouse_release":
+                    return
+                yield
 
         # Qt widget defined in docker.py
         dmg = Datamanager(parent=viewer)
@@ -415,52 +394,4 @@ class Reviewer(BasePluginSingleImage, metaclass=ui.QWidgetSingleton):
 
         viewer.dims.events.current_step.connect(update_button)
 
-        def crop_volume_around_point(points, layer, zoom_factor):
-            """Crops a volume around a point.
-
-            Args:
-                points (list): list of 3 integers, the coordinates of the point to crop around
-                layer (napari.layers.Image): the layer to crop
-                zoom_factor (list): list of 3 floats, the zoom factor to apply to the layer before cropping
-            """
-            if zoom_factor != [1, 1, 1]:
-                data = np.array(layer.data, dtype=np.int16)
-                volume = utils.resize(data, zoom_factor)
-                # image = ndimage.zoom(layer.data, zoom_factor, mode="nearest") # cleaner but much slower...
-            else:
-                volume = layer.data
-
-            min_coordinates = [point - 50 for point in points]
-            max_coordinates = [point + 50 for point in points]
-            inferior_bound = [
-                min_coordinate if min_coordinate < 0 else 0
-                for min_coordinate in min_coordinates
-            ]
-            superior_bound = [
-                max_coordinate - volume.shape[i]
-                if volume.shape[i] < max_coordinate
-                else 0
-                for i, max_coordinate in enumerate(max_coordinates)
-            ]
-
-            crop_slice = tuple(
-                slice(np.maximum(0, min_coordinate), max_coordinate)
-                for min_coordinate, max_coordinate in zip(
-                    min_coordinates, max_coordinates
-                )
-            )
-
-            # if self.config.as_stack:
-            #     crop_temp = volume[crop_slice].persist().compute()
-            # else:
-            crop_temp = volume[crop_slice]
-
-            cropped_volume = np.zeros((100, 100, 100), np.int16)
-            cropped_volume[
-                -inferior_bound[0] : 100 - superior_bound[0],
-                -inferior_bound[1] : 100 - superior_bound[1],
-                -inferior_bound[2] : 100 - superior_bound[2],
-            ] = crop_temp
-            return cropped_volume
-
         return viewer, [file_widget, canvas, dmg]
@@ -3,32 +3,50 @@ from datetime import datetime, timedelta
 from pathlib import Path
 from typing import TYPE_CHECKING
 
-import pandas as pd
-
 if TYPE_CHECKING:
     import napari
 
 # Qt
+from qtpy.QtCore import QTimer
 from qtpy.QtWidgets import QVBoxLayout, QWidget
 
 from napari_cellseg3d import interface as ui
 from napari_cellseg3d import utils
+from napari_cellseg3d.code_plugins.plugin_review_journal import (
+    CHECKED,
+    NOT_CHECKED,
+    ReviewJournal,
+)
 
 GUI_MAXIMUM_WIDTH = 225
 GUI_MAXIMUM_HEIGHT = 350
 GUI_MINIMUM_HEIGHT = 300
 TIMER_FORMAT = "%H:%M:%S"
+FLUSH_INTERVAL_MS = 2000
+"""Interval between writes of buffered status changes to the review journal."""
 
 logger = utils.LOGGER
 """
 plugin_dock.py
 ====================================
-Definition of Datamanager widget, for saving labels status in csv file
+Definition of Datamanager widget, for saving labels status in a review journal
 """
 
 
+def _session_number(path):
+    """Returns the number n of a review session file named {model_type}_train{n}."""
+    try:
+        return int(Path(path).stem.split("_train")[-1])
+    except ValueError:
+        return -1
+
+
 class Datamanager(QWidget):
-    """A widget with a single checkbox that allows to store the status of a slice in csv file (checked/not checked)."""
+    """A widget with a single checkbox that allows to store the status of a slice in a review journal (checked/not checked).
+
+    The status is stored in a :py:class:`~napari_cellseg3d.code_plugins.plugin_review_journal.ReviewJournal`,
+    and can be exported to a csv file.
+    """
 
     def __init__(self, parent: "napari.viewer.Viewer"):
         """Creates the datamanager widget in the specified viewer window.
@@ -52,6 +70,12 @@ class Datamanager(QWidget):
         self.pause_box = ui.CheckBox(
             "Pause timer", self.pause_timer, parent=self, fixed=True
         )
+        self.export_button = ui.Button(
+            "Export csv", self.export_csv, parent=self, fixed=True
+        )
+        self.export_button.setToolTip(
+            "Write the status of each slice to a csv file next to the labels"
+        )
 
         io_panel = ui.ContainerWidget()
         io_layout = io_panel.layout
@@ -64,6 +88,7 @@ class Datamanager(QWidget):
             ),
             alignment=ui.ABS_AL,
         )
+        io_layout.addWidget(self.export_button, alignment=ui.ABS_AL)
 
         io_panel.setLayout(io_layout)
         io_panel.setMaximumWidth(GUI_MAXIMUM_WIDTH)
@@ -73,8 +98,9 @@ class Datamanager(QWidget):
         # self.setMaximumHeight(GUI_MAXIMUM_HEIGHT)
         # self.setMaximumWidth(GUI_MAXIMUM_WIDTH)
 
-        self.df = None
+        self.journal = None
         self.csv_path = None
+        """Path the review status is exported to as csv"""
         self.slice_num = 0
         self.filetype = ""
         self.filename = None
@@ -88,6 +114,12 @@ class Datamanager(QWidget):
         self.is_paused = False
         # self.pause_time = None
 
+        self._flush_timer = QTimer(self)
+        self._flush_timer.setInterval(FLUSH_INTERVAL_MS)
+        self._flush_timer.timeout.connect(self._flush)
+        # the widget is destroyed without a close event when the viewer is closed
+        self.destroyed.connect(lambda: self._close_journal())
+
     def pause_timer(self):
         """Pause the timer for the review time."""
         if self.pause_box.isChecked():
@@ -107,19 +139,41 @@ class Datamanager(QWidget):
             # self.pause_time = datetime.now() - self.pause_start
             self.start_time = datetime.now()
             self.is_paused = False
-        self._update_time_csv()
+        self._update_time()
+        self._flush()
 
-    def _update_time_csv(self):
+    def _update_time(self):
         if not self.is_paused:
             self.time_elapsed += datetime.now() - self.start_time
             self.start_time = datetime.now()
         str_time = utils.time_difference(timedelta(), self.time_elapsed)
         logger.info(f"Time elapsed : {str_time}")
-        self.df.at[0, "time"] = str_time
-        self.df.to_csv(self.csv_path)
+        self.journal.time = str_time
+
+    def _flush(self):
+        if self.journal is not None:
+            self.journal.flush()
+
+    def _close_journal(self):
+        """Records the review time and closes the journal, which writes buffered changes and merges its write-ahead log into the database."""
+        if self.journal is not None:
+            self._update_time()
+            self.journal.close()
+            self.journal = None
+
+    def closeEvent(self, event):
+        """Stops the periodic writes and closes the journal when the widget is closed."""
+        self._flush_timer.stop()
+        self._close_journal()
+        super().closeEvent(event)
+
+    def export_csv(self):
+        """Writes the status of each slice and the review time to :py:attr:`csv_path`."""
+        self._update_time()
+        self.journal.export_csv(self.csv_path)
 
     def prepare(self, label_dir, filetype, model_type, checkbox):
-        """Initialize the Datamanager, which loads the csv file and updates it with the index of the current slice.
+        """Initialize the Datamanager, which loads the review journal and updates it with the index of the current slice.
 
         Args:
             label_dir (str): label path
@@ -140,15 +194,21 @@ class Datamanager(QWidget):
             logger.info(f"Loading single image : {self.filename}")
             logger.debug(label_dir)
 
-        self.df, self.csv_path = self.load_csv(label_dir, model_type, checkbox)
+        if self.journal is not None:
+            self.journal.close()
+        self.journal = self.load_journal(label_dir, model_type, checkbox)
+        self.csv_path = str(self.journal.path.with_suffix(".csv"))
+        self._flush_timer.start()
 
-        logger.debug(f"csv path : {self.csv_path}")
+        logger.debug(f"journal path : {self.journal.path}")
         logger.debug(f"Create new dataset : {checkbox}")
         # logger.debug(self.viewer.dims.current_step[0])
         self.update_dm(self.viewer.dims.current_step[0])
 
-    def load_csv(self, label_dir, model_type, checkbox):
-        """Loads newest csv or create new csv.
+    def load_journal(self, label_dir, model_type, checkbox):
+        """Loads the newest review journal or creates a new one.
+
+        If there is no journal but a csv file from a previous version, it is imported.
 
         Args:
             label_dir (str): label path
@@ -156,49 +216,49 @@ class Datamanager(QWidget):
             checkbox ( bool ): create new dataset or not
 
         Returns:
-            (pandas.DataFrame, str) dataframe、csv path
+            ReviewJournal: journal of the review session
         """
-        # if not self.as_folder :
-        #     label_dir = os.path.dirname(label_dir)
         logger.debug("label dir")
         logger.debug(label_dir)
-        csvs = sorted(list(Path(str(label_dir)).glob(f"{model_type}*.csv")))
-        if len(csvs) == 0:
-            df, csv_path = self.create_csv(
-                label_dir, model_type
-            )  # df,  train_data_dir, ...
+        label_dir = Path(str(label_dir))
+        journals = sorted(
+            label_dir.glob(f"{model_type}_train*.db"), key=_session_number
+        )
+        csvs = sorted(
+            label_dir.glob(f"{model_type}_train*.csv"), key=_session_number
+        )
+        if len(journals) > 0:
+            journal = ReviewJournal(journals[-1])
+        elif len(csvs) > 0:
+            journal = ReviewJournal.from_csv(
+                csvs[-1], csvs[-1].with_suffix(".db")
+            )
         else:
-            csv_path = str(csvs[-1])
-            df = pd.read_csv(csv_path, index_col=0)
-            if checkbox is True:
-                csv_path = (
-                    csv_path.split("_train")[0]
-                    + "_train"
-                    + str(int(Path(csv_path.split("_train")[1]).parent) + 1)
-                    + ".csv"
-                )  # adds 1 to current csv name number
-                df.to_csv(csv_path)
-            else:
-                pass
-
-        recorded_time = df.at[0, "time"]
-        # logger.debug("csv load time")
-        # logger.debug(recorded_time)
-        t = datetime.strptime(recorded_time, TIMER_FORMAT)
+            return self.create_journal(label_dir, model_type)
+
+        if checkbox is True:
+            # new session, starting from the status of the previous one
+            path = label_dir / (
+                f"{model_type}_train{_session_number(journal.path) + 1}.db"
+            )
+            previous = journal
+            journal = previous.copy(path)
+            previous.close()
+
+        t = datetime.strptime(journal.time, TIMER_FORMAT)
         self.time_elapsed = timedelta(
             hours=t.hour, minutes=t.minute, seconds=t.second
         )
-        # logger.debug(self.time_elapsed)
-        return df, csv_path
+        return journal
 
-    def create_csv(self, label_dir, model_type):
-        """Create a new dataframe and save the csv.
+    def create_journal(self, label_dir, model_type):
+        """Create a new review journal.
 
         Args:
           label_dir (str): label path
           model_type (str): model type
         Returns:
-         (pandas.DataFrame, str): dataframe, csv path.
+         ReviewJournal: journal of the review session
         """
         if self.as_folder:
             labels = sorted(
@@ -214,39 +274,28 @@ class Datamanager(QWidget):
             filename = self.filename if self.filename is not None else "image"
             labels = [str(filename) for i in range(self.image_dims[0])]
 
-        df = pd.DataFrame(
-            {
-                "filename": labels,
-                "train": ["Not checked"] * len(labels),
-                "time": [""] * len(labels),
-            }
-        )
-        df.at[0, "time"] = "00:00:00"
-
-        csv_path = Path(label_dir) / Path(f"{model_type}_train0.csv")
-        if not csv_path.parent.exists():
-            csv_path.parent.mkdir(parents=True)
-        logger.debug(f"CSV path : {csv_path}")
-        df.to_csv(str(csv_path))
-
-        return df, csv_path
+        path = Path(label_dir) / Path(f"{model_type}_train0.db")
+        if not path.parent.exists():
+            path.parent.mkdir(parents=True)
+        logger.debug(f"Journal path : {path}")
+        return ReviewJournal.create(path, labels)
 
     def _update_button(self):
-        if len(self.df) > 1:
+        if len(self.journal) > 1:
             self.button.setText(
-                self.df.at[self.df.index[self.slice_num], "train"]
-            )  # puts  button values at value of 1st csv item
+                self.journal.status(self.slice_num)
+            )  # puts  button values at value of 1st item
 
     def update_dm(self, slice_num):
         """Updates the Datamanager with the index of the current slice.
 
-        Also updates the text with the status contained in the csv (e.g. checked/not checked).
+        Also updates the text with the status contained in the journal (e.g. checked/not checked).
 
         Args:
             slice_num (int): index of the current slice
         """
         self.slice_num = slice_num
-        self._update_time_csv()
+        self._update_time()
 
         logger.info(f"New slice review started at {utils.get_time()}")
         # logger.debug(self.df)
@@ -257,22 +306,17 @@ class Datamanager(QWidget):
             self.slice_num -= 1
             self._update_button()
 
-    def _button_func(self):  # updates csv every time you press button...
+    def _button_func(self):  # records the new status in the journal
         if self.viewer.dims.ndisplay != 2:
             # TODO test if undefined behaviour or if okay
             logger.warning("Please switch back to 2D mode !")
             return
 
-        self._update_time_csv()
+        self._update_time()
 
-        if self.button.text() == "Not checked":
-            self.button.setText("Checked")
-            self.df.at[self.df.index[self.slice_num], "train"] = "Checked"
-            self.df.to_csv(self.csv_path)
-        else:
-            self.button.setText("Not checked")
-            self.df.at[self.df.index[self.slice_num], "train"] = "Not checked"
-            self.df.to_csv(self.csv_path)
+        status = CHECKED if self.button.text() == NOT_CHECKED else NOT_CHECKED
+        self.button.setText(status)
+        self.journal.set_status(self.slice_num, status)
 
     # def check_all_data_and_mod(self):
     #     for i in range(len(self.df)):
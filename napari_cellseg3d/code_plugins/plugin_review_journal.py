@@ -0,0 +1,232 @@
+"""Review journal storing the status of each reviewed slice in a SQLite database.
+
+Each status change is appended to an ``events`` table (with the annotator and a timestamp), and the current status
+of each slice is kept in a ``slices`` table, so that opening a journal does not replay or re-parse its history.
+Changes are buffered and written in batches, in a single transaction, and the database uses write-ahead logging (WAL)
+so that an interrupted session cannot corrupt previously written statuses, and several annotators can read
+the same journal while one writes to it.
+
+The journal can be exported on demand to the CSV format used by previous versions (filename, train, time),
+and such CSV files can be imported as journals.
+"""
+import getpass
+import sqlite3
+from datetime import datetime
+from pathlib import Path
+
+import pandas as pd
+
+from napari_cellseg3d.utils import LOGGER as logger
+
+NOT_CHECKED = "Not checked"
+CHECKED = "Checked"
+DEFAULT_TIME = "00:00:00"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS slices (
+    slice INTEGER PRIMARY KEY,
+    filename TEXT NOT NULL,
+    status TEXT NOT NULL,
+    annotator TEXT,
+    updated TEXT
+);
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    slice INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    annotator TEXT,
+    timestamp TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+class ReviewJournal:
+    """Status of each slice of a review session, stored in a SQLite database.
+
+    Status queries are answered from memory; changes are buffered and written every ``batch_size`` changes,
+    or when :py:meth:`flush` is called.
+    """
+
+    def __init__(self, path, annotator=None, batch_size=64):
+        """Opens a journal, creating the database if needed.
+
+        Args:
+            path (str): path to the database file
+            annotator (str): name recorded with each status change. Defaults to the current user name.
+            batch_size (int): number of buffered changes that triggers a write
+        """
+        self.path = Path(path)
+        self.annotator = (
+            annotator if annotator is not None else getpass.getuser()
+        )
+        self.batch_size = batch_size
+        self._connection = sqlite3.connect(str(self.path), timeout=10)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.executescript(_SCHEMA)
+        rows = self._connection.execute(
+            "SELECT filename, status FROM slices ORDER BY slice"
+        ).fetchall()
+        self.filenames = [row[0] for row in rows]
+        self._statuses = [row[1] for row in rows]
+        time = self._connection.execute(
+            "SELECT value FROM meta WHERE key = 'time'"
+        ).fetchone()
+        self._time = time[0] if time is not None else DEFAULT_TIME
+        self._pending_events = []
+        self._pending_time = False
+
+    @classmethod
+    def create(cls, path, filenames, time=DEFAULT_TIME, statuses=None):
+        """Creates a new journal with one slice per filename.
+
+        Args:
+            path (str): path to the database file. Must not exist.
+            filenames (list): filename of each slice
+            time (str): review time already elapsed, as HH:MM:SS
+            statuses (list): initial status of each slice. Defaults to "Not checked" for all slices.
+        """
+        if Path(path).exists():
+            raise FileExistsError(f"Review journal {path} already exists")
+        statuses = (
+            statuses
+            if statuses is not None
+            else [NOT_CHECKED] * len(filenames)
+        )
+        journal = cls(path)
+        with journal._connection:
+            journal._connection.executemany(
+                "INSERT INTO slices (slice, filename, status) VALUES (?, ?, ?)",
+                [
+                    (i, str(f), s)
+                    for i, (f, s) in enumerate(zip(filenames, statuses))
+                ],
+            )
+            journal._connection.execute(
+                "INSERT INTO meta (key, value) VALUES ('time', ?)", (time,)
+            )
+        journal.filenames = [str(f) for f in filenames]
+        journal._statuses = list(statuses)
+        journal._time = time
+        return journal
+
+    @classmethod
+    def from_csv(cls, csv_path, path):
+        """Creates a journal from a review CSV file of previous versions (columns filename, train, time)."""
+        df = pd.read_csv(csv_path, index_col=0)
+        time = df.at[df.index[0], "time"] if len(df) > 0 else DEFAULT_TIME
+        logger.info(f"Importing review status from {Path(csv_path).name}")
+        return cls.create(
+            path,
+            df["filename"].tolist(),
+            time=time if isinstance(time, str) else DEFAULT_TIME,
+            statuses=df["train"].tolist(),
+        )
+
+    def copy(self, path):
+        """Copies the journal, including its history, to a new database and returns it."""
+        self.flush()
+        destination = sqlite3.connect(str(path))
+        with destination:
+            self._connection.backup(destination)
+        destination.close()
+        return ReviewJournal(path, self.annotator, self.batch_size)
+
+    def __len__(self):
+        """Returns the number of slices."""
+        return len(self._statuses)
+
+    def status(self, index):
+        """Returns the status of a slice."""
+        return self._statuses[index]
+
+    def statuses(self):
+        """Returns the status of all slices."""
+        return list(self._statuses)
+
+    def set_status(self, index, status):
+        """Records a new status for a slice."""
+        self._statuses[index] = status
+        self._pending_events.append(
+            (index, status, self.annotator, datetime.now().isoformat())
+        )
+        if len(self._pending_events) >= self.batch_size:
+            self.flush()
+
+    @property
+    def time(self):
+        """Review time elapsed, as HH:MM:SS."""
+        return self._time
+
+    @time.setter
+    def time(self, value):
+        self._time = value
+        self._pending_time = True
+
+    def flush(self):
+        """Writes buffered changes to the database, in a single transaction."""
+        if not self._pending_events and not self._pending_time:
+            return
+        with self._connection:
+            self._connection.executemany(
+                "INSERT INTO events (slice, status, annotator, timestamp) VALUES (?, ?, ?, ?)",
+                self._pending_events,
+            )
+            self._connection.executemany(
+                "UPDATE slices SET status = ?, annotator = ?, updated = ? WHERE slice = ?",
+                [
+                    (status, annotator, timestamp, index)
+                    for index, status, annotator, timestamp in self._pending_events
+                ],
+            )
+            if self._pending_time:
+                self._connection.execute(
+                    "INSERT OR REPLACE INTO meta (key, value) VALUES ('time', ?)",
+                    (self._time,),
+                )
+        logger.debug(
+            f"Wrote {len(self._pending_events)} status changes to {self.path.name}"
+        )
+        self._pending_events = []
+        self._pending_time = False
+
+    def history(self, index=None):
+        """Returns the recorded status changes, of all slices or of one slice, oldest first."""
+        self.flush()
+        query = "SELECT slice, status, annotator, timestamp FROM events"
+        if index is not None:
+            query += " WHERE slice = ?"
+        return pd.read_sql_query(
+            query + " ORDER BY id",
+            self._connection,
+            params=(index,) if index is not None else None,
+        )
+
+    def to_dataframe(self):
+        """Returns the status of each slice in the CSV format of previous versions (filename, train, time)."""
+        times = [""] * len(self)
+        if len(times) > 0:
+            times[0] = self._time
+        return pd.DataFrame(
+            {
+                "filename": self.filenames,
+                "train": self._statuses,
+                "time": times,
+            }
+        )
+
+    def export_csv(self, csv_path):
+        """Writes the status of each slice to a CSV file, see :py:meth:`to_dataframe`."""
+        self.flush()
+        self.to_dataframe().to_csv(str(csv_path))
+        logger.info(f"Exported review status to {csv_path}")
+
+    def close(self):
+        """Writes buffered changes, merges the write-ahead log into the database and closes it."""
+        self.flush()
+        self._connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        self._connection.close()
@@ -0,0 +1,243 @@
+"""Orthogonal views of the review plugin, showing the volume around a shift-clicked point.
+
+Crops are served from a cache of resampled tiles : each tile of the rescaled volume is computed once,
+from the part of the layer data it covers, so the whole volume is never resampled
+and lazily-loaded volumes are only read where the user clicks.
+Cursor events are throttled, and the views are redrawn by blitting only the updated images.
+"""
+from collections import OrderedDict
+
+import numpy as np
+from qtpy.QtCore import QTimer
+
+from napari_cellseg3d.utils import LOGGER as logger
+
+CROP_SIZE = 100
+"""Size of the cubic crop shown in the orthogonal views."""
+
+
+def resampled_shape(shape, zoom_factor):
+    """Returns the shape of a volume rescaled by zoom_factor, as computed by :py:func:`napari_cellseg3d.utils.resize`."""
+    return tuple(
+        max(int(np.floor(s * z)), 1) for s, z in zip(shape, zoom_factor)
+    )
+
+
+def resampled_indices(start, stop, size, resampled_size):
+    """Returns the indices of the original voxels closest to resampled voxels start to stop (nearest-exact interpolation)."""
+    scale = size / resampled_size
+    indices = np.floor((np.arange(start, stop) + 0.5) * scale).astype(int)
+    return np.minimum(indices, size - 1)
+
+
+class ResampledTileCache:
+    """Serves crops of a volume rescaled by a zoom factor, from an LRU cache of resampled tiles.
+
+    Resampling uses nearest-exact interpolation, matching :py:func:`napari_cellseg3d.utils.resize`.
+    """
+
+    def __init__(self, volume, zoom_factor=None, tile_size=64, max_tiles=64):
+        """Creates a cache for a volume.
+
+        Args:
+            volume (array-like): ZYX volume supporting numpy-style slicing, e.g. a numpy, memory-mapped or Zarr array
+            zoom_factor (list): zoom factor of each axis. If None, the volume is not rescaled.
+            tile_size (int): size of the cubic tiles of the resampled volume kept in cache
+            max_tiles (int): maximum number of tiles in cache, least recently used tiles are evicted first
+        """
+        self.volume = volume
+        self.zoom_factor = (
+            list(zoom_factor) if zoom_factor is not None else [1, 1, 1]
+        )
+        self.shape = resampled_shape(volume.shape, self.zoom_factor)
+        self.tile_size = tile_size
+        self.max_tiles = max_tiles
+        self._tiles = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def _compute_tile(self, tile_index):
+        bounds = [
+            (i * self.tile_size, min((i + 1) * self.tile_size, s))
+            for i, s in zip(tile_index, self.shape)
+        ]
+        if self.zoom_factor == [1, 1, 1]:
+            return np.asarray(
+                self.volume[tuple(slice(a, b) for a, b in bounds)]
+            )
+        indices = [
+            resampled_indices(a, b, size, resampled_size)
+            for (a, b), size, resampled_size in zip(
+                bounds, self.volume.shape, self.shape
+            )
+        ]
+        # read the covered block of the source once, then pick the nearest voxels
+        block = np.asarray(
+            self.volume[tuple(slice(i[0], i[-1] + 1) for i in indices)]
+        )
+        return block[np.ix_(*[i - i[0] for i in indices])]
+
+    def tile(self, tile_index):
+        """Returns a tile of the resampled volume, computing it if it is not in cache."""
+        tile_index = tuple(tile_index)
+        if tile_index in self._tiles:
+            self.hits += 1
+            self._tiles.move_to_end(tile_index)
+            return self._tiles[tile_index]
+        self.misses += 1
+        tile = self._compute_tile(tile_index)
+        self._tiles[tile_index] = tile
+        if len(self._tiles) > self.max_tiles:
+            self._tiles.popitem(last=False)
+        return tile
+
+    def crop(self, center, size=CROP_SIZE):
+        """Returns a cubic crop of the resampled volume centered on a point, zero-padded outside the volume.
+
+        Args:
+            center (list): ZYX coordinates of the center, in the resampled volume
+            size (int): size of the crop
+        """
+        start = [int(c) - size // 2 for c in center]
+        crop = np.zeros((size,) * 3, dtype=self.volume.dtype)
+        low = [max(s, 0) for s in start]
+        high = [min(s + size, dim) for s, dim in zip(start, self.shape)]
+        if any(h <= lo for lo, h in zip(low, high)):
+            return crop
+        tile_ranges = [
+            range(lo // self.tile_size, (h - 1) // self.tile_size + 1)
+            for lo, h in zip(low, high)
+        ]
+        for z in tile_ranges[0]:
+            for y in tile_ranges[1]:
+                for x in tile_ranges[2]:
+                    tile = self.tile((z, y, x))
+                    origin = [i * self.tile_size for i in (z, y, x)]
+                    # intersection of the tile and the crop, in volume coordinates
+                    a = [max(lo, o) for lo, o in zip(low, origin)]
+                    b = [
+                        min(h, o + t)
+                        for h, o, t in zip(high, origin, tile.shape)
+                    ]
+                    crop[
+                        tuple(
+                            slice(i - s, j - s) for i, j, s in zip(a, b, start)
+                        )
+                    ] = tile[
+                        tuple(
+                            slice(i - o, j - o)
+                            for i, j, o in zip(a, b, origin)
+                        )
+                    ]
+        return crop
+
+    def clear(self):
+        """Empties the cache."""
+        self._tiles.clear()
+
+
+class OrthogonalViews:
+    """XY, YZ and ZX slices of a crop shown on matplotlib axes, updated by blitting.
+
+    Image artists are created once; on update only their data changes, and only the axes are redrawn.
+    The whole figure is redrawn when the canvas is resized or drawn by matplotlib.
+    """
+
+    def __init__(self, canvas, axes, vmin=200, vmax=2000, cmap="inferno"):
+        """Creates the views.
+
+        Args:
+            canvas (FigureCanvas): canvas containing the axes
+            axes (list): XY, YZ and ZX axes
+            vmin (float): lower contrast limit
+            vmax (float): upper contrast limit
+            cmap (str): colormap of the images
+        """
+        self.canvas = canvas
+        self.axes = axes
+        empty = np.zeros((CROP_SIZE, CROP_SIZE), np.int16)
+        self.images = [
+            ax.imshow(empty, cmap=cmap, vmin=vmin, vmax=vmax, animated=True)
+            for ax in axes
+        ]
+        self.markers = [
+            ax.scatter(
+                CROP_SIZE // 2,
+                CROP_SIZE // 2,
+                s=30,
+                c="green",
+                alpha=0.6,
+                marker="+",
+                animated=True,
+            )
+            for ax in axes
+        ]
+        self._backgrounds = None
+        canvas.mpl_connect("draw_event", self._on_draw)
+
+    def _on_draw(self, event=None):
+        """Saves the axes backgrounds after a full redraw, and draws the animated artists on top."""
+        self._backgrounds = [
+            self.canvas.copy_from_bbox(ax.bbox) for ax in self.axes
+        ]
+        self._draw_artists()
+
+    def _draw_artists(self):
+        for ax, image, marker in zip(self.axes, self.images, self.markers):
+            ax.draw_artist(image)
+            ax.draw_artist(marker)
+
+    def update(self, crop):
+        """Shows the central XY, YZ and ZX slices of a crop."""
+        center = crop.shape[0] // 2
+        slices = [
+            crop[center],
+            crop.transpose(1, 0, 2)[center],
+            crop.transpose(2, 0, 1)[center],
+        ]
+        for image, data in zip(self.images, slices):
+            image.set_data(data)
+        if self._backgrounds is None:
+            self.canvas.draw()  # calls _on_draw
+            return
+        for background in self._backgrounds:
+            self.canvas.restore_region(background)
+        self._draw_artists()
+        for ax in self.axes:
+            self.canvas.blit(ax.bbox)
+
+
+class ThrottledCallback:
+    """Calls a function with the latest arguments it was scheduled with, at most once per interval.
+
+    Events received while waiting replace the pending arguments, so that only the most recent one is processed.
+    """
+
+    def __init__(self, func, interval_ms=40):
+        """Creates the throttled callback.
+
+        Args:
+            func (callable): function to call
+            interval_ms (int): minimum time between two calls, in milliseconds
+        """
+        self.func = func
+        self._pending = None
+        self._timer = QTimer()
+        self._timer.setSingleShot(True)
+        self._timer.setInterval(interval_ms)
+        self._timer.timeout.connect(self._call)
+
+    def __call__(self, *args):
+        """Schedules a call with these arguments."""
+        self._pending = args
+        if not self._timer.isActive():
+            self._timer.start()
+
+    def _call(self):
+        args, self._pending = self._pending, None
+        if args is None:
+            return
+        try:
+            self.func(*args)
+        except Exception as e:
+            logger.exception(e)
@@ -2,13 +2,10 @@
 import datetime
 from dataclasses import dataclass
 from pathlib import Path
-from typing import List, Optional
+from typing import TYPE_CHECKING, List, Optional
 
-import napari
 import numpy as np
 
-from napari_cellseg3d.code_models.instance_segmentation import InstanceMethod
-
 # from napari_cellseg3d.models import model_TRAILMAP as TRAILMAP
 from napari_cellseg3d.code_models.models.model_SegResNet import SegResNet_
 from napari_cellseg3d.code_models.models.model_SwinUNetR import SwinUNETR_
@@ -17,6 +14,13 @@ from napari_cellseg3d.code_models.models.model_VNet import VNet_
 from napari_cellseg3d.code_models.models.model_WNet import WNet_
 from napari_cellseg3d.utils import LOGGER
 
+if TYPE_CHECKING:
+    import napari
+
+    from napari_cellseg3d.code_models.instance_segmentation import (
+        InstanceMethod,
+    )
+
 logger = LOGGER
 
 # TODO(cyril) add JSON load/save
@@ -34,6 +38,8 @@ MODEL_LIST = {
 PRETRAINED_WEIGHTS_DIR = str(
     Path(__file__).parent.resolve() / Path("code_models/models/pretrained")
 )
+DATASET_CACHE_PATH = str(Path.home() / "cellseg3d" / "cache")
+"""Default folder in which preprocessed training data is cached."""
 
 
 ################
@@ -165,10 +171,17 @@ class Zoom:
 
 @dataclass
 class InstanceSegConfig:
-    """Class to record params for instance segmentation."""
+    """Class to record params for instance segmentation.
+
+    Args:
+        enabled (bool): whether to run instance segmentation
+        method (InstanceMethod): instance segmentation method, with its parameters
+        n_workers (int): number of processes segmenting tiles of large volumes in parallel
+    """
 
     enabled: bool = False
-    method: InstanceMethod = None
+    method: "InstanceMethod" = None
+    n_workers: int = 1
 
 
 # Workers
@@ -200,6 +213,12 @@ class CRFConfig:
         w1 (float): weight of the appearance/bilateral kernel.
         w2 (float): weight of the smoothness/gaussian kernel.
         n_iter (int, optional): Number of iterations for the CRF post-processing step. Defaults to 5.
+        tile_size (int, optional): if set, volumes larger than this are processed in overlapping cubic blocks
+            of this size, whose marginals are blended back. If None, the CRF runs on the whole volume at once.
+        tile_overlap (int): number of voxels shared by neighbouring blocks
+        num_workers (int): number of processes running blocks (or images) in parallel
+        backend (str): implementation of the CRF, see :py:data:`napari_cellseg3d.code_models.crf.CRF_BACKENDS`.
+            "auto" uses pydensecrf if it is installed, and the approximate PyTorch implementation otherwise.
     """
 
     sa: float = 10
@@ -208,6 +227,10 @@ class CRFConfig:
     w1: float = 10
     w2: float = 5
     n_iters: int = 5
+    tile_size: Optional[int] = None
+    tile_overlap: int = 16
+    num_workers: int = 1
+    backend: str = "auto"
 
 
 #####################
@@ -217,16 +240,92 @@ class CRFConfig:
 
 @dataclass
 class SlidingWindowConfig:
-    """Class to record params for sliding window inference."""
+    """Class to record params for sliding window inference.
+
+    Args:
+        window_size (int): size of the window. If None, sliding window inference is disabled.
+        window_overlap (float): overlap between windows, as a fraction of the window size
+        sw_batch_size (int): number of windows run through the model at once
+        auto_tune_batch_size (bool): whether to choose sw_batch_size by timing candidate sizes before inference
+        memory_budget (float): maximum memory in MB a batch of windows may use when auto-tuning. If None, uses the free memory on CUDA devices and is unlimited on CPU.
+    """
 
     window_size: int = None
     window_overlap: float = 0.25
+    sw_batch_size: int = 1
+    auto_tune_batch_size: bool = False
+    memory_budget: float = None
 
     def is_enabled(self):
         """Return True if sliding window is enabled."""
         return self.window_size is not None
 
 
+@dataclass
+class TiledInferenceConfig:
+    """Class to record params for out-of-core tiled inference.
+
+    Args:
+        enabled (bool): whether to stream images from disk tile by tile rather than loading them in memory
+        tile_size (int): size of the tiles read from disk, in pixels
+        tile_overlap (int): number of pixels shared by neighbouring tiles
+        scratch_path (str): folder for the temporary disk-backed accumulators. If None, uses the system temporary folder.
+    """
+
+    enabled: bool = False
+    tile_size: int = 256
+    tile_overlap: int = 32
+    scratch_path: str = None
+
+
+@dataclass
+class ResultsWriterConfig:
+    """Class to record params for writing inference results, see :py:mod:`napari_cellseg3d.code_models.results_writer`.
+
+    Args:
+        format (str): "tif" for (Big)TIFF files or "zarr" for OME-Zarr folders (requires zarr)
+        compression (str): compression codec, "zstd" or "deflate" for TIFF, "zstd" or "lz4" for Zarr. If None, results are not compressed.
+        chunk_size (int): size of the TIFF tiles or Zarr chunks, in pixels. Must be a multiple of 16 for TIFF.
+        probability_dtype (str): data type of probability maps, "float32", "float16" or "uint8"
+        compact_labels (bool): whether to store labels with the smallest integer type that fits the largest label
+    """
+
+    format: str = "tif"
+    compression: Optional[str] = None
+    chunk_size: int = 128
+    probability_dtype: str = "float32"
+    compact_labels: bool = True
+
+    def is_plain_tiff(self):
+        """Return True if probabilities are written as uncompressed float32 TIFF files."""
+        return (
+            self.format == "tif"
+            and self.compression is None
+            and self.probability_dtype == "float32"
+        )
+
+
+@dataclass
+class PipelineConfig:
+    """Class to record params for pipelined folder inference.
+
+    When enabled, the next image is loaded and run through the model while the previous ones are post-processed and saved.
+
+    Args:
+        enabled (bool): whether to overlap the stages of folder inference
+        load_workers (int): number of processes loading and preprocessing images ahead of inference
+        post_process_workers (int): number of threads running instance segmentation, stats and CRF
+        save_workers (int): number of threads writing results to disk
+        queue_size (int): maximum number of inferred images waiting for post-processing
+    """
+
+    enabled: bool = True
+    load_workers: int = 2
+    post_process_workers: int = 1
+    save_workers: int = 1
+    queue_size: int = 2
+
+
 @dataclass
 class InfererConfig:
     """Class to record params for Inferer plugin.
@@ -260,6 +359,9 @@ class InferenceWorkerConfig:
         compute_stats (bool): compute stats
         post_process_config (PostProcessConfig): post processing config
         sliding_window_config (SlidingWindowConfig): sliding window config
+        tiled_inference_config (TiledInferenceConfig): out-of-core tiled inference config
+        pipeline_config (PipelineConfig): pipelined folder inference config
+        results_writer_config (ResultsWriterConfig): format and compression of the saved results
         images_filepaths (str): path to images to infer
         layer (napari.layers.Layer): napari layer to infer on
     """
@@ -273,11 +375,51 @@ class InferenceWorkerConfig:
     compute_stats: bool = False
     post_process_config: PostProcessConfig = PostProcessConfig()
     sliding_window_config: SlidingWindowConfig = SlidingWindowConfig()
+    tiled_inference_config: TiledInferenceConfig = TiledInferenceConfig()
+    pipeline_config: PipelineConfig = PipelineConfig()
+    results_writer_config: ResultsWriterConfig = ResultsWriterConfig()
     use_crf: bool = False
     crf_config: CRFConfig = CRFConfig()
 
     images_filepaths: List[str] = None
-    layer: napari.layers.Layer = None
+    layer: "napari.layers.Layer" = None
+
+
+@dataclass
+class HeadlessInferenceConfig:
+    """Class to record configuration for headless inference, see ``cellseg3d-infer``.
+
+    Args:
+        inputs (str): folder of .tif files, or glob pattern of the files to infer on
+        results_path (str): folder to save results to
+        device (str): device to use for inference
+        model_info (ModelInfo): model info
+        weights_config (WeightsInfo): weights info
+        sliding_window_config (SlidingWindowConfig): sliding window config
+        thresholding (Thresholding): thresholding of the semantic output
+        zoom (Zoom): anisotropy correction of the semantic output
+        instance_method (str): name of the instance segmentation method, see INSTANCE_SEGMENTATION_METHOD_LIST. If None, instance segmentation is skipped.
+        instance_parameters (dict): keyword arguments of the instance segmentation function
+        instance_workers (int): number of processes segmenting tiles of large volumes in parallel
+        artifact_removal_size (int): if set, objects larger than this are removed before instance segmentation
+        compute_stats (bool): compute stats of the instance labels
+        overwrite (bool): if False, files whose results all exist already are skipped
+    """
+
+    inputs: str = None
+    results_path: str = str(Path.home() / "cellseg3d" / "inference")
+    device: str = "cpu"
+    model_info: ModelInfo = ModelInfo()
+    weights_config: WeightsInfo = WeightsInfo()
+    sliding_window_config: SlidingWindowConfig = SlidingWindowConfig()
+    thresholding: Thresholding = Thresholding()
+    zoom: Zoom = Zoom()
+    instance_method: str = None
+    instance_parameters: dict = None
+    instance_workers: int = 1
+    artifact_removal_size: int = None
+    compute_stats: bool = False
+    overwrite: bool = False
 
 
 ####################
@@ -321,6 +463,11 @@ class TrainingWorkerConfig:
         do_augmentation (bool): whether to do augmentation
         num_workers (int): number of workers
         train_data_dict (dict): dict of train data as {"image": np.array, "labels": np.array}
+        cache_path (str): folder in which to cache preprocessed data across runs. If None, data is preprocessed on every run.
+        use_amp (bool): whether to use mixed precision (float16 on CUDA, bfloat16 on CPU if supported)
+        channels_last (bool): whether to use the channels-last memory format for models and inputs
+        preview_interval (int): interval, in epochs, at which preview images are sent to the GUI
+        checkpoint_interval (int): interval, in epochs, at which checkpoints are saved during training
     """
 
     # model params
@@ -341,6 +488,11 @@ class TrainingWorkerConfig:
     do_augmentation: bool = True
     num_workers: int = 4
     train_data_dict: dict = None
+    cache_path: str = None
+    use_amp: bool = False
+    channels_last: bool = False
+    preview_interval: int = 1
+    checkpoint_interval: int = 5
 
 
 @dataclass
@@ -8,6 +8,7 @@ from skimage.filters import threshold_otsu
 from tifffile import imread, imwrite
 
 from napari_cellseg3d.code_models.instance_segmentation import binary_watershed
+from napari_cellseg3d.dev_scripts.label_objects import map_objects
 
 # import sys
 # sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
@@ -19,15 +20,46 @@ Creates labels of artifacts in an image based on existing labels of neurons
 """
 
 
-def map_labels(labels, artefacts):
+def _map_artefact(i, artefact_crop, labels_crop):
+    """Maps an artefact to the neurons it overlaps, in the crop of its bounding box.
+
+    Returns:
+    -------
+    numpy array or None
+        The label value of the artefact and the label values of the neurons associated, or None if it is not associated to neurons
+    """
+    indexes = labels_crop[artefact_crop == i]
+    # find the most common label in the indexes
+    unique, counts = np.unique(indexes, return_counts=True)
+    unique = np.flip(unique[np.argsort(counts)])
+    counts = np.flip(counts[np.argsort(counts)])
+    if unique[0] != 0:
+        return np.array([i, unique[np.argmax(counts)]])
+    if (
+        counts[0] < np.sum(counts) * 2 / 3.0
+    ):  # the artefact is connected to multiple neurons
+        total = 0
+        ii = 1
+        while total < np.size(indexes) / 3.0:
+            total = np.sum(counts[1 : ii + 1])
+            ii += 1
+        return np.append([i], unique[1 : ii + 1])
+    return None
+
+
+def map_labels(labels, artefacts, n_workers=None):
     """Map the artefacts labels to the neurons labels.
 
+    Each artefact is only compared to the neurons in its bounding box, and artefacts are mapped in parallel processes.
+
     Parameters
     ----------
     labels : ndarray
         Label image with neurons labelled as mulitple values.
     artefacts : ndarray
         Label image with artefacts labelled as mulitple values.
+    n_workers : int, optional
+        Number of processes, by default all available CPUs.
 
     Returns:
     -------
@@ -39,27 +71,11 @@ def map_labels(labels, artefacts):
     map_labels_existing = []
     new_labels = []
 
-    for i in np.unique(artefacts):
-        if i == 0:
-            continue
-        indexes = labels[artefacts == i]
-        # find the most common label in the indexes
-        unique, counts = np.unique(indexes, return_counts=True)
-        unique = np.flip(unique[np.argsort(counts)])
-        counts = np.flip(counts[np.argsort(counts)])
-        if unique[0] != 0:
-            map_labels_existing.append(
-                np.array([i, unique[np.argmax(counts)]])
-            )
-        elif (
-            counts[0] < np.sum(counts) * 2 / 3.0
-        ):  # the artefact is connected to multiple neurons
-            total = 0
-            ii = 1
-            while total < np.size(indexes) / 3.0:
-                total = np.sum(counts[1 : ii + 1])
-                ii += 1
-            map_labels_existing.append(np.append([i], unique[1 : ii + 1]))
+    for i, _, mapped in map_objects(
+        _map_artefact, artefacts, labels, n_workers=n_workers
+    ):
+        if mapped is not None:
+            map_labels_existing.append(mapped)
         else:
             new_labels.append(i)
 
@@ -250,8 +266,8 @@ def make_artefact_labels(
         map_labels_existing, new_labels = map_labels(labels, artefacts)
 
         # remove the artefacts that are connected to the neurons
-        for i in map_labels_existing:
-            artefacts[artefacts == i[0]] = 0
+        connected = [i[0] for i in map_labels_existing]
+        artefacts[np.isin(artefacts, connected)] = 0
         # remove all the pixels of the neurons from the artefacts
         artefacts = np.where(labels > 0, 0, artefacts)
 
@@ -0,0 +1,123 @@
+"""Benchmarks the approximate PyTorch CRF against crf_with_config with pydensecrf.
+
+Runs both on the test volumes and on synthetic volumes of spheres with noisy probabilities,
+and reports timings, the agreement between the labels of both implementations, and their accuracy on synthetic volumes.
+pydensecrf is skipped if it is not installed.
+"""
+import time
+from functools import partial
+from pathlib import Path
+
+import numpy as np
+import torch
+from tifffile import imread
+
+from napari_cellseg3d.code_models.crf import CRF_INSTALLED, crf_with_config
+from napari_cellseg3d.config import CRFConfig
+
+TEST_RESOURCES = Path(__file__).parent.parent / "_tests/res"
+TEST_VOLUMES = ["test.tif", "wnet_test/vol/test.tif"]
+
+
+def synthetic_volume(size, num_spheres=10, noise=0.3, seed=0):
+    """Returns an image of bright spheres, noisy foreground/background probabilities, and the ground truth."""
+    rng = np.random.default_rng(seed)
+    grid = np.indices((size,) * 3)
+    truth = np.zeros((size,) * 3, dtype=bool)
+    for _ in range(num_spheres):
+        center = rng.integers(0, size, 3).reshape(3, 1, 1, 1)
+        radius = rng.integers(size // 16 + 2, size // 6 + 3)
+        truth |= ((grid - center) ** 2).sum(0) < radius**2
+    image = truth + rng.normal(0, 0.1, truth.shape)
+    foreground = np.clip(
+        0.2 + 0.6 * truth + rng.normal(0, noise, truth.shape), 0.01, 0.99
+    )
+    prob = np.stack([1 - foreground, foreground]).astype(np.float32)
+    return (image * 100).astype(np.float32)[None], prob, truth
+
+
+def load_test_volume(path, seed=0):
+    """Returns a test volume, with probabilities thresholded at the median intensity and perturbed."""
+    image = imread(str(path)).astype(np.float32)
+    rng = np.random.default_rng(seed)
+    foreground = (image > np.median(image)).astype(np.float32)
+    foreground = np.clip(
+        0.2 + 0.6 * foreground + rng.normal(0, 0.3, image.shape), 0.01, 0.99
+    )
+    prob = np.stack([1 - foreground, foreground]).astype(np.float32)
+    return image[None], prob, None
+
+
+def _time(func, repeats):
+    result = func()  # warmup
+    start = time.perf_counter()
+    for _ in range(repeats):
+        func()
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return result, (time.perf_counter() - start) / repeats
+
+
+def benchmark(sizes=(32, 64, 128), repeats=3, config=None, device=None):
+    """Runs both CRF implementations on the test volumes and on synthetic volumes of each size.
+
+    Args:
+        sizes (iterable): sizes of the synthetic cubic volumes
+        repeats (int): number of timed runs, after one warmup run
+        config (CRFConfig): CRF parameters. If None, uses the defaults.
+        device (str): device for the torch backend. If None, uses CUDA if available.
+
+    Returns:
+        list: one dict per volume, with timings in seconds, the fraction of voxels labelled identically by both
+        implementations, and the accuracy of each on synthetic volumes
+    """
+    config = config if config is not None else CRFConfig()
+    volumes = [
+        (name, *load_test_volume(TEST_RESOURCES / name))
+        for name in TEST_VOLUMES
+    ]
+    volumes += [(f"{s}^3", *synthetic_volume(s)) for s in sizes]
+    backends = ["torch", "pydensecrf"] if CRF_INSTALLED else ["torch"]
+    results = []
+    for name, image, prob, truth in volumes:
+        result = {"volume": name}
+        labels = {}
+        for backend in backends:
+            backend_config = CRFConfig(
+                **{**config.__dict__, "backend": backend}
+            )
+            output, duration = _time(
+                partial(
+                    crf_with_config,
+                    image,
+                    prob,
+                    backend_config,
+                    log=None,
+                    device=device,
+                ),
+                repeats,
+            )
+            labels[backend] = np.argmax(output, axis=0)
+            result[f"{backend} (s)"] = duration
+            if truth is not None:
+                result[f"{backend} accuracy"] = np.mean(
+                    labels[backend] == truth
+                )
+        if len(labels) > 1:
+            result["agreement"] = np.mean(
+                labels["torch"] == labels["pydensecrf"]
+            )
+        if truth is not None:
+            result["input accuracy"] = np.mean(np.argmax(prob, 0) == truth)
+        results.append(result)
+    return results
+
+
+if __name__ == "__main__":
+    for r in benchmark():
+        print(
+            ", ".join(
+                f"{k}: {v:.4f}" if isinstance(v, float) else f"{k}: {v}"
+                for k, v in r.items()
+            )
+        )
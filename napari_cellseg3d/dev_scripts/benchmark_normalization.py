@@ -0,0 +1,98 @@
+"""Benchmarks NormalizeBatch against the per-sample, per-channel normalization loop previously used in the WNet training loops."""
+import time
+
+import torch
+
+from napari_cellseg3d import utils
+from napari_cellseg3d.code_models.workers_utils import NormalizeBatch
+
+
+def per_sample_remap(batch, new_max=100, new_min=0):
+    """Original implementation : remaps each sample and channel in a Python double loop."""
+    for i in range(batch.shape[0]):
+        for j in range(batch.shape[1]):
+            batch[i, j] = utils.remap_image(
+                batch[i, j], new_max=new_max, new_min=new_min
+            )
+    return batch
+
+
+def per_sample_quantile(batch):
+    """Quantile normalization of each sample and channel in a Python double loop."""
+    for i in range(batch.shape[0]):
+        for j in range(batch.shape[1]):
+            batch[i, j] = utils.quantile_normalization(batch[i, j])
+    return batch
+
+
+def _time(func, batch, repeats, device):
+    func(batch.clone())  # warmup
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    total = 0
+    for _ in range(repeats):
+        inputs = batch.clone()
+        start = time.perf_counter()
+        func(inputs)
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+        total += time.perf_counter() - start
+    return total / repeats
+
+
+def benchmark(
+    batch_sizes=(1, 4, 16),
+    shape=(64, 64, 64),
+    channels=1,
+    repeats=5,
+    device=None,
+):
+    """Times both implementations of remap and quantile normalization for each batch size.
+
+    Args:
+        batch_sizes (iterable): numbers of samples in the batch to benchmark
+        shape (tuple): shape of the volumes
+        channels (int): number of channels of the volumes
+        repeats (int): number of timed runs, after one warmup run
+        device (str): device to run on. If None, uses CUDA if available.
+
+    Returns:
+        list: one dict per batch size and mode, with the timings in seconds and the largest difference between outputs
+    """
+    device = torch.device(
+        device or ("cuda" if torch.cuda.is_available() else "cpu")
+    )
+    implementations = {
+        "remap": (per_sample_remap, NormalizeBatch(new_max=100)),
+        "quantile": (per_sample_quantile, NormalizeBatch(mode="quantile")),
+    }
+    results = []
+    for batch_size in batch_sizes:
+        batch = torch.rand(batch_size, channels, *shape, device=device) * 1000
+        for mode, (loop, batched) in implementations.items():
+            results.append(
+                {
+                    "batch size": batch_size,
+                    "mode": mode,
+                    "loop (s)": _time(loop, batch, repeats, device),
+                    "batched (s)": _time(batched, batch, repeats, device),
+                    "difference": (
+                        loop(batch.clone()) - batched(batch.clone())
+                    )
+                    .abs()
+                    .max()
+                    .item(),
+                }
+            )
+    return results
+
+
+if __name__ == "__main__":
+    print(
+        f"{'batch':>6} {'mode':>9} {'loop (s)':>9} {'batched (s)':>12} {'speedup':>8}"
+    )
+    for r in benchmark():
+        print(
+            f"{r['batch size']:>6} {r['mode']:>9} {r['loop (s)']:>9.4f} {r['batched (s)']:>12.4f}"
+            f" {r['loop (s)'] / r['batched (s)']:>8.1f}"
+        )
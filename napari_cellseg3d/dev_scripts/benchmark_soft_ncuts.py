@@ -0,0 +1,121 @@
+"""Benchmarks the separable SoftNCutsLoss against the original dense 3D convolution implementation."""
+import time
+
+import torch
+import torch.nn.functional as F
+
+from napari_cellseg3d.code_models.models.wnet.soft_Ncuts import SoftNCutsLoss
+
+
+def dense_soft_ncuts(loss, labels, inputs):
+    """Original implementation of the loss : one pair of dense (2r+1)^3 convolutions per class, kernel rebuilt on each call."""
+    kernel = loss.gaussian_kernel(loss.radius, loss.spatial_sigma).to(
+        labels.device
+    )
+    K = labels.shape[1]
+    result = 0
+    for k in range(K):
+        class_probs = labels[:, k].unsqueeze(1)
+        class_mean = torch.mean(
+            inputs * class_probs, dim=(2, 3, 4), keepdim=True
+        ) / torch.add(
+            torch.mean(class_probs, dim=(2, 3, 4), keepdim=True), 1e-5
+        )
+        diff = (inputs - class_mean).pow(2).sum(dim=1).unsqueeze(1)
+        weights = torch.exp(diff.pow(2).mul(-1 / loss.intensity_sigma**2))
+        numerator = torch.sum(
+            class_probs
+            * F.conv3d(class_probs * weights, kernel, padding=loss.radius),
+            dim=(1, 2, 3, 4),
+        )
+        denominator = torch.sum(
+            class_probs * F.conv3d(weights, kernel, padding=loss.radius),
+            dim=(1, 2, 3, 4),
+        )
+        result += torch.mean(torch.abs(numerator / (denominator + 1e-6)))
+    return K - result
+
+
+def _time(func, repeats, device):
+    func()  # warmup
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    start = time.perf_counter()
+    for _ in range(repeats):
+        func()
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    return (time.perf_counter() - start) / repeats
+
+
+def benchmark(
+    radii=(2, 3, 4, 5, 6, 7, 8),
+    shape=(64, 64, 64),
+    batch_size=2,
+    num_classes=2,
+    repeats=5,
+    device=None,
+):
+    """Times the forward and backward passes of both implementations for each radius.
+
+    Args:
+        radii (iterable): radii of the spatial kernel to benchmark
+        shape (tuple): shape of the volumes
+        batch_size (int): number of volumes in the batch
+        num_classes (int): number of classes (K) of the labels
+        repeats (int): number of timed runs, after one warmup run
+        device (str): device to run on. If None, uses CUDA if available.
+
+    Returns:
+        list: one dict per radius, with the timings in seconds and the difference between the losses
+    """
+    device = torch.device(
+        device or ("cuda" if torch.cuda.is_available() else "cpu")
+    )
+    labels = torch.softmax(
+        torch.rand(batch_size, num_classes, *shape, device=device), dim=1
+    ).requires_grad_()
+    inputs = torch.rand(batch_size, 1, *shape, device=device)
+
+    results = []
+    for radius in radii:
+        loss = SoftNCutsLoss(
+            data_shape=shape,
+            device=device,
+            intensity_sigma=1,
+            spatial_sigma=4,
+            radius=radius,
+        )
+        results.append(
+            {
+                "radius": radius,
+                "dense (s)": _time(
+                    lambda loss=loss: dense_soft_ncuts(
+                        loss, labels, inputs
+                    ).backward(),
+                    repeats,
+                    device,
+                ),
+                "separable (s)": _time(
+                    lambda loss=loss: loss(labels, inputs).backward(),
+                    repeats,
+                    device,
+                ),
+                "difference": abs(
+                    dense_soft_ncuts(loss, labels, inputs).item()
+                    - loss(labels, inputs).item()
+                ),
+            }
+        )
+    return results
+
+
+if __name__ == "__main__":
+    print(
+        f"{'radius':>6} {'dense (s)':>10} {'separable (s)':>14} {'speedup':>8}"
+    )
+    for r in benchmark():
+        print(
+            f"{r['radius']:>6} {r['dense (s)']:>10.4f} {r['separable (s)']:>14.4f}"
+            f" {r['dense (s)'] / r['separable (s)']:>8.1f}"
+        )
@@ -13,6 +13,10 @@ from tqdm import tqdm
 
 import napari_cellseg3d.dev_scripts.artefact_labeling as make_artefact_labels
 from napari_cellseg3d.code_models.instance_segmentation import binary_watershed
+from napari_cellseg3d.dev_scripts.label_objects import (
+    map_objects,
+    object_slices,
+)
 
 # import sys
 # sys.path.append(str(Path(__file__) / "../../"))
@@ -24,43 +28,61 @@ Fixes labels and allows to auto-detect artifacts and neurons based on a simple i
 """
 
 
-def relabel_non_unique_i(label, save_path, go_fast=False):
+def _split_object(value, label_crop, go_fast=False):
+    """Splits an object in the crop of its bounding box into separate labels, numbered from 1."""
+    mask = label_crop == value
+    if go_fast:
+        return ndimage.label(mask)[0]
+    # catch the warning of the watershed
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        # pad so that binary_watershed does not squeeze flat crops
+        new_label = binary_watershed(np.pad(mask, 1))
+        return new_label[tuple(slice(1, -1) for _ in mask.shape)]
+
+
+def relabel_non_unique_i(label, save_path, go_fast=False, n_workers=None):
     """Relabel the image labelled with different label for each neuron and save it in the save_path location.
 
+    Each label is split in the bounding box of its object only, and objects are split in parallel processes.
+
     Parameters
     ----------
     label : np.array
         the label image
     save_path : str
         the path to save the relabeld image.
+    go_fast : bool, optional
+        if True, objects are split in connected components instead of with a watershed, by default False
+    n_workers : int, optional
+        the number of processes, by default all available CPUs.
     """
     value_label = 0
     new_labels = np.zeros_like(label)
     map_labels_existing = []
-    unique_label = np.unique(label)
-    for i_label in tqdm(
-        range(len(unique_label)), desc="relabeling", ncols=100
+    objects = object_slices(label)
+    results = map_objects(
+        partial(_split_object, go_fast=go_fast),
+        label,
+        objects=objects,
+        n_workers=n_workers,
+    )
+    for i, box, new_label in tqdm(
+        results, desc="relabeling", ncols=100, total=len(objects)
     ):
-        i = unique_label[i_label]
-        if i == 0:
-            continue
         if go_fast:
-            new_label, to_add = ndimage.label(label == i)
+            to_add = int(new_label.max())
             map_labels_existing.append(
                 [i, list(range(value_label + 1, value_label + to_add + 1))]
             )
-
         else:
-            # catch the warning of the watershed
-            with warnings.catch_warnings():
-                warnings.simplefilter("ignore")
-                new_label = binary_watershed(label == i)
-                unique = np.unique(new_label)
-                to_add = unique[-1]
-                map_labels_existing.append([i, unique[1:] + value_label])
-
-        new_label[new_label != 0] += value_label
-        new_labels += new_label
+            # the crop may not contain background if the object fills its bounding box
+            unique = np.unique(new_label[new_label != 0])
+            to_add = unique[-1] if len(unique) else 0
+            map_labels_existing.append([i, unique + value_label])
+
+        inside = new_label != 0
+        new_labels[box][inside] = new_label[inside] + value_label
         value_label += to_add
 
     imwrite(save_path, new_labels)
@@ -81,8 +103,12 @@ def add_label(old_label, artefact, new_label_path, i_labels_to_add):
     """
     new_label = old_label.copy()
     max_label = np.max(old_label)
+    boxes = dict(object_slices(artefact))
     for i, i_label in enumerate(i_labels_to_add):
-        new_label[artefact == i_label] = i + max_label + 1
+        if i_label not in boxes:
+            continue
+        box = boxes[i_label]
+        new_label[box][artefact[box] == i_label] = i + max_label + 1
     imwrite(new_label_path, new_label)
 
 
@@ -0,0 +1,91 @@
+"""Per-object operations on label images, restricted to the bounding box of each object.
+
+The bounding boxes of all objects are found in a single pass with :py:func:`scipy.ndimage.find_objects`,
+so that an operation on one object only reads its crop instead of the whole volume.
+Objects are processed in parallel processes, by chunks, and only their crops are sent to the processes.
+"""
+import os
+from collections import deque
+
+import numpy as np
+from scipy import ndimage
+
+from napari_cellseg3d.utils import process_pool
+
+
+def object_slices(labels):
+    """Returns the value and bounding box of each object of a label image.
+
+    Args:
+        labels (np.ndarray): label image with non-negative integer values
+
+    Returns:
+        list: (value, tuple of slices) for each label value present in the image, in increasing order
+    """
+    labels = np.asarray(labels)
+    if not np.issubdtype(labels.dtype, np.integer):
+        labels = labels.astype(np.int64)
+    return [
+        (value, box)
+        for value, box in enumerate(ndimage.find_objects(labels), start=1)
+        if box is not None
+    ]
+
+
+def _apply(func, value, crops):
+    return func(value, *crops)
+
+
+def _apply_chunk(func, chunk):
+    """Applies func to a chunk of (value, crops) items. Module-level to be usable in worker processes."""
+    return [_apply(func, value, crops) for value, crops in chunk]
+
+
+def map_objects(
+    func, labels, *images, objects=None, n_workers=None, chunksize=64
+):
+    """Applies a function to the crop of each object of a label image, in parallel processes.
+
+    Results are yielded as soon as they are available, in order, and at most ``2 * n_workers`` chunks are in flight,
+    so that memory use does not grow with the number of objects.
+
+    Args:
+        func (callable): picklable function called as ``func(value, labels_crop, *images_crops)``
+        labels (np.ndarray): label image with non-negative integer values
+        *images (np.ndarray): other images with the shape of ``labels``, cropped like it
+        objects (list): output of :py:func:`object_slices` for ``labels``, if already computed
+        n_workers (int): number of processes. If None, uses all available CPUs. If 1, runs in the current process.
+        chunksize (int): number of objects sent to a process at once. Images with at most this many objects
+            are processed in the current process.
+
+    Yields:
+        (int, tuple, object): value, bounding box and result of func for each object, in increasing order of value
+    """
+    objects = objects if objects is not None else object_slices(labels)
+
+    def crops(box):
+        return [np.asarray(labels[box])] + [image[box] for image in images]
+
+    n_workers = n_workers if n_workers is not None else os.cpu_count() or 1
+    if n_workers == 1 or len(objects) <= chunksize:
+        for value, box in objects:
+            yield value, box, _apply(func, value, crops(box))
+        return
+
+    chunks = [
+        objects[i : i + chunksize] for i in range(0, len(objects), chunksize)
+    ]
+    with process_pool(n_workers) as pool:
+        pending = deque()
+        for chunk in chunks:
+            items = [(value, crops(box)) for value, box in chunk]
+            pending.append((chunk, pool.submit(_apply_chunk, func, items)))
+            if len(pending) >= 2 * n_workers:
+                yield from _chunk_results(*pending.popleft())
+        while pending:
+            yield from _chunk_results(*pending.popleft())
+
+
+def _chunk_results(chunk, future):
+    for (value, box), result in zip(chunk, future.result()):
+        yield value, box, result
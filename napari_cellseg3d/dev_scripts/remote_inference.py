@@ -87,6 +87,8 @@ def inference_on_images(
 ):
     """This function provides inference on an image with minimal config.
 
+    The model is kept in :py:data:`~napari_cellseg3d.code_models.workers_utils.MODEL_CACHE`, so repeated calls do not reload it.
+
     Args:
         image (np.array): Image to perform inference on.
         config (InferenceWorkerConfig, optional): Config for InferenceWorker. Defaults to CONFIG, see above.
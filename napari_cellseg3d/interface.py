@@ -10,7 +10,7 @@ import napari
 # Qt
 # from qtpy.QtCore import QtWarningMsg
 from qtpy import QtCore
-from qtpy.QtCore import QObject, Qt, QUrl
+from qtpy.QtCore import QObject, Qt, QUrl, Signal
 from qtpy.QtGui import QCursor, QDesktopServices, QTextCursor
 from qtpy.QtWidgets import (
     QAbstractSpinBox,
@@ -35,9 +35,13 @@ from qtpy.QtWidgets import (
     QVBoxLayout,
     QWidget,
 )
+from superqt.utils._qthreading import WorkerBaseSignals
 
 # Local
 from napari_cellseg3d import utils
+from napari_cellseg3d.code_models.instance_segmentation import (
+    INSTANCE_SEGMENTATION_METHOD_LIST,
+)
 
 ###############
 # show debug tooltips
@@ -202,6 +206,31 @@ class UtilsDropdown(metaclass=utils.Singleton):
 ##############
 
 
+class LogSignal(WorkerBaseSignals):
+    """Signal to send messages to be logged from another thread.
+
+    Separate from Worker instances as indicated `on this post`_
+
+    .. _on this post: https://stackoverflow.com/questions/2970312/pyqt4-qtcore-pyqtsignal-object-has-no-attribute-connect
+    """  # TODO link ?
+
+    log_signal = Signal(str)
+    """qtpy.QtCore.Signal: signal to be sent when some text should be logged"""
+    log_w_replace_signal = Signal(str)
+    """qtpy.QtCore.Signal: signal to be sent when some text should be logged, replacing the last line"""
+    warn_signal = Signal(str)
+    """qtpy.QtCore.Signal: signal to be sent when some warning should be emitted in main thread"""
+    error_signal = Signal(Exception, str)
+    """qtpy.QtCore.Signal: signal to be sent when some error should be emitted in main thread"""
+
+    # Should not be an instance variable but a class variable, not defined in __init__, see
+    # https://stackoverflow.com/questions/2970312/pyqt4-qtcore-pyqtsignal-object-has-no-attribute-connect
+
+    def __init__(self, parent=None):
+        """Creates a LogSignal."""
+        super().__init__(parent=parent)
+
+
 class Log(QTextEdit):
     """Class to implement a log for important user info. Should be thread-safe."""
 
@@ -788,6 +817,77 @@ class AnisotropyWidgets(QWidget):
         self.checkbox.setVisible(False)
 
 
+class InstanceWidgets(QWidget):
+    """Base widget with several sliders, for use in instance segmentation parameters."""
+
+    def __init__(self, parent=None):
+        """Creates an InstanceWidgets widget.
+
+        Args:
+            parent: parent widget
+
+        """
+        super().__init__(parent)
+        self.method_choice = DropdownMenu(
+            list(INSTANCE_SEGMENTATION_METHOD_LIST.keys())
+        )
+        self.methods = {}
+        """Contains the instance of the method, with its name as key"""
+        self.instance_widgets = {}
+        """Contains the lists of widgets for each methods, to show/hide"""
+
+        self.method_choice.currentTextChanged.connect(self._set_visibility)
+        self._build()
+
+    def _build(self):
+        group = GroupedWidget("Instance segmentation")
+        group.layout.addWidget(self.method_choice)
+
+        try:
+            for name, method in INSTANCE_SEGMENTATION_METHOD_LIST.items():
+                method_class = method(widget_parent=self.parent())
+                self.methods[name] = method_class
+                self.instance_widgets[name] = []
+                # moderately unsafe way to init those widgets ?
+                if len(method_class.sliders) > 0:
+                    for slider in method_class.sliders:
+                        group.layout.addWidget(slider.container)
+                        self.instance_widgets[name].append(slider)
+                if len(method_class.counters) > 0:
+                    for counter in method_class.counters:
+                        group.layout.addWidget(counter.label)
+                        group.layout.addWidget(counter)
+                        self.instance_widgets[name].append(counter)
+        except RuntimeError as e:
+            logger.debug(
+                f"Caught runtime error {e}, most likely during testing"
+            )
+
+        self.setLayout(group.layout)
+        self._set_visibility()
+
+    def _set_visibility(self):
+        for name in self.instance_widgets:
+            if name != self.method_choice.currentText():
+                for widget in self.instance_widgets[name]:
+                    widget.set_visibility(False)
+            else:
+                for widget in self.instance_widgets[name]:
+                    widget.set_visibility(True)
+
+    def run_method(self, volume):
+        """Calls instance function with chosen parameters.
+
+        Args:
+            volume: image data to run method on
+
+        Returns: processed image from self._method
+
+        """
+        method = self.methods[self.method_choice.currentText()]
+        return method.run_method_on_channels(volume)
+
+
 class LayerSelecter(ContainerWidget):
     """Class that creates a dropdown menu to select a layer from a napari viewer."""
 
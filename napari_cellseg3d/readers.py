@@ -0,0 +1,270 @@
+"""Readers opening volumes from disk as lazy, chunk-addressable arrays.
+
+Each reader returns an array-like object supporting numpy-style slicing (memory-mapped array, Zarr array, HDF5 dataset),
+so that opening a volume only reads its metadata, and slicing it only reads the chunks that are needed.
+
+Supported formats :
+
+* TIFF (.tif, .tiff) : memory-mapped if uncompressed and contiguous, opened as a Zarr store otherwise (requires zarr)
+* Zarr and OME-Zarr (.zarr) : requires zarr. For groups, the full resolution array is returned.
+* N5 (.n5) : requires zarr 2
+* HDF5 (.h5, .hdf5) : requires h5py
+* NumPy (.npy) : memory-mapped
+
+Other formats can be added with :py:func:`register_reader`.
+"""
+import importlib
+from pathlib import Path
+from typing import Callable, Dict
+
+import numpy as np
+import tifffile
+from monai.data import ImageReader
+from monai.data.image_reader import _copy_compatible_dict, _stack_images
+from monai.transforms import LoadImaged
+from monai.utils import MetaKeys, SpaceKeys, ensure_tuple
+
+from napari_cellseg3d.utils import LOGGER as logger
+
+spec = importlib.util.find_spec("zarr")
+ZARR_INSTALLED = spec is not None
+if ZARR_INSTALLED:
+    import zarr
+
+spec = importlib.util.find_spec("h5py")
+H5PY_INSTALLED = spec is not None
+if H5PY_INSTALLED:
+    import h5py
+
+READERS: Dict[str, Callable] = {}
+"""Reader function of each file suffix, see :py:func:`register_reader`."""
+
+
+def register_reader(*suffixes: str):
+    """Decorator registering a reader function for the given file suffixes.
+
+    The reader is called as ``reader(path, key)``, where ``key`` optionally selects
+    an array in files containing several (Zarr/N5 groups, HDF5 files), and must return
+    an array-like object supporting numpy-style slicing, without loading the data.
+
+    Args:
+        suffixes (str): file suffixes handled by the reader, e.g. ".zarr"
+    """
+
+    def decorator(reader):
+        for suffix in suffixes:
+            READERS[suffix.lower()] = reader
+        return reader
+
+    return decorator
+
+
+def get_suffix(path) -> str:
+    """Returns the registered suffix matching ``path``, or an empty string if the format is not supported."""
+    name = Path(path).name.lower()
+    matches = [suffix for suffix in READERS if name.endswith(suffix)]
+    return max(matches, key=len) if matches else ""
+
+
+def is_supported(path) -> bool:
+    """Returns whether a reader is registered for the format of ``path``."""
+    return get_suffix(path) != ""
+
+
+def volume_name(path) -> str:
+    """Returns the name of a volume without its format suffix, e.g. ``volume`` for ``volume.ome.zarr``."""
+    name = Path(path).name
+    suffix = get_suffix(path)
+    if not suffix:
+        return Path(path).stem
+    name = name[: -len(suffix)]
+    return name[: -len(".ome")] if name.lower().endswith(".ome") else name
+
+
+def open_volume(path, key: str = None):
+    """Opens a volume from disk without loading it in memory, if the file format allows it.
+
+    Args:
+        path (str): path to the volume
+        key (str): name of the array to open in files containing several arrays. If None, the first one is used.
+
+    Returns:
+        array-like: lazily-loaded volume supporting numpy-style slicing
+    """
+    suffix = get_suffix(path)
+    if suffix == "":
+        if Path(path).is_dir():
+            suffix = ".zarr"
+        else:
+            raise ValueError(
+                f"Unsupported file format for {Path(path).name}, supported formats are {sorted(READERS)}"
+            )
+    return READERS[suffix](Path(path), key)
+
+
+def _first_array(group, key, path):
+    """Returns the array ``key`` of a Zarr/N5 group or HDF5 file, or the first array found if key is None."""
+    if key is not None:
+        return group[key]
+    if "0" in group:  # OME-Zarr full resolution
+        group = group["0"]
+        if not hasattr(group, "keys"):
+            return group
+    for name in sorted(group.keys()):
+        item = group[name]
+        if hasattr(item, "keys"):
+            try:
+                return _first_array(item, None, path)
+            except ValueError:
+                continue
+        return item
+    raise ValueError(f"No array found in {path.name}")
+
+
+def _require_zarr(path):
+    if not ZARR_INSTALLED:
+        raise ImportError(
+            f"zarr is required to read {path.name}, please install it with : pip install zarr"
+        )
+
+
+@register_reader(".tif", ".tiff")
+def read_tiff(path, key=None):
+    """Memory-maps a TIFF file, or opens it as a Zarr store if it is compressed or tiled."""
+    try:
+        return tifffile.memmap(str(path), mode="r")
+    except ValueError:
+        logger.debug(f"{path.name} cannot be memory-mapped")
+    if ZARR_INSTALLED:
+        return zarr.open(tifffile.imread(str(path), aszarr=True), mode="r")
+    logger.warning(
+        f"{path.name} is compressed or tiled and zarr is not installed, the whole volume will be loaded in memory"
+    )
+    return tifffile.imread(str(path))
+
+
+@register_reader(".zarr")
+def read_zarr(path, key=None):
+    """Opens a Zarr array, or an array of a Zarr group."""
+    _require_zarr(path)
+    volume = zarr.open(str(path), mode="r")
+    if isinstance(volume, zarr.Group):
+        return _first_array(volume, key, path)
+    return volume
+
+
+@register_reader(".n5")
+def read_n5(path, key=None):
+    """Opens an array of an N5 container."""
+    _require_zarr(path)
+    if not hasattr(zarr, "N5Store"):
+        raise ImportError(
+            f"Reading N5 requires zarr 2, found zarr {zarr.__version__}"
+        )
+    volume = zarr.open(zarr.N5Store(str(path)), mode="r")
+    if isinstance(volume, zarr.Group):
+        return _first_array(volume, key, path)
+    return volume
+
+
+@register_reader(".h5", ".hdf5")
+def read_hdf5(path, key=None):
+    """Opens a dataset of an HDF5 file. The file stays open as long as the dataset is referenced."""
+    if not H5PY_INSTALLED:
+        raise ImportError(
+            f"h5py is required to read {path.name}, please install it with : pip install h5py"
+        )
+    return _first_array(h5py.File(str(path), mode="r"), key, path)
+
+
+@register_reader(".npy")
+def read_npy(path, key=None):
+    """Memory-maps a NumPy array."""
+    return np.load(str(path), mmap_mode="r")
+
+
+class VolumeReader(ImageReader):
+    """MONAI reader for the formats of :py:data:`READERS`, to use them in ``LoadImaged`` transforms.
+
+    TIFF files are left to the MONAI default readers (ITK), so that existing pipelines, and their affines, are unchanged.
+    Like the ITK reader used for TIFF files, arrays are returned with reversed axes (XYZ),
+    so that :py:func:`napari_cellseg3d.utils.correct_rotation` applies to all formats.
+    """
+
+    def __init__(self, key: str = None):
+        """Creates a reader.
+
+        Args:
+            key (str): name of the array to read in files containing several arrays. If None, the first one is used.
+        """
+        super().__init__()
+        self.key = key
+
+    def verify_suffix(self, filename) -> bool:
+        """Returns whether all files have a registered, non-TIFF format."""
+        return all(
+            is_supported(name) and get_suffix(name) not in [".tif", ".tiff"]
+            for name in ensure_tuple(filename)
+        )
+
+    def read(self, data, **kwargs):
+        """Opens the volume(s) lazily, see :py:func:`open_volume`.
+
+        Raises:
+            ValueError: if a file is a TIFF or has an unsupported format. Use :py:func:`volume_loader` so that
+                these files are read by the MONAI default readers instead.
+        """
+        if not self.verify_suffix(data):
+            raise ValueError(
+                f"{self.__class__.__name__} does not read {ensure_tuple(data)}, leaving it to the MONAI readers"
+            )
+        volumes = [open_volume(name, self.key) for name in ensure_tuple(data)]
+        return volumes if len(volumes) > 1 else volumes[0]
+
+    def get_data(self, img):
+        """Loads the volume(s) and returns them with their metadata."""
+        arrays = []
+        meta = {}
+        volumes = img if isinstance(img, list) else [img]
+        for volume in volumes:
+            array = np.ascontiguousarray(np.transpose(np.asarray(volume)))
+            header = {
+                MetaKeys.SPATIAL_SHAPE: np.asarray(array.shape),
+                MetaKeys.SPACE: SpaceKeys.RAS,
+                MetaKeys.ORIGINAL_CHANNEL_DIM: float("nan"),
+            }
+            _copy_compatible_dict(header, meta)
+            arrays.append(array)
+        return _stack_images(arrays, meta), meta
+
+
+def volume_loader(keys, **kwargs) -> LoadImaged:
+    """Returns a ``LoadImaged`` transform reading the formats of :py:data:`READERS` with :py:class:`VolumeReader`.
+
+    The reader is registered on top of the MONAI default readers instead of being passed as ``reader``,
+    so that MONAI still selects readers by file suffix : TIFF files are read exactly as before,
+    while passing the reader would make MONAI try the other readers in turn, and read TIFF files with PIL.
+
+    Args:
+        keys (list): keys of the paths to load
+        **kwargs: arguments of ``LoadImaged``, e.g. ``image_only``
+    """
+    loader = LoadImaged(keys=keys, **kwargs)
+    loader.register(VolumeReader())
+    return loader
+
+
+def get_napari_reader(path):
+    """Returns a napari reader opening HDF5 and N5 volumes lazily as image layers, or None for other formats."""
+    if isinstance(path, list):
+        if len(path) != 1:
+            return None
+        path = path[0]
+    if get_suffix(path) not in [".h5", ".hdf5", ".n5"]:
+        return None
+
+    def reader(path):
+        path = path[0] if isinstance(path, list) else path
+        return [(open_volume(path), {"name": Path(path).stem}, "image")]
+
+    return reader
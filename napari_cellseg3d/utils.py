@@ -1,17 +1,21 @@
 """Utilities functions, classes, and variables."""
 import logging
-import math
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 from pathlib import Path
-from typing import Union
+from typing import TYPE_CHECKING, Union
 
-import napari
 import numpy as np
 import torch
 from monai.transforms import Zoom
 from numpy.random import PCG64, Generator
 from tifffile import imread, imwrite
 
+if TYPE_CHECKING:
+    import napari
+
 LOGGER = logging.getLogger(__name__)
 ###############
 # Global logging level setting
@@ -74,11 +78,11 @@ def show_result(
     layer,
     image,
     name,
-    existing_layer: napari.layers.Layer = None,
+    existing_layer: "napari.layers.Layer" = None,
     colormap="bop orange",
     add_as_labels=False,
     add_as_image=False,
-) -> napari.layers.Layer:
+) -> "napari.layers.Layer":
     """Adds layers to a viewer to show result to user.
 
     Args:
@@ -94,6 +98,8 @@ def show_result(
     Returns:
         napari.layers.Layer: the layer added to the viewer
     """
+    import napari
+
     colormap = colormap if colormap is not None else "gray"
     if existing_layer is None:
         if add_as_image:
@@ -195,31 +201,24 @@ def sphericity_axis(semi_major, semi_minor):
     .. math::
         sphericity = \\frac {2 \\sqrt[3]{ab^2}} {a+ \\frac {b^2} {\\sqrt{a^2-b^2}}ln( \\frac {a+ \\sqrt{a^2-b^2}} {b} )}
 
+    Accepts scalars or arrays of axes. For scalars, invalid results (e.g. for a = b) are returned as None;
+    for arrays, they are set to NaN.
     """
-    a = semi_major
-    b = semi_minor
+    a = np.asarray(semi_major, dtype=np.float64)
+    b = np.asarray(semi_minor, dtype=np.float64)
 
-    root = np.sqrt(a**2 - b**2)
-    try:
+    with np.errstate(divide="ignore", invalid="ignore"):
+        root = np.sqrt(a**2 - b**2)
         result = (
             2
-            * (a * (b**2)) ** (1 / 3)
+            * np.cbrt(a * (b**2))
             / (a + (b**2) / root * np.log((a + root) / b))
         )
-    except ZeroDivisionError:
-        # LOGGER.debug(
-        #     "Zero division in sphericity calculation was replaced by None"
-        # )
-        result = None
-    except ValueError as e:
-        LOGGER.warning(f"Error encountered in calculation : {e}")
-        result = "Error in calculation"
-
-    if math.isnan(result):
-        # LOGGER.debug("NaN in sphericity calculation was replaced by None")
-        result = None
 
-    return result
+    if result.ndim == 0:
+        # LOGGER.debug("NaN in sphericity calculation was replaced by None")
+        return float(result) if np.isfinite(result) else None
+    return np.where(np.isfinite(result), result, np.nan)
 
 
 def dice_coeff(
@@ -298,15 +297,14 @@ def remap_image(
     prev_max=None,
     prev_min=None,
 ):
-    """Normalizes a numpy array or Tensor using the max and min value."""
-    shape = image.shape
-    image = image.flatten()
+    """Normalizes a numpy array or Tensor using the max and min value.
+
+    See :py:class:`napari_cellseg3d.code_models.workers_utils.NormalizeBatch` to normalize every image of a batch at once.
+    """
     im_max = prev_max if prev_max is not None else image.max()
     im_min = prev_min if prev_min is not None else image.min()
     image = (image - im_min) / (im_max - im_min)
-    image = image * (new_max - new_min) + new_min
-    image = image.reshape(shape)
-    return image
+    return image * (new_max - new_min) + new_min
 
 
 def resize(image, zoom_factors):
@@ -552,10 +550,14 @@ def get_all_matching_files(path, pattern=None):
     return sorted(files)
 
 
-def load_images(dir_or_path, filetype="", as_folder: bool = False):
+def load_images(
+    dir_or_path, filetype="", as_folder: bool = False, lazy: bool = False
+):
     """Loads the images in ``directory``, with different behaviour depending on ``filetype`` and ``as_folder``.
 
     * If ``as_folder`` is **False**, will load the path as a single 3D **.tif** image.
+    * If ``lazy`` is **True**, the image is opened without being loaded in memory,
+      see :py:func:`napari_cellseg3d.readers.open_volume`. This also supports Zarr, N5, HDF5 and .npy files.
     * If **True**, it will try to load a folder as stack of images. In this case ``filetype`` must be specified.
 
     If **True** :
@@ -569,42 +571,172 @@ def load_images(dir_or_path, filetype="", as_folder: bool = False):
         dir_or_path (str): path to the directory containing the images or the images themselves
         filetype (str): expected file extension of the image(s) in the directory, if as_folder is False
         as_folder (bool): Whether to load a folder of images as stack or a single 3D image
+        lazy (bool): Whether to open the image lazily instead of loading it in memory
 
     Returns:
         np.array: array with loaded images
     """
+    if lazy:
+        from napari_cellseg3d.readers import open_volume
+
+        return open_volume(dir_or_path)
     # if not as_folder:
     filename_pattern_original = Path(dir_or_path)
     return imread(str(filename_pattern_original))  # tifffile imread
 
 
+EXACT_QUANTILES_MAX_SIZE = 2**24
+"""Arrays up to this size get exact quantiles (the largest size torch.quantile accepts), larger ones use a histogram."""
+
+
+def _iter_slabs(volume, slab_size: int):
+    """Yields slabs of ``slab_size`` slices of a volume along its first non-singleton axis, loaded as numpy arrays."""
+    shape = volume.shape
+    if len(shape) == 0:
+        yield np.asarray(volume)
+        return
+    axis = next((i for i, size in enumerate(shape) if size > 1), 0)
+    for start in range(0, shape[axis], slab_size):
+        index = (slice(None),) * axis + (slice(start, start + slab_size),)
+        yield np.asarray(volume[index])
+
+
+def _histogram_quantiles(volume, quantiles, bins: int, slab_size: int):
+    """Computes quantiles from a histogram accumulated one slab at a time.
+
+    Integer images of up to 16 bits are counted exactly, so the quantiles are exact.
+    Other images are binned between their minimum and maximum, and values are interpolated within bins.
+    """
+    dtype = np.dtype(volume.dtype)
+    if dtype.kind in "biu" and dtype.itemsize <= 2:
+        offset = int(np.iinfo(dtype).min) if dtype.kind != "b" else 0
+        length = 2 ** (8 * dtype.itemsize)
+        counts = np.zeros(length, dtype=np.int64)
+        for slab in _iter_slabs(volume, slab_size):
+            counts += np.bincount(
+                (slab.astype(np.int32) - offset).ravel(), minlength=length
+            )
+        edges = np.arange(length + 1, dtype=np.float64) + offset
+        exact = True
+    else:
+        low = high = None
+        for slab in _iter_slabs(volume, slab_size):
+            if slab.size == 0:
+                continue
+            slab_low, slab_high = float(np.min(slab)), float(np.max(slab))
+            low = slab_low if low is None else min(low, slab_low)
+            high = slab_high if high is None else max(high, slab_high)
+        if low is None:
+            raise ValueError("Cannot compute quantiles of an empty image")
+        if low == high:
+            return tuple(low for _ in quantiles)
+        edges = np.linspace(low, high, bins + 1)
+        counts = np.zeros(bins, dtype=np.int64)
+        for slab in _iter_slabs(volume, slab_size):
+            counts += np.histogram(slab, bins=edges)[0]
+        exact = False
+
+    cumulative = np.cumsum(counts)
+    total = cumulative[-1]
+
+    def value_at(rank):
+        """Returns the value of rank ``rank`` (0-based) in the sorted image."""
+        b = int(np.searchsorted(cumulative, rank, side="right"))
+        if exact:
+            return edges[b]
+        before = cumulative[b - 1] if b > 0 else 0
+        fraction = (rank - before + 0.5) / counts[b]
+        return edges[b] + fraction * (edges[b + 1] - edges[b])
+
+    values = []
+    for quantile in quantiles:
+        position = quantile * (total - 1)
+        rank = int(np.floor(position))
+        low_value = value_at(rank)
+        high_value = value_at(min(rank + 1, total - 1))
+        values.append(
+            float(low_value + (position - rank) * (high_value - low_value))
+        )
+    return tuple(values)
+
+
+def compute_quantiles(
+    image,
+    quantile_low=0.01,
+    quantile_high=0.99,
+    bins: int = 2**16,
+    slab_size: int = 16,
+):
+    """Returns the values of the low and high quantiles of an image.
+
+    In-memory images of up to :py:data:`EXACT_QUANTILES_MAX_SIZE` elements get exact quantiles.
+    Larger or lazily-loaded images (memory-mapped, Zarr, HDF5...) are read ``slab_size`` slices at a time
+    into a histogram with ``bins`` bins, so that the image is never sorted nor fully loaded.
+
+    Args:
+        image (np.ndarray, torch.Tensor or array-like): image to compute the quantiles of
+        quantile_low (float): low quantile, between 0 and 1
+        quantile_high (float): high quantile, between 0 and 1
+        bins (int): number of histogram bins used for large floating point images
+        slab_size (int): number of slices read at once for large images
+
+    Returns:
+        tuple(float, float): values of the low and high quantiles
+    """
+    if quantile_high < quantile_low:
+        raise ValueError(
+            f"quantile_high must be greater than quantile_low, got {quantile_high} and {quantile_low}"
+        )
+    if isinstance(image, torch.Tensor):
+        if image.numel() <= EXACT_QUANTILES_MAX_SIZE:
+            values = image.flatten()
+            if not values.is_floating_point():
+                values = values.float()
+            low, high = torch.quantile(
+                values,
+                torch.tensor(
+                    [quantile_low, quantile_high],
+                    dtype=values.dtype,
+                    device=values.device,
+                ),
+            )
+            return float(low), float(high)
+        image = image.detach().cpu().numpy()
+    if type(image) is np.ndarray and image.size <= EXACT_QUANTILES_MAX_SIZE:
+        low, high = np.quantile(image, [quantile_low, quantile_high])
+        return float(low), float(high)
+    return _histogram_quantiles(
+        image, (quantile_low, quantile_high), bins, slab_size
+    )
+
+
 def quantile_normalization(
     image: Union[np.ndarray, torch.Tensor],
     quantile_high=0.99,
     quantile_low=0.01,
+    quantile_values=None,
 ):
-    """Normalizes an image using the quantiles."""
+    """Normalizes an image by clipping it to its low and high quantiles.
+
+    Args:
+        image (np.ndarray or torch.Tensor): image to normalize
+        quantile_high (float): high quantile, between 0 and 1
+        quantile_low (float): low quantile, between 0 and 1
+        quantile_values (tuple): values of the low and high quantiles to clip to,
+            e.g. from :py:func:`compute_quantiles` on the whole volume the image is a part of.
+            If None, they are computed from the image itself.
+    """
     if quantile_high < quantile_low:
         raise ValueError(
             f"quantile_high must be greater than quantile_low, got {quantile_high} and {quantile_low}"
         )
-
-    if isinstance(image, torch.Tensor):
-        qtl = torch.quantile
-        where = torch.where
-    elif isinstance(image, np.ndarray):
-        qtl = np.quantile
-        where = np.where
-    else:
+    if not isinstance(image, (torch.Tensor, np.ndarray)):
         raise TypeError("image needs to be torch tensor or numpy array")
 
-    shape = image.shape
-    image = image.flatten()
-    high_quantile_value = qtl(image, quantile_high)
-    low_quantile_value = qtl(image, quantile_low)
-    image = where(image > high_quantile_value, high_quantile_value, image)
-    image = where(image < low_quantile_value, low_quantile_value, image)
-    return image.reshape(shape)
+    if quantile_values is None:
+        quantile_values = compute_quantiles(image, quantile_low, quantile_high)
+    low_quantile_value, high_quantile_value = quantile_values
+    return image.clip(low_quantile_value, high_quantile_value)
 
 
 def channels_fraction_above_threshold(volume: np.array, threshold=0.5) -> list:
@@ -645,3 +777,86 @@ def fraction_above_threshold(volume: np.array, threshold=0.5) -> float:
         f"non zero in above_thresh : {np.count_nonzero(above_thresh)}"
     )
     return np.count_nonzero(above_thresh) / np.size(flattened)
+
+
+def process_pool(max_workers: int) -> ProcessPoolExecutor:
+    """Returns a process pool whose workers are started with "spawn".
+
+    Pools are often created from napari worker threads, and forking a process running Qt threads is unsafe,
+    so workers start a fresh interpreter instead. Functions and arguments sent to them must be picklable.
+
+    Args:
+        max_workers (int): number of worker processes
+    """
+    return ProcessPoolExecutor(
+        max_workers=max_workers,
+        mp_context=multiprocessing.get_context("spawn"),
+    )
+
+
+def _process_status(field: str):
+    """Returns a memory field of /proc/self/status in bytes (Linux only), or None if unavailable."""
+    try:
+        with Path("/proc/self/status").open() as status:
+            for line in status:
+                if line.startswith(f"{field}:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+class PeakMemory:
+    """Measures the peak resident memory used during a block of code, in bytes (Linux only).
+
+    In worker processes started by :py:func:`process_pool`, which only run the block, the peak of the process
+    is reset on entering and read on exit. In the main process, e.g. napari, the peak of the process is left
+    untouched, and the resident memory is sampled by a background thread instead; this approximate measure
+    also includes memory allocated by other threads meanwhile.
+    Where resident memory is unavailable, ``peak`` is None.
+    """
+
+    def __init__(self, interval: float = 0.01):
+        """Creates a measure, see :py:meth:`__enter__`.
+
+        Args:
+            interval (float): time in seconds between samples of the resident memory, in the main process
+        """
+        self.interval = interval
+        self.start = None
+        self.peak = None
+        self._reset = multiprocessing.parent_process() is not None
+        self._max_rss = None
+        self._stop = threading.Event()
+        self._sampler = None
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self._max_rss = max(self._max_rss, _process_status("VmRSS") or 0)
+
+    def __enter__(self):
+        """Records the current resident memory, and resets the peak of worker processes or starts sampling."""
+        if self._reset:
+            try:
+                with Path("/proc/self/clear_refs").open("w") as clear_refs:
+                    clear_refs.write("5")
+            except OSError:
+                return self
+        self.start = _process_status("VmRSS")
+        if self.start is not None and not self._reset:
+            self._max_rss = self.start
+            self._sampler = threading.Thread(target=self._sample, daemon=True)
+            self._sampler.start()
+        return self
+
+    def __exit__(self, *args):
+        """Sets ``peak`` to the peak resident memory used since entering, in bytes."""
+        if self.start is None:
+            return
+        if self._reset:
+            peak = _process_status("VmHWM")
+        else:
+            self._stop.set()
+            self._sampler.join()
+            peak = max(self._max_rss, _process_status("VmRSS") or 0)
+        self.peak = max(peak - self.start, 0) if peak is not None else None